@@ -1,15 +1,87 @@
 """Flask application factory"""
 from flask import Flask
+from app import admission, compression, metrics, profiling
+from app.async_store import AsyncUserStore
+from app.changefeed import ChangeFeed
 from app.config import Config
+from app.json_provider import select_provider
+from app.serialization import UserJSONCache
+from app.storage import create_store
 
 
 def create_app(config_class=Config):
     """Create and configure Flask application"""
     app = Flask(__name__)
     app.config.from_object(config_class)
+    app.json = select_provider(app.config['JSON_PROVIDER'])(app)
+    app.json.sort_keys = app.config['JSON_SORT_KEYS']
+
+    store = create_store(app.config)
+    app.extensions['user_store'] = store
+    json_cache = UserJSONCache(app.json.dumps_bytes,
+                               app.config['JSON_CACHE_SIZE'],
+                               app.config['JSON_CACHE_ENABLED'])
+    store.add_listener(json_cache.invalidate)
+    app.extensions['user_json_cache'] = json_cache
+    # A store shared between processes brings its owner's feed, which
+    # sees the writes of every process
+    change_feed = getattr(store, 'change_feed', None)
+    if change_feed is None:
+        change_feed = ChangeFeed(app.config['CHANGE_FEED_SIZE'])
+        store.add_listener(change_feed.record)
+    app.extensions['change_feed'] = change_feed
+
+    if app.config['METRICS_ENABLED']:
+        app_metrics = metrics.Metrics(app.config['METRICS_BUCKETS']
+                                      or metrics.DEFAULT_BUCKETS)
+        metrics.instrument_store(store, app_metrics)
+        metrics.init_app(app, app_metrics)
+        app.extensions['metrics'] = app_metrics
+
+    if app.config['PROFILING_ENABLED']:
+        profiler = profiling.RequestProfiler(
+            app.config['PROFILING_MODE'],
+            app.config['PROFILING_SAMPLE_RATE'],
+            app.config['PROFILING_SAMPLE_INTERVAL_MS'])
+        profiling.init_app(app, profiler)
+        app.extensions['profiler'] = profiler
+
+    # After the metrics hooks, so that shed requests are counted too
+    if app.config['ADMISSION_ENABLED']:
+        rate = app.config['ADMISSION_RATE']
+        controller = admission.AdmissionController(
+            app.config['ADMISSION_INITIAL_LIMIT'],
+            app.config['ADMISSION_MIN_LIMIT'],
+            app.config['ADMISSION_MAX_LIMIT'],
+            app.config['ADMISSION_TARGET_LATENCY_MS'] / 1000,
+            app.config['ADMISSION_ROUTE_LIMITS'],
+            None if rate is None else admission.TokenBuckets(
+                rate, app.config['ADMISSION_BURST']),
+            app.config['ADMISSION_RETRY_AFTER_S'])
+        admission.init_app(app, controller)
+        app.extensions['admission'] = controller
+        if app.config['METRICS_ENABLED']:
+            app_metrics.admission = controller.stats
+
+    # After the metrics hooks, so that they count the compressed bytes
+    if app.config['COMPRESSION_ENABLED']:
+        compression.init_app(app)
 
     # Register blueprints
     from app.routes import api_bp
     app.register_blueprint(api_bp)
 
     return app
+
+
+def create_asgi_app(config_class=Config):
+    """Create the application for ASGI servers
+
+    For example `uvicorn --factory app:create_asgi_app`.
+    """
+    from app.asgi import AsgiApp
+    from app.routes import ASYNC_VIEWS
+    app = create_app(config_class)
+    async_store = AsyncUserStore(app.extensions['user_store'])
+    app.extensions['async_user_store'] = async_store
+    return AsgiApp(app, ASYNC_VIEWS, offload=async_store.offload)
@@ -0,0 +1,253 @@
+"""Admission control: shed load early instead of queueing it
+
+Every request is first given a priority class from its route and
+method, then checked in turn against:
+
+- its client's token bucket (clients are keyed by a header or their
+  address); an empty bucket gets 429.
+- its route's fixed concurrency limit, if it has one.
+- the adaptive concurrency limit, shared by every limited class but
+  reachable only up to the class's share of it, so bulk work is shed
+  first, writes next and reads last.
+
+A request turned away by a concurrency limit gets 503 straight away.
+Both kinds of refusal carry Retry-After. The adaptive limit follows AIMD
+on latency. Every WINDOW_S the mean latency of the reads and writes
+completed meanwhile is compared with the target. Above it, the limit is
+cut by BACKOFF. Otherwise the limit grows by one, but only if at least
+half of it was in use, so an idle server does not grow it without end.
+"""
+import math
+import threading
+import time
+from collections import Counter
+from typing import Dict, List, Optional
+
+from flask import jsonify, request
+
+CLASS_CRITICAL = 'critical'
+CLASS_READ = 'read'
+CLASS_WRITE = 'write'
+CLASS_BULK = 'bulk'
+CLASS_STREAM = 'stream'
+
+# Per class: the share of the adaptive limit it may fill (None if the
+# adaptive limit does not apply), whether its latency steers the limit,
+# and whether it is rate limited. Critical requests are always admitted;
+# long polls and event streams hold a slot for their whole wait, so they
+# only answer to route limits and rate limits
+CLASSES = {
+    CLASS_CRITICAL: (None, False, False),
+    CLASS_READ: (1.0, True, True),
+    CLASS_WRITE: (0.75, True, True),
+    CLASS_BULK: (0.5, False, True),
+    CLASS_STREAM: (None, False, True),
+}
+
+# Classes of routes that are not classed by method (GET and HEAD are
+# reads, the rest writes); ADMISSION_ROUTE_CLASSES adds to these
+DEFAULT_ROUTE_CLASSES = {
+    '/api/health': CLASS_CRITICAL,
+    '/api/metrics': CLASS_CRITICAL,
+    '/api/admin/profile': CLASS_CRITICAL,
+    '/api/users/changes': CLASS_STREAM,
+    '/api/users/batch': CLASS_BULK,
+    '/api/batch': CLASS_BULK,
+    '/api/users/import': CLASS_BULK,
+    '/api/users/export': CLASS_BULK,
+}
+
+_READ_METHODS = frozenset(('GET', 'HEAD', 'OPTIONS'))
+
+# Factor applied to the adaptive limit when latency is over target
+BACKOFF = 0.9
+# Seconds of completed requests averaged for each limit adjustment
+WINDOW_S = 0.1
+# Token buckets kept before full ones are dropped
+_MAX_BUCKETS = 10_000
+
+# WSGI environ key holding an admitted request's (class, route, start)
+_ADMITTED_KEY = 'app.admission.admitted'
+
+
+class TokenBuckets:
+    """A token bucket per client key, refilled at `rate` up to `burst`"""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self._lock = threading.Lock()
+        # key -> [tokens, monotonic time they were counted at]
+        self._buckets: Dict[str, List[float]] = {}
+
+    def take(self, key: str) -> float:
+        """Take a token: 0 if one was there, else seconds until one is"""
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                if len(self._buckets) >= _MAX_BUCKETS:
+                    self._prune(now)
+                bucket = self._buckets[key] = [self.burst, now]
+            tokens = min(self.burst,
+                         bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if tokens >= 1:
+                bucket[0] = tokens - 1
+                return 0.0
+            bucket[0] = tokens
+            return (1 - tokens) / self.rate
+
+    def _prune(self, now: float):
+        """Forget buckets that have refilled; they start out full anyway"""
+        refill = self.burst / self.rate
+        self._buckets = {key: bucket for key, bucket in self._buckets.items()
+                         if now - bucket[1] < refill}
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class AdmissionController:
+    """Decides which requests to serve and which to shed
+
+    `admit` returns None for an admitted request, which must later be
+    passed to `release`, or the (status, retry_after_s) to refuse it
+    with. Counters are guarded by one lock, held only for arithmetic.
+    """
+
+    def __init__(self, initial_limit: float = 32, min_limit: float = 4,
+                 max_limit: float = 512, target_latency_s: float = 0.05,
+                 route_limits: Optional[Dict[str, int]] = None,
+                 rate_limiter: Optional[TokenBuckets] = None,
+                 retry_after_s: int = 1):
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.target_latency_s = target_latency_s
+        self.route_limits = dict(route_limits or {})
+        self.rate_limiter = rate_limiter
+        self.retry_after_s = retry_after_s
+        self.latency: Optional[float] = None  # mean of the last window
+        self._lock = threading.Lock()
+        self._inflight = 0  # requests under the adaptive limit
+        self._route_inflight: Counter = Counter()
+        # Latencies and most requests in flight since _window_start
+        self._window_start = time.monotonic()
+        self._window_total = 0.0
+        self._window_count = 0
+        self._window_peak = 0
+        self.shed: Counter = Counter()  # (reason, class) -> requests
+
+    def admit(self, priority: str, route: str, client: str):
+        """None to serve the request, else (status, retry_after_s)"""
+        share, _, rate_limited = CLASSES[priority]
+        if rate_limited and self.rate_limiter is not None:
+            wait = self.rate_limiter.take(client)
+            if wait:
+                with self._lock:
+                    self.shed['rate', priority] += 1
+                return 429, max(1, math.ceil(wait))
+
+        route_limit = self.route_limits.get(route)
+        with self._lock:
+            if (route_limit is not None
+                    and self._route_inflight[route] >= route_limit):
+                self.shed['route', priority] += 1
+                return 503, self.retry_after_s
+            if share is not None:
+                if self._inflight + 1 > max(1.0, self.limit * share):
+                    self.shed['limit', priority] += 1
+                    return 503, self.retry_after_s
+                self._inflight += 1
+                self._window_peak = max(self._window_peak, self._inflight)
+            if route_limit is not None:
+                self._route_inflight[route] += 1
+        return None
+
+    def release(self, priority: str, route: str, latency_s: float):
+        """Free an admitted request's slots and learn from its latency"""
+        share, timed, _ = CLASSES[priority]
+        with self._lock:
+            if route in self.route_limits:
+                self._route_inflight[route] -= 1
+            if share is None:
+                return
+            if timed:
+                self._observe(latency_s)
+            self._inflight -= 1
+
+    def _observe(self, latency_s: float):
+        self._window_total += latency_s
+        self._window_count += 1
+        now = time.monotonic()
+        if now - self._window_start < WINDOW_S:
+            return
+        self.latency = self._window_total / self._window_count
+        if self.latency > self.target_latency_s:
+            self.limit = max(self.min_limit, self.limit * BACKOFF)
+        elif self._window_peak * 2 >= self.limit:
+            self.limit = min(self.max_limit, self.limit + 1)
+        self._window_start = now
+        self._window_total = 0.0
+        self._window_count = 0
+        self._window_peak = self._inflight
+
+    def stats(self) -> Dict:
+        """Current limit and load, and shed counts by (reason, class)"""
+        with self._lock:
+            return {"limit": self.limit, "inflight": self._inflight,
+                    "latency_s": self.latency,
+                    "route_inflight": {route: count for route, count
+                                       in self._route_inflight.items()
+                                       if count},
+                    "shed": dict(sorted(self.shed.items()))}
+
+
+def classify(method: str, route: str, classes: Dict[str, str]) -> str:
+    """Priority class of a request to `route` (a URL rule)"""
+    priority = classes.get(route)
+    if priority is not None:
+        return priority
+    return CLASS_READ if method in _READ_METHODS else CLASS_WRITE
+
+
+def init_app(app, controller: AdmissionController):
+    """Shed requests to app that the controller does not admit"""
+    classes = {**DEFAULT_ROUTE_CLASSES,
+               **app.config['ADMISSION_ROUTE_CLASSES']}
+    unknown = set(classes.values()) - set(CLASSES)
+    if unknown:
+        raise ValueError(f"Unknown ADMISSION_ROUTE_CLASSES: {unknown}")
+    client_header = app.config['ADMISSION_CLIENT_HEADER']
+
+    @app.before_request
+    def _admit():
+        req = request._get_current_object()  # pylint: disable=protected-access
+        rule = req.url_rule
+        if rule is None:
+            return None  # a 404 or 405 costs next to nothing
+        route = rule.rule
+        priority = classify(req.method, route, classes)
+        client = ((client_header and req.headers.get(client_header))
+                  or req.remote_addr or '')
+        refusal = controller.admit(priority, route, client)
+        if refusal is None:
+            req.environ[_ADMITTED_KEY] = (priority, route,
+                                          time.perf_counter())
+            return None
+        status, retry_after = refusal
+        message = ("Rate limit exceeded" if status == 429
+                   else "Server overloaded")
+        response = jsonify({"error": f"{message}, retry later"})
+        response.status_code = status
+        response.headers['Retry-After'] = str(retry_after)
+        return response
+
+    @app.teardown_request
+    def _release(_exc):
+        req = request._get_current_object()  # pylint: disable=protected-access
+        admitted = req.environ.pop(_ADMITTED_KEY, None)
+        if admitted is not None:
+            priority, route, start = admitted
+            controller.release(priority, route, time.perf_counter() - start)
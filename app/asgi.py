@@ -0,0 +1,233 @@
+"""ASGI adapter that serves the Flask app from an asyncio event loop
+
+Each HTTP request gets a normal Flask request context, so routing, the
+before/after request hooks (metrics, compression, profiling), error
+handlers and teardown all behave as under WSGI. Endpoints with a
+coroutine version (ASYNC_VIEWS in app.routes) are awaited on the event loop;
+a request waiting on one, such as a long poll, costs a suspended
+coroutine rather than a thread. Every other endpoint runs its regular
+view, directly on the loop for in-memory stores or on a thread pool
+when the store can block on I/O.
+
+Request bodies are read in full before the view runs.
+"""
+import asyncio
+import contextvars
+import io
+import sys
+from concurrent.futures import Executor
+from typing import Callable, Dict, Optional
+
+from flask import Flask, Response, request
+
+
+class AsyncStreamResponse(Response):
+    """Response whose body is an async iterator, sent as it is produced
+
+    Only the ASGI adapter can send such a body: under WSGI, and to the
+    after request hooks, the response looks empty.
+    """
+
+    automatically_set_content_length = False
+
+    def __init__(self, async_body, status: int = 200, **kwargs):
+        super().__init__(None, status, **kwargs)
+        self.async_body = async_body
+
+
+def _environ(scope: dict, body: bytes) -> dict:
+    """WSGI environ for an ASGI HTTP scope and its request body"""
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        # WSGI strings hold the raw bytes as latin-1
+        'SCRIPT_NAME': scope.get('root_path', '').encode().decode('latin-1'),
+        'PATH_INFO': scope['path'].encode().decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', ()):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        if name == 'CONTENT_LENGTH':
+            continue
+        key = name if name == 'CONTENT_TYPE' else 'HTTP_' + name
+        value = value.decode('latin-1')
+        environ[key] = f'{environ[key]},{value}' if key in environ else value
+    return environ
+
+
+async def _read_body(receive: Callable) -> Optional[bytes]:
+    """The whole request body, or None if the client went away first"""
+    chunks = []
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return None
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'):
+            return b''.join(chunks)
+
+
+async def _wait_disconnect(receive: Callable):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+class AsgiApp:
+    """ASGI 3 application serving a Flask app
+
+    `views` maps endpoint names to coroutine views to use in place of
+    the app's own. With `offload`, the other views, and iterating their
+    response bodies, run on `executor` (the loop's default pool if None)
+    so a slow store cannot stall the event loop.
+    """
+
+    def __init__(self, app: Flask, views: Dict[str, Callable],
+                 offload: bool = False, executor: Optional[Executor] = None):
+        self.app = app
+        self.views = views
+        self.offload = offload
+        self.executor = executor
+
+    async def __call__(self, scope: dict, receive: Callable, send: Callable):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self._http(scope, receive, send)
+        else:
+            raise ValueError(f"Unsupported ASGI scope type {scope['type']}")
+
+    @staticmethod
+    async def _lifespan(receive: Callable, send: Callable):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _http(self, scope: dict, receive: Callable, send: Callable):
+        body = await _read_body(receive)
+        if body is None:
+            return
+        environ = _environ(scope, body)
+        ctx = self.app.request_context(environ)
+        error = None
+        try:
+            ctx.push()
+            # The context the request context was pushed in, for running
+            # sync code on pool threads
+            context = contextvars.copy_context()
+            rule = request.url_rule
+            view = self.views.get(rule.endpoint) if rule else None
+            try:
+                if view is not None:
+                    response = await self._dispatch_async(view)
+                else:
+                    response = await self._run(
+                        context, self.app.full_dispatch_request)
+            except Exception as exc:  # pylint: disable=broad-except
+                error = exc
+                response = self.app.make_response(
+                    self.app.handle_exception(exc))
+            await self._send(response, environ, context, receive, send)
+        except Exception as exc:
+            error = exc
+            raise
+        finally:
+            if ctx.app.should_ignore_error(error):
+                error = None
+            ctx.pop(error)
+
+    async def _dispatch_async(self, view: Callable) -> Response:
+        """Like Flask.full_dispatch_request, but awaiting the view"""
+        app = self.app
+        try:
+            result = app.preprocess_request()
+            if result is None:
+                result = await view(**request.view_args)
+        except Exception as exc:  # pylint: disable=broad-except
+            result = app.handle_user_exception(exc)
+        return app.finalize_request(result)
+
+    async def _run(self, context: contextvars.Context, function, *args):
+        if not self.offload:
+            return function(*args)
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, context.run, function, *args)
+
+    async def _send(self, response: Response, environ: dict,
+                    context: contextvars.Context, receive: Callable,
+                    send: Callable):
+        body, status, headers = response.get_wsgi_response(environ)
+        await send({
+            'type': 'http.response.start',
+            'status': int(status.split(' ', 1)[0]),
+            'headers': [(name.lower().encode('latin-1'),
+                         value.encode('latin-1'))
+                        for name, value in headers],
+        })
+        if isinstance(response, AsyncStreamResponse) \
+                and environ['REQUEST_METHOD'] != 'HEAD':
+            await self._send_async_body(response.async_body, receive, send)
+        elif response.is_sequence:
+            # Already in memory: send it in one message
+            data = b''.join(body)
+            body.close()
+            await send({'type': 'http.response.body', 'body': data})
+            return
+        else:
+            await self._send_sync_body(body, context, send)
+        await send({'type': 'http.response.body', 'body': b''})
+
+    async def _send_sync_body(self, body, context: contextvars.Context,
+                              send: Callable):
+        chunks = iter(body)
+        try:
+            while True:
+                chunk = await self._run(context, next, chunks, None)
+                if chunk is None:
+                    return
+                if chunk:
+                    await send({'type': 'http.response.body',
+                                'body': chunk, 'more_body': True})
+        finally:
+            if hasattr(body, 'close'):
+                await self._run(context, body.close)
+
+    @staticmethod
+    async def _send_async_body(body, receive: Callable, send: Callable):
+        """Send chunks as they come until the body ends or the client
+        disconnects, whichever is first"""
+        disconnected = asyncio.ensure_future(_wait_disconnect(receive))
+        try:
+            while True:
+                chunk = asyncio.ensure_future(anext(body, None))
+                await asyncio.wait((chunk, disconnected),
+                                   return_when=asyncio.FIRST_COMPLETED)
+                if not chunk.done():
+                    chunk.cancel()
+                    await asyncio.wait((chunk,))
+                    return
+                data = chunk.result()
+                if data is None:
+                    return
+                await send({'type': 'http.response.body',
+                            'body': data.encode() if isinstance(data, str)
+                            else data, 'more_body': True})
+        finally:
+            disconnected.cancel()
+            await body.aclose()
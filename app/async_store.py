@@ -0,0 +1,105 @@
+"""Coroutine interface to the user stores, for the ASGI app"""
+import asyncio
+from concurrent.futures import Executor
+from functools import partial
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+from app.models import BaseUserStore, DuplicateEmail, User
+
+
+class AsyncUserStore:
+    """Async version of the BaseUserStore API over any synchronous store
+
+    Stores whose calls can block on I/O (`blocking_io`: SQLite, or a
+    write-ahead log that fsyncs every write) are called on a thread pool,
+    so the event loop keeps serving other connections meanwhile. Purely
+    in-memory stores answer in microseconds and are called directly,
+    which is much cheaper than a round trip through a thread.
+    """
+
+    def __init__(self, store: BaseUserStore,
+                 executor: Optional[Executor] = None):
+        self.store = store
+        self.executor = executor
+        self.offload = getattr(store, 'blocking_io', False)
+
+    async def _call(self, method, *args, **kwargs):
+        if not self.offload:
+            return method(*args, **kwargs)
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, partial(method, *args, **kwargs))
+
+    async def epoch(self) -> str:
+        """Token identifying the store contents since the last clear"""
+        return await self._call(getattr, self.store, 'epoch')
+
+    async def version(self) -> int:
+        """Number of mutations applied to the store"""
+        return await self._call(getattr, self.store, 'version')
+
+    async def create_user(self, name: str, email: str) -> User:
+        """Create a new user"""
+        return await self._call(self.store.create_user, name, email)
+
+    async def create_users(self, rows: Sequence[Tuple[str, str]]
+                           ) -> List[Union[User, DuplicateEmail]]:
+        """Create a user for each (name, email) row"""
+        return await self._call(self.store.create_users, rows)
+
+    async def get_user(self, user_id: int) -> Optional[User]:
+        """Get user by ID"""
+        return await self._call(self.store.get_user, user_id)
+
+    async def get_user_by_email(self, email: str) -> Optional[User]:
+        """Get user by email address"""
+        return await self._call(self.store.get_user_by_email, email)
+
+    async def get_all_users(self) -> List[User]:
+        """Get all users, ordered by ID"""
+        return await self._call(self.store.get_all_users)
+
+    async def get_users_page(self, after_id: int = 0,
+                             limit: Optional[int] = None) -> List[User]:
+        """Get up to `limit` users with an ID greater than `after_id`"""
+        return await self._call(self.store.get_users_page, after_id, limit)
+
+    async def search_users(self, email: Optional[str] = None,
+                           name_prefix: Optional[str] = None,
+                           created_after: Optional[float] = None,
+                           sort: str = 'id', after_id: int = 0,
+                           limit: Optional[int] = None) -> List[User]:
+        """Find users matching every given filter, in `sort` order"""
+        return await self._call(self.store.search_users, email, name_prefix,
+                                created_after, sort, after_id, limit)
+
+    async def count_users(self) -> int:
+        """Number of users"""
+        return await self._call(self.store.count_users)
+
+    async def stats(self, top_domains: Optional[int] = None) -> Dict:
+        """User count, most common email domains and creation series"""
+        return await self._call(self.store.stats, top_domains)
+
+    async def update_user(self, user_id: int, name: str = None,
+                          email: str = None,
+                          expected_version: Optional[int] = None
+                          ) -> Optional[User]:
+        """Update user information"""
+        return await self._call(self.store.update_user, user_id, name,
+                                email, expected_version)
+
+    async def update_users(self, rows: Sequence[Tuple[int, Optional[str],
+                                                      Optional[str]]]
+                           ) -> List[Union[User, None, DuplicateEmail]]:
+        """Apply an (id, name, email) update for each row"""
+        return await self._call(self.store.update_users, rows)
+
+    async def delete_user(self, user_id: int,
+                          expected_version: Optional[int] = None) -> bool:
+        """Delete user by ID"""
+        return await self._call(self.store.delete_user, user_id,
+                                expected_version)
+
+    async def delete_users(self, user_ids: Sequence[int]) -> List[bool]:
+        """Delete several users by ID"""
+        return await self._call(self.store.delete_users, user_ids)
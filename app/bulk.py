@@ -0,0 +1,357 @@
+"""Bulk export and import of users: a columnar binary format, CSV, NDJSON
+
+The binary format is a stream of record batches after an 8-byte magic:
+
+    stream   MAGIC, then (varint length, batch) per batch, then varint 0
+    batch    varint row count n, then the columns:
+             ids        n zigzag varints, each the delta from the row before
+             versions   n varints
+             created    n little-endian float64 epochs
+             names      string dictionary
+             emails     string list of the parts before the last '@',
+                        then a string dictionary of '@' + domain
+    strings  a string list is n varint UTF-8 byte lengths followed by the
+             bytes; a dictionary is a string list of its distinct values
+             followed by n varint indexes into it
+
+Every format carries the same fields: id, name, email, created_ts (epoch
+seconds) and version. Encoders take an iterable of users and yield one
+chunk per `batch_size` users, so a table is never held whole. Readers
+decode a binary stream as it is read: read_columnar yields the Columns
+of each batch, read_csv and read_ndjson (names, emails) list pairs.
+Frame lengths come from the client, so read_columnar refuses batches
+over a byte limit before reading them, and reads the rest a bounded
+chunk at a time.
+"""
+import csv
+import io
+import json
+import sys
+from array import array
+from itertools import islice
+from typing import (BinaryIO, Callable, Dict, Iterable, Iterator, List,
+                    NamedTuple, Tuple)
+
+from app.models import User
+
+MAGIC = b'USRCOLS1'
+
+COLUMNAR_MIMETYPE = 'application/vnd.users.columnar'
+CSV_MIMETYPE = 'text/csv'
+
+EXPORT_FIELDS = ('id', 'name', 'email', 'created_ts', 'version')
+
+# Largest batch read_columnar accepts unless told otherwise
+MAX_BATCH_BYTES = 16 * 1024 * 1024
+# Bytes read from the stream per call while reading a batch
+_READ_CHUNK = 64 * 1024
+
+
+class FormatError(ValueError):
+    """Bulk input that does not follow its format"""
+
+
+class Columns(NamedTuple):
+    """One decoded record batch, column by column"""
+    ids: List[int]
+    names: List[str]
+    emails: List[str]
+    created: List[float]
+    versions: List[int]
+
+
+def _chunks(users: Iterable[User], size: int) -> Iterator[List[User]]:
+    users = iter(users)
+    while True:
+        chunk = list(islice(users, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+# Varints and strings
+
+def _put_varints(out: bytearray, values: Iterable[int]):
+    append = out.append
+    for value in values:
+        while value > 0x7F:
+            append((value & 0x7F) | 0x80)
+            value >>= 7
+        append(value)
+
+
+def _get_varints(data: bytes, pos: int, count: int) -> Tuple[List[int], int]:
+    values = []
+    append = values.append
+    try:
+        for _ in range(count):
+            byte = data[pos]
+            pos += 1
+            if byte < 0x80:
+                append(byte)
+                continue
+            value, shift = byte & 0x7F, 7
+            while True:
+                byte = data[pos]
+                pos += 1
+                value |= (byte & 0x7F) << shift
+                if byte < 0x80:
+                    break
+                shift += 7
+            append(value)
+    except IndexError:
+        raise FormatError("Batch ends inside a varint") from None
+    return values, pos
+
+
+def _put_strings(out: bytearray, strings: List[str]):
+    encoded = [text.encode('utf-8') for text in strings]
+    _put_varints(out, map(len, encoded))
+    out += b''.join(encoded)
+
+
+def _get_strings(data: bytes, pos: int, count: int) -> Tuple[List[str], int]:
+    lengths, pos = _get_varints(data, pos, count)
+    end = pos + sum(lengths)
+    if end > len(data):
+        raise FormatError("Batch ends inside a string column")
+    blob = data[pos:end]
+    try:
+        text = blob.decode('utf-8')
+        if len(text) == len(blob):
+            # All ASCII: slice the decoded text instead of each string
+            source = text
+        else:
+            source = None
+        strings = []
+        start = 0
+        for length in lengths:
+            if source is not None:
+                strings.append(source[start:start + length])
+            else:
+                strings.append(blob[start:start + length].decode('utf-8'))
+            start += length
+    except UnicodeDecodeError:
+        raise FormatError("String column is not valid UTF-8") from None
+    return strings, end
+
+
+def _put_dictionary(out: bytearray, strings: List[str]):
+    codes: Dict[str, int] = {}
+    indexes = [codes.setdefault(text, len(codes)) for text in strings]
+    _put_varints(out, (len(codes),))
+    _put_strings(out, list(codes))
+    _put_varints(out, indexes)
+
+
+def _get_dictionary(data: bytes, pos: int,
+                    count: int) -> Tuple[List[str], int]:
+    (size,), pos = _get_varints(data, pos, 1)
+    values, pos = _get_strings(data, pos, size)
+    indexes, pos = _get_varints(data, pos, count)
+    try:
+        return [values[index] for index in indexes], pos
+    except IndexError:
+        raise FormatError("Dictionary index out of range") from None
+
+
+# The columnar binary format
+
+def encode_batch(users: List[User]) -> bytes:
+    """One record batch holding `users`"""
+    out = bytearray()
+    _put_varints(out, (len(users),))
+    deltas = []
+    previous = 0
+    for user in users:
+        delta = user.id - previous
+        deltas.append(delta << 1 if delta >= 0 else (-delta << 1) - 1)
+        previous = user.id
+    _put_varints(out, deltas)
+    _put_varints(out, [user.version for user in users])
+    created = array('d', [user.created_ts for user in users])
+    if sys.byteorder == 'big':
+        created.byteswap()
+    out += created.tobytes()
+    _put_dictionary(out, [user.name for user in users])
+    locals_, domains = [], []
+    for user in users:
+        local, at, domain = user.email.rpartition('@')
+        locals_.append(local)
+        domains.append(at + domain)
+    _put_strings(out, locals_)
+    _put_dictionary(out, domains)
+    return bytes(out)
+
+
+def decode_batch(data: bytes) -> Columns:
+    """Columns of one record batch; FormatError if it is malformed"""
+    (count,), pos = _get_varints(data, 0, 1)
+    deltas, pos = _get_varints(data, pos, count)
+    ids = []
+    previous = 0
+    for delta in deltas:
+        previous += (delta >> 1) if not delta & 1 else -((delta + 1) >> 1)
+        ids.append(previous)
+    versions, pos = _get_varints(data, pos, count)
+    end = pos + 8 * count
+    if end > len(data):
+        raise FormatError("Batch ends inside the created column")
+    created = array('d')
+    created.frombytes(data[pos:end])
+    if sys.byteorder == 'big':
+        created.byteswap()
+    names, pos = _get_dictionary(data, end, count)
+    locals_, pos = _get_strings(data, pos, count)
+    domains, pos = _get_dictionary(data, pos, count)
+    if pos != len(data):
+        raise FormatError("Unexpected bytes after the last column")
+    return Columns(ids, names, list(map(str.__add__, locals_, domains)),
+                   created.tolist(), versions)
+
+
+def iter_columnar(users: Iterable[User],
+                  batch_size: int) -> Iterator[bytes]:
+    """Yield the binary stream of users, one framed batch at a time"""
+    yield MAGIC
+    for chunk in _chunks(users, batch_size):
+        batch = encode_batch(chunk)
+        frame = bytearray()
+        _put_varints(frame, (len(batch),))
+        yield bytes(frame) + batch
+    yield b'\0'
+
+
+def _read_exact(stream: BinaryIO, size: int) -> bytes:
+    data = bytearray()
+    while len(data) < size:
+        more = stream.read(min(size - len(data), _READ_CHUNK))
+        if not more:
+            raise FormatError("Stream ends inside a batch")
+        data += more
+    return bytes(data)
+
+
+def _read_frame_length(stream: BinaryIO, limit: int) -> int:
+    value, shift = 0, 0
+    while True:
+        byte = stream.read(1)
+        if not byte:
+            raise FormatError("Stream ends without its end marker")
+        value |= (byte[0] & 0x7F) << shift
+        if value > limit:
+            raise FormatError(f"Batch larger than {limit} bytes")
+        if byte[0] < 0x80:
+            return value
+        shift += 7
+
+
+def read_columnar(stream: BinaryIO,
+                  max_batch_bytes: int = MAX_BATCH_BYTES
+                  ) -> Iterator[Columns]:
+    """Decode a binary stream batch by batch as it is read
+
+    A frame declaring more than `max_batch_bytes` raises FormatError
+    before any of it is read.
+    """
+    if stream.read(len(MAGIC)) != MAGIC:
+        raise FormatError("Not a columnar user stream")
+    while True:
+        length = _read_frame_length(stream, max_batch_bytes)
+        if length == 0:
+            return
+        yield decode_batch(_read_exact(stream, length))
+
+
+# Text fallbacks
+
+def iter_csv(users: Iterable[User], batch_size: int) -> Iterator[bytes]:
+    """Yield users as CSV with a header row, a batch at a time"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_FIELDS)
+    for chunk in _chunks(users, batch_size):
+        writer.writerows((user.id, user.name, user.email,
+                          repr(user.created_ts), user.version)
+                         for user in chunk)
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+
+def iter_ndjson(users: Iterable[User], batch_size: int,
+                dumps: Callable[[object], str] = json.dumps
+                ) -> Iterator[bytes]:
+    """Yield users as NDJSON, a batch at a time"""
+    for chunk in _chunks(users, batch_size):
+        yield ''.join(
+            dumps({"id": user.id, "name": user.name, "email": user.email,
+                   "created_ts": user.created_ts,
+                   "version": user.version}) + '\n'
+            for user in chunk).encode('utf-8')
+
+
+def _row_batches(rows: Iterator[Tuple[str, str]],
+                 batch_size: int) -> Iterator[Tuple[List[str], List[str]]]:
+    while True:
+        chunk = list(islice(rows, batch_size))
+        if not chunk:
+            return
+        names, emails = zip(*chunk)
+        yield list(names), list(emails)
+
+
+def read_csv(stream: BinaryIO, batch_size: int
+             ) -> Iterator[Tuple[List[str], List[str]]]:
+    """(names, emails) per `batch_size` rows of CSV with a header row
+
+    Only the name and email columns are read. Like read_columnar, nothing
+    is read, and no FormatError raised, until the first batch is asked
+    for.
+    """
+    text = io.TextIOWrapper(stream, encoding='utf-8', newline='')
+    reader = csv.reader(text)
+    try:
+        header = next(reader, [])
+        name_at, email_at = header.index('name'), header.index('email')
+    except ValueError:
+        raise FormatError("CSV header must name a name and an email "
+                          "column") from None
+    except UnicodeDecodeError:
+        raise FormatError("CSV is not valid UTF-8") from None
+    except csv.Error as exc:
+        raise FormatError(f"Bad CSV: {exc}") from None
+
+    def rows():
+        try:
+            for row in reader:
+                if len(row) > max(name_at, email_at):
+                    yield row[name_at], row[email_at]
+                elif row:
+                    yield '', ''  # counted as invalid
+        except (csv.Error, UnicodeDecodeError) as exc:
+            raise FormatError(f"Bad CSV: {exc}") from None
+    yield from _row_batches(rows(), batch_size)
+
+
+def read_ndjson(stream: BinaryIO, batch_size: int,
+                loads: Callable[[bytes], object] = json.loads
+                ) -> Iterator[Tuple[List[str], List[str]]]:
+    """(names, emails) per `batch_size` lines of NDJSON objects"""
+    def rows():
+        for line_number, line in enumerate(stream, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                row = loads(line)
+            except ValueError:
+                raise FormatError(
+                    f"Malformed JSON on line {line_number}") from None
+            if isinstance(row, dict):
+                yield row.get('name'), row.get('email')
+            else:
+                yield '', ''  # counted as invalid
+    return _row_batches(rows(), batch_size)
@@ -0,0 +1,116 @@
+"""Bounded in-memory feed of user store mutations"""
+import asyncio
+import secrets
+import threading
+from collections import deque
+from itertools import islice
+from typing import Dict, List, Optional, Set, Tuple
+
+from app.models import OP_CLEAR, OP_DELETE, User
+
+
+class CursorExpired(Exception):
+    """A change feed cursor can no longer be served; resync instead"""
+
+
+class ChangeFeed:
+    """Ring buffer of the last `capacity` store mutations
+
+    `record` is registered as a store listener and numbers every mutation
+    with a sequence number that increases by exactly one, so a consumer
+    holding the last sequence number it applied can ask for everything
+    after it. Created and updated users are captured as they were at the
+    time of the write; deletes carry only the ID.
+
+    Cursors older than the oldest buffered change, newer than the latest
+    one, or from another `epoch` (a previous run of the server) raise
+    CursorExpired: the consumer must re-read the full user list.
+    """
+
+    def __init__(self, capacity: int = 10_000):
+        self.epoch = secrets.token_hex(4)
+        self.seq = 0
+        self._events: deque = deque(maxlen=capacity)
+        self._cond = threading.Condition()
+        # (loop, future) of each coroutine waiting in read_async
+        self._async_waiters: Set[Tuple[asyncio.AbstractEventLoop,
+                                       asyncio.Future]] = set()
+
+    def record(self, op: str, user: Optional[User]):
+        """Store listener: append one change"""
+        if op == OP_CLEAR:
+            change = {"op": op}
+        elif op == OP_DELETE:
+            change = {"op": op, "id": user.id}
+        else:
+            change = {"op": op, "user": user.to_dict()}
+        with self._cond:
+            self.seq += 1
+            self._events.append((self.seq, change))
+            self._cond.notify_all()
+            waiters, self._async_waiters = self._async_waiters, set()
+        for loop, future in waiters:
+            try:
+                loop.call_soon_threadsafe(_wake, future)
+            except RuntimeError:
+                pass  # the loop has been closed
+
+    def read(self, since: int, limit: int = 1000, timeout: float = 0,
+             epoch: Optional[str] = None) -> List[Dict]:
+        """Changes after `since`, oldest first, at most `limit` of them
+
+        With a timeout, wait up to that many seconds for a change if there
+        is none yet (long polling).
+        """
+        with self._cond:
+            self._check_cursor(since, epoch)
+            if timeout and since == self.seq:
+                self._cond.wait_for(lambda: self.seq > since, timeout)
+                self._check_cursor(since, epoch)
+            oldest = self._events[0][0] if self._events else self.seq + 1
+            changes = islice(self._events, since + 1 - oldest,
+                             since + 1 - oldest + limit)
+            return [dict(change, seq=seq) for seq, change in changes]
+
+    async def read_async(self, since: int, limit: int = 1000,
+                         timeout: float = 0,
+                         epoch: Optional[str] = None) -> List[Dict]:
+        """Coroutine version of read
+
+        Waiting for a change holds no thread, only a future on the
+        running event loop, so one loop can serve many long polls.
+        """
+        changes = self.read(since, limit, 0, epoch)
+        if changes or not timeout:
+            return changes
+        loop = asyncio.get_running_loop()
+        waiter = (loop, loop.create_future())
+        with self._cond:
+            waiting = self.seq == since
+            if waiting:
+                self._async_waiters.add(waiter)
+        if waiting:
+            try:
+                await asyncio.wait_for(waiter[1], timeout)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                with self._cond:
+                    self._async_waiters.discard(waiter)
+        return self.read(since, limit, 0, epoch)
+
+    def _check_cursor(self, since: int, epoch: Optional[str]):
+        oldest = self._events[0][0] if self._events else self.seq + 1
+        if (epoch is not None and epoch != self.epoch) or since > self.seq \
+                or since < oldest - 1:
+            raise CursorExpired(since)
+
+    def position(self) -> Tuple[str, int]:
+        """(epoch, seq) to resume from after a full read of the store"""
+        with self._cond:
+            return self.epoch, self.seq
+
+
+def _wake(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
@@ -0,0 +1,187 @@
+"""Compact column-oriented user storage"""
+from array import array
+from bisect import bisect_left, bisect_right
+from typing import List, Optional
+
+from app.models import (OP_CLEAR, OP_CREATE, OP_DELETE, OP_UPDATE,
+                        BaseUserStore, User, VersionConflict)
+
+# Compaction is skipped below this many rows; it is not worth it yet
+_MIN_COMPACT_ROWS = 1024
+
+
+class ColumnarUserStore(BaseUserStore):
+    """In-memory user storage packed into parallel arrays
+
+    Each user is one row across typed arrays (ID, creation epoch, version,
+    and the offset/length of its name and email inside a shared UTF-8 arena), so
+    a user costs a few dozen bytes instead of a full object graph. `User`
+    objects are only built on demand as read-only views of a row.
+
+    IDs are appended in increasing order, so the ID column stays sorted
+    and doubles as the index. Deletes leave a tombstone and updates leave
+    dead bytes in the arena; both are reclaimed by compacting once they
+    make up half the store.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.next_id = 1
+        self._reset()
+
+    def _reset(self):
+        self._ids = array('q')
+        self._created = array('d')
+        self._versions = array('q')
+        self._name_off = array('Q')
+        self._name_len = array('I')
+        self._email_off = array('Q')
+        self._email_len = array('I')
+        self._alive = bytearray()
+        self._arena = bytearray()
+        self._live_rows = 0
+        self._dead_bytes = 0
+
+    def _pack(self, text: str):
+        data = text.encode('utf-8')
+        offset = len(self._arena)
+        self._arena += data
+        return offset, len(data)
+
+    def _text(self, offset: int, length: int) -> str:
+        return self._arena[offset:offset + length].decode('utf-8')
+
+    def _row(self, user_id: int) -> int:
+        row = bisect_left(self._ids, user_id)
+        if (row < len(self._ids) and self._ids[row] == user_id
+                and self._alive[row]):
+            return row
+        return -1
+
+    def _view(self, row: int) -> User:
+        return User(self._ids[row],
+                    self._text(self._name_off[row], self._name_len[row]),
+                    self._text(self._email_off[row], self._email_len[row]),
+                    self._created[row], self._versions[row])
+
+    def _maybe_compact(self):
+        rows = len(self._ids)
+        if rows < _MIN_COMPACT_ROWS:
+            return
+        if (rows - self._live_rows) * 2 > rows or \
+                self._dead_bytes * 2 > len(self._arena):
+            self._compact()
+
+    def _compact(self):
+        """Rewrite the columns without tombstones or dead arena bytes"""
+        users = [self._view(row) for row in range(len(self._ids))
+                 if self._alive[row]]
+        self._reset()
+        for user in users:
+            self._append(user)
+
+    def _append(self, user: User):
+        self._insert(len(self._ids), user)
+
+    def _insert(self, row: int, user: User):
+        name_off, name_len = self._pack(user.name)
+        email_off, email_len = self._pack(user.email)
+        self._ids.insert(row, user.id)
+        self._created.insert(row, user.created_ts)
+        self._versions.insert(row, user.version)
+        self._name_off.insert(row, name_off)
+        self._name_len.insert(row, name_len)
+        self._email_off.insert(row, email_off)
+        self._email_len.insert(row, email_len)
+        self._alive.insert(row, 1)
+        self._live_rows += 1
+
+    def create_user(self, name: str, email: str) -> User:
+        """Create a new user"""
+        user = User(self.next_id, name, email)
+        self._append(user)
+        self.next_id += 1
+        self._notify(OP_CREATE, user)
+        return user
+
+    def restore_user(self, user: User):
+        """Insert or replace a user with a known ID (used for recovery)"""
+        row = bisect_left(self._ids, user.id)
+        if row < len(self._ids) and self._ids[row] == user.id:
+            if not self._alive[row]:
+                self._alive[row] = 1
+                self._live_rows += 1
+            self._dead_bytes += self._name_len[row] + self._email_len[row]
+            self._created[row] = user.created_ts
+            self._versions[row] = user.version
+            self._name_off[row], self._name_len[row] = self._pack(user.name)
+            self._email_off[row], self._email_len[row] = \
+                self._pack(user.email)
+        else:
+            self._insert(row, user)
+        self.next_id = max(self.next_id, user.id + 1)
+
+    def get_user(self, user_id: int) -> Optional[User]:
+        """Get user by ID"""
+        row = self._row(user_id)
+        return self._view(row) if row >= 0 else None
+
+    def get_all_users(self) -> List[User]:
+        """Get all users"""
+        return [self._view(row) for row in range(len(self._ids))
+                if self._alive[row]]
+
+    def get_users_page(self, after_id: int = 0,
+                       limit: Optional[int] = None) -> List[User]:
+        """Get up to `limit` users with an ID greater than `after_id`"""
+        page = []
+        for row in range(bisect_right(self._ids, after_id), len(self._ids)):
+            if limit is not None and len(page) == limit:
+                break
+            if self._alive[row]:
+                page.append(self._view(row))
+        return page
+
+    def update_user(self, user_id: int, name: str = None,
+                    email: str = None,
+                    expected_version: Optional[int] = None
+                    ) -> Optional[User]:
+        """Update user information"""
+        row = self._row(user_id)
+        if row < 0:
+            return None
+        if (expected_version is not None
+                and self._versions[row] != expected_version):
+            raise VersionConflict(user_id)
+        self._versions[row] += 1
+        if name:
+            self._dead_bytes += self._name_len[row]
+            self._name_off[row], self._name_len[row] = self._pack(name)
+        if email:
+            self._dead_bytes += self._email_len[row]
+            self._email_off[row], self._email_len[row] = self._pack(email)
+        user = self._view(row)
+        self._notify(OP_UPDATE, user)
+        self._maybe_compact()
+        return user
+
+    def delete_user(self, user_id: int,
+                    expected_version: Optional[int] = None) -> bool:
+        """Delete user by ID"""
+        row = self._row(user_id)
+        if row < 0:
+            return False
+        user = self._view(row)
+        self._check_version(user, expected_version)
+        self._alive[row] = 0
+        self._live_rows -= 1
+        self._dead_bytes += self._name_len[row] + self._email_len[row]
+        self._notify(OP_DELETE, user)
+        self._maybe_compact()
+        return True
+
+    def clear_all(self):
+        """Clear all users (for testing)"""
+        self._reset()
+        self.next_id = 1
+        self._notify(OP_CLEAR, None)
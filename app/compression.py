@@ -0,0 +1,274 @@
+"""Content-negotiated response compression and request decompression
+
+Responses are compressed with the best encoding the client accepts out
+of zstd and br (when their modules are installed), gzip and deflate.
+Streamed responses are compressed chunk by chunk as they are produced;
+only enough of the stream to decide against the size threshold is read
+up front. Request bodies sent with a Content-Encoding are decompressed
+as the view reads them, never more than the view asked for at a time,
+so a small body that inflates hugely is stopped at the size limit
+rather than after it has been inflated.
+"""
+import io
+import zlib
+
+from flask import jsonify, request
+from werkzeug.exceptions import BadRequest, RequestEntityTooLarge
+from werkzeug.wsgi import LimitedStream
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - depends on the environment
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover - depends on the environment
+    zstandard = None
+
+# Mimetypes worth compressing besides text/*
+COMPRESSIBLE_MIMETYPES = frozenset(('application/json',
+                                    'application/x-ndjson',
+                                    'application/vnd.users.columnar'))
+
+# Raw request bytes decompressed per step
+_READ_SIZE = 16 * 1024
+
+
+class _BrotliCompressor:
+    """brotli.Compressor with the zlib compressobj method names"""
+
+    def __init__(self, quality: int):
+        self._compressor = brotli.Compressor(quality=quality)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.process(data)
+
+    def flush(self) -> bytes:
+        return self._compressor.finish()
+
+
+def available_encodings(config) -> dict:
+    """Encoding name -> compressor factory, most preferred first"""
+    level = config['COMPRESSION_LEVEL']
+    encodings = {}
+    if zstandard is not None:
+        zstd_level = config['COMPRESSION_ZSTD_LEVEL']
+        encodings['zstd'] = lambda: zstandard.ZstdCompressor(
+            level=zstd_level).compressobj()
+    if brotli is not None:
+        quality = config['COMPRESSION_BROTLI_QUALITY']
+        encodings['br'] = lambda: _BrotliCompressor(quality)
+    encodings['gzip'] = lambda: zlib.compressobj(level, zlib.DEFLATED,
+                                                 16 + zlib.MAX_WBITS)
+    encodings['deflate'] = lambda: zlib.compressobj(level)
+    return encodings
+
+
+class _ZlibInflater:
+    """Inflates a zlib, gzip or raw deflate stream a bounded read at a time"""
+
+    def __init__(self, raw, wbits: int):
+        self._raw = raw
+        self._inflater = zlib.decompressobj(wbits)
+
+    def read(self, size: int) -> bytes:
+        inflater = self._inflater
+        while not inflater.eof:
+            if inflater.unconsumed_tail:
+                data = inflater.decompress(inflater.unconsumed_tail, size)
+            else:
+                chunk = self._raw.read(_READ_SIZE)
+                if not chunk:
+                    # Truncated: what is left is at most the window
+                    return inflater.flush()
+                data = inflater.decompress(chunk, size)
+            if data:
+                return data
+        return b''
+
+
+class _BrotliInflater:
+    """Decompresses a brotli stream a bounded read at a time"""
+
+    def __init__(self, raw):
+        self._raw = raw
+        self._decompressor = brotli.Decompressor()
+
+    def read(self, size: int) -> bytes:
+        decompressor = self._decompressor
+        while not decompressor.is_finished():
+            if decompressor.can_accept_more_data():
+                chunk = self._raw.read(_READ_SIZE)
+                if not chunk:
+                    return b''
+            else:
+                chunk = b''  # drain the output held back last time
+            data = decompressor.process(chunk, output_buffer_limit=size)
+            if data:
+                return data
+        return b''
+
+
+def _decompressor(encoding: str):
+    """Function opening a bounded reader of the decompressed bytes of a
+    raw stream, or None if the encoding is unsupported
+
+    Each reader's read(size) returns at most size bytes, b'' at the end.
+    Brotli needs a release whose Decompressor can limit its output.
+    """
+    if encoding in ('gzip', 'x-gzip'):
+        return lambda raw: _ZlibInflater(raw, 16 + zlib.MAX_WBITS)
+    if encoding == 'deflate':
+        return lambda raw: _ZlibInflater(raw, zlib.MAX_WBITS)
+    if (encoding == 'br' and brotli is not None
+            and hasattr(brotli.Decompressor, 'can_accept_more_data')):
+        return _BrotliInflater
+    if encoding == 'zstd' and zstandard is not None:
+        return lambda raw: zstandard.ZstdDecompressor().stream_reader(
+            raw, read_size=_READ_SIZE)
+    return None
+
+
+class _DecompressingReader(io.RawIOBase):
+    """Readable stream of the decompressed bytes of another stream"""
+
+    def __init__(self, raw, open_reader, max_bytes: int):
+        super().__init__()
+        self._reader = open_reader(raw)
+        self._max_bytes = max_bytes
+        self._total = 0
+        self._eof = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self._eof or not len(buffer):
+            return 0
+        # One byte past the limit is enough to know it was passed
+        size = min(len(buffer), self._max_bytes - self._total + 1)
+        try:
+            data = self._reader.read(size)
+        except Exception as exc:
+            raise BadRequest("Malformed compressed request body") from exc
+        if not data:
+            self._eof = True
+            return 0
+        self._total += len(data)
+        if self._total > self._max_bytes:
+            raise RequestEntityTooLarge()
+        buffer[:len(data)] = data
+        return len(data)
+
+
+def _compressible(response) -> bool:
+    mimetype = response.mimetype or ''
+    if mimetype == 'text/event-stream':
+        return False  # long-lived; events must not sit in a compressor
+    return mimetype in COMPRESSIBLE_MIMETYPES or mimetype.startswith('text/')
+
+
+def _encoded(chunk) -> bytes:
+    return chunk.encode('utf-8') if isinstance(chunk, str) else chunk
+
+
+def _compress_stream(head, rest, original, compressor):
+    """Yield the compressed head chunks followed by the rest of a body"""
+    try:
+        for chunk in head:
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        for chunk in rest:
+            data = compressor.compress(_encoded(chunk))
+            if data:
+                yield data
+        yield compressor.flush()
+    finally:
+        if hasattr(original, 'close'):
+            original.close()
+
+
+def init_app(app):
+    """Compress responses and decompress request bodies for app"""
+    config = app.config
+    encodings = available_encodings(config)
+    min_bytes = config['COMPRESSION_MIN_BYTES']
+    max_request_bytes = config['COMPRESSION_MAX_REQUEST_BYTES']
+
+    @app.before_request
+    def _decompress_request():
+        environ = request.environ
+        encoding = environ.get('HTTP_CONTENT_ENCODING', '').strip().lower()
+        if not encoding or encoding == 'identity':
+            return None
+        open_reader = _decompressor(encoding)
+        if open_reader is None:
+            return jsonify({"error": "Unsupported Content-Encoding: "
+                                     f"{encoding}"}), 415
+        raw = environ['wsgi.input']
+        length = environ.get('CONTENT_LENGTH')
+        if length:
+            raw = LimitedStream(raw, int(length))
+        environ['wsgi.input'] = io.BufferedReader(
+            _DecompressingReader(raw, open_reader, max_request_bytes))
+        # The decompressed length is unknown; read to the end instead
+        environ['wsgi.input_terminated'] = True
+        environ.pop('CONTENT_LENGTH', None)
+        del environ['HTTP_CONTENT_ENCODING']
+        return None
+
+    @app.after_request
+    def _compress_response(response):
+        if (response.status_code < 200 or response.status_code in (204, 304)
+                or response.direct_passthrough
+                or 'Content-Encoding' in response.headers
+                or not _compressible(response)):
+            return response
+        response.vary.add('Accept-Encoding')
+        encoding = request.accept_encodings.best_match(list(encodings))
+        if encoding is None or request.method == 'HEAD':
+            return response
+
+        if not response.is_streamed:
+            data = response.get_data()
+            if len(data) >= min_bytes:
+                compressor = encodings[encoding]()
+                response.set_data(compressor.compress(data)
+                                  + compressor.flush())
+                _mark_encoded(response, encoding)
+            return response
+
+        # Read just enough of the stream to compare with the threshold
+        original = response.response
+        chunks = iter(original)
+        head, size, exhausted = [], 0, True
+        for chunk in chunks:
+            head.append(_encoded(chunk))
+            size += len(head[-1])
+            if size >= min_bytes:
+                exhausted = False
+                break
+
+        if exhausted:
+            # Small enough to have been read whole; send it as it is
+            response.set_data(b''.join(head))
+            if hasattr(original, 'close'):
+                original.close()
+            return response
+
+        _mark_encoded(response, encoding)
+        response.headers.pop('Content-Length', None)
+        response.response = _compress_stream(head, chunks, original,
+                                             encodings[encoding]())
+        return response
+
+
+def _mark_encoded(response, encoding: str):
+    response.headers['Content-Encoding'] = encoding
+    # The compressed bytes differ from the identity representation, so a
+    # strong validator would be wrong; If-None-Match compares weakly
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
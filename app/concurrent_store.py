@@ -0,0 +1,199 @@
+"""Thread-safe user storage with lock striping"""
+import heapq
+import threading
+from bisect import bisect_right, insort
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from app.models import (OP_CLEAR, OP_CREATE, OP_DELETE, OP_UPDATE,
+                        BaseUserStore, User)
+
+
+class _Shard:
+    """One stripe of the store: its users, sorted ids and lock"""
+
+    __slots__ = ('users', 'ids', 'lock')
+
+    def __init__(self):
+        self.users: Dict[int, User] = {}
+        self.ids: List[int] = []
+        self.lock = threading.Lock()
+
+
+class ConcurrentUserStore(BaseUserStore):
+    """In-memory user storage safe to share between request threads
+
+    Users are spread over `shard_count` shards by ID, each guarded by its
+    own lock, so writers only contend when they touch the same stripe.
+    Point reads and `get_all_users` never take a lock: a single `dict.get`
+    or `dict.copy` on an int-keyed dict runs without releasing the GIL, so
+    readers see each shard either before or after a write, never halfway
+    through it.
+    """
+
+    def __init__(self, shard_count: int = 16):
+        super().__init__()
+        self._shards = [_Shard() for _ in range(shard_count)]
+        self._id_lock = threading.Lock()
+        self.next_id = 1
+
+    def _shard(self, user_id: int) -> _Shard:
+        return self._shards[user_id % len(self._shards)]
+
+    def _allocate_ids(self, count: int = 1) -> int:
+        """Reserve `count` consecutive IDs and return the first"""
+        with self._id_lock:
+            first = self.next_id
+            self.next_id += count
+            return first
+
+    def _by_shard(self, user_ids: Sequence[int]) -> Dict[_Shard, List[int]]:
+        """Group positions in user_ids by the shard owning each ID"""
+        groups: Dict[_Shard, List[int]] = {}
+        for index, user_id in enumerate(user_ids):
+            groups.setdefault(self._shard(user_id), []).append(index)
+        return groups
+
+    def _insert_locked(self, shard: _Shard, user: User):
+        shard.users[user.id] = user
+        # Ids arrive nearly in order, so this is almost always an append
+        insort(shard.ids, user.id)
+        self._notify(OP_CREATE, user)
+
+    def _update_locked(self, shard: _Shard, user_id: int, name: str,
+                       email: str, expected_version: Optional[int] = None
+                       ) -> Optional[User]:
+        user = shard.users.get(user_id)
+        if user is None:
+            return None
+        self._check_version(user, expected_version)
+        # Swap in a new User rather than changing the shared one, so
+        # lock-free readers and earlier snapshots never see a mix
+        updated = User(user_id, name or user.name, email or user.email,
+                       user.created_ts, user.version + 1)
+        shard.users[user_id] = updated
+        self._notify(OP_UPDATE, updated)
+        return updated
+
+    def _delete_locked(self, shard: _Shard, user_id: int,
+                       expected_version: Optional[int] = None) -> bool:
+        user = shard.users.get(user_id)
+        if user is None:
+            return False
+        self._check_version(user, expected_version)
+        del shard.users[user_id]
+        del shard.ids[bisect_right(shard.ids, user_id) - 1]
+        self._notify(OP_DELETE, user)
+        return True
+
+    def create_user(self, name: str, email: str) -> User:
+        """Create a new user"""
+        user = User(self._allocate_ids(), name, email)
+        shard = self._shard(user.id)
+        with shard.lock:
+            self._insert_locked(shard, user)
+        return user
+
+    def create_users(self, rows: Sequence[Tuple[str, str]]) -> List[User]:
+        """Create several users, locking each shard once"""
+        first = self._allocate_ids(len(rows))
+        users = [User(first + offset, name, email)
+                 for offset, (name, email) in enumerate(rows)]
+        for shard, indexes in self._by_shard([u.id for u in users]).items():
+            with shard.lock:
+                for index in indexes:
+                    self._insert_locked(shard, users[index])
+        return users
+
+    def restore_user(self, user: User):
+        """Insert or replace a user with a known ID (used for recovery)"""
+        shard = self._shard(user.id)
+        with shard.lock:
+            if user.id not in shard.users:
+                insort(shard.ids, user.id)
+            shard.users[user.id] = user
+        with self._id_lock:
+            self.next_id = max(self.next_id, user.id + 1)
+
+    def get_user(self, user_id: int) -> Optional[User]:
+        """Get user by ID"""
+        return self._shard(user_id).users.get(user_id)
+
+    def get_all_users(self) -> List[User]:
+        """Get a snapshot of all users, ordered by ID"""
+        users = []
+        for shard in self._shards:
+            users.extend(shard.users.copy().values())
+        users.sort(key=lambda user: user.id)
+        return users
+
+    def get_users_page(self, after_id: int = 0,
+                       limit: Optional[int] = None) -> List[User]:
+        """Get up to `limit` users with an ID greater than `after_id`"""
+        runs = []
+        for shard in self._shards:
+            with shard.lock:
+                start = bisect_right(shard.ids, after_id)
+                end = len(shard.ids) if limit is None else start + limit
+                runs.append(shard.ids[start:end])
+
+        page = []
+        for user_id in heapq.merge(*runs):
+            user = self.get_user(user_id)
+            if user is not None:
+                page.append(user)
+                if limit is not None and len(page) == limit:
+                    break
+        return page
+
+    def update_user(self, user_id: int, name: str = None,
+                    email: str = None,
+                    expected_version: Optional[int] = None
+                    ) -> Optional[User]:
+        """Update user information"""
+        shard = self._shard(user_id)
+        with shard.lock:
+            return self._update_locked(shard, user_id, name, email,
+                                       expected_version)
+
+    def update_users(self, rows: Sequence[Tuple[int, Optional[str],
+                                                Optional[str]]]
+                     ) -> List[Optional[User]]:
+        """Update several users, locking each shard once"""
+        results: List[Optional[User]] = [None] * len(rows)
+        for shard, indexes in self._by_shard([r[0] for r in rows]).items():
+            with shard.lock:
+                for index in indexes:
+                    results[index] = self._update_locked(shard, *rows[index])
+        return results
+
+    def delete_user(self, user_id: int,
+                    expected_version: Optional[int] = None) -> bool:
+        """Delete user by ID"""
+        shard = self._shard(user_id)
+        with shard.lock:
+            return self._delete_locked(shard, user_id, expected_version)
+
+    def delete_users(self, user_ids: Sequence[int]) -> List[bool]:
+        """Delete several users, locking each shard once"""
+        results = [False] * len(user_ids)
+        for shard, indexes in self._by_shard(user_ids).items():
+            with shard.lock:
+                for index in indexes:
+                    results[index] = self._delete_locked(shard,
+                                                         user_ids[index])
+        return results
+
+    def clear_all(self):
+        """Clear all users (for testing)"""
+        for shard in self._shards:
+            shard.lock.acquire()
+        try:
+            for shard in self._shards:
+                shard.users.clear()
+                shard.ids.clear()
+            with self._id_lock:
+                self.next_id = 1
+            self._notify(OP_CLEAR, None)
+        finally:
+            for shard in self._shards:
+                shard.lock.release()
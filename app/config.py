@@ -6,6 +6,123 @@ class Config:
     DEBUG = False
     TESTING = False
     JSON_SORT_KEYS = False
+    # Largest page GET /api/users will return for a single ?limit= request
+    USERS_MAX_PAGE_SIZE = 1000
+    # Users fetched from the store per step when streaming a listing
+    USERS_STREAM_CHUNK_SIZE = 1000
+    # Rows applied to the store per bulk call by the /users/batch endpoints
+    BATCH_CHUNK_SIZE = 1000
+    # Most sub-requests a single POST /api/batch may carry
+    BATCH_MAX_REQUESTS = 100
+    # Largest record batch POST /api/users/import takes in the columnar
+    # format; a frame declaring more is refused before it is read
+    BULK_MAX_BATCH_BYTES = 16 * 1024 * 1024
+    # 'memory' (one writer at a time, reads from snapshots), 'concurrent'
+    # (lock-striped, thread-safe), 'columnar' (compact parallel arrays,
+    # single-threaded), 'mapped' (served from the memory-mapped
+    # SNAPSHOT_PATH plus an in-memory overlay), 'sqlite' (the SQLITE_PATH
+    # database file) or 'tiered' (most-read users in RAM up to
+    # TIERED_MEMORY_BUDGET, the rest in a spill file)
+    USER_STORE_BACKEND = 'memory'
+    # Number of lock stripes used by the concurrent store
+    USER_STORE_SHARDS = 16
+    # Database file for the sqlite backend, and how many prepared
+    # statements each per-thread connection keeps cached
+    SQLITE_PATH = 'users.db'
+    SQLITE_STATEMENT_CACHE = 64
+    # Bytes of users the tiered backend keeps in RAM (its ID and email
+    # indexes are extra), and its spill file; None for a temporary file.
+    # The spill file starts empty each run: it is not a durable copy
+    TIERED_MEMORY_BUDGET = 64 * 1024 * 1024
+    TIERED_SPILL_PATH = None
+    # Write-ahead log file; None keeps the store purely in memory
+    WAL_PATH = None
+    # When logged writes reach disk: 'always' (group-committed fsync before
+    # each write returns), 'interval' (fsync every WAL_FSYNC_INTERVAL_MS)
+    # or 'os' (flush to the OS, let it decide when to write back)
+    WAL_FSYNC = 'always'
+    WAL_FSYNC_INTERVAL_MS = 10
+    # Set by the prefork launcher (app.prefork) in its workers: the Unix
+    # socket of the process that owns the user store and the key that
+    # authenticates to it. Workers then use that store, not their own
+    SHARED_STORE_SOCKET = None
+    SHARED_STORE_AUTHKEY = None
+    # Compacted snapshot file loaded (or mapped) at startup; with WAL_PATH
+    # set, the log is folded into a new snapshot every SNAPSHOT_INTERVAL_S
+    # seconds once it has grown past SNAPSHOT_MIN_WAL_BYTES
+    SNAPSHOT_PATH = None
+    SNAPSHOT_INTERVAL_S = 60
+    SNAPSHOT_MIN_WAL_BYTES = 64 * 1024 * 1024
+    # JSON encoder used for responses: 'orjson' (C-accelerated, must be
+    # installed), 'stdlib' (Flask's default) or 'auto' (orjson if present)
+    JSON_PROVIDER = 'auto'
+    # Keep each user's encoded JSON between requests, up to JSON_CACHE_SIZE
+    # users; entries are dropped when the user is updated or deleted
+    JSON_CACHE_ENABLED = True
+    JSON_CACHE_SIZE = 100_000
+    # Compress responses of at least COMPRESSION_MIN_BYTES with the best
+    # Accept-Encoding the client offers (zstd and br need the zstandard
+    # and brotli packages); request bodies with a Content-Encoding are
+    # decompressed up to COMPRESSION_MAX_REQUEST_BYTES
+    COMPRESSION_ENABLED = True
+    COMPRESSION_MIN_BYTES = 1024
+    COMPRESSION_LEVEL = 6
+    COMPRESSION_ZSTD_LEVEL = 3
+    COMPRESSION_BROTLI_QUALITY = 4
+    COMPRESSION_MAX_REQUEST_BYTES = 64 * 1024 * 1024
+    # Mutations kept for GET /api/users/changes; older cursors must
+    # resync. Long polls wait at most CHANGE_FEED_MAX_WAIT_S, and
+    # Server-Sent Events streams send a keep-alive comment every
+    # CHANGE_FEED_HEARTBEAT_S while idle
+    CHANGE_FEED_SIZE = 10_000
+    CHANGE_FEED_MAX_WAIT_S = 30
+    CHANGE_FEED_HEARTBEAT_S = 15
+    # Email domains listed by GET /api/users/stats (None for all of them);
+    # with STATS_CHECK set, each call first recounts every user and raises
+    # StatsMismatch if the maintained aggregates disagree (O(n), for tests)
+    STATS_TOP_DOMAINS = 20
+    STATS_CHECK = False
+    # Record request latencies, byte counts and store timings for
+    # GET /api/metrics; METRICS_BUCKETS are the histogram upper bounds in
+    # seconds (None for the defaults in app.metrics)
+    METRICS_ENABLED = True
+    METRICS_BUCKETS = None
+    # Profile PROFILING_SAMPLE_RATE of requests, either with cProfile
+    # ('cprofile') or by sampling their stacks every
+    # PROFILING_SAMPLE_INTERVAL_MS ('sample'); results are served by
+    # GET /api/admin/profile and dropped by DELETE, which both need
+    # PROFILING_ADMIN_TOKEN as a bearer token and refuse everyone while
+    # it is unset
+    PROFILING_ENABLED = False
+    PROFILING_MODE = 'cprofile'
+    PROFILING_SAMPLE_RATE = 0.01
+    PROFILING_SAMPLE_INTERVAL_MS = 5
+    PROFILING_ADMIN_TOKEN = None
+    # Shed load rather than queue it (app.admission). Requests beyond an
+    # adaptive concurrency limit get 503: bulk routes past half of it,
+    # other writes past three quarters, reads past all of it, while health
+    # and metrics are never shed. The limit starts at
+    # ADMISSION_INITIAL_LIMIT and stays between the min and max, shrinking
+    # while reads and writes take longer than ADMISSION_TARGET_LATENCY_MS.
+    # ADMISSION_ROUTE_LIMITS caps the requests in flight on single URL
+    # rules, ADMISSION_ROUTE_CLASSES reclasses them ('critical', 'read',
+    # 'write', 'bulk' or 'stream'). Each client, told apart by the
+    # ADMISSION_CLIENT_HEADER header (e.g. 'X-API-Key') or else by address,
+    # gets ADMISSION_RATE requests per second with bursts of
+    # ADMISSION_BURST (None for no rate limit) before getting 429
+    ADMISSION_ENABLED = False
+    ADMISSION_INITIAL_LIMIT = 32
+    ADMISSION_MIN_LIMIT = 4
+    ADMISSION_MAX_LIMIT = 512
+    ADMISSION_TARGET_LATENCY_MS = 50
+    ADMISSION_ROUTE_LIMITS = {'/api/users/batch': 4, '/api/batch': 4,
+                              '/api/users/import': 2,
+                              '/api/users/export': 2}
+    ADMISSION_ROUTE_CLASSES = {}
+    ADMISSION_RATE = None
+    ADMISSION_BURST = 50
+    ADMISSION_CLIENT_HEADER = None
+    ADMISSION_RETRY_AFTER_S = 1
 
 
 class DevelopmentConfig(Config):
@@ -16,3 +133,4 @@ class DevelopmentConfig(Config):
 class TestingConfig(Config):
     """Testing configuration"""
     TESTING = True
+    STATS_CHECK = True
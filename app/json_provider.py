@@ -0,0 +1,58 @@
+"""JSON providers for the Flask app
+
+`StdlibJSONProvider` is Flask's default provider plus `dumps_bytes`, which
+the serialization cache uses to keep encoded users. `OrjsonProvider` does
+the same work with the C-accelerated orjson package when it is installed.
+"""
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - depends on the environment
+    orjson = None
+
+
+class StdlibJSONProvider(DefaultJSONProvider):
+    """Flask's default JSON provider, able to encode straight to bytes"""
+
+    def dumps_bytes(self, obj) -> bytes:
+        """Serialize obj to UTF-8 encoded JSON"""
+        return self.dumps(obj).encode('utf-8')
+
+
+class OrjsonProvider(StdlibJSONProvider):
+    """JSON provider backed by orjson"""
+
+    def _options(self) -> int:
+        return orjson.OPT_SORT_KEYS if self.sort_keys else 0
+
+    def dumps_bytes(self, obj) -> bytes:
+        """Serialize obj to UTF-8 encoded JSON"""
+        return orjson.dumps(obj, default=self.default, option=self._options())
+
+    def dumps(self, obj, **kwargs) -> str:
+        """Serialize obj to a JSON string"""
+        if kwargs:
+            # Stdlib-only options such as indent for debug responses
+            return super().dumps(obj, **kwargs)
+        return self.dumps_bytes(obj).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        """Deserialize JSON from a string or bytes"""
+        if kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+
+def select_provider(name: str):
+    """Provider class for JSON_PROVIDER: 'auto', 'stdlib' or 'orjson'"""
+    if name == 'stdlib':
+        return StdlibJSONProvider
+    if name == 'orjson':
+        if orjson is None:
+            raise ValueError("JSON_PROVIDER is 'orjson' but orjson is not "
+                             "installed")
+        return OrjsonProvider
+    if name == 'auto':
+        return StdlibJSONProvider if orjson is None else OrjsonProvider
+    raise ValueError(f"Unknown JSON_PROVIDER: {name!r}")
@@ -0,0 +1,345 @@
+"""Request and store instrumentation, exported in Prometheus text format
+
+Every thread records into its own set of counters, registered once on
+its first observation, so the request path takes no locks and never
+loses an increment. `render` merges the per-thread counters when the
+metrics are scraped. The counters of a thread that has ended are folded
+into a single retired set.
+"""
+import threading
+import weakref
+from bisect import bisect_left
+from functools import wraps
+from time import perf_counter
+from typing import Dict, List, Sequence, Tuple
+
+from flask import request
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# WSGI environ key holding the time a request started
+_START_KEY = 'app.metrics.start'
+
+# Upper bounds, in seconds, of the latency histogram buckets
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Store methods timed by `instrument_store`
+STORE_OPERATIONS = ('create_user', 'create_users', 'get_user',
+                    'get_user_by_email', 'get_all_users', 'get_users_page',
+                    'search_users', 'count_users', 'stats',
+                    'update_user', 'update_users', 'delete_user',
+                    'delete_users', 'clear_all')
+
+# cache_stats keys exported by stores that cache users in RAM
+_STORE_CACHE_SERIES = (
+    ('hits', 'counter', 'User reads served from RAM'),
+    ('misses', 'counter', 'User reads that went to disk'),
+    ('evictions', 'counter', 'Users evicted from RAM'),
+    ('spills', 'counter', 'Evicted users written to the spill file'),
+    ('resident_users', 'gauge', 'Users held in RAM'),
+    ('resident_bytes', 'gauge', 'Approximate bytes of users held in RAM'),
+    ('memory_budget', 'gauge', 'Most bytes of users held in RAM'),
+)
+
+
+class _ThreadCounters:
+    """Counters written by a single thread
+
+    A series is a list of per-bucket counts (plus one for +Inf) followed
+    by the sum of observed seconds and two extra counters: request and
+    response bytes for requests, calls' user counts for store operations.
+    """
+
+    __slots__ = ('requests', 'operations', 'store_depth')
+
+    def __init__(self):
+        self.requests: Dict[Tuple[str, str, int], list] = {}
+        self.operations: Dict[str, list] = {}
+        # Nonzero while inside a timed store call, so nested calls (a bulk
+        # method calling the single-row one) are not counted twice
+        self.store_depth = 0
+
+
+class _ThreadMark:
+    """Held only by one thread's thread-local, so dropped when it ends"""
+    __slots__ = ('__weakref__',)
+
+
+def _add_series(into: dict, source: dict):
+    for key, series in source.items():
+        total = into.get(key)
+        if total is None:
+            into[key] = list(series)
+        else:
+            for index, value in enumerate(series):
+                total[index] += value
+
+
+def _retire(counters: _ThreadCounters, threads: List[_ThreadCounters],
+            retired: _ThreadCounters, lock: threading.Lock):
+    with lock:
+        threads.remove(counters)
+        _add_series(retired.requests, counters.requests)
+        _add_series(retired.operations, counters.operations)
+
+
+class Metrics:
+    """Latency histograms and byte counters for requests and the store"""
+
+    def __init__(self, buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self._local = threading.local()
+        self._threads: List[_ThreadCounters] = []
+        # Counts of threads that have ended, folded together
+        self._retired = _ThreadCounters()
+        self._threads_lock = threading.Lock()
+        # The store's cache_stats method, for stores that cache users
+        self.store_cache = None
+        # The admission controller's stats method, when one sheds load
+        self.admission = None
+
+    def _counters(self) -> _ThreadCounters:
+        try:
+            return self._local.counters
+        except AttributeError:
+            counters = self._local.counters = _ThreadCounters()
+            # The thread-local's values go when the thread does; its
+            # counts then move to _retired, so a thread per client does
+            # not grow _threads
+            mark = self._local.mark = _ThreadMark()
+            weakref.finalize(mark, _retire, counters, self._threads,
+                             self._retired, self._threads_lock)
+            with self._threads_lock:
+                self._threads.append(counters)
+            return counters
+
+    def _new_series(self) -> list:
+        return [0] * (len(self.buckets) + 1) + [0.0, 0, 0]
+
+    def observe_request(self, route: str, method: str, status: int,
+                        seconds: float, request_bytes: int,
+                        response_bytes: int):
+        """Record one handled request"""
+        requests = self._counters().requests
+        key = (route, method, status)
+        series = requests.get(key)
+        if series is None:
+            series = requests[key] = self._new_series()
+        series[bisect_left(self.buckets, seconds)] += 1
+        series[-3] += seconds
+        series[-2] += request_bytes
+        series[-1] += response_bytes
+
+    def add_response_bytes(self, route: str, method: str, status: int,
+                           count: int):
+        """Count body bytes of a streamed response once it has been sent"""
+        requests = self._counters().requests
+        series = requests.get((route, method, status))
+        if series is None:
+            series = requests[(route, method, status)] = self._new_series()
+        series[-1] += count
+
+    def observe_operation(self, operation: str, seconds: float, users: int):
+        """Record one store call and how many users it returned or wrote"""
+        operations = self._counters().operations
+        series = operations.get(operation)
+        if series is None:
+            series = operations[operation] = self._new_series()
+        series[bisect_left(self.buckets, seconds)] += 1
+        series[-3] += seconds
+        series[-2] += users
+
+    def timed(self, method, operation: str):
+        """Wrap a store method so its calls are recorded as `operation`
+
+        Only the outermost store call of a thread is recorded.
+        """
+        @wraps(method)
+        def timed(*args, **kwargs):
+            counters = self._counters()
+            if counters.store_depth:
+                return method(*args, **kwargs)
+            counters.store_depth = 1
+            start = perf_counter()
+            try:
+                result = method(*args, **kwargs)
+            finally:
+                counters.store_depth = 0
+            self.observe_operation(operation, perf_counter() - start,
+                                   _count_users(result))
+            return result
+        return timed
+
+    def _merged(self, attribute: str) -> dict:
+        merged = {}
+        # Under the lock, so a thread cannot retire between being read
+        # and having its counts added to _retired
+        with self._threads_lock:
+            _add_series(merged, getattr(self._retired, attribute))
+            for counters in self._threads:
+                # Copy first: the owning thread may add series meanwhile
+                _add_series(merged, dict(getattr(counters, attribute)))
+        return merged
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text exposition format"""
+        lines = []
+        requests = self._merged('requests')
+        self._render_histogram(
+            lines, 'http_request_duration_seconds',
+            'Time spent handling a request, by route, method and status',
+            {_labels(route=route, method=method, status=status): series
+             for (route, method, status), series in sorted(requests.items())})
+        self._render_counter(
+            lines, 'http_request_bytes_total', 'Request body bytes received',
+            {_labels(route=route, method=method, status=status): series[-2]
+             for (route, method, status), series in sorted(requests.items())})
+        self._render_counter(
+            lines, 'http_response_bytes_total', 'Response body bytes sent',
+            {_labels(route=route, method=method, status=status): series[-1]
+             for (route, method, status), series in sorted(requests.items())})
+
+        operations = self._merged('operations')
+        self._render_histogram(
+            lines, 'user_store_operation_seconds',
+            'Time spent in user store calls, by operation',
+            {_labels(operation=name): series
+             for name, series in sorted(operations.items())})
+        self._render_counter(
+            lines, 'user_store_operation_users_total',
+            'Users returned or written by user store calls',
+            {_labels(operation=name): series[-2]
+             for name, series in sorted(operations.items())})
+        if self.store_cache is not None:
+            self._render_store_cache(lines, self.store_cache())
+        if self.admission is not None:
+            self._render_admission(lines, self.admission())
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def _render_store_cache(lines: list, stats: dict):
+        for key, kind, help_text in _STORE_CACHE_SERIES:
+            name = f'user_store_cache_{key}'
+            if kind == 'counter':
+                name += '_total'
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            lines.append(f'{name} {stats[key]}')
+
+    def _render_admission(self, lines: list, stats: dict):
+        for key, help_text in (
+                ('limit', 'Adaptive limit on requests in flight'),
+                ('inflight', 'Requests in flight under the adaptive limit')):
+            name = f'admission_{key}'
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} gauge')
+            lines.append(f'{name} {stats[key]!r}')
+        self._render_counter(
+            lines, 'admission_shed_total',
+            'Requests refused, by reason and priority class',
+            {_labels(reason=reason, priority=priority): count
+             for (reason, priority), count in stats['shed'].items()})
+
+    def _render_histogram(self, lines: list, name: str, help_text: str,
+                          series_by_labels: dict):
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} histogram')
+        bounds = [repr(float(bound)) for bound in self.buckets] + ['+Inf']
+        for labels, series in series_by_labels.items():
+            cumulative = 0
+            for bound, count in zip(bounds, series):
+                cumulative += count
+                lines.append(f'{name}_bucket{{{labels},le="{bound}"}} '
+                             f'{cumulative}')
+            lines.append(f'{name}_sum{{{labels}}} {series[-3]!r}')
+            lines.append(f'{name}_count{{{labels}}} {cumulative}')
+
+    @staticmethod
+    def _render_counter(lines: list, name: str, help_text: str,
+                        values_by_labels: dict):
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} counter')
+        for labels, value in values_by_labels.items():
+            lines.append(f'{name}{{{labels}}} {value}')
+
+
+def _escape(value) -> str:
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def _labels(**labels) -> str:
+    return ','.join(f'{key}="{_escape(value)}"'
+                    for key, value in labels.items())
+
+
+def _count_users(result) -> int:
+    if isinstance(result, list):
+        return len(result)
+    if result is None or result is False:
+        return 0
+    return 1
+
+
+def instrument_store(store, metrics: Metrics):
+    """Time the store's operations by wrapping them on the instance
+
+    The store keeps its class, so callers and isinstance checks are
+    unaffected. Stores with a `cache_stats` method also get their cache
+    counters exported.
+    """
+    for operation in STORE_OPERATIONS:
+        method = getattr(store, operation, None)
+        if method is not None:
+            setattr(store, operation, metrics.timed(method, operation))
+    metrics.store_cache = getattr(store, 'cache_stats', None)
+
+
+def init_app(app, metrics: Metrics):
+    """Record every request handled by app in metrics"""
+
+    # The hooks resolve the request proxy once; every attribute read
+    # through it costs about a microsecond
+
+    @app.before_request
+    def _start_timer():
+        environ = request._get_current_object().environ  # pylint: disable=protected-access
+        environ[_START_KEY] = perf_counter()
+
+    @app.after_request
+    def _record_request(response):
+        req = request._get_current_object()  # pylint: disable=protected-access
+        environ = req.environ
+        start = environ.pop(_START_KEY, None)
+        if start is None:
+            return response
+        rule = req.url_rule
+        route = rule.rule if rule is not None else 'unmatched'
+        status = response.status_code
+        if response.is_streamed:
+            response.response = _counting(response.response, metrics,
+                                          route, req.method, status)
+            body_bytes = 0
+        else:
+            # Cheaper than parsing the Content-Length header back
+            body_bytes = sum(map(len, response.response))
+        metrics.observe_request(route, req.method, status,
+                                perf_counter() - start,
+                                int(environ.get('CONTENT_LENGTH') or 0),
+                                body_bytes)
+        return response
+
+
+def _counting(body, metrics: Metrics, route: str, method: str,
+              status: int):
+    """Pass a streamed body through, counting its encoded bytes"""
+    sent = 0
+    try:
+        for chunk in body:
+            sent += len(chunk.encode() if isinstance(chunk, str) else chunk)
+            yield chunk
+    finally:
+        if hasattr(body, 'close'):
+            body.close()
+        metrics.add_response_bytes(route, method, status, sent)
@@ -1,16 +1,66 @@
 """Data models and in-memory storage"""
+import math
+import secrets
+import threading
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
 from datetime import datetime
-from typing import List, Dict, Optional
+from itertools import islice
+from typing import (Callable, List, Dict, Iterator, Optional, Sequence,
+                    Tuple, Union)
+
+from app.persistent import FrozenSortedMap, SortedMap
+from app.stats import StatsMismatch, UserStats
+
+# Mutation kinds passed to store listeners
+OP_CREATE = 'create'
+OP_UPDATE = 'update'
+OP_DELETE = 'delete'
+OP_CLEAR = 'clear'
+
+
+# Orderings accepted by search_users, each optionally prefixed with '-'
+# for descending order; ties are broken by ID
+SORT_FIELDS = ('id', 'name', 'created_at')
+
+
+class VersionConflict(Exception):
+    """A conditional write expected a different user version"""
+
+
+class DuplicateEmail(Exception):
+    """A write would give two users the same email address"""
 
 
 class User:
-    """User model"""
+    """User model
 
-    def __init__(self, user_id: int, name: str, email: str):
+    The creation time is kept as a float epoch and only formatted when the
+    user is serialized; `__slots__` drops the per-instance `__dict__`.
+    `version` starts at 1 and is bumped by every update.
+    """
+
+    __slots__ = ('id', 'name', 'email', 'created_ts', 'version')
+
+    def __init__(self, user_id: int, name: str, email: str,
+                 created_ts: Optional[float] = None, version: int = 1):
         self.id = user_id
         self.name = name
         self.email = email
-        self.created_at = datetime.now().isoformat()
+        self.created_ts = time.time() if created_ts is None else created_ts
+        self.version = version
+
+    def __reduce__(self):
+        # Half the size and time of pickling the slots one by one; users
+        # are pickled for every call to a shared store
+        return User, (self.id, self.name, self.email, self.created_ts,
+                      self.version)
+
+    @property
+    def created_at(self) -> str:
+        """Creation time as a local ISO 8601 string"""
+        return datetime.fromtimestamp(self.created_ts).isoformat()
 
     def to_dict(self) -> Dict:
         """Convert user to dictionary"""
@@ -22,51 +72,630 @@ class User:
         }
 
 
-class UserStore:
-    """In-memory user storage"""
+def parse_sort(sort: str) -> Tuple[str, bool]:
+    """Split a search ordering into (field, descending)
+
+    Raises ValueError for fields not in SORT_FIELDS.
+    """
+    field = sort[1:] if sort.startswith('-') else sort
+    if field not in SORT_FIELDS:
+        raise ValueError(sort)
+    return field, sort.startswith('-')
+
+
+def sort_key(field: str) -> Callable[[User], tuple]:
+    """Key function ordering users by a SORT_FIELDS field, then ID"""
+    if field == 'name':
+        return lambda user: (user.name, user.id)
+    if field == 'created_at':
+        return lambda user: (user.created_ts, user.id)
+    return lambda user: (user.id,)
+
+
+def prefix_end(prefix: str) -> Optional[str]:
+    """Smallest string sorting after every string starting with prefix
+
+    None if there is no such string (the prefix is all U+10FFFF).
+    """
+    for index in range(len(prefix) - 1, -1, -1):
+        code = ord(prefix[index]) + 1
+        if 0xD800 <= code <= 0xDFFF:
+            code = 0xE000  # surrogates cannot be encoded
+        if code <= 0x10FFFF:
+            return prefix[:index] + chr(code)
+    return None
+
+
+def user_matches(user: User, email: Optional[str] = None,
+                 name_prefix: Optional[str] = None,
+                 created_after: Optional[float] = None) -> bool:
+    """Check a user against the search_users filters"""
+    return ((email is None or user.email == email)
+            and (not name_prefix or user.name.startswith(name_prefix))
+            and (created_after is None or user.created_ts > created_after))
+
+
+def row_result(write, *args):
+    """Run one row of a bulk write, returning DuplicateEmail if raised"""
+    try:
+        return write(*args)
+    except DuplicateEmail as exc:
+        return exc
+
+
+class BaseUserStore(ABC):
+    """Interface every user store implementation provides
+
+    Stores hand out increasing IDs starting at 1 and never reuse one
+    within a store's lifetime (clear_all starts over). `next_id` is the
+    ID the next create will get; recovery code may raise it.
+
+    `version` counts every mutation of the store, and `epoch` is a random
+    token replaced whenever the store starts or is cleared. Together with
+    a user's own version they identify a state that can never recur, so
+    they are safe to use as ETags.
+
+    Listeners registered with `add_listener` are called as
+    `listener(op, user)` after each mutation, while the store still holds
+    whatever lock protects that user, so they observe the mutations of
+    any one user in the order they were applied. `user` is the created,
+    updated or deleted user, or None for OP_CLEAR.
+    """
+
+    next_id: int
+
+    # Whether `transaction` can group writes into one atomic unit
+    supports_transactions = False
+    # Whether calls may block on disk or network I/O, so async callers
+    # should run them off the event loop
+    blocking_io = False
 
     def __init__(self):
+        self._listeners: List[Callable[[str, Optional[User]], None]] = []
+        self._version_lock = threading.Lock()
+        self._version = 0
+        self._epoch = secrets.token_hex(4)
+
+    @property
+    def version(self) -> int:
+        """Number of mutations applied since the store started"""
+        return self._version
+
+    @property
+    def epoch(self) -> str:
+        """Token identifying this run of the store"""
+        return self._epoch
+
+    def add_listener(self, listener: Callable[[str, Optional[User]], None]):
+        """Register a callback to run after every mutation"""
+        self._listeners.append(listener)
+
+    def _notify(self, op: str, user: Optional[User]):
+        with self._version_lock:
+            self._version += 1
+            if op == OP_CLEAR:
+                self._epoch = secrets.token_hex(4)
+        for listener in self._listeners:
+            listener(op, user)
+
+    @contextmanager
+    def transaction(self):
+        """Apply the enclosed writes atomically: all of them or none
+
+        Stores that can undo writes override this and set
+        `supports_transactions`.
+        """
+        raise NotImplementedError(
+            f"{type(self).__name__} does not support transactions")
+        yield  # pylint: disable=unreachable
+
+    @staticmethod
+    def _check_version(user: User, expected_version: Optional[int]):
+        if expected_version is not None and user.version != expected_version:
+            raise VersionConflict(user.id)
+
+    @abstractmethod
+    def create_user(self, name: str, email: str) -> User:
+        """Create a new user"""
+
+    def create_users(self, rows: Sequence[Tuple[str, str]]
+                     ) -> List[Union[User, DuplicateEmail]]:
+        """Create a user for each (name, email) row
+
+        Stores with locks or transactions override the bulk methods to take
+        them once for the whole batch instead of once per row. A row whose
+        email is taken gets the DuplicateEmail error in place of a user.
+        """
+        return [row_result(self.create_user, name, email)
+                for name, email in rows]
+
+    @abstractmethod
+    def restore_user(self, user: User):
+        """Insert or replace a user with a known ID (used for recovery)"""
+
+    @abstractmethod
+    def get_user(self, user_id: int) -> Optional[User]:
+        """Get user by ID"""
+
+    def get_user_by_email(self, email: str) -> Optional[User]:
+        """Get user by email address"""
+        for user in self.iter_users():
+            if user.email == email:
+                return user
+        return None
+
+    def search_users(self, email: Optional[str] = None,
+                     name_prefix: Optional[str] = None,
+                     created_after: Optional[float] = None,
+                     sort: str = 'id', after_id: int = 0,
+                     limit: Optional[int] = None) -> List[User]:
+        """Find users matching every given filter, in `sort` order
+
+        `created_after` is an epoch and excludes that exact time; `sort`
+        is one of SORT_FIELDS, optionally prefixed with '-'. Only users
+        with an ID above `after_id` are considered. This default scans
+        the whole store; stores with indexes override it.
+        """
+        field, descending = parse_sort(sort)
+        users = [user for user in self.iter_users(after_id)
+                 if user_matches(user, email, name_prefix, created_after)]
+        users.sort(key=sort_key(field), reverse=descending)
+        return users if limit is None else users[:limit]
+
+    @abstractmethod
+    def get_all_users(self) -> List[User]:
+        """Get all users, ordered by ID"""
+
+    @abstractmethod
+    def get_users_page(self, after_id: int = 0,
+                       limit: Optional[int] = None) -> List[User]:
+        """Get up to `limit` users with an ID greater than `after_id`"""
+
+    def iter_users(self, after_id: int = 0,
+                   chunk_size: int = 1000) -> Iterator[User]:
+        """Iterate users in ID order, one keyset page at a time
+
+        Only one page is materialized at once, and each page is re-read
+        from the id index, so mutations between pages are tolerated.
+        """
+        while True:
+            page = self.get_users_page(after_id, chunk_size)
+            if not page:
+                return
+            yield from page
+            after_id = page[-1].id
+
+    def snapshot(self):
+        """Read-only view of the store at one point in time
+
+        Every read on the view sees the same state, however long the
+        reads take. This default returns the store itself, so reads see
+        writes as they land; stores that keep old versions override it.
+        """
+        return self
+
+    def count_users(self) -> int:
+        """Number of users"""
+        return len(self.get_all_users())
+
+    def stats(self, top_domains: Optional[int] = None) -> Dict:
+        """User count, most common email domains and creation series
+
+        See UserStats.summary. This default recounts every user; stores
+        that keep the aggregates up to date override it.
+        """
+        return UserStats.of(self.iter_users()).summary(time.time(),
+                                                       top_domains)
+
+    def check_stats(self):
+        """Raise StatsMismatch if maintained aggregates are off
+
+        Compares them with a recount from scratch, so it costs O(n); meant
+        for tests. Stores that count on demand have nothing to check.
+        """
+
+    @abstractmethod
+    def update_user(self, user_id: int, name: str = None,
+                    email: str = None,
+                    expected_version: Optional[int] = None
+                    ) -> Optional[User]:
+        """Update user information, bumping its version
+
+        With expected_version set, raise VersionConflict instead of
+        updating if the user is at a different version.
+        """
+
+    def update_users(self, rows: Sequence[Tuple[int, Optional[str],
+                                                Optional[str]]]
+                     ) -> List[Union[User, None, DuplicateEmail]]:
+        """Apply each (user_id, name, email) update
+
+        Each result is the updated user, None if it was not found, or the
+        DuplicateEmail error if the new email is taken.
+        """
+        return [row_result(self.update_user, user_id, name, email)
+                for user_id, name, email in rows]
+
+    @abstractmethod
+    def delete_user(self, user_id: int,
+                    expected_version: Optional[int] = None) -> bool:
+        """Delete user by ID
+
+        With expected_version set, raise VersionConflict instead of
+        deleting if the user is at a different version.
+        """
+
+    def delete_users(self, user_ids: Sequence[int]) -> List[bool]:
+        """Delete each user ID, reporting which ones existed"""
+        return [self.delete_user(user_id) for user_id in user_ids]
+
+    @abstractmethod
+    def clear_all(self):
+        """Clear all users (for testing)"""
+
+    def close(self):
+        """Release any resources held by the store"""
+
+
+class UserSnapshot:
+    """Read-only view of a UserStore at one point in time
+
+    Holds frozen copies of the store's ordered maps, so it answers the
+    store's reads without taking any lock and keeps returning the same
+    users however long it is used while writers carry on. `version` and
+    `epoch` are the store's as of the snapshot.
+    """
+
+    def __init__(self, by_id: FrozenSortedMap, by_email: FrozenSortedMap,
+                 by_name: FrozenSortedMap, by_created: FrozenSortedMap,
+                 version: int, epoch: str):
+        self._by_id = by_id
+        self._by_email = by_email
+        self._by_name = by_name
+        self._by_created = by_created
+        self.version = version
+        self.epoch = epoch
+
+    def snapshot(self) -> 'UserSnapshot':
+        """The snapshot itself, which never changes"""
+        return self
+
+    def get_user(self, user_id: int) -> Optional[User]:
+        """Get user by ID"""
+        return self._by_id.get(user_id)
+
+    def get_user_by_email(self, email: str) -> Optional[User]:
+        """Get user by email address"""
+        return self._by_email.get(email)
+
+    def count_users(self) -> int:
+        """Number of users"""
+        return len(self._by_id)
+
+    def get_all_users(self) -> List[User]:
+        """Get all users, ordered by ID"""
+        return list(self._by_id.values())
+
+    def get_users_page(self, after_id: int = 0,
+                       limit: Optional[int] = None) -> List[User]:
+        """Get up to `limit` users with an ID greater than `after_id`"""
+        return list(islice(self._by_id.values(after_id + 1), limit))
+
+    def iter_users(self, after_id: int = 0,
+                   chunk_size: int = 1000) -> Iterator[User]:
+        """Iterate users in ID order (chunk_size is accepted and ignored)"""
+        return self._by_id.values(after_id + 1)
+
+    def search_users(self, email: Optional[str] = None,
+                     name_prefix: Optional[str] = None,
+                     created_after: Optional[float] = None,
+                     sort: str = 'id', after_id: int = 0,
+                     limit: Optional[int] = None) -> List[User]:
+        """Find users matching every given filter, in `sort` order
+
+        The most selective filter picks the index to read: email, then
+        name prefix, then creation time, then ID. When that index is
+        already in `sort` order the scan stops after `limit` matches, so
+        a query costs O(log n + k); otherwise the k matches are sorted.
+        """
+        field, descending = parse_sort(sort)
+        if email is not None:
+            user = self._by_email.get(email)
+            driver, rows = 'email', [user] if user else []
+        elif name_prefix:
+            end = prefix_end(name_prefix)
+            driver, rows = 'name', self._by_name.values(
+                (name_prefix,), None if end is None else (end,), descending)
+        elif created_after is not None:
+            driver, rows = 'created_at', self._by_created.values(
+                (created_after, math.inf), None, descending)
+        else:
+            driver, rows = 'id', self._by_id.values(after_id + 1, None,
+                                                    descending)
+
+        matches = (user for user in rows if user.id > after_id
+                   and user_matches(user, email, name_prefix, created_after))
+        if driver != field:
+            matches = sorted(matches, key=sort_key(field),
+                             reverse=descending)
+        return list(islice(matches, limit))
+
+
+class UserStore(BaseUserStore):
+    """In-memory user storage
+
+    Users are kept in a dict for lookups by ID and in copy-on-write
+    sorted maps (see app.persistent) by ID, email, (name, id) and
+    (created_ts, id). `snapshot` freezes those maps in O(1), and listing,
+    paging and search all run against a snapshot, so they see one
+    consistent state and never hold up writers; a snapshot's old map
+    nodes are freed when the last reader drops it. Writes are serialized
+    by a lock.
+
+    The indexes cost more memory than the users they hold: about 555
+    bytes per user at 100k users, against about 309 for the users in a
+    plain dict (benchmarks.memory_layout). The columnar backend is the
+    compact one.
+
+    Inside `transaction` every write also records how to undo itself,
+    and listeners are only told about the writes once it commits.
+    """
+
+    supports_transactions = True
+
+    def __init__(self):
+        super().__init__()
         self.users: Dict[int, User] = {}
+        self._emails: Dict[str, int] = {}
+        self._by_id = SortedMap()
+        self._by_email = SortedMap()
+        self._by_name = SortedMap()
+        self._by_created = SortedMap()
         self.next_id = 1
+        self._stats = UserStats()
+        self._lock = threading.RLock()
+        # Snapshot of the current state, dropped by every write
+        self._snapshot: Optional[UserSnapshot] = None
+        # While a transaction is open: callables undoing its writes, and
+        # the notifications held back until it commits
+        self._undo: Optional[List[Callable[[], None]]] = None
+        self._pending: List[Tuple[str, Optional[User]]] = []
+
+    def _index(self, user: User):
+        """Add or replace a user everywhere (User objects never change)"""
+        self.users[user.id] = user
+        self._emails[user.email] = user.id
+        self._by_id.set(user.id, user)
+        self._by_email.set(user.email, user)
+        self._by_name.set((user.name, user.id), user)
+        self._by_created.set((user.created_ts, user.id), user)
+        self._stats.add(user)
+        self._snapshot = None
+
+    def _unindex(self, user: User):
+        if self._emails.get(user.email) == user.id:
+            del self._emails[user.email]
+            self._by_email.discard(user.email)
+        self._by_name.discard((user.name, user.id))
+        self._by_created.discard((user.created_ts, user.id))
+        self._stats.remove(user)
+        self._snapshot = None
+
+    def _check_email(self, email: str, user_id: Optional[int] = None):
+        owner = self._emails.get(email)
+        if owner is not None and owner != user_id:
+            raise DuplicateEmail(email)
+
+    def snapshot(self) -> UserSnapshot:
+        """Consistent, read-only view of the store as it is now
+
+        Taking one costs O(1) whatever the store size; the same snapshot
+        is handed out again until the next write.
+        """
+        snapshot = self._snapshot
+        if snapshot is None:
+            with self._lock:
+                snapshot = self._snapshot
+                if snapshot is None:
+                    snapshot = self._snapshot = UserSnapshot(
+                        self._by_id.freeze(), self._by_email.freeze(),
+                        self._by_name.freeze(), self._by_created.freeze(),
+                        self._version, self._epoch)
+        return snapshot
+
+    @contextmanager
+    def transaction(self):
+        """Apply the enclosed writes atomically: all of them or none
+
+        If the block raises, its writes are undone in reverse order and
+        no listener ever hears of them. Other threads' writes wait for
+        the transaction to end. Nested calls join the outermost
+        transaction. IDs handed out inside a rolled back transaction are
+        not reused.
+        """
+        with self._lock:
+            if self._undo is not None:
+                yield self
+                return
+            self._undo = []
+            try:
+                yield self
+            except BaseException:
+                for undo in reversed(self._undo):
+                    undo()
+                self._pending.clear()
+                raise
+            finally:
+                self._undo = None
+            pending, self._pending = self._pending, []
+            for op, user in pending:
+                super()._notify(op, user)
+
+    def _notify(self, op: str, user: Optional[User]):
+        if self._undo is None:
+            super()._notify(op, user)
+        else:
+            self._pending.append((op, user))
+
+    def _remove(self, user_id: int):
+        """Drop a user without notifying (undoes a create)"""
+        user = self.users.pop(user_id)
+        self._by_id.discard(user_id)
+        self._unindex(user)
 
     def create_user(self, name: str, email: str) -> User:
         """Create a new user"""
-        user = User(self.next_id, name, email)
-        self.users[self.next_id] = user
-        self.next_id += 1
+        with self._lock:
+            self._check_email(email)
+            user = User(self.next_id, name, email)
+            self._index(user)
+            self.next_id += 1
+            if self._undo is not None:
+                self._undo.append(lambda: self._remove(user.id))
+            self._notify(OP_CREATE, user)
         return user
 
+    def create_users(self, rows: Sequence[Tuple[str, str]]
+                     ) -> List[Union[User, DuplicateEmail]]:
+        """Create several users under one lock acquisition"""
+        with self._lock:
+            return super().create_users(rows)
+
+    def restore_user(self, user: User):
+        """Insert or replace a user with a known ID (used for recovery)"""
+        with self._lock:
+            current = self.users.get(user.id)
+            if current is not None:
+                self._unindex(current)
+            self._index(user)
+            self.next_id = max(self.next_id, user.id + 1)
+
     def get_user(self, user_id: int) -> Optional[User]:
         """Get user by ID"""
         return self.users.get(user_id)
 
+    def get_user_by_email(self, email: str) -> Optional[User]:
+        """Get user by email address, using the email index"""
+        user_id = self._emails.get(email)
+        return None if user_id is None else self.users.get(user_id)
+
+    def count_users(self) -> int:
+        """Number of users"""
+        return len(self.users)
+
+    def stats(self, top_domains: Optional[int] = None) -> Dict:
+        """User count, most common email domains and creation series
+
+        Read from aggregates kept up to date by every write, so the cost
+        does not depend on the number of users.
+        """
+        with self._lock:
+            return self._stats.summary(time.time(), top_domains)
+
+    def check_stats(self):
+        """Raise StatsMismatch if the maintained aggregates are off"""
+        with self._lock:
+            differences = self._stats.differences(
+                UserStats.of(self.users.values()))
+        if differences:
+            raise StatsMismatch(', '.join(differences))
+
     def get_all_users(self) -> List[User]:
-        """Get all users"""
-        return list(self.users.values())
+        """Get all users, ordered by ID"""
+        return self.snapshot().get_all_users()
+
+    def get_users_page(self, after_id: int = 0,
+                       limit: Optional[int] = None) -> List[User]:
+        """Get up to `limit` users with an ID greater than `after_id`"""
+        return self.snapshot().get_users_page(after_id, limit)
+
+    def iter_users(self, after_id: int = 0,
+                   chunk_size: int = 1000) -> Iterator[User]:
+        """Iterate users in ID order, as of when iteration started"""
+        return self.snapshot().iter_users(after_id)
+
+    def search_users(self, email: Optional[str] = None,
+                     name_prefix: Optional[str] = None,
+                     created_after: Optional[float] = None,
+                     sort: str = 'id', after_id: int = 0,
+                     limit: Optional[int] = None) -> List[User]:
+        """Find users matching every given filter, in `sort` order
+
+        Runs on a snapshot; see UserSnapshot.search_users.
+        """
+        return self.snapshot().search_users(email, name_prefix,
+                                            created_after, sort, after_id,
+                                            limit)
 
     def update_user(self, user_id: int, name: str = None,
-                    email: str = None) -> Optional[User]:
-        """Update user information"""
-        user = self.users.get(user_id)
-        if user:
-            if name:
-                user.name = name
+                    email: str = None,
+                    expected_version: Optional[int] = None
+                    ) -> Optional[User]:
+        """Update user information
+
+        The stored User is replaced by a new one rather than changed, so
+        snapshots holding the old one are unaffected.
+        """
+        with self._lock:
+            user = self.users.get(user_id)
+            if user is None:
+                return None
+            self._check_version(user, expected_version)
             if email:
-                user.email = email
-        return user
+                self._check_email(email, user_id)
+            updated = User(user_id, name or user.name, email or user.email,
+                           user.created_ts, user.version + 1)
+            self._unindex(user)
+            self._index(updated)
+            if self._undo is not None:
+                self._undo.append(lambda: self.restore_user(user))
+            self._notify(OP_UPDATE, updated)
+        return updated
+
+    def update_users(self, rows: Sequence[Tuple[int, Optional[str],
+                                                Optional[str]]]
+                     ) -> List[Union[User, None, DuplicateEmail]]:
+        """Apply several updates under one lock acquisition"""
+        with self._lock:
+            return super().update_users(rows)
 
-    def delete_user(self, user_id: int) -> bool:
+    def delete_user(self, user_id: int,
+                    expected_version: Optional[int] = None) -> bool:
         """Delete user by ID"""
-        if user_id in self.users:
-            del self.users[user_id]
-            return True
-        return False
+        with self._lock:
+            user = self.users.get(user_id)
+            if user is None:
+                return False
+            self._check_version(user, expected_version)
+            self._remove(user_id)
+            if self._undo is not None:
+                self._undo.append(lambda: self.restore_user(user))
+            self._notify(OP_DELETE, user)
+        return True
+
+    def delete_users(self, user_ids: Sequence[int]) -> List[bool]:
+        """Delete several users under one lock acquisition"""
+        with self._lock:
+            return super().delete_users(user_ids)
 
     def clear_all(self):
         """Clear all users (for testing)"""
-        self.users.clear()
-        self.next_id = 1
-
+        with self._lock:
+            if self._undo is not None:
+                users, next_id = list(self.users.values()), self.next_id
+                self._undo.append(lambda: self._restore_all(users, next_id))
+            self.users.clear()
+            self._emails.clear()
+            for index in (self._by_id, self._by_email, self._by_name,
+                          self._by_created):
+                index.clear()
+            self._stats = UserStats()
+            self._snapshot = None
+            self.next_id = 1
+            self._notify(OP_CLEAR, None)
 
-# Global store instance
-user_store = UserStore()
+    def _restore_all(self, users: List[User], next_id: int):
+        """Put back the users removed by clear_all (undoes a clear)"""
+        for user in users:
+            self.restore_user(user)
+        self.next_id = next_id
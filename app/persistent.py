@@ -0,0 +1,218 @@
+"""Copy-on-write sorted maps, for point-in-time snapshots
+
+`SortedMap` is a B+ tree whose nodes can be shared between versions.
+`freeze` hands out a read-only `FrozenSortedMap` of the current contents
+in O(1): the view takes the current root, and the map starts a new
+generation. From then on a write copies each node on its path that
+belongs to an older generation instead of changing it, so views never
+see later writes. Nodes made in the current generation are not
+reachable from any view and are changed in place, which keeps a map
+that is rarely frozen about as cheap to update as a plain B+ tree.
+
+Old nodes are ordinary objects: they are freed as soon as the last view
+holding them is dropped.
+"""
+from bisect import bisect_left, bisect_right
+from itertools import chain
+from typing import Any, Iterator, Optional
+
+# Most entries in a leaf, or children in a branch, before it splits
+NODE_SIZE = 64
+
+_MISSING = object()
+
+
+class _Node:
+    """Leaf (keys and values) or branch (lowest key and child per entry)"""
+
+    __slots__ = ('keys', 'values', 'leaf', 'gen')
+
+    def __init__(self, keys: list, values: list, leaf: bool, gen: object):
+        self.keys = keys
+        self.values = values
+        self.leaf = leaf
+        self.gen = gen
+
+
+def _child_index(node: _Node, key) -> int:
+    """Child of a branch that holds key, if anything does"""
+    return max(bisect_right(node.keys, key) - 1, 0)
+
+
+def _leaves(node: _Node, start, reverse: bool) -> Iterator[_Node]:
+    """Leaves in key order (or reversed), from the one holding start on"""
+    if node.leaf:
+        yield node
+        return
+    children = node.values
+    if start is None:
+        first = len(children) - 1 if reverse else 0
+    elif reverse:
+        first = max(bisect_left(node.keys, start) - 1, 0)
+    else:
+        first = _child_index(node, start)
+    yield from _leaves(children[first], start, reverse)
+    rest = range(first - 1, -1, -1) if reverse else \
+        range(first + 1, len(children))
+    for index in rest:
+        yield from _leaves(children[index], None, reverse)
+
+
+def _runs(root: _Node, low, high, reverse: bool) -> Iterator[list]:
+    """Slices of leaf values whose keys lie in [low, high), in order"""
+    if not reverse:
+        for leaf in _leaves(root, low, False):
+            keys = leaf.keys
+            start = 0 if low is None else bisect_left(keys, low)
+            if high is not None and keys and keys[-1] >= high:
+                yield leaf.values[start:bisect_left(keys, high)]
+                return
+            yield leaf.values[start:] if start else leaf.values
+    else:
+        for leaf in _leaves(root, high, True):
+            keys = leaf.keys
+            end = len(keys) if high is None else bisect_left(keys, high)
+            if low is not None and keys and keys[0] < low:
+                yield leaf.values[bisect_left(keys, low):end][::-1]
+                return
+            yield leaf.values[end - 1::-1] if end else []
+
+
+class _SortedMapBase:
+    """Reads shared by the live map and its frozen views"""
+
+    __slots__ = ()
+
+    _root: _Node
+    _len: int
+
+    def __len__(self) -> int:
+        return self._len
+
+    def get(self, key, default: Any = None) -> Any:
+        """Value stored under key, or default"""
+        node = self._root
+        while not node.leaf:
+            node = node.values[_child_index(node, key)]
+        index = bisect_left(node.keys, key)
+        if index < len(node.keys) and node.keys[index] == key:
+            return node.values[index]
+        return default
+
+    def values(self, low=None, high=None,
+               reverse: bool = False) -> Iterator[Any]:
+        """Values whose keys lie in [low, high), in key order
+
+        Either bound may be None for an open end. With `reverse` the
+        same values come out in descending key order.
+        """
+        return chain.from_iterable(_runs(self._root, low, high, reverse))
+
+
+class FrozenSortedMap(_SortedMapBase):
+    """Read-only view of a SortedMap at the moment it was frozen"""
+
+    __slots__ = ('_root', '_len')
+
+    def __init__(self, root: _Node, length: int):
+        self._root = root
+        self._len = length
+
+
+class SortedMap(_SortedMapBase):
+    """Sorted map that can hand out O(1) frozen views of itself
+
+    Keys must be mutually comparable. The map itself is not thread-safe:
+    callers serialize writes, and concurrent readers should read frozen
+    views. Deletes drop emptied nodes but do not merge sparse ones.
+    """
+
+    __slots__ = ('_root', '_len', '_gen')
+
+    def __init__(self):
+        self._gen = object()
+        self._root = _Node([], [], True, self._gen)
+        self._len = 0
+
+    def freeze(self) -> FrozenSortedMap:
+        """Read-only view of the current contents, in O(1)"""
+        view = FrozenSortedMap(self._root, self._len)
+        self._gen = object()
+        return view
+
+    def _own(self, node: _Node) -> _Node:
+        """node itself if this generation made it, else a private copy"""
+        if node.gen is self._gen:
+            return node
+        return _Node(node.keys[:], node.values[:], node.leaf, self._gen)
+
+    def set(self, key, value):
+        """Store value under key, replacing any value already there"""
+        root = self._root = self._own(self._root)
+        sibling = self._insert(root, key, value)
+        if sibling is not None:
+            self._root = _Node([root.keys[0], sibling.keys[0]],
+                               [root, sibling], False, self._gen)
+
+    def _insert(self, node: _Node, key, value) -> Optional[_Node]:
+        """Insert into an owned node, returning its new right sibling if
+        it had to split"""
+        keys, values = node.keys, node.values
+        if node.leaf:
+            index = bisect_left(keys, key)
+            if index < len(keys) and keys[index] == key:
+                values[index] = value
+                return None
+            keys.insert(index, key)
+            values.insert(index, value)
+            self._len += 1
+        else:
+            index = _child_index(node, key)
+            child = values[index] = self._own(values[index])
+            if key < keys[index]:
+                keys[index] = key
+            sibling = self._insert(child, key, value)
+            if sibling is None:
+                return None
+            index += 1
+            keys.insert(index, sibling.keys[0])
+            values.insert(index, sibling)
+        if len(keys) <= NODE_SIZE:
+            return None
+        # Appending (as ascending IDs and timestamps do) splits off just
+        # the new entry, so those nodes end up full rather than half full
+        split = index if index == len(keys) - 1 else len(keys) // 2
+        sibling = _Node(keys[split:], values[split:], node.leaf, self._gen)
+        del keys[split:]
+        del values[split:]
+        return sibling
+
+    def discard(self, key):
+        """Remove key if it is present"""
+        if self.get(key, _MISSING) is _MISSING:
+            return
+        root = self._root = self._own(self._root)
+        self._delete(root, key)
+        while not root.leaf and len(root.values) == 1:
+            root = self._root = root.values[0]
+        if not root.keys:
+            self._root = _Node([], [], True, self._gen)
+
+    def _delete(self, node: _Node, key):
+        if node.leaf:
+            index = bisect_left(node.keys, key)
+            del node.keys[index]
+            del node.values[index]
+            self._len -= 1
+            return
+        index = _child_index(node, key)
+        child = node.values[index] = self._own(node.values[index])
+        self._delete(child, key)
+        if not child.keys:
+            del node.keys[index]
+            del node.values[index]
+
+    def clear(self):
+        """Remove every key; frozen views keep their contents"""
+        self._root = _Node([], [], True, self._gen)
+        self._len = 0
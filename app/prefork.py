@@ -0,0 +1,136 @@
+"""Production server: pre-forked worker processes sharing one user store
+
+The launching process owns the user store and serves it to the workers
+over a Unix socket (see app.shared_store); the workers serve HTTP. They
+all accept from one listening socket, so the kernel spreads connections
+across them, and since every worker reads and writes the owner's store
+they agree on every user, ID, ETag and change feed position.
+"""
+import os
+import secrets
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import time
+import traceback
+
+from flask import Config as FlaskConfig
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+from app import create_app, create_asgi_app
+from app.changefeed import ChangeFeed
+from app.config import Config
+from app.shared_store import StoreServer
+from app.storage import create_store
+
+
+def default_workers() -> int:
+    """One worker per CPU core this process may run on"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+class _RequestHandler(WSGIRequestHandler):
+    """Request handler that logs nothing for successful requests"""
+
+    def log_request(self, code='-', size='-'):
+        if str(code)[0] in '45':
+            super().log_request(code, size)
+
+
+def _run_worker(config_class, listener: socket.socket, asgi: bool):
+    """Serve HTTP on listener until SIGTERM; never returns"""
+    code = 1
+    try:
+        # Only the owner reacts to Ctrl-C; it stops the workers itself
+        os.setpgid(0, 0)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        if asgi:
+            import uvicorn  # pylint: disable=import-outside-toplevel
+            server = uvicorn.Server(uvicorn.Config(
+                create_asgi_app(config_class), log_level='warning'))
+            server.run(sockets=[listener])
+        else:
+            host, port = listener.getsockname()[:2]
+            server = make_server(host, port, create_app(config_class),
+                                 threaded=True,
+                                 request_handler=_RequestHandler,
+                                 fd=listener.fileno())
+            signal.signal(signal.SIGTERM, lambda *_: threading.Thread(
+                target=server.shutdown).start())
+            server.serve_forever()
+        code = 0
+    except BaseException:  # pylint: disable=broad-except
+        traceback.print_exc()
+    finally:
+        # Skip the owner's exit handlers, which this process inherited
+        os._exit(code)  # pylint: disable=protected-access
+
+
+def serve(config_class=Config, host: str = '127.0.0.1', port: int = 5000,
+          workers: int = 0, asgi: bool = False):
+    """Serve the app from `workers` processes until SIGINT or SIGTERM
+
+    `workers` defaults to one per core. The calling process becomes the
+    store owner: it forks the workers first, then builds the store with
+    create_store (so WAL and snapshot settings apply as usual) and
+    serves it. A worker that exits is replaced. With `asgi`, workers run
+    create_asgi_app under uvicorn instead of werkzeug's threaded server.
+    """
+    workers = workers or default_workers()
+    socket_dir = tempfile.mkdtemp(prefix='user-store-')
+    authkey = secrets.token_bytes(32)
+    store_server = StoreServer(os.path.join(socket_dir, 'store.sock'),
+                               authkey)
+    listener = socket.create_server((host, port), backlog=2048)
+
+    class WorkerConfig(config_class):
+        SHARED_STORE_SOCKET = store_server.path
+        SHARED_STORE_AUTHKEY = authkey
+
+    children = {}
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            _run_worker(WorkerConfig, listener, asgi)
+        children[pid] = time.monotonic()
+
+    for _ in range(workers):
+        spawn()
+
+    config = FlaskConfig(os.getcwd())
+    config.from_object(config_class)
+    config['SHARED_STORE_SOCKET'] = None
+    store = create_store(config)
+    change_feed = ChangeFeed(config['CHANGE_FEED_SIZE'])
+    store.add_listener(change_feed.record)
+    store_server.start(store, change_feed)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    print(f"Serving on http://{host}:{listener.getsockname()[1]} "
+          f"with {workers} workers", flush=True)
+    try:
+        while True:
+            pid, _ = os.wait()
+            started = children.pop(pid, None)
+            if started is None:
+                continue
+            if time.monotonic() - started < 1:
+                time.sleep(1)  # failing at startup; don't spin
+            spawn()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+        for pid in children:
+            os.waitpid(pid, 0)
+        store_server.close()
+        listener.close()
+        store.close()
+        shutil.rmtree(socket_dir, ignore_errors=True)
@@ -0,0 +1,180 @@
+"""Sampled request profiling, aggregated by route
+
+A fraction of requests is profiled in one of two modes:
+
+- 'cprofile': a cProfile.Profile runs for the whole request and its
+  stats are merged into the route's pstats, readable as a text report
+  or as a binary dump for pstats/snakeviz.
+- 'sample': a background thread snapshots the stack of every thread
+  serving a sampled request each interval and counts identical stacks,
+  producing collapsed stacks for flamegraph.pl or speedscope.
+
+Requests that are not sampled only pay for one random() call.
+"""
+import cProfile
+import io
+import marshal
+import pstats
+import random
+import sys
+import threading
+from collections import Counter
+from typing import Dict, Optional
+
+from flask import request
+
+MODE_CPROFILE = 'cprofile'
+MODE_SAMPLE = 'sample'
+MODES = (MODE_CPROFILE, MODE_SAMPLE)
+
+# WSGI environ key holding the profiler of a sampled request
+_PROFILE_KEY = 'app.profiling.profile'
+
+
+class RequestProfiler:
+    """Profiles a random `sample_rate` fraction of requests per route"""
+
+    def __init__(self, mode: str = MODE_CPROFILE, sample_rate: float = 0.01,
+                 interval_ms: float = 5):
+        if mode not in MODES:
+            raise ValueError(f"Unknown PROFILING_MODE: {mode!r}")
+        self.mode = mode
+        self.sample_rate = sample_rate
+        self.interval_ms = interval_ms
+        self._lock = threading.Lock()
+        self._stats: Dict[str, pstats.Stats] = {}
+        self._stacks: Dict[str, Counter] = {}
+        self.requests: Counter = Counter()
+        # Threads currently serving a sampled request, and its route
+        self._sampled_threads: Dict[int, str] = {}
+        self._sampler: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    def start(self, route: str):
+        """Maybe start profiling the current request; returns a token"""
+        if random.random() >= self.sample_rate:
+            return None
+        if self.mode == MODE_SAMPLE:
+            self._ensure_sampler()
+            self._sampled_threads[threading.get_ident()] = route
+            return route
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            return None  # another profiler is active on this interpreter
+        return profile
+
+    def finish(self, route: str, token):
+        """Stop profiling a request started with `start`"""
+        if self.mode == MODE_SAMPLE:
+            self._sampled_threads.pop(threading.get_ident(), None)
+            with self._lock:
+                self.requests[route] += 1
+            return
+        token.disable()
+        with self._lock:
+            self.requests[route] += 1
+            stats = self._stats.get(route)
+            if stats is None:
+                self._stats[route] = pstats.Stats(token)
+            else:
+                stats.add(token)
+
+    def _ensure_sampler(self):
+        if self._sampler is not None:
+            return
+        with self._lock:
+            if self._sampler is None:
+                self._sampler = threading.Thread(
+                    target=self._sample_loop, name='stack-sampler',
+                    daemon=True)
+                self._sampler.start()
+
+    def _sample_loop(self):
+        interval = self.interval_ms / 1000
+        while not self._stop.wait(interval):
+            if not self._sampled_threads:
+                continue
+            frames = sys._current_frames()  # pylint: disable=protected-access
+            for thread_id, route in list(self._sampled_threads.items()):
+                frame = frames.get(thread_id)
+                if frame is None:
+                    continue
+                stack = _collapse(frame)
+                with self._lock:
+                    self._stacks.setdefault(route, Counter())[stack] += 1
+
+    def stop(self):
+        """Stop the sampler thread"""
+        self._stop.set()
+        if self._sampler is not None:
+            self._sampler.join()
+
+    def reset(self):
+        """Forget everything collected so far"""
+        with self._lock:
+            self._stats.clear()
+            self._stacks.clear()
+            self.requests.clear()
+
+    def _merged_stats(self, route: Optional[str]) -> pstats.Stats:
+        merged = pstats.Stats(stream=io.StringIO())
+        with self._lock:
+            for name, stats in self._stats.items():
+                if route is None or name == route:
+                    merged.add(stats)
+        return merged
+
+    def pstats_text(self, route: Optional[str] = None,
+                    sort: str = 'cumulative', limit: int = 50) -> str:
+        """Merged stats as a pstats report"""
+        merged = self._merged_stats(route)
+        merged.stream = io.StringIO()
+        merged.sort_stats(sort).print_stats(limit)
+        return merged.stream.getvalue()
+
+    def pstats_dump(self, route: Optional[str] = None) -> bytes:
+        """Merged stats in the format written by pstats.Stats.dump_stats"""
+        return marshal.dumps(self._merged_stats(route).stats)
+
+    def collapsed(self, route: Optional[str] = None) -> str:
+        """Sampled stacks as 'route;frame;...;frame count' lines"""
+        with self._lock:
+            lines = [f'{name};{stack} {count}'
+                     for name, stacks in sorted(self._stacks.items())
+                     if route is None or name == route
+                     for stack, count in stacks.most_common()]
+        return ''.join(line + '\n' for line in lines)
+
+
+def _collapse(frame) -> str:
+    """A stack as root-first frame labels joined by ';'"""
+    labels = []
+    while frame is not None:
+        code = frame.f_code
+        labels.append(f'{code.co_name} ({code.co_filename}:'
+                      f'{code.co_firstlineno})')
+        frame = frame.f_back
+    return ';'.join(reversed(labels))
+
+
+def init_app(app, profiler: RequestProfiler):
+    """Profile a sample of the requests handled by app"""
+
+    @app.before_request
+    def _maybe_profile():
+        req = request._get_current_object()  # pylint: disable=protected-access
+        rule = req.url_rule
+        token = profiler.start(rule.rule if rule is not None else 'unmatched')
+        if token is not None:
+            req.environ[_PROFILE_KEY] = token
+
+    @app.teardown_request
+    def _finish_profile(_exc):
+        req = request._get_current_object()  # pylint: disable=protected-access
+        token = req.environ.pop(_PROFILE_KEY, None)
+        if token is not None:
+            rule = req.url_rule
+            profiler.finish(rule.rule if rule is not None else 'unmatched',
+                            token)
@@ -1,9 +1,34 @@
 """API routes"""
-from flask import Blueprint, request, jsonify
-from app.models import user_store
+import hmac
+import io
+from datetime import datetime
+from itertools import islice
+from typing import Callable, Dict
+from urllib.parse import urlencode
+
+from flask import (Blueprint, Response, current_app, request, jsonify,
+                   stream_with_context)
+from werkzeug.local import LocalProxy
+
+from app import bulk, metrics, profiling, subrequests
+from app.asgi import AsyncStreamResponse
+from app.changefeed import CursorExpired
+from app.models import DuplicateEmail, VersionConflict, parse_sort
+from app.serialization import USER_FIELDS, parse_fields
+
+# The store configured for the current app (see app.storage.create_store)
+user_store = LocalProxy(lambda: current_app.extensions['user_store'])
+# Encoded JSON per user (see app.serialization.UserJSONCache)
+json_cache = LocalProxy(lambda: current_app.extensions['user_json_cache'])
+# Recent mutations (see app.changefeed.ChangeFeed)
+change_feed = LocalProxy(lambda: current_app.extensions['change_feed'])
+# Async adapter of user_store, under ASGI (see app.async_store)
+async_store = LocalProxy(lambda: current_app.extensions['async_user_store'])
 
 api_bp = Blueprint('api', __name__, url_prefix='/api')
 
+NDJSON_MIMETYPE = 'application/x-ndjson'
+
 
 @api_bp.route('/health', methods=['GET'])
 def health_check():
@@ -11,38 +36,334 @@ def health_check():
     return jsonify({"status": "healthy"}), 200
 
 
+@api_bp.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Request and store metrics in Prometheus text format"""
+    app_metrics = current_app.extensions.get('metrics')
+    if app_metrics is None:
+        return jsonify({"error": "Metrics are disabled"}), 404
+    return Response(app_metrics.render(), 200,
+                    content_type=metrics.CONTENT_TYPE)
+
+
+def _profiler_or_refusal():
+    """(profiler, None) for an admin request, else (None, refusal)
+
+    The profile endpoint is closed unless PROFILING_ADMIN_TOKEN is set
+    and the request carries it as a bearer token.
+    """
+    profiler = current_app.extensions.get('profiler')
+    if profiler is None:
+        return None, (jsonify({"error": "Profiling is disabled"}), 404)
+    token = current_app.config['PROFILING_ADMIN_TOKEN']
+    if not token:
+        return None, (jsonify({"error": "Set PROFILING_ADMIN_TOKEN to "
+                                        "read profiles"}), 403)
+    if not hmac.compare_digest(request.headers.get('Authorization', ''),
+                               f'Bearer {token}'):
+        return None, (jsonify({"error": "Forbidden"}), 403)
+    return profiler, None
+
+
+@api_bp.route('/admin/profile', methods=['GET'])
+def get_profile():
+    """Aggregated request profiles
+
+    `format` is 'text' (pstats report), 'pstats' (binary dump for
+    pstats.Stats or snakeviz) or 'collapsed' (stacks for flamegraph
+    tools); `route` narrows to one URL rule.
+    """
+    profiler, refusal = _profiler_or_refusal()
+    if refusal:
+        return refusal
+
+    output = request.args.get('format', 'text')
+    route = request.args.get('route')
+    collapsed = profiler.mode == profiling.MODE_SAMPLE
+    if output == 'collapsed' and collapsed:
+        return Response(profiler.collapsed(route), 200,
+                        mimetype='text/plain')
+    if output == 'text' and not collapsed:
+        try:
+            report = profiler.pstats_text(
+                route, request.args.get('sort', 'cumulative'))
+        except KeyError:
+            return jsonify({"error": "Unknown sort key"}), 400
+        return Response(report, 200, mimetype='text/plain')
+    if output == 'pstats' and not collapsed:
+        response = Response(profiler.pstats_dump(route), 200,
+                            mimetype='application/octet-stream')
+        response.headers['Content-Disposition'] = \
+            'attachment; filename="profile.pstats"'
+        return response
+    expected = 'collapsed' if collapsed else 'text or pstats'
+    return jsonify({"error": f"format must be {expected} in "
+                             f"{profiler.mode} mode"}), 400
+
+
+@api_bp.route('/admin/profile', methods=['DELETE'])
+def reset_profile():
+    """Drop the profiles gathered so far and start over"""
+    profiler, refusal = _profiler_or_refusal()
+    if refusal:
+        return refusal
+    profiler.reset()
+    return '', 204
+
+
+def _user_etag(user_id, version):
+    """Strong ETag for one version of one user"""
+    return f'{user_store.epoch}-{user_id}-{version}'
+
+
+def _store_etag():
+    """Strong ETag covering every user; changes on any mutation"""
+    return f'{user_store.epoch}-{user_store.version}'
+
+
+def _not_modified(etag):
+    """Return a 304 response if the client already has etag, else None"""
+    # Weak comparison, as compressed responses carry weak ETags
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+    return None
+
+
+def _email_taken():
+    return jsonify({"error": "Email already in use"}), 409
+
+
+def _precondition_failed():
+    return jsonify({"error": "Precondition failed: user has changed"}), 412
+
+
+def _precondition_version(user):
+    """Version a write must apply to, per If-Match
+
+    Returns (version, None), where version is None without a pinned
+    If-Match, or (None, error_response) if the user's current ETag does
+    not match.
+    """
+    version = user.version
+    if not request.if_match:
+        return None, None
+    if not request.if_match.contains(_user_etag(user.id, version)):
+        return None, _precondition_failed()
+    return (None if request.if_match.star_tag else version), None
+
+
+def _json_response(data, status=200):
+    """Response for already encoded JSON"""
+    return Response(data, status, mimetype='application/json')
+
+
+def _int_arg(name, minimum=0):
+    """Read an optional integer query parameter, raising ValueError if bad"""
+    raw = request.args.get(name)
+    if raw is None:
+        return None
+    value = int(raw)
+    if value < minimum:
+        raise ValueError(name)
+    return value
+
+
+def _wants_ndjson():
+    """Check whether the client asked for newline-delimited JSON"""
+    if request.args.get('format') == 'ndjson':
+        return True
+    best = request.accept_mimetypes.best_match(
+        ['application/json', NDJSON_MIMETYPE])
+    return best == NDJSON_MIMETYPE
+
+
+def _fields_arg():
+    """Fields asked for with ?fields=, None for all; ValueError if bad"""
+    raw = request.args.get('fields')
+    return None if raw is None else parse_fields(raw)
+
+
+def _bad_fields():
+    return jsonify({"error": "fields must be a comma-separated list of "
+                             + ', '.join(USER_FIELDS)}), 400
+
+
+def _stream_users(after_id, limit, ndjson, fields):
+    """Yield users as NDJSON lines or as pieces of one JSON array"""
+    chunk_size = current_app.config['USERS_STREAM_CHUNK_SIZE']
+    users = user_store.iter_users(after_id, chunk_size)
+    if limit is not None:
+        users = islice(users, limit)
+    if ndjson:
+        return json_cache.iter_lines(users, fields)
+    return json_cache.iter_array(users, fields)
+
+
+# Query parameters that turn a listing into a search
+_SEARCH_ARGS = ('email', 'name_prefix', 'created_after', 'sort')
+
+
+def _search_filters():
+    """Read the search parameters, raising ValueError if one is bad"""
+    filters = {'email': request.args.get('email'),
+               'name_prefix': request.args.get('name_prefix'),
+               'sort': request.args.get('sort', 'id')}
+    parse_sort(filters['sort'])
+    created_after = request.args.get('created_after')
+    if created_after is not None:
+        # created_at is shown rounded to the microsecond; skip every user
+        # whose created_at reads as the given time
+        filters['created_after'] = \
+            datetime.fromisoformat(created_after).timestamp() + 0.5e-6
+    return filters
+
+
+def _set_change_position(response, position):
+    """Tell the client where to follow the change feed from"""
+    epoch, seq = position
+    response.headers['X-Change-Epoch'] = epoch
+    response.headers['X-Change-Seq'] = str(seq)
+
+
 @api_bp.route('/users', methods=['GET'])
 def get_users():
-    """Get all users"""
-    users = user_store.get_all_users()
-    return jsonify([user.to_dict() for user in users]), 200
+    """Get all users, optionally filtered or one keyset page at a time"""
+    try:
+        limit = _int_arg('limit', minimum=1)
+        after_id = _int_arg('after_id') or 0
+    except ValueError:
+        return jsonify({"error": "limit must be a positive integer and "
+                                 "after_id a non-negative integer"}), 400
+    try:
+        fields = _fields_arg()
+    except ValueError:
+        return _bad_fields()
+
+    filters = None
+    if any(name in request.args for name in _SEARCH_ARGS):
+        try:
+            filters = _search_filters()
+        except ValueError:
+            return jsonify({"error": "sort must be one of id, name, "
+                                     "created_at (optionally prefixed with "
+                                     "-) and created_after an ISO 8601 "
+                                     "timestamp"}), 400
+        if after_id and filters['sort'] != 'id':
+            return jsonify({"error": "after_id requires sort=id"}), 400
+
+    if limit is not None:
+        limit = min(limit, current_app.config['USERS_MAX_PAGE_SIZE'])
+
+    # Taken before reading users, so a racing write can only make the
+    # body newer than its ETag and change feed position, never older
+    etag = _store_etag()
+    position = change_feed.position()
+    not_modified = _not_modified(etag)
+    if not_modified:
+        return not_modified
+
+    ndjson = _wants_ndjson()
+    if filters is None and (ndjson or request.args.get('stream', type=int)):
+        mimetype = NDJSON_MIMETYPE if ndjson else 'application/json'
+        body = stream_with_context(_stream_users(after_id, limit, ndjson,
+                                                 fields))
+        response = Response(body, 200, mimetype=mimetype)
+        response.set_etag(etag)
+        _set_change_position(response, position)
+        return response
+
+    if filters is not None:
+        users = user_store.search_users(after_id=after_id, limit=limit,
+                                        **filters)
+    elif limit is None and after_id == 0:
+        users = user_store.get_all_users()
+    else:
+        users = user_store.get_users_page(after_id, limit)
+
+    if ndjson:
+        response = Response(json_cache.iter_lines(users, fields), 200,
+                            mimetype=NDJSON_MIMETYPE)
+    else:
+        response = _json_response(json_cache.list_bytes(users, fields))
+    response.set_etag(etag)
+    _set_change_position(response, position)
+    if (limit is not None and len(users) == limit
+            and (filters is None or filters['sort'] == 'id')):
+        next_after_id = users[-1].id
+        args = request.args.to_dict()
+        args.update(limit=limit, after_id=next_after_id)
+        response.headers['X-Next-After-Id'] = str(next_after_id)
+        response.headers['Link'] = \
+            f'<{request.path}?{urlencode(args)}>; rel="next"'
+    return response, 200
 
 
 @api_bp.route('/users/<int:user_id>', methods=['GET'])
 def get_user(user_id):
     """Get user by ID"""
+    try:
+        fields = _fields_arg()
+    except ValueError:
+        return _bad_fields()
     user = user_store.get_user(user_id)
-    if user:
-        return jsonify(user.to_dict()), 200
-    return jsonify({"error": "User not found"}), 404
+    if not user:
+        return jsonify({"error": "User not found"}), 404
 
+    etag = _user_etag(user.id, user.version)
+    not_modified = _not_modified(etag)
+    if not_modified:
+        return not_modified
 
-@api_bp.route('/users', methods=['POST'])
-def create_user():
-    """Create a new user"""
-    data = request.get_json()
+    response = _json_response(json_cache.user_bytes(user, fields))
+    response.set_etag(etag)
+    return response, 200
 
+
+def _user_response(user, status):
+    """JSON response for one user, tagged with its ETag"""
+    response = _json_response(json_cache.user_bytes(user), status)
+    response.set_etag(_user_etag(user.id, user.version))
+    return response
+
+
+def _parse_new_user(data):
+    """Return ((name, email), None) or (None, error) for a create payload"""
     if not data:
-        return jsonify({"error": "No data provided"}), 400
+        return None, "No data provided"
+    if not isinstance(data, dict):
+        return None, "Expected a JSON object"
 
     name = data.get('name')
     email = data.get('email')
 
     if not name or not email:
-        return jsonify({"error": "Missing required fields: name, email"}), 400
+        return None, "Missing required fields: name, email"
+    return (name, email), None
+
+
+def _parse_user_changes(data):
+    """Return ((name, email), None) or (None, error) for an update payload"""
+    if not data:
+        return None, "No data provided"
+    if not isinstance(data, dict):
+        return None, "Expected a JSON object"
+    return (data.get('name'), data.get('email')), None
 
-    user = user_store.create_user(name, email)
-    return jsonify(user.to_dict()), 201
+
+@api_bp.route('/users', methods=['POST'])
+def create_user():
+    """Create a new user"""
+    fields, error = _parse_new_user(request.get_json())
+    if error:
+        return jsonify({"error": error}), 400
+
+    try:
+        user = user_store.create_user(*fields)
+    except DuplicateEmail:
+        return _email_taken()
+    return _user_response(user, 201)
 
 
 @api_bp.route('/users/<int:user_id>', methods=['PUT'])
@@ -52,21 +373,43 @@ def update_user(user_id):
     if not user:
         return jsonify({"error": "User not found"}), 404
 
-    data = request.get_json()
-    if not data:
-        return jsonify({"error": "No data provided"}), 400
+    expected_version, failed = _precondition_version(user)
+    if failed:
+        return failed
 
-    name = data.get('name')
-    email = data.get('email')
+    changes, error = _parse_user_changes(request.get_json())
+    if error:
+        return jsonify({"error": error}), 400
 
-    updated_user = user_store.update_user(user_id, name, email)
-    return jsonify(updated_user.to_dict()), 200
+    try:
+        updated_user = user_store.update_user(
+            user_id, *changes, expected_version=expected_version)
+    except VersionConflict:
+        return _precondition_failed()
+    except DuplicateEmail:
+        return _email_taken()
+    if not updated_user:
+        return jsonify({"error": "User not found"}), 404
+    return _user_response(updated_user, 200)
 
 
 @api_bp.route('/users/<int:user_id>', methods=['DELETE'])
 def delete_user(user_id):
     """Delete user by ID"""
-    if user_store.delete_user(user_id):
+    expected_version = None
+    if request.if_match:
+        user = user_store.get_user(user_id)
+        if not user:
+            return jsonify({"error": "User not found"}), 404
+        expected_version, failed = _precondition_version(user)
+        if failed:
+            return failed
+
+    try:
+        deleted = user_store.delete_user(user_id, expected_version)
+    except VersionConflict:
+        return _precondition_failed()
+    if deleted:
         return jsonify({"message": "User deleted successfully"}), 200
     return jsonify({"error": "User not found"}), 404
 
@@ -74,5 +417,602 @@ def delete_user(user_id):
 @api_bp.route('/users/count', methods=['GET'])
 def count_users():
     """Get total user count"""
-    count = len(user_store.get_all_users())
-    return jsonify({"total_users": count}), 200
+    etag = _store_etag()
+    not_modified = _not_modified(etag)
+    if not_modified:
+        return not_modified
+
+    count = user_store.count_users()
+    response = jsonify({"total_users": count})
+    response.set_etag(etag)
+    return response, 200
+
+
+@api_bp.route('/users/stats', methods=['GET'])
+def get_user_stats():
+    """Get the user count, top email domains and users created over time
+
+    No ETag: the time series move on with the clock, not just with writes.
+    """
+    if current_app.config['STATS_CHECK']:
+        user_store.check_stats()
+    return jsonify(user_store.stats(
+        current_app.config['STATS_TOP_DOMAINS'])), 200
+
+
+SSE_MIMETYPE = 'text/event-stream'
+
+
+def _resync_required():
+    epoch, seq = change_feed.position()
+    return jsonify({"error": "Cursor is no longer available; re-read "
+                             "GET /api/users and follow from its "
+                             "X-Change-Seq",
+                    "resync": True, "epoch": epoch, "seq": seq}), 410
+
+
+def _sse_cursor():
+    """(epoch, since) from a Last-Event-ID header, or None"""
+    last_event_id = request.headers.get('Last-Event-ID')
+    if not last_event_id:
+        return None
+    epoch, _, seq = last_event_id.rpartition(':')
+    return epoch, int(seq)
+
+
+SSE_KEEP_ALIVE = ': keep-alive\n\n'
+
+
+def _sse_resync(dumps):
+    return f'event: resync\ndata: {dumps({"resync": True})}\n\n'
+
+
+def _sse_event(epoch, change, dumps):
+    return (f'id: {epoch}:{change["seq"]}\nevent: change\n'
+            f'data: {dumps(change)}\n\n')
+
+
+def _sse_changes(feed, dumps, epoch, since, heartbeat_s):
+    """Yield changes as Server-Sent Events until the client goes away"""
+    while True:
+        try:
+            changes = feed.read(since, timeout=heartbeat_s, epoch=epoch)
+        except CursorExpired:
+            yield _sse_resync(dumps)
+            return
+        if not changes:
+            yield SSE_KEEP_ALIVE
+            continue
+        for change in changes:
+            yield _sse_event(feed.epoch, change, dumps)
+        since = changes[-1]['seq']
+        epoch = feed.epoch
+
+
+def _changes_args():
+    """(epoch, since, limit, wait, sse) for a change feed request
+
+    Raises ValueError if a number is bad. For SSE a Last-Event-ID header
+    takes the place of the epoch and since parameters; other requests
+    ignore it.
+    """
+    since = _int_arg('since') or 0
+    limit = _int_arg('limit', minimum=1) or 1000
+    wait = _int_arg('wait') or 0
+    epoch = request.args.get('epoch')
+    limit = min(limit, current_app.config['USERS_MAX_PAGE_SIZE'])
+    wait = min(wait, current_app.config['CHANGE_FEED_MAX_WAIT_S'])
+
+    best = request.accept_mimetypes.best_match(['application/json',
+                                                SSE_MIMETYPE])
+    sse = request.args.get('format') == 'sse' or best == SSE_MIMETYPE
+    if sse:
+        sse_cursor = _sse_cursor()
+        if sse_cursor is not None:
+            epoch, since = sse_cursor
+    return epoch, since, limit, wait, sse
+
+
+def _bad_changes_args():
+    return jsonify({"error": "limit must be a positive integer, since "
+                             "and wait non-negative integers, and "
+                             "Last-Event-ID epoch:seq"}), 400
+
+
+def _changes_response(changes, since):
+    next_since = changes[-1]['seq'] if changes else since
+    return jsonify({"changes": changes, "epoch": change_feed.epoch,
+                    "next_since": next_since}), 200
+
+
+@api_bp.route('/users/changes', methods=['GET'])
+def get_user_changes():
+    """Changes after the `since` cursor, optionally waiting for some
+
+    `wait=N` long-polls up to N seconds for a change; `format=sse` (or
+    `Accept: text/event-stream`) streams changes as Server-Sent Events.
+    Answers 410 with `"resync": true` when the cursor has expired.
+    """
+    try:
+        epoch, since, limit, wait, sse = _changes_args()
+    except ValueError:
+        return _bad_changes_args()
+
+    if sse:
+        body = _sse_changes(change_feed._get_current_object(),
+                            current_app.json.dumps, epoch, since,
+                            current_app.config['CHANGE_FEED_HEARTBEAT_S'])
+        response = Response(body, 200, mimetype=SSE_MIMETYPE)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+
+    try:
+        changes = change_feed.read(since, limit, wait, epoch)
+    except CursorExpired:
+        return _resync_required()
+    return _changes_response(changes, since)
+
+
+def _batch_user_id(row):
+    """Extract the target ID of an update or delete batch row"""
+    user_id = row.get('id') if isinstance(row, dict) else row
+    if isinstance(user_id, int) and not isinstance(user_id, bool):
+        return user_id
+    return None
+
+
+def _parse_batch_update(row):
+    user_id = _batch_user_id(row)
+    if user_id is None:
+        return None, "Missing required field: id"
+    changes, error = _parse_user_changes(row)
+    return (None, error) if error else ((user_id,) + changes, None)
+
+
+def _parse_batch_delete(row):
+    user_id = _batch_user_id(row)
+    if user_id is None:
+        return None, "Missing required field: id"
+    return user_id, None
+
+
+def _batch_write_result(user, status):
+    """Result for one row of a bulk create or update"""
+    if isinstance(user, DuplicateEmail):
+        return {"status": 409, "error": "Email already in use"}
+    if user is None:
+        return {"status": 404, "error": "User not found"}
+    return {"status": status, "user": user.to_dict()}
+
+
+def _apply_batch_create(rows):
+    return [_batch_write_result(user, 201)
+            for user in user_store.create_users(rows)]
+
+
+def _apply_batch_update(rows):
+    return [_batch_write_result(user, 200)
+            for user in user_store.update_users(rows)]
+
+
+def _apply_batch_delete(user_ids):
+    return [{"status": 200} if deleted else
+            {"status": 404, "error": "User not found"}
+            for deleted in user_store.delete_users(user_ids)]
+
+
+# Stands in for an NDJSON line that isn't valid JSON
+_MALFORMED_ROW = object()
+
+
+def _iter_ndjson_body():
+    """Yield each row of an NDJSON request body as it is read"""
+    for line in request.stream:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield current_app.json.loads(line)
+        except ValueError:
+            yield _MALFORMED_ROW
+
+
+def _run_batch(rows, parse, apply):
+    """Validate and apply rows one chunk at a time, yielding row results
+
+    Invalid rows get a 400 result of their own; the valid rows of each
+    chunk go to the store in a single bulk call.
+    """
+    chunk_size = current_app.config['BATCH_CHUNK_SIZE']
+    rows = iter(rows)
+    offset = 0
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            return
+        results = [None] * len(chunk)
+        valid, positions = [], []
+        for position, row in enumerate(chunk):
+            if row is _MALFORMED_ROW:
+                args, error = None, "Malformed JSON"
+            else:
+                args, error = parse(row)
+            if error:
+                results[position] = {"status": 400, "error": error}
+            else:
+                valid.append(args)
+                positions.append(position)
+        for position, result in zip(positions, apply(valid)):
+            results[position] = result
+        for position, result in enumerate(results):
+            yield {"index": offset + position, **result}
+        offset += len(chunk)
+
+
+def _batch(parse, apply):
+    """Run a bulk request and return its per-row results
+
+    NDJSON bodies are parsed and applied incrementally and answered with
+    a streamed NDJSON result per row, as are requests that ask for NDJSON
+    output; a JSON array body gets a JSON array back.
+    """
+    if request.mimetype == NDJSON_MIMETYPE:
+        rows = _iter_ndjson_body()
+    else:
+        rows = request.get_json()
+        if not isinstance(rows, list):
+            return jsonify({"error": "Expected a JSON array or an "
+                                     "NDJSON body"}), 400
+
+    results = _run_batch(rows, parse, apply)
+    if request.mimetype == NDJSON_MIMETYPE or _wants_ndjson():
+        dumps = current_app.json.dumps
+        body = (dumps(result) + '\n' for result in results)
+        return Response(stream_with_context(body), 200,
+                        mimetype=NDJSON_MIMETYPE)
+    return jsonify(list(results)), 200
+
+
+@api_bp.route('/users/batch', methods=['POST'])
+def create_users_batch():
+    """Create many users from a JSON array or NDJSON stream"""
+    return _batch(_parse_new_user, _apply_batch_create)
+
+
+@api_bp.route('/users/batch', methods=['PATCH'])
+def update_users_batch():
+    """Update many users; each row needs an id plus fields to change"""
+    return _batch(_parse_batch_update, _apply_batch_update)
+
+
+@api_bp.route('/users/batch', methods=['DELETE'])
+def delete_users_batch():
+    """Delete many users given as IDs or {"id": ...} objects"""
+    return _batch(_parse_batch_delete, _apply_batch_delete)
+
+
+# Formats of GET /api/users/export by ?format= name
+_EXPORT_FORMATS = {'columnar': bulk.COLUMNAR_MIMETYPE,
+                   'csv': bulk.CSV_MIMETYPE,
+                   'ndjson': NDJSON_MIMETYPE}
+
+
+def _export_format():
+    """Export format asked for with ?format= or Accept; None if unknown"""
+    name = request.args.get('format')
+    if name is not None:
+        return name if name in _EXPORT_FORMATS else None
+    best = request.accept_mimetypes.best_match(list(_EXPORT_FORMATS.values()))
+    for name, mimetype in _EXPORT_FORMATS.items():
+        if mimetype == best:
+            return name
+    return 'columnar'
+
+
+@api_bp.route('/users/export', methods=['GET'])
+def export_users():
+    """Stream every user in the columnar format, CSV or NDJSON
+
+    Users are read from one snapshot of the store and encoded a batch of
+    USERS_STREAM_CHUNK_SIZE at a time; see app.bulk for the formats. The
+    memory, sqlite and tiered backends keep such snapshots; the others
+    page through the live store, so an export taken during writes may
+    mix states from before and after them.
+    """
+    output = _export_format()
+    if output is None:
+        return jsonify({"error": "format must be columnar, csv or "
+                                 "ndjson"}), 400
+    etag = _store_etag()
+    position = change_feed.position()
+    not_modified = _not_modified(etag)
+    if not_modified:
+        return not_modified
+
+    users = user_store.snapshot().iter_users()
+    batch_size = current_app.config['USERS_STREAM_CHUNK_SIZE']
+    if output == 'columnar':
+        body = bulk.iter_columnar(users, batch_size)
+    elif output == 'csv':
+        body = bulk.iter_csv(users, batch_size)
+    else:
+        body = bulk.iter_ndjson(users, batch_size, current_app.json.dumps)
+    response = Response(stream_with_context(body), 200,
+                        mimetype=_EXPORT_FORMATS[output])
+    response.set_etag(etag)
+    _set_change_position(response, position)
+    return response
+
+
+@api_bp.route('/users/import', methods=['POST'])
+def import_users():
+    """Create users in bulk from a columnar, CSV or NDJSON body
+
+    The Content-Type picks the format. Rows go to the store's bulk create
+    a batch at a time as the body is read, and the response only counts
+    created, duplicate and invalid (no name or email) rows instead of
+    reporting on each. Only names and emails are read: IDs, creation
+    times and versions are assigned anew.
+    """
+    mimetype = request.mimetype
+    # The readers take lines and frame headers a few bytes at a time
+    stream = io.BufferedReader(request.stream)
+    if mimetype == bulk.COLUMNAR_MIMETYPE:
+        batches = ((columns.names, columns.emails)
+                   for columns in bulk.read_columnar(
+                       stream, current_app.config['BULK_MAX_BATCH_BYTES']))
+    elif mimetype == bulk.CSV_MIMETYPE:
+        batches = bulk.read_csv(stream,
+                                current_app.config['BATCH_CHUNK_SIZE'])
+    elif mimetype == NDJSON_MIMETYPE:
+        batches = bulk.read_ndjson(stream,
+                                   current_app.config['BATCH_CHUNK_SIZE'],
+                                   current_app.json.loads)
+    else:
+        return jsonify({"error": "Content-Type must be "
+                                 f"{bulk.COLUMNAR_MIMETYPE}, "
+                                 f"{bulk.CSV_MIMETYPE} or "
+                                 f"{NDJSON_MIMETYPE}"}), 415
+
+    counts = {"created": 0, "duplicates": 0, "invalid": 0}
+    try:
+        for names, emails in batches:
+            rows = [(name, email) for name, email in zip(names, emails)
+                    if name and email and isinstance(name, str)
+                    and isinstance(email, str)]
+            counts["invalid"] += len(names) - len(rows)
+            duplicates = sum(isinstance(result, DuplicateEmail)
+                             for result in user_store.create_users(rows))
+            counts["duplicates"] += duplicates
+            counts["created"] += len(rows) - duplicates
+    except bulk.FormatError as exc:
+        return jsonify({"error": str(exc), **counts}), 400
+    return jsonify(counts), 200
+
+
+class _Rollback(Exception):
+    """Aborts an atomic batch after a failed request"""
+
+
+@api_bp.route('/batch', methods=['POST'])
+def run_batch():
+    """Run several API requests in order and return all their results
+
+    The body is {"requests": [{"method", "path", "body", "headers"}],
+    "atomic": false}; only path is required. Requests are dispatched
+    in-process to the same views. With atomic set they run in a single
+    store transaction, which is rolled back, and the remaining requests
+    skipped, as soon as one of them answers with an error status.
+    """
+    data = request.get_json(silent=True)
+    if isinstance(data, list):
+        data = {"requests": data}
+    if not isinstance(data, dict) or not isinstance(data.get('requests'),
+                                                    list):
+        return jsonify({"error": "Expected {\"requests\": [...]}"}), 400
+    if len(data['requests']) > current_app.config['BATCH_MAX_REQUESTS']:
+        return jsonify({"error": "Too many requests in one batch"}), 400
+    try:
+        ops = [subrequests.parse(op) for op in data['requests']]
+    except subrequests.SubrequestError as exc:
+        return jsonify({"error": str(exc)}), 400
+
+    if not data.get('atomic'):
+        return jsonify({"results": [subrequests.run(*op) for op in ops]}), 200
+    if not user_store.supports_transactions:
+        return jsonify({"error": "The configured store does not support "
+                                 "atomic batches"}), 400
+
+    results = []
+    try:
+        with user_store.transaction():
+            for op in ops:
+                results.append(subrequests.run(*op))
+                if results[-1]['status'] >= 400:
+                    raise _Rollback()
+    except _Rollback:
+        skipped = {"status": 424,
+                   "body": {"error": "Not run: an earlier request failed"}}
+        results += [skipped] * (len(ops) - len(results))
+        return jsonify({"results": results, "committed": False}), 200
+    return jsonify({"results": results, "committed": True}), 200
+
+
+# Coroutine versions of routes, used in place of the views above when
+# serving through ASGI (see app.asgi). Each answers exactly like its
+# namesake but goes through the async store, and the change feed ones
+# wait on the event loop rather than in a thread. Routes without one
+# run their regular view.
+
+# Coroutine views by the endpoint they stand in for
+ASYNC_VIEWS: Dict[str, Callable] = {}
+
+
+def _async_view(endpoint: str):
+    """Register a coroutine to serve an api endpoint under ASGI"""
+    def register(view):
+        ASYNC_VIEWS[f'api.{endpoint}'] = view
+        return view
+    return register
+
+
+async def _user_etag_async(user_id, version):
+    return f'{await async_store.epoch()}-{user_id}-{version}'
+
+
+async def _store_etag_async():
+    return f'{await async_store.epoch()}-{await async_store.version()}'
+
+
+async def _user_response_async(user, status):
+    response = _json_response(json_cache.user_bytes(user), status)
+    response.set_etag(await _user_etag_async(user.id, user.version))
+    return response
+
+
+async def _precondition_version_async(user):
+    """Coroutine version of _precondition_version"""
+    if not request.if_match:
+        return None, None
+    etag = await _user_etag_async(user.id, user.version)
+    if not request.if_match.contains(etag):
+        return None, _precondition_failed()
+    return (None if request.if_match.star_tag else user.version), None
+
+
+@_async_view('get_user')
+async def get_user_async(user_id):
+    """Get user by ID"""
+    try:
+        fields = _fields_arg()
+    except ValueError:
+        return _bad_fields()
+    user = await async_store.get_user(user_id)
+    if not user:
+        return jsonify({"error": "User not found"}), 404
+
+    etag = await _user_etag_async(user.id, user.version)
+    not_modified = _not_modified(etag)
+    if not_modified:
+        return not_modified
+
+    response = _json_response(json_cache.user_bytes(user, fields))
+    response.set_etag(etag)
+    return response, 200
+
+
+@_async_view('create_user')
+async def create_user_async():
+    """Create a new user"""
+    fields, error = _parse_new_user(request.get_json())
+    if error:
+        return jsonify({"error": error}), 400
+
+    try:
+        user = await async_store.create_user(*fields)
+    except DuplicateEmail:
+        return _email_taken()
+    return await _user_response_async(user, 201)
+
+
+@_async_view('update_user')
+async def update_user_async(user_id):
+    """Update user information"""
+    user = await async_store.get_user(user_id)
+    if not user:
+        return jsonify({"error": "User not found"}), 404
+
+    expected_version, failed = await _precondition_version_async(user)
+    if failed:
+        return failed
+
+    changes, error = _parse_user_changes(request.get_json())
+    if error:
+        return jsonify({"error": error}), 400
+
+    try:
+        updated_user = await async_store.update_user(
+            user_id, *changes, expected_version=expected_version)
+    except VersionConflict:
+        return _precondition_failed()
+    except DuplicateEmail:
+        return _email_taken()
+    if not updated_user:
+        return jsonify({"error": "User not found"}), 404
+    return await _user_response_async(updated_user, 200)
+
+
+@_async_view('delete_user')
+async def delete_user_async(user_id):
+    """Delete user by ID"""
+    expected_version = None
+    if request.if_match:
+        user = await async_store.get_user(user_id)
+        if not user:
+            return jsonify({"error": "User not found"}), 404
+        expected_version, failed = await _precondition_version_async(user)
+        if failed:
+            return failed
+
+    try:
+        deleted = await async_store.delete_user(user_id, expected_version)
+    except VersionConflict:
+        return _precondition_failed()
+    if deleted:
+        return jsonify({"message": "User deleted successfully"}), 200
+    return jsonify({"error": "User not found"}), 404
+
+
+@_async_view('count_users')
+async def count_users_async():
+    """Get total user count"""
+    etag = await _store_etag_async()
+    not_modified = _not_modified(etag)
+    if not_modified:
+        return not_modified
+
+    count = await async_store.count_users()
+    response = jsonify({"total_users": count})
+    response.set_etag(etag)
+    return response, 200
+
+
+async def _sse_changes_async(feed, dumps, epoch, since, heartbeat_s):
+    """Yield changes as Server-Sent Events until the client goes away"""
+    while True:
+        try:
+            changes = await feed.read_async(since, timeout=heartbeat_s,
+                                            epoch=epoch)
+        except CursorExpired:
+            yield _sse_resync(dumps)
+            return
+        if not changes:
+            yield SSE_KEEP_ALIVE
+            continue
+        for change in changes:
+            yield _sse_event(feed.epoch, change, dumps)
+        since = changes[-1]['seq']
+        epoch = feed.epoch
+
+
+@_async_view('get_user_changes')
+async def get_user_changes_async():
+    """Changes after the `since` cursor, optionally waiting for some"""
+    try:
+        epoch, since, limit, wait, sse = _changes_args()
+    except ValueError:
+        return _bad_changes_args()
+
+    if sse:
+        body = _sse_changes_async(
+            change_feed._get_current_object(), current_app.json.dumps,
+            epoch, since, current_app.config['CHANGE_FEED_HEARTBEAT_S'])
+        response = AsyncStreamResponse(body, 200, mimetype=SSE_MIMETYPE)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+
+    try:
+        changes = await change_feed.read_async(since, limit, wait, epoch)
+    except CursorExpired:
+        return _resync_required()
+    return _changes_response(changes, since)
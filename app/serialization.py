@@ -0,0 +1,124 @@
+"""Encoding users as JSON: cached full documents and field projections"""
+from functools import lru_cache
+from typing import (Callable, Dict, Iterable, Iterator, Optional, Sequence,
+                    Tuple)
+
+from app.models import OP_CLEAR, OP_CREATE, User
+
+# Fields of a serialized user, in output order
+USER_FIELDS = ('id', 'name', 'email', 'created_at')
+
+
+def parse_fields(raw: str) -> Optional[Tuple[str, ...]]:
+    """Turn a ?fields= value into a canonical field tuple
+
+    Fields come back in USER_FIELDS order without duplicates, so every
+    spelling of a field set shares one projection. Returns None when all
+    fields are asked for; raises ValueError on unknown or missing names.
+    """
+    names = {name.strip() for name in raw.split(',') if name.strip()}
+    if not names or not names <= set(USER_FIELDS):
+        raise ValueError(raw)
+    fields = tuple(name for name in USER_FIELDS if name in names)
+    return None if fields == USER_FIELDS else fields
+
+
+@lru_cache(maxsize=None)
+def projection(fields: Tuple[str, ...]) -> Callable[[User], Dict]:
+    """Function building the dict of only `fields` for a user
+
+    The function is generated once per field set, like namedtuple does,
+    so it reads exactly the requested attributes with no per-field loop
+    (and never formats created_at unless asked to). `fields` must come
+    from parse_fields; there are only 15 possible sets.
+    """
+    if not set(fields) <= set(USER_FIELDS):
+        raise ValueError(fields)
+    items = ', '.join(f'{name!r}: user.{name}' for name in fields)
+    namespace = {}
+    exec(f'def project(user):\n    return {{{items}}}\n',  # pylint: disable=exec-used
+         namespace)
+    return namespace['project']
+
+
+class UserJSONCache:
+    """Encoded JSON bytes per user, reused until the user changes
+
+    Entries remember the version and creation time of the user they were
+    encoded from and are only served for that exact user state, so a
+    stale entry never leaks out even when an invalidation is missed (for
+    example a write made by another process sharing a SQLite file).
+    `invalidate` is registered as a store listener to free entries for
+    updated and deleted users straight away. Once `max_entries` is
+    reached the oldest entry is dropped per insert.
+
+    Every method takes an optional `fields` tuple from parse_fields;
+    projections are encoded directly from their compiled projection
+    rather than cached.
+    """
+
+    def __init__(self, encode: Callable[[object], bytes],
+                 max_entries: int = 100_000, enabled: bool = True):
+        self._encode = encode
+        self.max_entries = max_entries
+        self.enabled = enabled
+        self._entries: Dict[int, Tuple[int, float, bytes]] = {}
+
+    def user_bytes(self, user: User,
+                   fields: Optional[Sequence[str]] = None) -> bytes:
+        """Encoded JSON object for one user"""
+        if fields is not None:
+            return self._encode(projection(fields)(user))
+        if not self.enabled:
+            return self._encode(user.to_dict())
+        version, created_ts = user.version, user.created_ts
+        entry = self._entries.get(user.id)
+        if (entry is not None and entry[0] == version
+                and entry[1] == created_ts):
+            return entry[2]
+
+        data = self._encode(user.to_dict())
+        if len(self._entries) >= self.max_entries:
+            try:
+                del self._entries[next(iter(self._entries))]
+            except (KeyError, RuntimeError, StopIteration):
+                pass  # another thread evicted or resized concurrently
+        self._entries[user.id] = (version, created_ts, data)
+        return data
+
+    def list_bytes(self, users: Iterable[User],
+                   fields: Optional[Sequence[str]] = None) -> bytes:
+        """Encoded JSON array of users"""
+        if fields is not None:
+            # One encoder call for the whole list beats joining fragments
+            # when nothing is cached
+            project = projection(fields)
+            return self._encode([project(user) for user in users])
+        return b'[' + b','.join(map(self.user_bytes, users)) + b']'
+
+    def iter_array(self, users: Iterable[User],
+                   fields: Optional[Sequence[str]] = None
+                   ) -> Iterator[bytes]:
+        """Yield a JSON array of users piece by piece"""
+        separator = b'['
+        for user in users:
+            yield separator + self.user_bytes(user, fields)
+            separator = b','
+        yield b'[]' if separator == b'[' else b']'
+
+    def iter_lines(self, users: Iterable[User],
+                   fields: Optional[Sequence[str]] = None
+                   ) -> Iterator[bytes]:
+        """Yield one encoded user per line (NDJSON)"""
+        for user in users:
+            yield self.user_bytes(user, fields) + b'\n'
+
+    def invalidate(self, op: str, user: Optional[User]):
+        """Store listener: forget entries for changed users"""
+        if op == OP_CLEAR:
+            self._entries.clear()
+        elif op != OP_CREATE:
+            self._entries.pop(user.id, None)
+
+    def __len__(self):
+        return len(self._entries)
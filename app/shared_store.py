@@ -0,0 +1,399 @@
+"""One user store shared by several processes over a Unix socket
+
+The process that owns the store runs a `StoreServer`; every other
+process uses a `RemoteUserStore`, which implements the store interface
+by forwarding each call. IDs, versions, the epoch and the change feed
+all come from the owner, so every process sees the same users.
+
+Messages are pickled tuples sent with multiprocessing.connection, which
+frames them and authenticates both ends with a shared key:
+
+    ('call', target, name, args, kwargs)   target is 'store' or 'feed'
+    ('get', target, name)
+    ('set', target, name, value)
+    ('begin',), ('commit',), ('rollback',)
+
+Each is answered with (True, result) or (False, exception), in order.
+"""
+import asyncio
+import os
+import threading
+from contextlib import contextmanager
+from functools import partial
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Connection, Listener
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+from app.changefeed import ChangeFeed
+from app.models import BaseUserStore, DuplicateEmail, User
+
+# Calls and attributes a client may use, per target
+_EXPOSED = {
+    'store': (frozenset(('create_user', 'create_users', 'restore_user',
+                         'get_user', 'get_user_by_email', 'search_users',
+                         'get_all_users', 'get_users_page', 'count_users',
+                         'stats', 'check_stats', 'update_user',
+                         'update_users', 'delete_user', 'delete_users',
+                         'clear_all')),
+              frozenset(('version', 'epoch', 'next_id',
+                         'supports_transactions'))),
+    'feed': (frozenset(('read', 'position')), frozenset(('epoch', 'seq'))),
+}
+_SETTABLE = frozenset(('next_id',))
+
+# Most requests a pipeline writes before reading replies, so that neither
+# side can block writing into a full socket buffer
+PIPELINE_DEPTH = 64
+
+
+class _Rollback(Exception):
+    """Ends a transaction its client rolled back or abandoned"""
+
+
+class StoreServer:
+    """Serves a store and its change feed to other processes
+
+    Binds the Unix socket at `path` straight away, so clients can
+    connect (and queue) before `start` is called with the store. Each
+    connection gets a thread that answers its requests in order; a
+    client may write several requests before reading the replies.
+    A transaction begun on a connection belongs to its thread until it
+    is committed or rolled back, and is rolled back if the connection
+    drops.
+    """
+
+    def __init__(self, path: str, authkey: bytes):
+        self.path = path
+        self.store: Optional[BaseUserStore] = None
+        self.change_feed: Optional[ChangeFeed] = None
+        self._listener = Listener(path, 'AF_UNIX', authkey=authkey)
+        os.chmod(path, 0o600)
+        self._closed = False
+
+    def start(self, store: BaseUserStore, change_feed: ChangeFeed):
+        """Start accepting connections to store and change_feed"""
+        self.store = store
+        self.change_feed = change_feed
+        threading.Thread(target=self._accept_loop, name='store-server',
+                         daemon=True).start()
+
+    def close(self):
+        """Stop accepting connections and remove the socket"""
+        self._closed = True
+        try:
+            # Wake the accept loop so it sees _closed
+            with Client(self.path, 'AF_UNIX'):
+                pass
+        except (OSError, EOFError):
+            pass
+        self._listener.close()
+
+    def _accept_loop(self):
+        while not self._closed:
+            try:
+                conn = self._listener.accept()
+            except (OSError, EOFError, AuthenticationError):
+                continue  # failed the handshake, or the listener closed
+            threading.Thread(target=self._serve, args=(conn,),
+                             daemon=True).start()
+
+    def _serve(self, conn: Connection):
+        transaction = None
+        try:
+            while True:
+                try:
+                    message = conn.recv()
+                except (EOFError, OSError):
+                    return
+                try:
+                    op = message[0]
+                    if op == 'begin':
+                        if transaction is not None:
+                            raise RuntimeError("Transaction already open")
+                        transaction = self.store.transaction()
+                        transaction.__enter__()
+                        reply = (True, None)
+                    elif op in ('commit', 'rollback'):
+                        if transaction is None:
+                            raise RuntimeError("No transaction is open")
+                        current, transaction = transaction, None
+                        if op == 'commit':
+                            current.__exit__(None, None, None)
+                        else:
+                            current.__exit__(_Rollback, _Rollback(), None)
+                        reply = (True, None)
+                    else:
+                        reply = (True, self._apply(*message))
+                except Exception as exc:  # pylint: disable=broad-except
+                    reply = (False, exc)
+                try:
+                    conn.send(reply)
+                except OSError:
+                    return
+                except Exception as exc:  # pylint: disable=broad-except
+                    # The result or error would not pickle
+                    conn.send((False, RuntimeError(repr(exc))))
+        finally:
+            if transaction is not None:
+                transaction.__exit__(_Rollback, _Rollback(), None)
+            conn.close()
+
+    def _apply(self, op: str, target: str, name: str, *args):
+        calls, attributes = _EXPOSED[target]
+        obj = self.store if target == 'store' else self.change_feed
+        if op == 'call' and name in calls:
+            call_args, kwargs = args
+            return getattr(obj, name)(*call_args, **kwargs)
+        if op == 'get' and name in attributes:
+            return getattr(obj, name)
+        if op == 'set' and name in _SETTABLE:
+            setattr(obj, name, args[0])
+            return None
+        raise ValueError(f"{op} {target}.{name} is not allowed")
+
+
+class RemoteUserStore(BaseUserStore):
+    """User store living in another process, served by a StoreServer
+
+    Calls go over a pool of connections, so concurrent threads never
+    wait on each other's round trips; `transaction` pins one connection
+    to the calling thread until it ends. Store errors are raised here as
+    they were raised in the owner.
+
+    Listeners are not called: writes reach the owner from every process,
+    so those of one process would only hear about some of them. Follow
+    `change_feed`, the owner's feed, instead.
+    """
+
+    # Every call is a round trip to another process
+    blocking_io = True
+
+    def __init__(self, path: str, authkey: bytes):
+        super().__init__()
+        self.path = path
+        self._authkey = authkey
+        self._idle: List[Connection] = []
+        self._local = threading.local()
+        self.supports_transactions = self._request(
+            ('get', 'store', 'supports_transactions'))
+        self.change_feed = RemoteChangeFeed(self)
+
+    def _checkout(self) -> Connection:
+        """An idle pooled connection, or a new one"""
+        try:
+            return self._idle.pop()
+        except IndexError:
+            return Client(self.path, 'AF_UNIX', authkey=self._authkey)
+
+    @staticmethod
+    def _exchange(conn: Connection, messages: Sequence[tuple]
+                  ) -> List[tuple]:
+        try:
+            for message in messages:
+                conn.send(message)
+            return [conn.recv() for _ in messages]
+        except (EOFError, OSError) as exc:
+            conn.close()
+            raise ConnectionError("Lost the connection to the shared "
+                                  "user store") from exc
+
+    def _round_trip(self, messages: Sequence[tuple]) -> List[tuple]:
+        """Send messages on this thread's transaction connection, or a
+        pooled one, and return the raw replies"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            return self._exchange(conn, messages)
+        conn = self._checkout()
+        replies = self._exchange(conn, messages)
+        self._idle.append(conn)
+        return replies
+
+    def _request(self, message: tuple):
+        ok, result = self._round_trip((message,))[0]
+        if not ok:
+            raise result
+        return result
+
+    def _call(self, name: str, *args, **kwargs):
+        return self._request(('call', 'store', name, args, kwargs))
+
+    def pipeline(self, calls: Sequence[Tuple[str, tuple]]) -> list:
+        """Results of several (method name, args) store calls
+
+        The requests are written together and the replies read after,
+        so the calls cost about one round trip per PIPELINE_DEPTH. They
+        run one after another in the owner but not atomically. If any
+        raised, the first error is raised once all calls have run.
+        """
+        replies = []
+        for start in range(0, len(calls), PIPELINE_DEPTH):
+            replies += self._round_trip([
+                ('call', 'store', name, tuple(args), {})
+                for name, args in calls[start:start + PIPELINE_DEPTH]])
+        for ok, result in replies:
+            if not ok:
+                raise result
+        return [result for _, result in replies]
+
+    @contextmanager
+    def transaction(self):
+        """Run the enclosed calls in one transaction of the owner's store
+
+        Nested calls join the outermost transaction.
+        """
+        if getattr(self._local, 'conn', None) is not None:
+            yield self
+            return
+        conn = self._local.conn = self._checkout()
+        try:
+            self._request(('begin',))
+            try:
+                yield self
+            except BaseException:
+                self._request(('rollback',))
+                raise
+            self._request(('commit',))
+        finally:
+            self._local.conn = None
+            if not conn.closed:
+                self._idle.append(conn)
+
+    @property
+    def version(self) -> int:
+        """Number of mutations applied to the owner's store"""
+        return self._request(('get', 'store', 'version'))
+
+    @property
+    def epoch(self) -> str:
+        """Token identifying the owner's store since its last clear"""
+        return self._request(('get', 'store', 'epoch'))
+
+    @property
+    def next_id(self) -> int:
+        """ID the next created user will get"""
+        return self._request(('get', 'store', 'next_id'))
+
+    @next_id.setter
+    def next_id(self, value: int):
+        self._request(('set', 'store', 'next_id', value))
+
+    def create_user(self, name: str, email: str) -> User:
+        """Create a new user"""
+        return self._call('create_user', name, email)
+
+    def create_users(self, rows: Sequence[Tuple[str, str]]
+                     ) -> List[Union[User, DuplicateEmail]]:
+        """Create a user for each (name, email) row"""
+        return self._call('create_users', rows)
+
+    def restore_user(self, user: User):
+        """Insert or replace a user with a known ID (used for recovery)"""
+        self._call('restore_user', user)
+
+    def get_user(self, user_id: int) -> Optional[User]:
+        """Get user by ID"""
+        return self._call('get_user', user_id)
+
+    def get_user_by_email(self, email: str) -> Optional[User]:
+        """Get user by email address"""
+        return self._call('get_user_by_email', email)
+
+    def search_users(self, email: Optional[str] = None,
+                     name_prefix: Optional[str] = None,
+                     created_after: Optional[float] = None,
+                     sort: str = 'id', after_id: int = 0,
+                     limit: Optional[int] = None) -> List[User]:
+        """Find users matching every given filter, in `sort` order"""
+        return self._call('search_users', email, name_prefix, created_after,
+                          sort, after_id, limit)
+
+    def get_all_users(self) -> List[User]:
+        """Get all users, ordered by ID"""
+        return self._call('get_all_users')
+
+    def get_users_page(self, after_id: int = 0,
+                       limit: Optional[int] = None) -> List[User]:
+        """Get up to `limit` users with an ID greater than `after_id`"""
+        return self._call('get_users_page', after_id, limit)
+
+    def count_users(self) -> int:
+        """Number of users"""
+        return self._call('count_users')
+
+    def stats(self, top_domains: Optional[int] = None) -> Dict:
+        """User count, most common email domains and creation series"""
+        return self._call('stats', top_domains)
+
+    def check_stats(self):
+        """Raise StatsMismatch if the owner's aggregates are off"""
+        self._call('check_stats')
+
+    def update_user(self, user_id: int, name: str = None,
+                    email: str = None,
+                    expected_version: Optional[int] = None
+                    ) -> Optional[User]:
+        """Update user information, bumping its version"""
+        return self._call('update_user', user_id, name, email,
+                          expected_version)
+
+    def update_users(self, rows: Sequence[Tuple[int, Optional[str],
+                                                Optional[str]]]
+                     ) -> List[Union[User, None, DuplicateEmail]]:
+        """Apply each (user_id, name, email) update"""
+        return self._call('update_users', rows)
+
+    def delete_user(self, user_id: int,
+                    expected_version: Optional[int] = None) -> bool:
+        """Delete user by ID"""
+        return self._call('delete_user', user_id, expected_version)
+
+    def delete_users(self, user_ids: Sequence[int]) -> List[bool]:
+        """Delete each user ID, reporting which ones existed"""
+        return self._call('delete_users', user_ids)
+
+    def clear_all(self):
+        """Clear all users (for testing)"""
+        self._call('clear_all')
+
+    def close(self):
+        """Close the pooled connections"""
+        while self._idle:
+            self._idle.pop().close()
+
+
+class RemoteChangeFeed:
+    """The owner's ChangeFeed, read over a RemoteUserStore's connections
+
+    A long poll holds one pooled connection (and a thread in the owner)
+    while it waits.
+    """
+
+    def __init__(self, store: RemoteUserStore):
+        self._store = store
+
+    @property
+    def epoch(self) -> str:
+        """Epoch of the owner's feed"""
+        return self._store._request(('get', 'feed', 'epoch'))
+
+    @property
+    def seq(self) -> int:
+        """Sequence number of the latest change"""
+        return self._store._request(('get', 'feed', 'seq'))
+
+    def read(self, since: int, limit: int = 1000, timeout: float = 0,
+             epoch: Optional[str] = None) -> List[Dict]:
+        """Changes after `since`, oldest first (see ChangeFeed.read)"""
+        return self._store._request(('call', 'feed', 'read',
+                                     (since, limit, timeout, epoch), {}))
+
+    async def read_async(self, since: int, limit: int = 1000,
+                         timeout: float = 0,
+                         epoch: Optional[str] = None) -> List[Dict]:
+        """Coroutine version of read; waits on a pool thread"""
+        return await asyncio.get_running_loop().run_in_executor(
+            None, partial(self.read, since, limit, timeout, epoch))
+
+    def position(self) -> Tuple[str, int]:
+        """(epoch, seq) to resume from after a full read of the store"""
+        return self._store._request(('call', 'feed', 'position', (), {}))
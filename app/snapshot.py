@@ -0,0 +1,347 @@
+"""Compacted, memory-mappable snapshots of the user store
+
+A snapshot file has a fixed layout so it can be served straight from an
+mmap without decoding it first:
+
+    header   magic, user count, next_id, string heap offset
+    records  one fixed-width record per user, sorted by ID
+    heap     UTF-8 names and emails referenced by the records
+
+Pages are faulted in by the OS the first time a record is touched, so
+opening a snapshot of any size costs the same.
+"""
+import heapq
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+import threading
+from bisect import bisect_left, bisect_right
+from typing import Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+from app.models import (OP_CLEAR, OP_CREATE, OP_DELETE, OP_UPDATE,
+                        BaseUserStore, User)
+
+MAGIC = b'USRSNAP2'
+
+_HEADER = struct.Struct('<8sQQQ')
+# id, created epoch, version, name offset, name length, email offset,
+# email length
+_RECORD = struct.Struct('<qdqQIQI')
+# Records are 48 bytes, i.e. six 8-byte words with the ID in the first
+_RECORD_WORDS = _RECORD.size // 8
+
+
+def write_snapshot(users: Iterable[User], next_id: int, path: str) -> int:
+    """Write users (in ascending ID order) to a snapshot file atomically
+
+    Records and strings are streamed to disk as they are produced, so
+    memory use does not grow with the store. Returns the user count.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    count = 0
+    try:
+        with os.fdopen(fd, 'w+b') as out, tempfile.TemporaryFile() as heap:
+            out.write(b'\0' * _HEADER.size)
+            heap_size = 0
+            for user in users:
+                name = user.name.encode('utf-8')
+                email = user.email.encode('utf-8')
+                out.write(_RECORD.pack(user.id, user.created_ts,
+                                       user.version, heap_size, len(name),
+                                       heap_size + len(name), len(email)))
+                heap.write(name)
+                heap.write(email)
+                heap_size += len(name) + len(email)
+                count += 1
+                next_id = max(next_id, user.id + 1)
+
+            heap_offset = out.tell()
+            heap.seek(0)
+            shutil.copyfileobj(heap, out)
+            out.seek(0)
+            out.write(_HEADER.pack(MAGIC, count, next_id, heap_offset))
+            out.flush()
+            os.fsync(out.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return count
+
+
+class Snapshot:
+    """Read-only, memory-mapped view of a snapshot file"""
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, 'rb') as snapshot_file:
+            self._mmap = mmap.mmap(snapshot_file.fileno(), 0,
+                                   access=mmap.ACCESS_READ)
+        magic, self.count, self.next_id, self._heap_offset = \
+            _HEADER.unpack_from(self._mmap)
+        if magic != MAGIC:
+            self._mmap.close()
+            raise ValueError(f"{path} is not a user snapshot")
+        records = memoryview(self._mmap)[
+            _HEADER.size:_HEADER.size + self.count * _RECORD.size]
+        self._words = records.cast('q')
+        self.ids = _IdColumn(self._words, self.count)
+
+    def find(self, user_id: int) -> int:
+        """Row holding user_id, or -1"""
+        row = bisect_left(self.ids, user_id)
+        if row < self.count and self.ids[row] == user_id:
+            return row
+        return -1
+
+    def user_at(self, row: int) -> User:
+        """Build a User from one record"""
+        (user_id, created_ts, version, name_off, name_len, email_off,
+         email_len) = _RECORD.unpack_from(
+             self._mmap, _HEADER.size + row * _RECORD.size)
+        heap = self._heap_offset
+        name = self._mmap[heap + name_off:heap + name_off + name_len]
+        email = self._mmap[heap + email_off:heap + email_off + email_len]
+        return User(user_id, name.decode('utf-8'), email.decode('utf-8'),
+                    created_ts, version)
+
+    def __iter__(self):
+        return (self.user_at(row) for row in range(self.count))
+
+    def close(self):
+        """Release the mapping"""
+        self.ids = None
+        self._words.release()
+        self._mmap.close()
+
+
+class _IdColumn:
+    """Sequence over the ID word of each record, for bisect"""
+
+    __slots__ = ('_words', '_count')
+
+    def __init__(self, words, count):
+        self._words = words
+        self._count = count
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, row):
+        return self._words[row * _RECORD_WORDS]
+
+
+def load_snapshot(store: BaseUserStore, path: str) -> int:
+    """Rebuild a store from a snapshot, returning the user count"""
+    snapshot = Snapshot(path)
+    try:
+        for user in snapshot:
+            store.restore_user(user)
+        store.next_id = max(store.next_id, snapshot.next_id)
+        return snapshot.count
+    finally:
+        snapshot.close()
+
+
+class MappedUserStore(BaseUserStore):
+    """User storage served from a memory-mapped snapshot plus an overlay
+
+    The snapshot is never modified. Users created or changed since it was
+    taken live in an in-memory overlay, and deleted snapshot users are
+    remembered in a set, so the store is writable while startup only has
+    to map the file. A single lock guards the overlay; it is reentrant so
+    the bulk methods can hold it across a whole batch.
+    """
+
+    def __init__(self, snapshot: Optional[Snapshot] = None):
+        super().__init__()
+        self._snapshot = snapshot
+        self._overlay: Dict[int, User] = {}
+        self._overlay_ids: List[int] = []
+        self._deleted: Set[int] = set()
+        self._lock = threading.RLock()
+        self.next_id = snapshot.next_id if snapshot else 1
+
+    @classmethod
+    def open(cls, path: str) -> 'MappedUserStore':
+        """Map the snapshot at path, or start empty if there is none"""
+        return cls(Snapshot(path) if os.path.exists(path) else None)
+
+    def _snapshot_user(self, user_id: int) -> Optional[User]:
+        if self._snapshot is None or user_id in self._deleted:
+            return None
+        row = self._snapshot.find(user_id)
+        return self._snapshot.user_at(row) if row >= 0 else None
+
+    def _put(self, user: User):
+        if user.id not in self._overlay:
+            self._overlay_ids.insert(
+                bisect_left(self._overlay_ids, user.id), user.id)
+        self._overlay[user.id] = user
+
+    def create_user(self, name: str, email: str) -> User:
+        """Create a new user"""
+        with self._lock:
+            user = User(self.next_id, name, email)
+            self.next_id += 1
+            self._put(user)
+            self._notify(OP_CREATE, user)
+        return user
+
+    def create_users(self, rows: Sequence[Tuple[str, str]]) -> List[User]:
+        """Create several users under one lock acquisition"""
+        with self._lock:
+            return [self.create_user(name, email) for name, email in rows]
+
+    def restore_user(self, user: User):
+        """Insert or replace a user with a known ID (used for recovery)"""
+        with self._lock:
+            self._deleted.discard(user.id)
+            self._put(user)
+            self.next_id = max(self.next_id, user.id + 1)
+
+    def get_user(self, user_id: int) -> Optional[User]:
+        """Get user by ID"""
+        user = self._overlay.get(user_id)
+        if user is not None:
+            return user
+        return self._snapshot_user(user_id)
+
+    def get_all_users(self) -> List[User]:
+        """Get all users"""
+        return self.get_users_page()
+
+    def get_users_page(self, after_id: int = 0,
+                       limit: Optional[int] = None) -> List[User]:
+        """Get up to `limit` users with an ID greater than `after_id`"""
+        with self._lock:
+            start = bisect_right(self._overlay_ids, after_id)
+            end = None if limit is None else start + limit
+            runs = [self._overlay_ids[start:end]]
+        if self._snapshot is not None:
+            runs.append(self._snapshot_ids(after_id))
+
+        page = []
+        last_id = None
+        for user_id in heapq.merge(*runs):
+            if user_id == last_id:
+                continue
+            last_id = user_id
+            user = self.get_user(user_id)
+            if user is not None:
+                page.append(user)
+                if limit is not None and len(page) == limit:
+                    break
+        return page
+
+    def _snapshot_ids(self, after_id: int):
+        ids = self._snapshot.ids
+        for row in range(bisect_right(ids, after_id), len(ids)):
+            yield ids[row]
+
+    def update_user(self, user_id: int, name: str = None,
+                    email: str = None,
+                    expected_version: Optional[int] = None
+                    ) -> Optional[User]:
+        """Update user information"""
+        with self._lock:
+            current = self.get_user(user_id)
+            if current is None:
+                return None
+            self._check_version(current, expected_version)
+            user = User(user_id, name or current.name,
+                        email or current.email, current.created_ts,
+                        current.version + 1)
+            self._put(user)
+            self._notify(OP_UPDATE, user)
+        return user
+
+    def update_users(self, rows: Sequence[Tuple[int, Optional[str],
+                                                Optional[str]]]
+                     ) -> List[Optional[User]]:
+        """Apply several updates under one lock acquisition"""
+        with self._lock:
+            return [self.update_user(*row) for row in rows]
+
+    def delete_user(self, user_id: int,
+                    expected_version: Optional[int] = None) -> bool:
+        """Delete user by ID"""
+        with self._lock:
+            user = self.get_user(user_id)
+            if user is None:
+                return False
+            self._check_version(user, expected_version)
+            if self._overlay.pop(user_id, None) is not None:
+                del self._overlay_ids[bisect_left(self._overlay_ids, user_id)]
+            if self._snapshot_user(user_id) is not None:
+                self._deleted.add(user_id)
+            self._notify(OP_DELETE, user)
+        return True
+
+    def delete_users(self, user_ids: Sequence[int]) -> List[bool]:
+        """Delete several users under one lock acquisition"""
+        with self._lock:
+            return [self.delete_user(user_id) for user_id in user_ids]
+
+    def clear_all(self):
+        """Clear all users (for testing)"""
+        with self._lock:
+            if self._snapshot is not None:
+                self._snapshot.close()
+                self._snapshot = None
+            self._overlay.clear()
+            self._overlay_ids.clear()
+            self._deleted.clear()
+            self.next_id = 1
+            self._notify(OP_CLEAR, None)
+
+    def close(self):
+        """Unmap the snapshot"""
+        with self._lock:
+            if self._snapshot is not None:
+                self._snapshot.close()
+                self._snapshot = None
+
+
+def checkpoint(store, path: str) -> int:
+    """Snapshot a durable store and drop the log segment it replaces
+
+    Returns the number of users written.
+    """
+    store.wal.rotate()
+    count = write_snapshot(store.iter_users(), store.next_id, path)
+    store.wal.drop_previous()
+    return count
+
+
+class Checkpointer:
+    """Background thread that checkpoints once the log grows large enough"""
+
+    def __init__(self, store, path: str, interval_s: float,
+                 min_wal_bytes: int):
+        self.store = store
+        self.path = path
+        self.interval_s = interval_s
+        self.min_wal_bytes = min_wal_bytes
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='checkpointer',
+                                        daemon=True)
+
+    def start(self):
+        """Start checking the log size every interval_s seconds"""
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval_s):
+            if self.store.wal.size() >= self.min_wal_bytes:
+                checkpoint(self.store, self.path)
+
+    def stop(self):
+        """Stop the background thread"""
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
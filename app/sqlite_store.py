@@ -0,0 +1,401 @@
+"""SQLite-backed user storage"""
+import secrets
+import sqlite3
+import threading
+import weakref
+from contextlib import contextmanager
+from typing import Iterator, List, Optional, Sequence, Set, Tuple, Union
+
+from app.models import (OP_CLEAR, OP_CREATE, OP_DELETE, OP_UPDATE,
+                        BaseUserStore, DuplicateEmail, User, parse_sort,
+                        prefix_end, row_result)
+
+_SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS users ('
+    ' id INTEGER PRIMARY KEY AUTOINCREMENT,'
+    ' name TEXT NOT NULL,'
+    ' email TEXT NOT NULL,'
+    ' created_ts REAL NOT NULL,'
+    ' version INTEGER NOT NULL DEFAULT 1)',
+    'CREATE INDEX IF NOT EXISTS idx_users_email ON users (email)',
+    # Every index also holds the rowid, so these serve ORDER BY x, id
+    'CREATE INDEX IF NOT EXISTS idx_users_name ON users (name)',
+    'CREATE INDEX IF NOT EXISTS idx_users_created ON users (created_ts)',
+    # Store-wide version and epoch, shared by every process on the file
+    'CREATE TABLE IF NOT EXISTS store_meta (key TEXT PRIMARY KEY, value)',
+    "INSERT OR IGNORE INTO store_meta VALUES ('version', 0)",
+)
+
+# Statements are kept as constants so sqlite3's per-connection statement
+# cache always hits and each one is only prepared once per connection.
+_COLUMNS = 'id, name, email, created_ts, version'
+_INSERT = 'INSERT INTO users (name, email, created_ts) VALUES (?, ?, ?)'
+_UPSERT = f'INSERT OR REPLACE INTO users ({_COLUMNS}) VALUES (?, ?, ?, ?, ?)'
+_SELECT_ONE = f'SELECT {_COLUMNS} FROM users WHERE id = ?'
+_SELECT_EMAIL = f'SELECT {_COLUMNS} FROM users WHERE email = ? LIMIT 1'
+_EMAIL_OWNER = 'SELECT id FROM users WHERE email = ? AND id != ? LIMIT 1'
+_SELECT_PAGE = (f'SELECT {_COLUMNS} FROM users WHERE id > ? '
+                'ORDER BY id LIMIT ?')
+_UPDATE = ('UPDATE users SET name = COALESCE(?, name), '
+           'email = COALESCE(?, email), version = version + 1 WHERE id = ?')
+_DELETE = 'DELETE FROM users WHERE id = ?'
+_SEQUENCE = "SELECT seq FROM sqlite_sequence WHERE name = 'users'"
+_SET_SEQUENCE = "UPDATE sqlite_sequence SET seq = ? WHERE name = 'users'"
+_INIT_SEQUENCE = "INSERT INTO sqlite_sequence (name, seq) VALUES ('users', ?)"
+_GET_META = 'SELECT value FROM store_meta WHERE key = ?'
+_BUMP_VERSION = ("UPDATE store_meta SET value = value + ? "
+                 "WHERE key = 'version'")
+_SET_EPOCH = "INSERT OR REPLACE INTO store_meta VALUES ('epoch', ?)"
+_ORDER_BY = {'id': 'id', 'name': 'name, id', 'created_at': 'created_ts, id'}
+
+
+def _to_user(row) -> Optional[User]:
+    return User(*row) if row else None
+
+
+class _ThreadMark:
+    """Held only by one thread's thread-local, so dropped when it ends"""
+    __slots__ = ('__weakref__',)
+
+
+def _close_connection(conn: sqlite3.Connection,
+                      connections: Set[sqlite3.Connection],
+                      lock: threading.Lock):
+    with lock:
+        connections.discard(conn)
+    conn.close()
+
+
+class SQLiteSnapshot:
+    """Read-only view of a SQLite store at one point in time
+
+    Holds its own connection with a read transaction open, so in WAL mode
+    every read sees the database as of the first one while writers carry
+    on. The connection, and with it the transaction, is closed when the
+    view is garbage collected; until then the WAL cannot be checkpointed
+    past that point, so views are meant to be short-lived.
+    """
+
+    def __init__(self, path: str):
+        conn = sqlite3.connect(path, isolation_level=None,
+                               check_same_thread=False)
+        weakref.finalize(self, conn.close)
+        self._conn = conn
+        conn.execute('BEGIN')
+        # The first read fixes the state the transaction sees
+        self.version = conn.execute(_GET_META, ('version',)).fetchone()[0]
+        self.epoch = conn.execute(_GET_META, ('epoch',)).fetchone()[0]
+
+    def snapshot(self) -> 'SQLiteSnapshot':
+        """The snapshot itself, which never changes"""
+        return self
+
+    def get_user(self, user_id: int) -> Optional[User]:
+        """Get user by ID"""
+        return _to_user(self._conn.execute(_SELECT_ONE,
+                                           (user_id,)).fetchone())
+
+    def count_users(self) -> int:
+        """Number of users"""
+        return self._conn.execute('SELECT COUNT(*) FROM users').fetchone()[0]
+
+    def get_all_users(self) -> List[User]:
+        """Get all users, ordered by ID"""
+        return self.get_users_page()
+
+    def get_users_page(self, after_id: int = 0,
+                       limit: Optional[int] = None) -> List[User]:
+        """Get up to `limit` users with an ID greater than `after_id`"""
+        rows = self._conn.execute(
+            _SELECT_PAGE, (after_id, -1 if limit is None else limit))
+        return [User(*row) for row in rows]
+
+    def iter_users(self, after_id: int = 0,
+                   chunk_size: int = 1000) -> Iterator[User]:
+        """Iterate users in ID order, fetching chunk_size rows at a time"""
+        cursor = self._conn.execute(_SELECT_PAGE, (after_id, -1))
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                return
+            for row in rows:
+                yield User(*row)
+
+
+class SQLiteUserStore(BaseUserStore):
+    """User storage in a SQLite database file
+
+    Each thread gets its own connection, opened on first use and closed
+    when the thread ends, so request threads never share or wait on a
+    connection, and a server starting a thread per client does not pile
+    up connections. The database runs in WAL journal mode so readers are
+    not blocked by the single writer. Writes go through `transaction`, which
+    takes the write lock once (BEGIN IMMEDIATE) and can wrap any number
+    of operations in one commit.
+    """
+
+    supports_transactions = True
+    blocking_io = True
+
+    def __init__(self, path: str, statement_cache_size: int = 64):
+        super().__init__()
+        if path == ':memory:' or 'mode=memory' in path:
+            raise ValueError("SQLiteUserStore needs a database file; "
+                             "in-memory databases are per connection")
+        self.path = path
+        self.statement_cache_size = statement_cache_size
+        self._local = threading.local()
+        self._connections: Set[sqlite3.Connection] = set()
+        self._pool_lock = threading.Lock()
+        self._commit_lock = threading.Lock()
+        with self.transaction() as conn:
+            columns = [row[1] for row in
+                       conn.execute('PRAGMA table_info(users)')]
+            if columns and 'version' not in columns:
+                conn.execute('ALTER TABLE users ADD COLUMN '
+                             'version INTEGER NOT NULL DEFAULT 1')
+            for statement in _SCHEMA:
+                conn.execute(statement)
+            if conn.execute(_GET_META, ('epoch',)).fetchone() is None:
+                conn.execute(_SET_EPOCH, (secrets.token_hex(4),))
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # Only this thread uses the connection, but close() may run
+            # on another one
+            conn = sqlite3.connect(
+                self.path, isolation_level=None, check_same_thread=False,
+                cached_statements=self.statement_cache_size)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.depth = 0
+            self._local.pending = []
+            # The thread-local's values go when the thread does, and the
+            # connection with them
+            mark = self._local.mark = _ThreadMark()
+            weakref.finalize(mark, _close_connection, conn,
+                             self._connections, self._pool_lock)
+            with self._pool_lock:
+                self._connections.add(conn)
+        return conn
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        """Run the enclosed operations in one write transaction
+
+        Nested calls join the outermost transaction. Listeners are told
+        about the changes once they have committed, so other connections
+        already see them, and not at all if the transaction rolls back or
+        fails to commit. A lock held from COMMIT until they are told keeps
+        the notifications of successive transactions in commit order.
+        """
+        conn = self._conn()
+        local = self._local
+        if local.depth:
+            local.depth += 1
+            try:
+                yield conn
+            finally:
+                local.depth -= 1
+            return
+
+        conn.execute('BEGIN IMMEDIATE')
+        local.depth = 1
+        committed = False
+        try:
+            yield conn
+            pending = local.pending
+            if pending:
+                conn.execute(_BUMP_VERSION, (len(pending),))
+                if any(op == OP_CLEAR for op, _ in pending):
+                    conn.execute(_SET_EPOCH, (secrets.token_hex(4),))
+            with self._commit_lock:
+                conn.execute('COMMIT')
+                committed = True
+                for op, user in pending:
+                    self._notify(op, user)
+        except BaseException:
+            if not committed:
+                conn.execute('ROLLBACK')
+            raise
+        finally:
+            local.depth = 0
+            local.pending = []
+
+    def _defer_notify(self, op: str, user: Optional[User]):
+        self._local.pending.append((op, user))
+
+    @property
+    def version(self) -> int:
+        """Number of mutations committed to the database"""
+        return self._conn().execute(_GET_META, ('version',)).fetchone()[0]
+
+    @property
+    def epoch(self) -> str:
+        """Token identifying the database contents since the last clear"""
+        return self._conn().execute(_GET_META, ('epoch',)).fetchone()[0]
+
+    @property
+    def next_id(self) -> int:
+        """ID the next created user will get"""
+        row = self._conn().execute(_SEQUENCE).fetchone()
+        return (row[0] if row else 0) + 1
+
+    @next_id.setter
+    def next_id(self, value: int):
+        with self.transaction() as conn:
+            if conn.execute(_SET_SEQUENCE, (value - 1,)).rowcount == 0:
+                conn.execute(_INIT_SEQUENCE, (value - 1,))
+
+    @staticmethod
+    def _check_email(conn: sqlite3.Connection, email: str, user_id: int = 0):
+        # Runs inside the write transaction, so no other writer can claim
+        # the address between this check and the write
+        if conn.execute(_EMAIL_OWNER, (email, user_id)).fetchone():
+            raise DuplicateEmail(email)
+
+    def create_user(self, name: str, email: str) -> User:
+        """Create a new user"""
+        with self.transaction() as conn:
+            self._check_email(conn, email)
+            user = User(0, name, email)
+            user.id = conn.execute(
+                _INSERT, (name, email, user.created_ts)).lastrowid
+            self._defer_notify(OP_CREATE, user)
+        return user
+
+    def create_users(self, rows: Sequence[Tuple[str, str]]
+                     ) -> List[Union[User, DuplicateEmail]]:
+        """Create several users in one transaction"""
+        with self.transaction():
+            return [row_result(self.create_user, name, email)
+                    for name, email in rows]
+
+    def restore_user(self, user: User):
+        """Insert or replace a user with a known ID (used for recovery)"""
+        with self.transaction() as conn:
+            conn.execute(_UPSERT, (user.id, user.name, user.email,
+                                   user.created_ts, user.version))
+
+    def snapshot(self) -> SQLiteSnapshot:
+        """Read-only view of the database at this point in time
+
+        It reads through a connection of its own, kept in one read
+        transaction for as long as the view is referenced.
+        """
+        return SQLiteSnapshot(self.path)
+
+    def get_user(self, user_id: int) -> Optional[User]:
+        """Get user by ID"""
+        return _to_user(self._conn().execute(_SELECT_ONE,
+                                             (user_id,)).fetchone())
+
+    def get_user_by_email(self, email: str) -> Optional[User]:
+        """Get user by email address, using the email index"""
+        return _to_user(self._conn().execute(_SELECT_EMAIL,
+                                             (email,)).fetchone())
+
+    def get_all_users(self) -> List[User]:
+        """Get all users, ordered by ID"""
+        return self.get_users_page()
+
+    def get_users_page(self, after_id: int = 0,
+                       limit: Optional[int] = None) -> List[User]:
+        """Get up to `limit` users with an ID greater than `after_id`"""
+        rows = self._conn().execute(
+            _SELECT_PAGE, (after_id, -1 if limit is None else limit))
+        return [User(*row) for row in rows]
+
+    def search_users(self, email: Optional[str] = None,
+                     name_prefix: Optional[str] = None,
+                     created_after: Optional[float] = None,
+                     sort: str = 'id', after_id: int = 0,
+                     limit: Optional[int] = None) -> List[User]:
+        """Find users matching every given filter, in `sort` order
+
+        Filters become indexed range conditions, so SQLite can read the
+        email, name or created_ts index instead of scanning the table.
+        """
+        field, descending = parse_sort(sort)
+        clauses, params = ['id > ?'], [after_id]
+        if email is not None:
+            clauses.append('email = ?')
+            params.append(email)
+        if name_prefix:
+            clauses.append('name >= ?')
+            params.append(name_prefix)
+            end = prefix_end(name_prefix)
+            if end is not None:
+                clauses.append('name < ?')
+                params.append(end)
+        if created_after is not None:
+            clauses.append('created_ts > ?')
+            params.append(created_after)
+        order = _ORDER_BY[field]
+        if descending:
+            order = order.replace(',', ' DESC,') + ' DESC'
+        params.append(-1 if limit is None else limit)
+        rows = self._conn().execute(
+            f'SELECT {_COLUMNS} FROM users WHERE {" AND ".join(clauses)} '
+            f'ORDER BY {order} LIMIT ?', params)
+        return [User(*row) for row in rows]
+
+    def update_user(self, user_id: int, name: str = None,
+                    email: str = None,
+                    expected_version: Optional[int] = None
+                    ) -> Optional[User]:
+        """Update user information"""
+        with self.transaction() as conn:
+            current = _to_user(conn.execute(_SELECT_ONE,
+                                            (user_id,)).fetchone())
+            if current is None:
+                return None
+            self._check_version(current, expected_version)
+            if email:
+                self._check_email(conn, email, user_id)
+            conn.execute(_UPDATE, (name or None, email or None, user_id))
+            user = _to_user(conn.execute(_SELECT_ONE, (user_id,)).fetchone())
+            self._defer_notify(OP_UPDATE, user)
+        return user
+
+    def update_users(self, rows: Sequence[Tuple[int, Optional[str],
+                                                Optional[str]]]
+                     ) -> List[Union[User, None, DuplicateEmail]]:
+        """Apply several updates in one transaction"""
+        with self.transaction():
+            return [row_result(self.update_user, *row) for row in rows]
+
+    def delete_user(self, user_id: int,
+                    expected_version: Optional[int] = None) -> bool:
+        """Delete user by ID"""
+        with self.transaction() as conn:
+            user = _to_user(conn.execute(_SELECT_ONE, (user_id,)).fetchone())
+            if user is None:
+                return False
+            self._check_version(user, expected_version)
+            conn.execute(_DELETE, (user_id,))
+            self._defer_notify(OP_DELETE, user)
+        return True
+
+    def delete_users(self, user_ids: Sequence[int]) -> List[bool]:
+        """Delete several users in one transaction"""
+        with self.transaction():
+            return [self.delete_user(user_id) for user_id in user_ids]
+
+    def clear_all(self):
+        """Clear all users (for testing)"""
+        with self.transaction() as conn:
+            conn.execute('DELETE FROM users')
+            conn.execute("DELETE FROM sqlite_sequence WHERE name = 'users'")
+            self._defer_notify(OP_CLEAR, None)
+
+    def close(self):
+        """Close every connection opened by the store"""
+        with self._pool_lock:
+            connections = list(self._connections)
+            self._connections.clear()
+        for conn in connections:
+            conn.close()
+        self._local = threading.local()
@@ -0,0 +1,91 @@
+"""Aggregate user statistics, maintained one write at a time"""
+from collections import Counter
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Optional
+
+# Creation-time series reported by GET /api/users/stats: name, bucket
+# width in seconds and how many of the latest buckets to report
+SERIES = (('minute', 60, 60), ('hour', 3600, 48), ('day', 86400, 30))
+
+
+class StatsMismatch(Exception):
+    """Maintained aggregates disagree with a recount of the users"""
+
+
+def email_domain(email: str) -> str:
+    """Lower-cased part of an address after the last '@' ('' if none)"""
+    return email.rpartition('@')[2].lower() if '@' in email else ''
+
+
+def _bump(counter: Counter, key, delta: int):
+    """Add delta to a count, dropping it once it reaches zero"""
+    count = counter[key] + delta
+    if count:
+        counter[key] = count
+    else:
+        del counter[key]
+
+
+class UserStats:
+    """User count, email domain histogram and users per creation bucket
+
+    `add` and `remove` cost O(1), so a store can keep these up to date on
+    every write. Buckets are aligned to UTC and count the users currently
+    stored, so deleting a user takes it out of its creation buckets.
+    Counts that drop to zero are removed, which keeps two UserStats over
+    the same users equal however they were built.
+    """
+
+    __slots__ = ('count', 'domains', 'created')
+
+    def __init__(self):
+        self.count = 0
+        self.domains: Counter = Counter()
+        self.created: Dict[str, Counter] = {name: Counter()
+                                            for name, _, _ in SERIES}
+
+    @classmethod
+    def of(cls, users: Iterable) -> 'UserStats':
+        """Stats computed from scratch over users"""
+        stats = cls()
+        for user in users:
+            stats.add(user)
+        return stats
+
+    def add(self, user, delta: int = 1):
+        """Count a stored user (or, with delta=-1, stop counting it)"""
+        self.count += delta
+        _bump(self.domains, email_domain(user.email), delta)
+        for name, width, _ in SERIES:
+            _bump(self.created[name], int(user.created_ts // width) * width,
+                  delta)
+
+    def remove(self, user):
+        """Stop counting a user that is no longer stored"""
+        self.add(user, -1)
+
+    def differences(self, other: 'UserStats') -> List[str]:
+        """Names of the aggregates that differ from other's"""
+        found = [name for name in ('count', 'domains')
+                 if getattr(self, name) != getattr(other, name)]
+        found += [f'created.{name}' for name in self.created
+                  if self.created[name] != other.created[name]]
+        return found
+
+    def summary(self, now: float, top_domains: Optional[int] = None
+                ) -> Dict:
+        """JSON-ready view: the count, the `top_domains` most common
+        domains and the latest buckets of each creation series"""
+        created = {}
+        for name, width, length in SERIES:
+            current = int(now // width) * width
+            counts = self.created[name]
+            created[name] = [
+                {"start": datetime.fromtimestamp(
+                    start, timezone.utc).isoformat(),
+                 "count": counts.get(start, 0)}
+                for start in range(current - (length - 1) * width,
+                                   current + 1, width)]
+        return {"total_users": self.count,
+                "domains": dict(self.domains.most_common(top_domains)),
+                "created": created}
@@ -0,0 +1,77 @@
+"""User store selection"""
+import atexit
+import os
+
+from app.columnar_store import ColumnarUserStore
+from app.concurrent_store import ConcurrentUserStore
+from app.models import BaseUserStore, UserStore
+from app.shared_store import RemoteUserStore
+from app.sqlite_store import SQLiteUserStore
+from app.snapshot import Checkpointer, MappedUserStore, load_snapshot
+from app.tiered_store import TieredUserStore
+from app.wal import DurableUserStore, WriteAheadLog
+
+
+def create_store(config) -> BaseUserStore:
+    """Build the user store described by the app config
+
+    USER_STORE_BACKEND picks the implementation. When SNAPSHOT_PATH holds
+    a snapshot it is either mapped ('mapped' backend) or loaded into the
+    store. When WAL_PATH is set the log is replayed on top, and the store
+    is wrapped so every further mutation is appended to it; with both set
+    a background thread checkpoints the log into a fresh snapshot.
+
+    With SHARED_STORE_SOCKET set, none of that applies here: the store
+    is the one served by the owner process on that socket.
+    """
+    if config.get('SHARED_STORE_SOCKET'):
+        return RemoteUserStore(config['SHARED_STORE_SOCKET'],
+                               config['SHARED_STORE_AUTHKEY'])
+    snapshot_path = config.get('SNAPSHOT_PATH')
+    if config.get('USER_STORE_BACKEND') == 'mapped':
+        if not snapshot_path:
+            raise ValueError("The 'mapped' backend requires SNAPSHOT_PATH")
+        store = MappedUserStore.open(snapshot_path)
+    else:
+        store = _create_backend(config)
+        if snapshot_path and os.path.exists(snapshot_path):
+            load_snapshot(store, snapshot_path)
+
+    wal_path = config.get('WAL_PATH')
+    if wal_path:
+        wal = WriteAheadLog(wal_path,
+                            config.get('WAL_FSYNC', 'always'),
+                            config.get('WAL_FSYNC_INTERVAL_MS', 10))
+        wal.replay(store)
+        wal.open()
+        atexit.register(wal.close)
+        store = DurableUserStore(store, wal)
+
+        if snapshot_path:
+            store.checkpointer = Checkpointer(
+                store, snapshot_path,
+                config.get('SNAPSHOT_INTERVAL_S', 60),
+                config.get('SNAPSHOT_MIN_WAL_BYTES', 64 * 1024 * 1024))
+            store.checkpointer.start()
+            atexit.register(store.checkpointer.stop)
+    return store
+
+
+def _create_backend(config) -> BaseUserStore:
+    backend = config.get('USER_STORE_BACKEND', 'memory')
+    if backend == 'memory':
+        return UserStore()
+    if backend == 'concurrent':
+        return ConcurrentUserStore(config.get('USER_STORE_SHARDS', 16))
+    if backend == 'columnar':
+        return ColumnarUserStore()
+    if backend == 'sqlite':
+        return SQLiteUserStore(config.get('SQLITE_PATH', 'users.db'),
+                               config.get('SQLITE_STATEMENT_CACHE', 64))
+    if backend == 'tiered':
+        store = TieredUserStore(
+            config.get('TIERED_MEMORY_BUDGET', 64 * 1024 * 1024),
+            config.get('TIERED_SPILL_PATH'))
+        atexit.register(store.close)
+        return store
+    raise ValueError(f"Unknown USER_STORE_BACKEND: {backend!r}")
@@ -0,0 +1,94 @@
+"""Running API requests in-process, for POST /api/batch"""
+import io
+from typing import Dict, Optional
+from urllib.parse import unquote_to_bytes, urlsplit
+
+from flask import current_app, request
+from werkzeug.exceptions import HTTPException, MethodNotAllowed
+
+# Endpoints a batch may not call: itself, ones that block or stream
+# indefinitely, and bulk export and import, whose bodies are binary or
+# too large to carry inside a JSON result
+EXCLUDED_ENDPOINTS = frozenset(('api.run_batch', 'api.get_user_changes',
+                                'api.export_users', 'api.import_users'))
+
+# Outer request environ keys every sub-request inherits
+_INHERITED_KEYS = ('SERVER_NAME', 'SERVER_PORT', 'SERVER_PROTOCOL',
+                   'SCRIPT_NAME', 'REMOTE_ADDR', 'HTTP_HOST')
+
+
+class SubrequestError(Exception):
+    """A sub-request description is invalid"""
+
+
+def _environ(method: str, path: str, body, headers: Dict[str, str]) -> dict:
+    """WSGI environ for a sub-request, based on the current request's"""
+    outer = request.environ
+    split = urlsplit(path)
+    environ = {key: value for key, value in outer.items()
+               if key.startswith('wsgi.') or key in _INHERITED_KEYS}
+    data = b'' if body is None else current_app.json.dumps(body).encode()
+    environ.update({
+        'REQUEST_METHOD': method,
+        # PATH_INFO holds the raw bytes of the path, as latin-1
+        'PATH_INFO': unquote_to_bytes(split.path).decode('latin-1'),
+        'QUERY_STRING': split.query,
+        'CONTENT_LENGTH': str(len(data)),
+        'wsgi.input': io.BytesIO(data),
+    })
+    if body is not None:
+        environ['CONTENT_TYPE'] = 'application/json'
+    for name, value in headers.items():
+        environ['HTTP_' + name.upper().replace('-', '_')] = str(value)
+    return environ
+
+
+def parse(op) -> tuple:
+    """(method, path, body, headers) from one batch entry
+
+    Raises SubrequestError if the entry is malformed.
+    """
+    if not isinstance(op, dict):
+        raise SubrequestError("Each request must be a JSON object")
+    method = op.get('method', 'GET')
+    path = op.get('path')
+    headers = op.get('headers')
+    if headers is None:
+        headers = {}
+    if not isinstance(method, str) or not isinstance(path, str) \
+            or not path.startswith('/'):
+        raise SubrequestError("Each request needs a method and an "
+                              "absolute path")
+    if not isinstance(headers, dict):
+        raise SubrequestError("headers must be a JSON object")
+    return method.upper(), path, op.get('body'), headers
+
+
+def run(method: str, path: str, body=None,
+        headers: Optional[Dict[str, str]] = None) -> dict:
+    """Dispatch one request straight to its view function
+
+    The request gets its own request context, so views see it as usual,
+    but it skips the WSGI server and the app's request hooks. Returns
+    {"status", "body", and "etag" if the response has one}.
+    """
+    app = current_app._get_current_object()  # pylint: disable=protected-access
+    with app.request_context(_environ(method, path, body, headers or {})):
+        try:
+            rule = request.url_rule
+            if rule is not None and rule.endpoint in EXCLUDED_ENDPOINTS:
+                raise MethodNotAllowed(
+                    description="This endpoint cannot be batched")
+            response = app.make_response(app.dispatch_request())
+        except HTTPException as exc:
+            return {"status": exc.code, "body": {"error": exc.description}}
+
+        result = {"status": response.status_code}
+        if response.status_code != 304:
+            result["body"] = (response.get_json() if response.is_json
+                              else response.get_data(as_text=True))
+        etag, weak = response.get_etag()
+        if etag:
+            result["etag"] = f'W/"{etag}"' if weak else f'"{etag}"'
+        response.close()
+        return result
@@ -0,0 +1,615 @@
+"""User storage with a bounded set of users in RAM and the rest on disk"""
+import os
+import struct
+import sys
+import tempfile
+import threading
+import time
+import weakref
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from contextlib import contextmanager
+from itertools import islice
+from typing import (Callable, Dict, Iterator, List, Optional, Sequence,
+                    Tuple, Union)
+
+from app.models import (OP_CLEAR, OP_CREATE, OP_DELETE, OP_UPDATE,
+                        BaseUserStore, DuplicateEmail, User, user_matches)
+from app.stats import StatsMismatch, UserStats
+
+# Spill file record: id, created epoch, version, name length and email
+# length, followed by the UTF-8 name and email
+_RECORD = struct.Struct('<qdqII')
+# What a cached user costs beyond its object and strings: its created
+# float and version int, and its cache entry
+_ENTRY_OVERHEAD = 160
+# Share of the memory budget users hit more than once may fill
+PROTECTED_SHARE = 0.8
+# Compaction is skipped below this many rows or spill file bytes
+_MIN_COMPACT_ROWS = 1024
+_MIN_COMPACT_BYTES = 1024 * 1024
+
+
+def _read_record(fd: int, offset: int, length: int) -> User:
+    data = os.pread(fd, length, offset)
+    user_id, created_ts, version, name_len, email_len = \
+        _RECORD.unpack_from(data)
+    name_end = _RECORD.size + name_len
+    return User(user_id, data[_RECORD.size:name_end].decode('utf-8'),
+                data[name_end:name_end + email_len].decode('utf-8'),
+                created_ts, version)
+
+
+def _footprint(user: User) -> int:
+    """Approximate bytes a cached user keeps alive"""
+    return (sys.getsizeof(user) + sys.getsizeof(user.name)
+            + sys.getsizeof(user.email) + _ENTRY_OVERHEAD)
+
+
+class TieredSnapshot:
+    """Read-only view of a TieredUserStore at one point in time
+
+    Holds copies of the store's row arrays, the users it had in RAM (the
+    only copy of those changed since they were last spilled) and a
+    descriptor of its own for the spill file. A record is never changed
+    once written: compaction and clear_all move the store to a new file,
+    and this view keeps reading the old one, which the descriptor keeps
+    alive until the view is garbage collected. So the view costs about
+    20 bytes per user, not a copy of every user.
+    """
+
+    def __init__(self, ids: array, offsets: array, lengths: array,
+                 alive: bytes, resident: Dict[int, User], fd: int,
+                 version: int, epoch: str):
+        weakref.finalize(self, os.close, fd)
+        self._ids = ids
+        self._offsets = offsets
+        self._lengths = lengths
+        self._alive = alive
+        self._resident = resident
+        self._fd = fd
+        self._count = alive.count(1)
+        self.version = version
+        self.epoch = epoch
+
+    def snapshot(self) -> 'TieredSnapshot':
+        """The snapshot itself, which never changes"""
+        return self
+
+    def _user(self, row: int) -> User:
+        user = self._resident.get(self._ids[row])
+        if user is not None:
+            return user
+        return _read_record(self._fd, self._offsets[row], self._lengths[row])
+
+    def get_user(self, user_id: int) -> Optional[User]:
+        """Get user by ID"""
+        row = bisect_left(self._ids, user_id)
+        if (row < len(self._ids) and self._ids[row] == user_id
+                and self._alive[row]):
+            return self._user(row)
+        return None
+
+    def count_users(self) -> int:
+        """Number of users"""
+        return self._count
+
+    def get_all_users(self) -> List[User]:
+        """Get all users, ordered by ID"""
+        return list(self.iter_users())
+
+    def get_users_page(self, after_id: int = 0,
+                       limit: Optional[int] = None) -> List[User]:
+        """Get up to `limit` users with an ID greater than `after_id`"""
+        return list(islice(self.iter_users(after_id), limit))
+
+    def iter_users(self, after_id: int = 0,
+                   chunk_size: int = 1000) -> Iterator[User]:
+        """Iterate users in ID order (chunk_size is accepted and ignored)"""
+        for row in range(bisect_right(self._ids, after_id), len(self._ids)):
+            if self._alive[row]:
+                yield self._user(row)
+
+
+class TieredUserStore(BaseUserStore):
+    """User storage keeping at most `memory_budget` bytes of users in RAM
+
+    Every user has a row in compact arrays sorted by ID, giving its
+    place in the spill file, and emails map to IDs in a dict; these
+    indexes stay resident, at a few dozen bytes per user plus its email.
+    Whole users are cached in a segmented LRU: they enter a probation
+    segment and move to a protected one when read again, and eviction
+    takes probation's least recently used first. Users read only once
+    cannot push out the ones read over and over, and listings read
+    through the cache without admitting or reordering anything, so a
+    full scan leaves the hot set as it was.
+
+    Evicted users that changed since they were last written are appended
+    to the spill file; reading a user that is not in RAM faults it back
+    in. The file is scratch space that each store starts empty (for
+    durability use WAL_PATH and SNAPSHOT_PATH as with any backend). Dead
+    rows and superseded records are reclaimed by compacting once they
+    make up half the store, as in ColumnarUserStore. One lock serializes
+    every call; transactions undo their writes as UserStore's do.
+    """
+
+    supports_transactions = True
+    blocking_io = True
+
+    def __init__(self, memory_budget: int, path: Optional[str] = None):
+        super().__init__()
+        self.memory_budget = memory_budget
+        self._temporary = path is None
+        if path is None:
+            fd, path = tempfile.mkstemp(prefix='users-', suffix='.spill')
+            os.close(fd)
+        self.path = path
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+        self._lock = threading.RLock()
+        self.next_id = 1
+        self.hits = self.misses = self.evictions = self.spills = 0
+        # While a transaction is open: callables undoing its writes, and
+        # the notifications held back until it commits
+        self._undo: Optional[List[Callable[[], None]]] = None
+        self._pending: List[Tuple[str, Optional[User]]] = []
+        self._reset()
+
+    def _reset(self):
+        self._ids = array('q')
+        # Where each user's current record is in the spill file; -1 if
+        # it changed since it was last written
+        self._offsets = array('q')
+        self._lengths = array('I')
+        self._alive = bytearray()
+        self._live_rows = 0
+        self._emails: Dict[str, int] = {}
+        self._stats = UserStats()
+        self._probation: 'OrderedDict[int, User]' = OrderedDict()
+        self._protected: 'OrderedDict[int, User]' = OrderedDict()
+        self._probation_bytes = 0
+        self._protected_bytes = 0
+        self._file_size = 0
+        self._dead_bytes = 0
+
+    # Rows and the spill file
+
+    def _row(self, user_id: int) -> int:
+        row = bisect_left(self._ids, user_id)
+        if (row < len(self._ids) and self._ids[row] == user_id
+                and self._alive[row]):
+            return row
+        return -1
+
+    def _insert_row(self, row: int, user_id: int):
+        self._ids.insert(row, user_id)
+        self._offsets.insert(row, -1)
+        self._lengths.insert(row, 0)
+        self._alive.insert(row, 1)
+        self._live_rows += 1
+
+    def _read(self, row: int) -> User:
+        return _read_record(self._fd, self._offsets[row], self._lengths[row])
+
+    def _write(self, row: int, user: User):
+        name = user.name.encode('utf-8')
+        email = user.email.encode('utf-8')
+        data = _RECORD.pack(user.id, user.created_ts, user.version,
+                            len(name), len(email)) + name + email
+        os.pwrite(self._fd, data, self._file_size)
+        self._offsets[row] = self._file_size
+        self._lengths[row] = len(data)
+        self._file_size += len(data)
+        self.spills += 1
+
+    def _discard_record(self, row: int):
+        """Mark a row's spill file record as superseded"""
+        if self._offsets[row] >= 0:
+            self._dead_bytes += self._lengths[row]
+            self._offsets[row] = -1
+
+    def _maybe_compact(self):
+        rows = len(self._ids)
+        if ((rows >= _MIN_COMPACT_ROWS
+             and (rows - self._live_rows) * 2 > rows)
+                or (self._file_size >= _MIN_COMPACT_BYTES
+                    and self._dead_bytes * 2 > self._file_size)):
+            self._compact()
+
+    def _compact(self):
+        """Rewrite the rows without dead ones and the spill file without
+        superseded records"""
+        ids, offsets, lengths = array('q'), array('q'), array('I')
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(self.path)))
+        size = 0
+        with os.fdopen(fd, 'wb') as out:
+            for row, alive in enumerate(self._alive):
+                if not alive:
+                    continue
+                ids.append(self._ids[row])
+                lengths.append(self._lengths[row])
+                if self._offsets[row] < 0:
+                    offsets.append(-1)
+                    continue
+                out.write(os.pread(self._fd, self._lengths[row],
+                                   self._offsets[row]))
+                offsets.append(size)
+                size += self._lengths[row]
+        self._replace_file(tmp_path)
+        self._ids, self._offsets, self._lengths = ids, offsets, lengths
+        self._alive = bytearray(b'\1' * len(ids))
+        self._file_size = size
+        self._dead_bytes = 0
+
+    def _replace_file(self, tmp_path: str):
+        """Move the spill file to tmp_path's contents
+
+        The old file is replaced rather than rewritten, so snapshots
+        still reading it are unaffected.
+        """
+        os.replace(tmp_path, self.path)
+        os.close(self._fd)
+        self._fd = os.open(self.path, os.O_RDWR)
+
+    # The cache
+
+    def _cached(self, user_id: int) -> Optional[User]:
+        """A user in RAM, moved up as for a point read; None if not"""
+        user = self._protected.get(user_id)
+        if user is not None:
+            self._protected.move_to_end(user_id)
+            return user
+        user = self._probation.pop(user_id, None)
+        if user is None:
+            return None
+        size = _footprint(user)
+        self._probation_bytes -= size
+        self._protected[user_id] = user
+        self._protected_bytes += size
+        limit = self.memory_budget * PROTECTED_SHARE
+        while self._protected_bytes > limit and len(self._protected) > 1:
+            demoted_id, demoted = self._protected.popitem(last=False)
+            size = _footprint(demoted)
+            self._protected_bytes -= size
+            self._probation[demoted_id] = demoted
+            self._probation_bytes += size
+        return user
+
+    def _peek(self, row: int) -> User:
+        """A user read without touching the cache order"""
+        user_id = self._ids[row]
+        user = self._protected.get(user_id) or self._probation.get(user_id)
+        return user if user is not None else self._read(row)
+
+    def _get(self, user_id: int) -> Optional[User]:
+        row = self._row(user_id)
+        if row < 0:
+            return None
+        user = self._cached(user_id)
+        if user is not None:
+            self.hits += 1
+            return user
+        self.misses += 1
+        user = self._read(row)
+        self._admit(user)
+        return user
+
+    def _admit(self, user: User):
+        """Cache a user on probation, evicting others to fit the budget"""
+        self._probation[user.id] = user
+        self._probation_bytes += _footprint(user)
+        self._evict()
+
+    def _replace_cached(self, user: User):
+        """Cache a new version of a user where the old one was"""
+        old = self._protected.get(user.id)
+        if old is None:
+            self._uncache(user.id)
+            self._admit(user)
+            return
+        self._protected[user.id] = user
+        self._protected.move_to_end(user.id)
+        self._protected_bytes += _footprint(user) - _footprint(old)
+        self._evict()
+
+    def _uncache(self, user_id: int):
+        user = self._probation.pop(user_id, None)
+        if user is not None:
+            self._probation_bytes -= _footprint(user)
+            return
+        user = self._protected.pop(user_id, None)
+        if user is not None:
+            self._protected_bytes -= _footprint(user)
+
+    def _evict(self):
+        while self._probation_bytes + self._protected_bytes > \
+                self.memory_budget:
+            if self._probation:
+                user_id, user = self._probation.popitem(last=False)
+                self._probation_bytes -= _footprint(user)
+            else:
+                user_id, user = self._protected.popitem(last=False)
+                self._protected_bytes -= _footprint(user)
+            row = self._row(user_id)
+            if self._offsets[row] < 0:
+                self._write(row, user)
+            self.evictions += 1
+
+    def cache_stats(self) -> Dict[str, int]:
+        """Cache hit, miss and eviction counts and current residency
+
+        `spills` counts users written to the spill file on eviction.
+        """
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses,
+                    "evictions": self.evictions, "spills": self.spills,
+                    "resident_users": (len(self._probation)
+                                       + len(self._protected)),
+                    "resident_bytes": (self._probation_bytes
+                                       + self._protected_bytes),
+                    "memory_budget": self.memory_budget,
+                    "spill_file_bytes": self._file_size}
+
+    # Indexes
+
+    def _index(self, user: User):
+        self._emails[user.email] = user.id
+        self._stats.add(user)
+
+    def _unindex(self, user: User):
+        if self._emails.get(user.email) == user.id:
+            del self._emails[user.email]
+        self._stats.remove(user)
+
+    def _check_email(self, email: str, user_id: Optional[int] = None):
+        owner = self._emails.get(email)
+        if owner is not None and owner != user_id:
+            raise DuplicateEmail(email)
+
+    # The store interface
+
+    @contextmanager
+    def transaction(self):
+        """Apply the enclosed writes atomically: all of them or none
+
+        Behaves as UserStore.transaction: other threads wait until it
+        ends, nested calls join it, and listeners only hear of its writes
+        once it commits.
+        """
+        with self._lock:
+            if self._undo is not None:
+                yield self
+                return
+            self._undo = []
+            try:
+                yield self
+            except BaseException:
+                for undo in reversed(self._undo):
+                    undo()
+                self._pending.clear()
+                raise
+            finally:
+                self._undo = None
+            pending, self._pending = self._pending, []
+            for op, user in pending:
+                super()._notify(op, user)
+
+    def _notify(self, op: str, user: Optional[User]):
+        if self._undo is None:
+            super()._notify(op, user)
+        else:
+            self._pending.append((op, user))
+
+    def _remove(self, row: int, user: User):
+        """Drop a user's row without notifying"""
+        self._uncache(user.id)
+        self._discard_record(row)
+        self._alive[row] = 0
+        self._live_rows -= 1
+        self._unindex(user)
+
+    def create_user(self, name: str, email: str) -> User:
+        """Create a new user"""
+        with self._lock:
+            self._check_email(email)
+            user = User(self.next_id, name, email)
+            self._insert_row(len(self._ids), user.id)
+            self._index(user)
+            self.next_id += 1
+            self._admit(user)
+            if self._undo is not None:
+                self._undo.append(lambda: self._remove(self._row(user.id),
+                                                       user))
+            self._notify(OP_CREATE, user)
+        return user
+
+    def create_users(self, rows: Sequence[Tuple[str, str]]
+                     ) -> List[Union[User, DuplicateEmail]]:
+        """Create several users under one lock acquisition"""
+        with self._lock:
+            return super().create_users(rows)
+
+    def restore_user(self, user: User):
+        """Insert or replace a user with a known ID (used for recovery)"""
+        with self._lock:
+            row = bisect_left(self._ids, user.id)
+            if row < len(self._ids) and self._ids[row] == user.id:
+                if self._alive[row]:
+                    self._unindex(self._peek(row))
+                    self._uncache(user.id)
+                    self._discard_record(row)
+                else:
+                    self._alive[row] = 1
+                    self._live_rows += 1
+            else:
+                self._insert_row(row, user.id)
+            self._index(user)
+            self._admit(user)
+            self.next_id = max(self.next_id, user.id + 1)
+
+    def snapshot(self) -> TieredSnapshot:
+        """Read-only view of the store at this point in time
+
+        Copies the row arrays and references the users in RAM; users on
+        disk are read from the spill file as the view is read.
+        """
+        with self._lock:
+            resident = dict(self._probation)
+            resident.update(self._protected)
+            return TieredSnapshot(
+                array('q', self._ids), array('q', self._offsets),
+                array('I', self._lengths), bytes(self._alive), resident,
+                os.dup(self._fd), self.version, self.epoch)
+
+    def get_user(self, user_id: int) -> Optional[User]:
+        """Get user by ID, reading it from disk if it is not in RAM"""
+        with self._lock:
+            return self._get(user_id)
+
+    def get_user_by_email(self, email: str) -> Optional[User]:
+        """Get user by email address, using the email index"""
+        with self._lock:
+            user_id = self._emails.get(email)
+            return None if user_id is None else self._get(user_id)
+
+    def count_users(self) -> int:
+        """Number of users"""
+        return self._live_rows
+
+    def get_all_users(self) -> List[User]:
+        """Get all users, ordered by ID, without caching them"""
+        return self.get_users_page()
+
+    def get_users_page(self, after_id: int = 0,
+                       limit: Optional[int] = None) -> List[User]:
+        """Get up to `limit` users with an ID greater than `after_id`
+
+        Users not in RAM are read from disk but not cached.
+        """
+        page = []
+        with self._lock:
+            for row in range(bisect_right(self._ids, after_id),
+                             len(self._ids)):
+                if limit is not None and len(page) == limit:
+                    break
+                if self._alive[row]:
+                    page.append(self._peek(row))
+        return page
+
+    def search_users(self, email: Optional[str] = None,
+                     name_prefix: Optional[str] = None,
+                     created_after: Optional[float] = None,
+                     sort: str = 'id', after_id: int = 0,
+                     limit: Optional[int] = None) -> List[User]:
+        """Find users matching every given filter, in `sort` order
+
+        Email searches use the email index; the others scan the store.
+        """
+        if email is None:
+            return super().search_users(email, name_prefix, created_after,
+                                        sort, after_id, limit)
+        user = self.get_user_by_email(email)
+        if (user is None or user.id <= after_id or limit == 0
+                or not user_matches(user, email, name_prefix,
+                                    created_after)):
+            return []
+        return [user]
+
+    def stats(self, top_domains: Optional[int] = None) -> Dict:
+        """User count, most common email domains and creation series
+
+        Read from aggregates kept up to date by every write.
+        """
+        with self._lock:
+            return self._stats.summary(time.time(), top_domains)
+
+    def check_stats(self):
+        """Raise StatsMismatch if the maintained aggregates are off"""
+        with self._lock:
+            differences = self._stats.differences(
+                UserStats.of(self.get_all_users()))
+        if differences:
+            raise StatsMismatch(', '.join(differences))
+
+    def update_user(self, user_id: int, name: str = None,
+                    email: str = None,
+                    expected_version: Optional[int] = None
+                    ) -> Optional[User]:
+        """Update user information"""
+        with self._lock:
+            user = self._get(user_id)
+            if user is None:
+                return None
+            self._check_version(user, expected_version)
+            if email:
+                self._check_email(email, user_id)
+            updated = User(user_id, name or user.name, email or user.email,
+                           user.created_ts, user.version + 1)
+            self._unindex(user)
+            self._index(updated)
+            self._discard_record(self._row(user_id))
+            self._replace_cached(updated)
+            if self._undo is not None:
+                self._undo.append(lambda: self.restore_user(user))
+            self._notify(OP_UPDATE, updated)
+            self._maybe_compact()
+        return updated
+
+    def update_users(self, rows: Sequence[Tuple[int, Optional[str],
+                                                Optional[str]]]
+                     ) -> List[Union[User, None, DuplicateEmail]]:
+        """Apply several updates under one lock acquisition"""
+        with self._lock:
+            return super().update_users(rows)
+
+    def delete_user(self, user_id: int,
+                    expected_version: Optional[int] = None) -> bool:
+        """Delete user by ID"""
+        with self._lock:
+            row = self._row(user_id)
+            if row < 0:
+                return False
+            user = self._peek(row)
+            self._check_version(user, expected_version)
+            self._remove(row, user)
+            if self._undo is not None:
+                self._undo.append(lambda: self.restore_user(user))
+            self._notify(OP_DELETE, user)
+            self._maybe_compact()
+        return True
+
+    def delete_users(self, user_ids: Sequence[int]) -> List[bool]:
+        """Delete several users under one lock acquisition"""
+        with self._lock:
+            return super().delete_users(user_ids)
+
+    def clear_all(self):
+        """Clear all users (for testing)"""
+        with self._lock:
+            if self._undo is not None:
+                users, next_id = self.get_all_users(), self.next_id
+                self._undo.append(lambda: self._restore_all(users, next_id))
+            self._reset()
+            fd, tmp_path = tempfile.mkstemp(
+                dir=os.path.dirname(os.path.abspath(self.path)))
+            os.close(fd)
+            self._replace_file(tmp_path)
+            self.next_id = 1
+            self._notify(OP_CLEAR, None)
+
+    def _restore_all(self, users: List[User], next_id: int):
+        """Put back the users removed by clear_all (undoes a clear)"""
+        for user in users:
+            self.restore_user(user)
+        self.next_id = next_id
+
+    def close(self):
+        """Close the spill file, deleting it if the store created it"""
+        with self._lock:
+            if self._fd < 0:
+                return
+            os.close(self._fd)
+            self._fd = -1
+            if self._temporary:
+                os.remove(self.path)
@@ -0,0 +1,366 @@
+"""Append-only write-ahead log for user store durability"""
+import os
+import shutil
+import struct
+import threading
+import zlib
+from contextlib import contextmanager
+from typing import List, Optional, Sequence, Tuple
+
+from app.models import OP_CLEAR, OP_DELETE, BaseUserStore, User
+
+MAGIC = b'USRWAL02'
+
+# Record framing: payload length, CRC32 of (kind + payload), kind
+_HEADER = struct.Struct('<IIB')
+# PUT payload prefix: id, created epoch, version, name bytes, email bytes
+_PUT = struct.Struct('<qdqII')
+_DELETE = struct.Struct('<q')
+
+KIND_PUT = 1
+KIND_DELETE = 2
+KIND_CLEAR = 3
+
+FSYNC_ALWAYS = 'always'
+FSYNC_INTERVAL = 'interval'
+FSYNC_OS = 'os'
+FSYNC_POLICIES = (FSYNC_ALWAYS, FSYNC_INTERVAL, FSYNC_OS)
+
+
+def encode_record(kind: int, payload: bytes = b'') -> bytes:
+    """Frame one record: header followed by its payload"""
+    crc = zlib.crc32(payload, zlib.crc32(bytes((kind,))))
+    return _HEADER.pack(len(payload), crc, kind) + payload
+
+
+def encode_put(user: User) -> bytes:
+    """Encode the full state of a user as a PUT record"""
+    name = user.name.encode('utf-8')
+    email = user.email.encode('utf-8')
+    payload = _PUT.pack(user.id, user.created_ts, user.version, len(name),
+                        len(email))
+    return encode_record(KIND_PUT, payload + name + email)
+
+
+def decode_put(payload: bytes) -> User:
+    """Decode a PUT record payload back into a User"""
+    user_id, created_ts, version, name_len, email_len = \
+        _PUT.unpack_from(payload)
+    start = _PUT.size
+    name = payload[start:start + name_len].decode('utf-8')
+    start += name_len
+    email = payload[start:start + email_len].decode('utf-8')
+    return User(user_id, name, email, created_ts, version)
+
+
+def iter_records(data: bytes, offset: int = 0):
+    """Yield (kind, payload, end_offset) for each intact record in data
+
+    Stops quietly at the first truncated or corrupt record, which is what
+    a crash in the middle of an append leaves behind.
+    """
+    while offset + _HEADER.size <= len(data):
+        length, crc, kind = _HEADER.unpack_from(data, offset)
+        start = offset + _HEADER.size
+        end = start + length
+        if end > len(data):
+            return
+        payload = bytes(data[start:end])
+        if zlib.crc32(payload, zlib.crc32(bytes((kind,)))) != crc:
+            return
+        yield kind, payload, end
+        offset = end
+
+
+def apply_record(store: BaseUserStore, kind: int, payload: bytes) -> int:
+    """Apply one decoded record to a store, returning the ID it touched"""
+    if kind == KIND_PUT:
+        user = decode_put(payload)
+        store.restore_user(user)
+        return user.id
+    if kind == KIND_DELETE:
+        (user_id,) = _DELETE.unpack(payload)
+        store.delete_user(user_id)
+        return user_id
+    if kind == KIND_CLEAR:
+        store.clear_all()
+        return 0
+    raise ValueError(f"Unknown WAL record kind: {kind}")
+
+
+class WriteAheadLog:
+    """Binary append-only log of user store mutations
+
+    `record` is registered as a store listener and only buffers the
+    record; `commit` then makes the calling thread's last record durable
+    according to the fsync policy:
+
+    - 'always': fsync before returning, with group commit. Whichever
+      waiting writer gets there first fsyncs everything written so far,
+      and every writer whose record it covered returns without another
+      fsync.
+    - 'interval': a background thread fsyncs every `interval_ms`, so a
+      machine crash loses at most that window of writes.
+    - 'os': records are flushed to the OS on every write but never
+      fsynced; this survives a process crash but not a power loss.
+    """
+
+    def __init__(self, path: str, fsync_policy: str = FSYNC_ALWAYS,
+                 interval_ms: int = 10):
+        if fsync_policy not in FSYNC_POLICIES:
+            raise ValueError(f"Unknown WAL fsync policy: {fsync_policy!r}")
+        self.path = path
+        self.fsync_policy = fsync_policy
+        self.interval_ms = interval_ms
+        self._file = None
+        self._write_lock = threading.Lock()
+        self._sync_cond = threading.Condition()
+        self._written = 0
+        self._synced = 0
+        self._syncing = False
+        self._local = threading.local()
+        self._stop = threading.Event()
+        self._flusher: Optional[threading.Thread] = None
+
+    def open(self):
+        """Open the log for appending, creating it if needed"""
+        self._file = open(self.path, 'ab')  # pylint: disable=consider-using-with
+        if self._file.tell() == 0:
+            self._file.write(MAGIC)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        if self.fsync_policy == FSYNC_INTERVAL:
+            self._flusher = threading.Thread(target=self._flush_loop,
+                                             name='wal-flusher', daemon=True)
+            self._flusher.start()
+
+    @property
+    def previous_path(self) -> str:
+        """Where `rotate` moves the log while a checkpoint is in progress"""
+        return self.path + '.prev'
+
+    def replay(self, store: BaseUserStore) -> int:
+        """Apply every intact record to the store, returning the count
+
+        A segment left behind by an interrupted checkpoint is replayed
+        first. A torn record at the tail is cut off so later appends start
+        on a clean boundary. The store's next_id is advanced past every ID
+        the log mentions, including deleted ones, so IDs are never reused.
+        """
+        count = 0
+        max_id = store.next_id - 1
+        for path in (self.previous_path, self.path):
+            if os.path.exists(path):
+                replayed, max_id = self._replay_file(path, store, max_id)
+                count += replayed
+        store.next_id = max(store.next_id, max_id + 1)
+        return count
+
+    @staticmethod
+    def _replay_file(path: str, store: BaseUserStore, max_id: int):
+        with open(path, 'rb') as log:
+            data = log.read()
+        if not data.startswith(MAGIC):
+            raise ValueError(f"{path} is not a user WAL")
+
+        count = 0
+        good_end = len(MAGIC)
+        for kind, payload, end in iter_records(data, good_end):
+            user_id = apply_record(store, kind, payload)
+            max_id = 0 if kind == KIND_CLEAR else max(max_id, user_id)
+            good_end = end
+            count += 1
+
+        if good_end < len(data):
+            with open(path, 'r+b') as log:
+                log.truncate(good_end)
+        return count, max_id
+
+    def rotate(self):
+        """Move the current log aside and start an empty one
+
+        Records are full-state and idempotent, so a snapshot taken after
+        rotating covers everything in the previous segment; records for
+        writes racing with the snapshot land in the new segment and are
+        simply re-applied on top of it during recovery.
+        """
+        with self._write_lock:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+            if os.path.exists(self.previous_path):
+                # An earlier checkpoint never finished; keep its records
+                with open(self.path, 'rb') as current, \
+                        open(self.previous_path, 'ab') as previous:
+                    current.seek(len(MAGIC))
+                    shutil.copyfileobj(current, previous)
+                    previous.flush()
+                    os.fsync(previous.fileno())
+                os.remove(self.path)
+            else:
+                os.replace(self.path, self.previous_path)
+            self._file = open(self.path, 'ab')  # pylint: disable=consider-using-with
+            self._file.write(MAGIC)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        with self._sync_cond:
+            # Everything before the rotation was fsynced above
+            self._synced = max(self._synced, self._written)
+
+    def drop_previous(self):
+        """Delete the segment kept by `rotate` once a snapshot covers it"""
+        if os.path.exists(self.previous_path):
+            os.remove(self.previous_path)
+
+    def record(self, op: str, user: Optional[User]):
+        """Store listener: append the record for one mutation"""
+        if op == OP_CLEAR:
+            data = encode_record(KIND_CLEAR)
+        elif op == OP_DELETE:
+            data = encode_record(KIND_DELETE, _DELETE.pack(user.id))
+        else:
+            data = encode_put(user)
+        with self._write_lock:
+            self._file.write(data)
+            if self.fsync_policy == FSYNC_OS:
+                self._file.flush()
+            self._written += 1
+            self._local.lsn = self._written
+
+    def commit(self):
+        """Block until this thread's last record meets the fsync policy"""
+        if self.fsync_policy != FSYNC_ALWAYS:
+            return
+        lsn = getattr(self._local, 'lsn', 0)
+        with self._sync_cond:
+            while self._synced < lsn:
+                if self._syncing:
+                    self._sync_cond.wait()
+                    continue
+                self._syncing = True
+                self._sync_cond.release()
+                try:
+                    synced = self._sync()
+                finally:
+                    self._sync_cond.acquire()
+                    self._syncing = False
+                self._synced = max(self._synced, synced)
+                self._sync_cond.notify_all()
+
+    def _sync(self) -> int:
+        """Flush and fsync; return the last record number it covers"""
+        with self._write_lock:
+            self._file.flush()
+            target = self._written
+            # A private descriptor stays valid if the log is rotated or
+            # closed while we fsync outside the lock
+            fd = os.dup(self._file.fileno())
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        return target
+
+    def _flush_loop(self):
+        while not self._stop.wait(self.interval_ms / 1000):
+            self._sync()
+
+    def size(self) -> int:
+        """Current length of the log file in bytes"""
+        with self._write_lock:
+            return self._file.tell()
+
+    def close(self):
+        """Make everything durable and close the file"""
+        if self._file is None:
+            return
+        self._stop.set()
+        if self._flusher is not None:
+            self._flusher.join()
+        self._sync()
+        self._file.close()
+        self._file = None
+
+
+class DurableUserStore:
+    """Wraps a user store so every mutation is logged before returning
+
+    Reads pass straight through to the wrapped store.
+    """
+
+    def __init__(self, store: BaseUserStore, wal: WriteAheadLog):
+        self.store = store
+        self.wal = wal
+        # Set by create_store when periodic snapshots are enabled
+        self.checkpointer = None
+        store.add_listener(wal.record)
+
+    def __getattr__(self, name):
+        return getattr(self.store, name)
+
+    @property
+    def blocking_io(self) -> bool:
+        """Whether calls may wait on the disk (fsync on every write)"""
+        return (self.wal.fsync_policy == FSYNC_ALWAYS
+                or self.store.blocking_io)
+
+    @contextmanager
+    def transaction(self):
+        """Run the wrapped store's transaction, then wait for one commit
+
+        The wrapped store only notifies the log when its transaction
+        commits, so rolled back writes are never logged.
+        """
+        with self.store.transaction() as transaction:
+            yield transaction
+        self.wal.commit()
+
+    def create_user(self, name: str, email: str) -> User:
+        """Create a new user"""
+        user = self.store.create_user(name, email)
+        self.wal.commit()
+        return user
+
+    def create_users(self, rows: Sequence[Tuple[str, str]]) -> List[User]:
+        """Create several users, waiting for one commit"""
+        users = self.store.create_users(rows)
+        self.wal.commit()
+        return users
+
+    def update_user(self, user_id: int, name: str = None,
+                    email: str = None,
+                    expected_version: Optional[int] = None
+                    ) -> Optional[User]:
+        """Update user information"""
+        user = self.store.update_user(user_id, name, email,
+                                      expected_version)
+        if user:
+            self.wal.commit()
+        return user
+
+    def update_users(self, rows: Sequence[Tuple[int, Optional[str],
+                                                Optional[str]]]
+                     ) -> List[Optional[User]]:
+        """Apply several updates, waiting for one commit"""
+        users = self.store.update_users(rows)
+        self.wal.commit()
+        return users
+
+    def delete_user(self, user_id: int,
+                    expected_version: Optional[int] = None) -> bool:
+        """Delete user by ID"""
+        deleted = self.store.delete_user(user_id, expected_version)
+        if deleted:
+            self.wal.commit()
+        return deleted
+
+    def delete_users(self, user_ids: Sequence[int]) -> List[bool]:
+        """Delete several users, waiting for one commit"""
+        results = self.store.delete_users(user_ids)
+        self.wal.commit()
+        return results
+
+    def clear_all(self):
+        """Clear all users (for testing)"""
+        self.store.clear_all()
+        self.wal.commit()
@@ -0,0 +1,173 @@
+"""Idle long-poll connections held by the WSGI and the ASGI server
+
+Starts each server in a subprocess, opens N connections that long-poll
+GET /api/users/changes, and reports what holding them costs the server
+(resident memory and threads), how quickly it still answers another
+request, and how long one write takes to wake every poller. The WSGI
+path is werkzeug's threaded server, one thread per connection; the ASGI
+path is uvicorn (pip install uvicorn) running create_asgi_app.
+
+Usage: python -m benchmarks.asgi_connections [connections]
+"""
+import asyncio
+import importlib.util
+import json
+import socket
+import subprocess
+import sys
+import time
+
+from app.config import Config
+
+_POLL = (b'GET /api/users/changes?since=0&wait=30 HTTP/1.1\r\n'
+         b'Host: bench\r\n\r\n')
+
+
+class BenchConfig(Config):
+    DEBUG = False
+    METRICS_ENABLED = False
+    COMPRESSION_ENABLED = False
+    CHANGE_FEED_MAX_WAIT_S = 30
+
+
+def serve(kind, port):
+    """Run one server in this process until it is killed"""
+    if kind == 'wsgi':
+        from werkzeug.serving import WSGIRequestHandler, make_server
+        from app import create_app
+
+        class QuietHandler(WSGIRequestHandler):
+            def log_request(self, *args, **kwargs):
+                pass
+
+        server = make_server('127.0.0.1', port, create_app(BenchConfig),
+                             threaded=True, request_handler=QuietHandler)
+        server.socket.listen(4096)
+        server.serve_forever()
+    else:
+        import uvicorn
+        from app import create_asgi_app
+        uvicorn.run(create_asgi_app(BenchConfig), host='127.0.0.1',
+                    port=port, log_level='warning', backlog=4096)
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _process_status(pid):
+    """(resident MiB, threads) of a process, from /proc"""
+    status = {}
+    with open(f'/proc/{pid}/status', encoding='ascii') as file:
+        for line in file:
+            name, _, value = line.partition(':')
+            status[name] = value.split()
+    return int(status['VmRSS'][0]) / 1024, int(status['Threads'][0])
+
+
+async def _call(port, method, path, body=None):
+    """One request on a fresh connection; returns the response body"""
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    data = b'' if body is None else json.dumps(body).encode()
+    writer.write(f'{method} {path} HTTP/1.1\r\nHost: bench\r\n'
+                 f'Content-Type: application/json\r\n'
+                 f'Content-Length: {len(data)}\r\n'
+                 f'Connection: close\r\n\r\n'.encode() + data)
+    response = await reader.read()
+    writer.close()
+    return response
+
+
+async def _wait_ready(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return await _call(port, 'GET', '/api/health')
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.1)
+
+
+async def _poll(port, started):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(_POLL)
+    await writer.drain()
+    started.append(True)
+    try:
+        # Headers, then the body of the answer
+        await reader.readuntil(b'\r\n\r\n')
+        return True
+    finally:
+        writer.close()
+
+
+async def measure(kind, connections):
+    """Resource use and latencies of one server holding the polls"""
+    port = _free_port()
+    server = subprocess.Popen([sys.executable, '-m',
+                               'benchmarks.asgi_connections', 'serve', kind,
+                               str(port)])
+    try:
+        await _wait_ready(port)
+        idle = _process_status(server.pid)
+        started = []
+        polls = []
+        for _ in range(0, connections, 100):
+            polls += [asyncio.ensure_future(_poll(port, started))
+                      for _ in range(min(100, connections - len(polls)))]
+            await asyncio.sleep(0.05)
+        while len(started) < connections:
+            await asyncio.sleep(0.05)
+        await asyncio.sleep(1)  # let the server accept and park them all
+        held = _process_status(server.pid)
+
+        latencies = []
+        for _ in range(20):
+            start = time.perf_counter()
+            await _call(port, 'GET', '/api/health')
+            latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await _call(port, 'POST', '/api/users',
+                    {"name": "John", "email": "john@example.com"})
+        answered = sum(await asyncio.wait_for(asyncio.gather(*polls), 60))
+        wake = time.perf_counter() - start
+    finally:
+        server.kill()
+        server.wait()
+    latencies.sort()
+    return {"idle": idle, "held": held, "answered": answered, "wake": wake,
+            "p50": latencies[len(latencies) // 2], "max": latencies[-1]}
+
+
+def main(argv):
+    if len(argv) > 1 and argv[1] == 'serve':
+        serve(argv[2], int(argv[3]))
+        return
+    connections = int(argv[1]) if len(argv) > 1 else 1000
+    kinds = ['wsgi']
+    if importlib.util.find_spec('uvicorn'):
+        kinds.append('asgi')
+    else:
+        print("uvicorn is not installed; measuring WSGI only")
+
+    print(f"{connections} idle long polls per server")
+    print(f"{'server':8}{'RSS MiB':>16}{'threads':>14}{'health p50':>13}"
+          f"{'max':>9}{'wake all':>11}")
+    for kind in kinds:
+        result = asyncio.run(measure(kind, connections))
+        idle_rss, idle_threads = result['idle']
+        rss, threads = result['held']
+        print(f"{kind:8}{idle_rss:7.1f} -> {rss:6.1f}"
+              f"{idle_threads:6} -> {threads:5}"
+              f"{result['p50'] * 1e3:10.2f} ms{result['max'] * 1e3:6.1f} ms"
+              f"{result['wake'] * 1e3:8.0f} ms"
+              + ("" if result['answered'] == connections else
+                 f"  ({result['answered']} polls answered)"))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,97 @@
+"""Pulling and loading the whole user table: bulk formats against JSON
+
+Exports every user through GET /api/users (one JSON array) and through
+GET /api/users/export in each format, timing the request plus decoding
+the body on the client side, then loads the same users into an empty app
+through POST /api/users/batch and POST /api/users/import.
+
+Usage: python -m benchmarks.bulk_export [user_count]
+"""
+import csv
+import io
+import json
+import sys
+import time
+
+from app import bulk, create_app
+from app.config import Config
+
+
+class BenchConfig(Config):
+    METRICS_ENABLED = False
+    COMPRESSION_ENABLED = False
+
+
+def _json_rows(data):
+    return json.loads(data)
+
+
+def _columnar_rows(data):
+    return [row for columns in bulk.read_columnar(io.BytesIO(data))
+            for row in zip(*columns)]
+
+
+def _csv_rows(data):
+    return list(csv.reader(io.StringIO(data.decode('utf-8'))))[1:]
+
+
+def _ndjson_rows(data):
+    return [json.loads(line) for line in data.splitlines()]
+
+
+EXPORTS = (
+    ('GET /api/users (JSON)', '/api/users', _json_rows),
+    ('export columnar', '/api/users/export?format=columnar', _columnar_rows),
+    ('export csv', '/api/users/export?format=csv', _csv_rows),
+    ('export ndjson', '/api/users/export?format=ndjson', _ndjson_rows),
+)
+
+
+def _timed(function):
+    start = time.perf_counter()
+    result = function()
+    return result, time.perf_counter() - start
+
+
+def main(argv):
+    user_count = int(argv[1]) if len(argv) > 1 else 100_000
+    client = create_app(BenchConfig).test_client()
+    client.post('/api/users/batch', json=[
+        {"name": f"User {i % 5000}", "email": f"user{i}@example{i % 20}.com"}
+        for i in range(user_count)])
+
+    print(f"{user_count:,} users")
+    print(f"{'export':<24}{'bytes':>12}{'serve s':>10}{'decode s':>10}")
+    bodies = {}
+    for name, path, decode in EXPORTS:
+        data, serve = _timed(lambda path=path: client.get(path).get_data())
+        rows, parse = _timed(lambda: decode(data))
+        assert len(rows) == user_count
+        bodies[name] = data
+        print(f"{name:<24}{len(data):>12,}{serve:>10.3f}{parse:>10.3f}")
+
+    rows = json.loads(bodies['GET /api/users (JSON)'])
+    loads = (
+        ('POST /api/users/batch', '/api/users/batch',
+         json.dumps([{"name": r['name'], "email": r['email']}
+                     for r in rows]), 'application/json'),
+        ('import columnar', '/api/users/import',
+         bodies['export columnar'], bulk.COLUMNAR_MIMETYPE),
+        ('import csv', '/api/users/import', bodies['export csv'],
+         bulk.CSV_MIMETYPE),
+        ('import ndjson', '/api/users/import', bodies['export ndjson'],
+         'application/x-ndjson'),
+    )
+    print(f"\n{'load':<24}{'users/s':>12}")
+    for name, path, body, content_type in loads:
+        target = create_app(BenchConfig).test_client()
+        response, seconds = _timed(lambda path=path, body=body,
+                                   content_type=content_type: target.post(
+                                       path, data=body,
+                                       content_type=content_type))
+        assert response.status_code == 200
+        print(f"{name:<24}{user_count / seconds:>12,.0f}")
+
+
+if __name__ == '__main__':
+    main(sys.argv)
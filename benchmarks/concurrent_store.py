@@ -0,0 +1,54 @@
+"""Write/read throughput of the user stores as thread count grows
+
+Usage: python -m benchmarks.concurrent_store [ops_per_thread]
+"""
+import sys
+import threading
+import time
+
+from app.concurrent_store import ConcurrentUserStore
+from app.models import UserStore
+
+THREAD_COUNTS = (1, 2, 4, 8, 16)
+
+
+def run(store, thread_count, ops_per_thread):
+    """Run a create/read/update mix and return (ops/sec, duplicate ids)"""
+    barrier = threading.Barrier(thread_count + 1)
+    created = [[] for _ in range(thread_count)]
+
+    def worker(slot):
+        barrier.wait()
+        for i in range(ops_per_thread):
+            user = store.create_user(f"u{slot}-{i}", f"u{slot}-{i}@example.com")
+            created[slot].append(user.id)
+            store.get_user(user.id)
+            store.update_user(user.id, name=f"v{slot}-{i}")
+
+    threads = [threading.Thread(target=worker, args=(slot,))
+               for slot in range(thread_count)]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    ids = [user_id for chunk in created for user_id in chunk]
+    total_ops = 3 * thread_count * ops_per_thread
+    return total_ops / elapsed, len(ids) - len(set(ids))
+
+
+def main(argv):
+    ops_per_thread = int(argv[1]) if len(argv) > 1 else 20000
+    print(f"{'store':<12}{'threads':>8}{'ops/sec':>14}{'dup ids':>9}")
+    for name, factory in (('memory', UserStore),
+                          ('concurrent', ConcurrentUserStore)):
+        for thread_count in THREAD_COUNTS:
+            ops, duplicates = run(factory(), thread_count, ops_per_thread)
+            print(f"{name:<12}{thread_count:>8}{ops:>14,.0f}{duplicates:>9}")
+
+
+if __name__ == '__main__':
+    main(sys.argv)
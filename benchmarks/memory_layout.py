@@ -0,0 +1,113 @@
+"""Bytes per user for the original and compact user layouts
+
+The legacy and slots rows hold users the same way, in a dict keyed by
+ID, so they compare the User layouts alone. The memory backend row is
+the whole UserStore, whose sorted indexes for search and snapshots cost
+more than the slotted users themselves.
+
+Usage: python -m benchmarks.memory_layout [user_count]
+"""
+import sys
+import tracemalloc
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from app.columnar_store import ColumnarUserStore
+from app.models import User, UserStore
+
+
+class LegacyUser:
+    """The original User layout: instance __dict__ and an ISO string"""
+
+    def __init__(self, user_id, name, email):
+        self.id = user_id
+        self.name = name
+        self.email = email
+        self.created_at = datetime.now().isoformat()
+
+
+class LegacyUserStore:
+    """The original UserStore, unchanged but for holding LegacyUser
+
+    Kept as its own copy so later changes to UserStore cannot change the
+    baseline it is measured against.
+    """
+
+    def __init__(self):
+        self.users: Dict[int, LegacyUser] = {}
+        self.next_id = 1
+
+    def create_user(self, name: str, email: str) -> LegacyUser:
+        """Create a new user"""
+        user = LegacyUser(self.next_id, name, email)
+        self.users[self.next_id] = user
+        self.next_id += 1
+        return user
+
+    def get_user(self, user_id: int) -> Optional[LegacyUser]:
+        """Get user by ID"""
+        return self.users.get(user_id)
+
+    def get_all_users(self) -> List[LegacyUser]:
+        """Get all users"""
+        return list(self.users.values())
+
+    def update_user(self, user_id: int, name: str = None,
+                    email: str = None) -> Optional[LegacyUser]:
+        """Update user information"""
+        user = self.users.get(user_id)
+        if user:
+            if name:
+                user.name = name
+            if email:
+                user.email = email
+        return user
+
+    def delete_user(self, user_id: int) -> bool:
+        """Delete user by ID"""
+        if user_id in self.users:
+            del self.users[user_id]
+            return True
+        return False
+
+    def clear_all(self):
+        """Clear all users (for testing)"""
+        self.users.clear()
+        self.next_id = 1
+
+
+class SlotUserStore(LegacyUserStore):
+    """The same store holding slotted, epoch-stamped User objects"""
+
+    def create_user(self, name: str, email: str) -> User:
+        """Create a new user"""
+        user = User(self.next_id, name, email)
+        self.users[self.next_id] = user
+        self.next_id += 1
+        return user
+
+
+def measure(factory, user_count):
+    """Return bytes allocated per user to fill a fresh store"""
+    tracemalloc.start()
+    store = factory()
+    for i in range(user_count):
+        store.create_user(f"User {i}", f"user{i}@example.com")
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del store
+    return current / user_count
+
+
+def main(argv):
+    user_count = int(argv[1]) if len(argv) > 1 else 1_000_000
+    print(f"{user_count:,} users")
+    for name, factory in (('legacy (dict + ISO)', LegacyUserStore),
+                          ('slots + epoch', SlotUserStore),
+                          ('memory backend', UserStore),
+                          ('columnar', ColumnarUserStore)):
+        print(f"{name:<22}{measure(factory, user_count):>8.1f} bytes/user")
+
+
+if __name__ == '__main__':
+    main(sys.argv)
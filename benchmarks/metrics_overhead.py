@@ -0,0 +1,88 @@
+"""Per-request cost of the metrics instrumentation
+
+Usage: python -m benchmarks.metrics_overhead [requests]
+"""
+import sys
+import time
+
+from app import create_app
+from app.config import Config
+from app.metrics import Metrics
+
+
+def _config(enabled):
+    class BenchConfig(Config):
+        METRICS_ENABLED = enabled
+    return BenchConfig
+
+
+def request_latency(enabled, requests):
+    """Mean µs per GET /api/users/<id> through the test client"""
+    app = create_app(_config(enabled))
+    app.extensions['user_store'].create_user("John", "john@example.com")
+    client = app.test_client()
+    for _ in range(1000):
+        client.get('/api/users/1')
+    start = time.perf_counter()
+    for _ in range(requests):
+        client.get('/api/users/1')
+    return (time.perf_counter() - start) / requests * 1e6
+
+
+def hook_cost(iterations):
+    """Mean µs per request spent in the before/after request hooks"""
+    app = create_app(_config(True))
+    before = app.before_request_funcs[None]
+    after = app.after_request_funcs[None]
+    response = app.response_class(b'{"id": 1}', mimetype='application/json')
+    with app.test_request_context('/api/users/1'):
+        app.url_map.bind('localhost').match('/api/users/1')
+        start = time.perf_counter()
+        for _ in range(iterations):
+            for func in before:
+                func()
+            for func in after:
+                func(response)
+        return (time.perf_counter() - start) / iterations * 1e6
+
+
+def store_wrapper_cost(calls):
+    """Mean µs added to each store call by the timing wrapper"""
+    results = []
+    for enabled in (False, True):
+        store = create_app(_config(enabled)).extensions['user_store']
+        store.create_user("John", "john@example.com")
+        start = time.perf_counter()
+        for _ in range(calls):
+            store.get_user(1)
+        results.append((time.perf_counter() - start) / calls * 1e6)
+    return results[1] - results[0]
+
+
+def recorder_cost(observations):
+    """Mean µs per observe_request call"""
+    metrics = Metrics()
+    start = time.perf_counter()
+    for _ in range(observations):
+        metrics.observe_request('/api/users/<int:user_id>', 'GET', 200,
+                                0.0004, 0, 120)
+    return (time.perf_counter() - start) / observations * 1e6
+
+
+def main(argv):
+    requests = int(argv[1]) if len(argv) > 1 else 20_000
+    # Interleave runs so machine noise hits both sides alike
+    off, on = [], []
+    for _ in range(3):
+        off.append(request_latency(False, requests))
+        on.append(request_latency(True, requests))
+    print(f"observe_request:      {recorder_cost(1_000_000):.2f} µs")
+    print(f"request hooks:        {hook_cost(200_000):.2f} µs")
+    print(f"store call wrapper:   {store_wrapper_cost(1_000_000):.2f} µs")
+    print(f"request, metrics off: {min(off):.2f} µs")
+    print(f"request, metrics on:  {min(on):.2f} µs")
+    print(f"end to end (noisy):   {min(on) - min(off):+.2f} µs/request")
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,81 @@
+"""N sequential HTTP calls versus one POST /api/batch
+
+Runs the app on a local werkzeug server so each call pays a real
+round trip, then times the same reads sent one by one and as a batch.
+
+Usage: python -m benchmarks.multi_batch [calls]
+"""
+import http.client
+import json
+import sys
+import threading
+import time
+
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+from app import create_app
+from app.config import Config
+
+
+class BenchConfig(Config):
+    DEBUG = False
+    METRICS_ENABLED = False
+    COMPRESSION_ENABLED = False
+
+
+class _QuietHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+def _serve(app):
+    server = make_server('127.0.0.1', 0, app, threaded=True,
+                         request_handler=_QuietHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def sequential(conn, calls):
+    """Seconds to GET /api/users/<id> `calls` times, one after another"""
+    start = time.perf_counter()
+    for user_id in range(1, calls + 1):
+        conn.request('GET', f'/api/users/{user_id}')
+        conn.getresponse().read()
+    return time.perf_counter() - start
+
+
+def batched(conn, calls):
+    """Seconds to send the same reads as one batch"""
+    body = json.dumps({"requests": [{"path": f"/api/users/{user_id}"}
+                                    for user_id in range(1, calls + 1)]})
+    start = time.perf_counter()
+    conn.request('POST', '/api/batch', body,
+                 {'Content-Type': 'application/json'})
+    conn.getresponse().read()
+    return time.perf_counter() - start
+
+
+def main(argv):
+    calls = int(argv[1]) if len(argv) > 1 else 50
+    app = create_app(BenchConfig)
+    app.config['BATCH_MAX_REQUESTS'] = max(calls, 100)
+    store = app.extensions['user_store']
+    store.create_users([(f"User {i}", f"user{i}@example.com")
+                        for i in range(calls)])
+    server = _serve(app)
+    conn = http.client.HTTPConnection('127.0.0.1', server.server_port)
+    try:
+        sequential(conn, calls)
+        batched(conn, calls)
+        seq = min(sequential(conn, calls) for _ in range(5))
+        batch = min(batched(conn, calls) for _ in range(5))
+    finally:
+        conn.close()
+        server.shutdown()
+    print(f"{calls} sequential calls: {seq * 1e3:8.2f} ms")
+    print(f"one batch of {calls}:     {batch * 1e3:8.2f} ms "
+          f"({seq / batch:.1f}x faster)")
+
+
+if __name__ == '__main__':
+    main(sys.argv)
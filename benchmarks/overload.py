@@ -0,0 +1,94 @@
+"""Read latency while bulk writes overload the app, with and without
+admission control
+
+Reader threads fetch single users back to back while writer threads
+post batches of new users as fast as they are answered, all against one
+in-process app for a fixed time. Writers told 503 wait out Retry-After.
+Shed requests count as errors, so the bulk row's error rate is the share
+of batches turned away.
+
+Usage: python -m benchmarks.overload [seconds] [readers] [writers]
+"""
+import itertools
+import random
+import sys
+import threading
+import time
+
+from app import create_app
+from benchmarks.replay import (Recorder, ReplayConfig, app_sender,
+                               print_report, seed_users, summarize)
+
+SEED_USERS = 10_000
+BATCH_ROWS = 500
+
+
+class NoAdmissionConfig(ReplayConfig):
+    ADMISSION_ENABLED = False
+
+
+class AdmissionConfig(ReplayConfig):
+    ADMISSION_ENABLED = True
+    # Batches are CPU bound: with one core, one at a time is plenty
+    ADMISSION_ROUTE_LIMITS = {'/api/users/batch': 1}
+
+
+def run(config, seconds: float, readers: int, writers: int) -> Recorder:
+    """Recorder of `seconds` of reads and bulk writes against a new app"""
+    make_sender = app_sender(create_app(config))
+    seed_users(make_sender, SEED_USERS)
+    recorder = Recorder()
+    batch_numbers = itertools.count()
+    deadline = time.perf_counter() + seconds
+
+    def reader(seed):
+        send = make_sender()
+        rng = random.Random(seed)
+        while time.perf_counter() < deadline:
+            entry = {"method": "GET",
+                     "path": f"/api/users/{rng.randint(1, SEED_USERS)}"}
+            start = time.perf_counter()
+            status = send(entry)
+            recorder.record('GET /api/users/<id>',
+                            time.perf_counter() - start, status < 400)
+
+    def writer():
+        send = make_sender()
+        while time.perf_counter() < deadline:
+            batch = next(batch_numbers)
+            entry = {"method": "POST", "path": "/api/users/batch",
+                     "body": [{"name": f"Bulk {batch}",
+                               "email": f"bulk{batch}.{i}@example.com"}
+                              for i in range(BATCH_ROWS)]}
+            start = time.perf_counter()
+            status = send(entry)
+            recorder.record('POST /api/users/batch',
+                            time.perf_counter() - start, status < 400)
+            if status == 503:
+                time.sleep(1)  # as Retry-After asks
+
+    threads = ([threading.Thread(target=reader, args=(seed,))
+                for seed in range(readers)] +
+               [threading.Thread(target=writer) for _ in range(writers)])
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return recorder
+
+
+def main(argv):
+    seconds = float(argv[1]) if len(argv) > 1 else 5.0
+    readers = int(argv[2]) if len(argv) > 2 else 4
+    writers = int(argv[3]) if len(argv) > 3 else 8
+    print(f"{seconds:g}s, {readers} readers, {writers} bulk writers "
+          f"({BATCH_ROWS} users per batch)")
+    for name, config in (('without admission control', NoAdmissionConfig),
+                         ('with admission control', AdmissionConfig)):
+        print(f"\n{name}")
+        print_report(summarize(run(config, seconds, readers, writers),
+                               seconds))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,93 @@
+"""Request throughput of serve.py from 1 worker up to one per core
+
+For each worker count, starts the prefork server, loads it with users,
+then has client processes issue GET /api/users/<id> over keep-alive
+connections for a fixed time. Clients run on the same machine and use
+CPU too, so the speedup is a lower bound of what the server can do.
+
+Usage: python -m benchmarks.prefork_scaling [seconds] [max workers]
+"""
+import http.client
+import json
+import multiprocessing
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+from app.prefork import default_workers
+
+USERS = 1000
+CLIENTS_PER_WORKER = 2
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _client(port, seconds, results):
+    conn = http.client.HTTPConnection('127.0.0.1', port)
+    done = 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        conn.request('GET', f'/api/users/{random.randint(1, USERS)}')
+        conn.getresponse().read()
+        done += 1
+    conn.close()
+    results.put(done)
+
+
+def measure(workers, seconds):
+    """Requests per second served with `workers` worker processes"""
+    port = _free_port()
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    server = subprocess.Popen(
+        [sys.executable, 'serve.py', '--host', '127.0.0.1',
+         '--port', str(port), '--workers', str(workers)],
+        cwd=root, stdout=subprocess.PIPE, text=True)
+    try:
+        server.stdout.readline()
+        conn = http.client.HTTPConnection('127.0.0.1', port)
+        conn.request('POST', '/api/users/batch', json.dumps(
+            [{"name": f"User {i}", "email": f"user{i}@example.com"}
+             for i in range(USERS)]), {'Content-Type': 'application/json'})
+        conn.getresponse().read()
+        conn.close()
+
+        results = multiprocessing.Queue()
+        clients = [multiprocessing.Process(target=_client,
+                                           args=(port, seconds, results))
+                   for _ in range(CLIENTS_PER_WORKER * workers)]
+        for client in clients:
+            client.start()
+        total = sum(results.get() for _ in clients)
+        for client in clients:
+            client.join()
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait()
+    return total / seconds
+
+
+def main(argv):
+    seconds = float(argv[1]) if len(argv) > 1 else 5
+    most = int(argv[2]) if len(argv) > 2 else default_workers()
+    counts = sorted({1, 2, most} | set(range(4, most + 1, 4)))
+    counts = [count for count in counts if count <= most]
+    print(f"{default_workers()} cores available; "
+          f"{CLIENTS_PER_WORKER} client processes per worker")
+    base = None
+    for workers in counts:
+        rate = measure(workers, seconds)
+        base = base or rate
+        print(f"{workers:3} workers: {rate:9.0f} req/s "
+              f"({rate / base:.2f}x)")
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,48 @@
+"""Request latency with sampled profiling at various rates
+
+Usage: python -m benchmarks.profiling_overhead [requests]
+"""
+import sys
+import time
+
+from app import create_app
+from app.config import Config
+
+
+def _config(mode, rate):
+    class BenchConfig(Config):
+        PROFILING_ENABLED = mode is not None
+        PROFILING_MODE = mode or 'cprofile'
+        PROFILING_SAMPLE_RATE = rate
+    return BenchConfig
+
+
+def request_latency(mode, rate, requests):
+    """Mean µs per GET /api/users/<id> through the test client"""
+    app = create_app(_config(mode, rate))
+    app.extensions['user_store'].create_user("John", "john@example.com")
+    client = app.test_client()
+    for _ in range(500):
+        client.get('/api/users/1')
+    start = time.perf_counter()
+    for _ in range(requests):
+        client.get('/api/users/1')
+    elapsed = (time.perf_counter() - start) / requests * 1e6
+    if mode is not None:
+        app.extensions['profiler'].stop()
+    return elapsed
+
+
+def main(argv):
+    requests = int(argv[1]) if len(argv) > 1 else 10_000
+    runs = (('off', None, 0.0), ('cprofile 1%', 'cprofile', 0.01),
+            ('sample 1%', 'sample', 0.01), ('cprofile 100%', 'cprofile', 1.0),
+            ('sample 100%', 'sample', 1.0))
+    for label, mode, rate in runs:
+        # Best of three to keep machine noise out
+        best = min(request_latency(mode, rate, requests) for _ in range(3))
+        print(f"{label:<15}{best:>10.1f} µs/request")
+
+
+if __name__ == '__main__':
+    main(sys.argv)
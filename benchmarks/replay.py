@@ -0,0 +1,364 @@
+"""Replay recorded traffic, or a synthetic mix, against the API
+
+A log is JSONL, one request per line:
+
+    {"timestamp": 0.25, "method": "PUT", "path": "/api/users/7",
+     "body": {"name": "Jo"}}
+
+`timestamp` is in seconds (any origin) and `body`, if present, is sent
+as JSON. Requests go to an in-process create_app() unless --url names a
+running server.
+
+Open loop (the default) issues each request at its recorded time,
+scaled by --speed, whether or not earlier ones have finished; latency
+is counted from that scheduled time, so a server falling behind shows
+up as queueing rather than as a slower arrival rate. --closed instead
+has --concurrency clients each sending the next request as soon as
+their previous one completes, ignoring timestamps.
+
+--generate builds a synthetic log instead: Poisson arrivals at --rate,
+--read-ratio GET /api/users/<id> against Zipf-distributed user IDs, and
+the rest writes (PUT renames of Zipf-picked users, one in ten a POST).
+
+Usage:
+    python -m benchmarks.replay traffic.jsonl --speed 2
+    python -m benchmarks.replay traffic.jsonl --url http://127.0.0.1:5000
+    python -m benchmarks.replay --generate 20000 --rate 1000 --zipf 1.2
+    python -m benchmarks.replay --generate 20000 --record traffic.jsonl
+"""
+import argparse
+import bisect
+import http.client
+import itertools
+import json
+import queue
+import random
+import re
+import sys
+import threading
+import time
+from collections import defaultdict
+from typing import Callable, Dict, Iterable, List, Optional
+from urllib.parse import urlsplit
+
+from app import create_app
+from app.config import Config
+
+SEED_CHUNK = 1000
+WRITE_CREATE_SHARE = 0.1
+_ID_SEGMENT = re.compile(r'/\d+(?=/|$)')
+
+
+class ReplayConfig(Config):
+    METRICS_ENABLED = False
+
+
+def load_log(path: str) -> List[Dict]:
+    """Entries of a JSONL request log, in timestamp order"""
+    with open(path, encoding='utf-8') as file:
+        entries = [json.loads(line) for line in file if line.strip()]
+    entries.sort(key=lambda entry: entry.get('timestamp', 0))
+    return entries
+
+
+def save_log(path: str, entries: Iterable[Dict]):
+    """Write entries as a JSONL request log"""
+    with open(path, 'w', encoding='utf-8') as file:
+        for entry in entries:
+            file.write(json.dumps(entry) + '\n')
+
+
+class Zipf:
+    """Draws ranks 1..n with probability proportional to 1 / rank**s"""
+
+    def __init__(self, n: int, s: float, rng: random.Random):
+        self._rng = rng
+        self._cumulative = list(itertools.accumulate(
+            1 / rank ** s for rank in range(1, n + 1)))
+
+    def __call__(self) -> int:
+        point = self._rng.random() * self._cumulative[-1]
+        return bisect.bisect_left(self._cumulative, point) + 1
+
+
+def generate(count: int, users: int, read_ratio: float = 0.95,
+             zipf: float = 1.1, rate: float = 500.0,
+             seed: int = 0) -> List[Dict]:
+    """A synthetic log of `count` requests against users 1..`users`"""
+    rng = random.Random(seed)
+    pick = Zipf(users, zipf, rng)
+    entries = []
+    now = 0.0
+    for i in range(count):
+        now += rng.expovariate(rate)
+        if rng.random() < read_ratio:
+            entry = {"method": "GET", "path": f"/api/users/{pick()}"}
+        elif rng.random() < WRITE_CREATE_SHARE:
+            entry = {"method": "POST", "path": "/api/users",
+                     "body": {"name": f"New {i}",
+                              "email": f"new{seed}-{i}@example.com"}}
+        else:
+            entry = {"method": "PUT", "path": f"/api/users/{pick()}",
+                     "body": {"name": f"Renamed {i}"}}
+        entry["timestamp"] = round(now, 6)
+        entries.append(entry)
+    return entries
+
+
+def route_of(entry: Dict) -> str:
+    """Group key of a request: method, path with IDs folded, query keys"""
+    parts = urlsplit(entry['path'])
+    route = f"{entry['method']} {_ID_SEGMENT.sub('/<id>', parts.path)}"
+    if parts.query:
+        keys = sorted({pair.split('=', 1)[0]
+                       for pair in parts.query.split('&')})
+        route += '?' + '&'.join(keys)
+    return route
+
+
+def app_sender(app) -> Callable[[], Callable[[Dict], int]]:
+    """Sender factory for an in-process app; one test client per thread"""
+    def make():
+        client = app.test_client()
+
+        def send(entry):
+            response = client.open(entry['path'], method=entry['method'],
+                                   json=entry.get('body'),
+                                   headers=entry.get('headers'))
+            response.close()
+            return response.status_code
+        return send
+    return make
+
+
+def http_sender(url: str) -> Callable[[], Callable[[Dict], int]]:
+    """Sender factory for a server; one keep-alive connection per thread"""
+    parts = urlsplit(url)
+
+    def make():
+        conn = http.client.HTTPConnection(parts.hostname, parts.port or 80)
+
+        def send(entry):
+            body = headers = None
+            if 'body' in entry:
+                body = json.dumps(entry['body'])
+                headers = {'Content-Type': 'application/json'}
+            headers = {**(headers or {}), **entry.get('headers', {})}
+            try:
+                conn.request(entry['method'], parts.path.rstrip('/') +
+                             entry['path'], body, headers)
+                response = conn.getresponse()
+                response.read()
+                return response.status
+            except (OSError, http.client.HTTPException):
+                conn.close()  # reconnects on the next request
+                raise
+        return send
+    return make
+
+
+def seed_users(make_sender, count: int):
+    """Create users 1..count (on an empty store) through the batch API"""
+    send = make_sender()
+    for start in range(0, count, SEED_CHUNK):
+        rows = [{"name": f"User {i}", "email": f"user{i}@example.com"}
+                for i in range(start, min(count, start + SEED_CHUNK))]
+        status = send({"method": "POST", "path": "/api/users/batch",
+                       "body": rows})
+        if status != 200:
+            raise RuntimeError(f"Seeding users failed with {status}")
+
+
+class Recorder:
+    """Latencies and error counts per route, shared by client threads"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def record(self, route: str, seconds: float, ok: bool):
+        with self._lock:
+            self.latencies[route].append(seconds)
+            if not ok:
+                self.errors[route] += 1
+
+
+def _issue(send, entry, recorder: Recorder, started: float):
+    try:
+        ok = send(entry) < 400
+    except Exception:  # pylint: disable=broad-except
+        ok = False
+    recorder.record(route_of(entry), time.perf_counter() - started, ok)
+
+
+def replay_closed(entries: List[Dict], make_sender,
+                  concurrency: int) -> Recorder:
+    """Send entries from `concurrency` clients, each waiting on its last"""
+    recorder = Recorder()
+    pending = iter(entries)
+    lock = threading.Lock()
+
+    def client():
+        send = make_sender()
+        while True:
+            with lock:
+                entry = next(pending, None)
+            if entry is None:
+                return
+            _issue(send, entry, recorder, time.perf_counter())
+
+    _run_threads(client, concurrency)
+    return recorder
+
+
+def replay_open(entries: List[Dict], make_sender, concurrency: int,
+                speed: float = 1.0) -> Recorder:
+    """Send entries at their recorded times divided by `speed`
+
+    At most `concurrency` requests are in flight; the rest wait in a
+    queue, and that wait counts toward their latency.
+    """
+    recorder = Recorder()
+    due = queue.SimpleQueue()
+
+    def client():
+        send = make_sender()
+        while True:
+            item = due.get()
+            if item is None:
+                return
+            _issue(send, item[1], recorder, item[0])
+
+    threads = _start_threads(client, concurrency)
+    origin = entries[0].get('timestamp', 0) if entries else 0
+    start = time.perf_counter()
+    for entry in entries:
+        scheduled = start + (entry.get('timestamp', 0) - origin) / speed
+        delay = scheduled - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        due.put((scheduled, entry))
+    for _ in threads:
+        due.put(None)
+    for thread in threads:
+        thread.join()
+    return recorder
+
+
+def _start_threads(target, count: int) -> List[threading.Thread]:
+    threads = [threading.Thread(target=target, daemon=True)
+               for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    return threads
+
+
+def _run_threads(target, count: int):
+    for thread in _start_threads(target, count):
+        thread.join()
+
+
+def _percentile(ordered: List[float], fraction: float) -> float:
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def summarize(recorder: Recorder, elapsed: float) -> Dict[str, Dict]:
+    """Throughput, latency percentiles (ms) and error rate per route,
+    plus an 'all' row"""
+    rows = {}
+    groups = dict(recorder.latencies)
+    groups['all'] = [latency for latencies in recorder.latencies.values()
+                     for latency in latencies]
+    for route, latencies in groups.items():
+        if not latencies:
+            continue
+        ordered = sorted(latencies)
+        errors = (sum(recorder.errors.values()) if route == 'all'
+                  else recorder.errors[route])
+        rows[route] = {
+            "count": len(ordered),
+            "req_per_sec": len(ordered) / elapsed,
+            **{f"p{label}_ms": _percentile(ordered, fraction) * 1e3
+               for label, fraction in (('50', 0.5), ('95', 0.95),
+                                       ('99', 0.99), ('999', 0.999))},
+            "error_rate": errors / len(ordered)}
+    return rows
+
+
+def print_report(rows: Dict[str, Dict]):
+    print(f"{'route':<32}{'count':>8}{'req/s':>9}{'p50 ms':>9}"
+          f"{'p95 ms':>9}{'p99 ms':>9}{'p999 ms':>9}{'errors':>8}")
+    for route in sorted(rows, key=lambda route: (route == 'all', route)):
+        row = rows[route]
+        print(f"{route:<32}{row['count']:>8}{row['req_per_sec']:>9,.0f}"
+              f"{row['p50_ms']:>9.2f}{row['p95_ms']:>9.2f}"
+              f"{row['p99_ms']:>9.2f}{row['p999_ms']:>9.2f}"
+              f"{row['error_rate']:>8.1%}")
+
+
+def main(argv) -> Optional[int]:
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks.replay',
+        description="Replay a JSONL request log or a synthetic mix")
+    parser.add_argument('log', nargs='?', help="JSONL request log")
+    parser.add_argument('--url', help="server to target instead of an "
+                                      "in-process app")
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help="replay rate multiplier (open loop)")
+    parser.add_argument('--closed', action='store_true',
+                        help="closed loop: ignore timestamps")
+    parser.add_argument('--seed-users', type=int,
+                        help="users to create first (default: --users "
+                             "when generating, else none)")
+    synthetic = parser.add_argument_group('synthetic mix')
+    synthetic.add_argument('--generate', type=int, metavar='COUNT')
+    synthetic.add_argument('--users', type=int, default=1000)
+    synthetic.add_argument('--read-ratio', type=float, default=0.95)
+    synthetic.add_argument('--zipf', type=float, default=1.1)
+    synthetic.add_argument('--rate', type=float, default=500.0,
+                           help="mean requests per second")
+    synthetic.add_argument('--record', metavar='FILE',
+                           help="write the generated log and exit")
+    args = parser.parse_args(argv[1:])
+
+    if args.generate:
+        entries = generate(args.generate, args.users, args.read_ratio,
+                           args.zipf, args.rate)
+        if args.record:
+            save_log(args.record, entries)
+            print(f"Wrote {len(entries)} requests to {args.record}")
+            return 0
+        default_seed = args.users
+    elif args.log:
+        entries = load_log(args.log)
+        default_seed = 0
+    else:
+        parser.error("give a request log or --generate COUNT")
+
+    if args.url:
+        make_sender = http_sender(args.url)
+    else:
+        make_sender = app_sender(create_app(ReplayConfig))
+    seed_count = (args.seed_users if args.seed_users is not None
+                  else default_seed)
+    if seed_count:
+        seed_users(make_sender, seed_count)
+
+    mode = 'closed loop' if args.closed else f'open loop at {args.speed:g}x'
+    print(f"Replaying {len(entries)} requests against "
+          f"{args.url or 'create_app()'} ({mode}, "
+          f"concurrency {args.concurrency})")
+    start = time.perf_counter()
+    if args.closed:
+        recorder = replay_closed(entries, make_sender, args.concurrency)
+    else:
+        recorder = replay_open(entries, make_sender, args.concurrency,
+                               args.speed)
+    print_report(summarize(recorder, time.perf_counter() - start))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
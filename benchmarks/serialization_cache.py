@@ -0,0 +1,68 @@
+"""Read latency of the user endpoints with the JSON cache on and off
+
+Also times the full listing projected to ?fields=id,email.
+
+Usage: python -m benchmarks.serialization_cache [user_count]
+"""
+import random
+import sys
+import time
+
+from app import create_app
+from app.config import Config
+
+
+def _config(provider, cache_enabled):
+    class BenchConfig(Config):
+        JSON_PROVIDER = provider
+        JSON_CACHE_ENABLED = cache_enabled
+    return BenchConfig
+
+
+def run(provider, cache_enabled, user_count, requests):
+    """Return (single-user µs, page-of-100 µs, full list ms, id+email ms)"""
+    app = create_app(_config(provider, cache_enabled))
+    app.extensions['user_store'].create_users(
+        [(f"User {i}", f"user{i}@example.com") for i in range(user_count)])
+    client = app.test_client()
+    ids = [random.randint(1, user_count) for _ in range(requests)]
+
+    start = time.perf_counter()
+    for user_id in ids:
+        client.get(f'/api/users/{user_id}')
+    single = (time.perf_counter() - start) / requests * 1e6
+
+    start = time.perf_counter()
+    for user_id in ids[:requests // 10]:
+        client.get(f'/api/users?limit=100&after_id={user_id}')
+    page = (time.perf_counter() - start) / (requests // 10) * 1e6
+
+    client.get('/api/users')  # warm the cache for the full listing
+    start = time.perf_counter()
+    for _ in range(5):
+        client.get('/api/users')
+    full = (time.perf_counter() - start) / 5 * 1e3
+
+    start = time.perf_counter()
+    for _ in range(5):
+        client.get('/api/users?fields=id,email')
+    sparse = (time.perf_counter() - start) / 5 * 1e3
+    return single, page, full, sparse
+
+
+def main(argv):
+    user_count = int(argv[1]) if len(argv) > 1 else 50_000
+    requests = 5_000
+    print(f"{user_count:,} users")
+    print(f"{'provider':<10}{'cache':<7}{'get (µs)':>12}{'page (µs)':>12}"
+          f"{'list (ms)':>12}{'id,email (ms)':>15}")
+    for provider in ('stdlib', 'auto'):
+        for cache_enabled in (False, True):
+            results = run(provider, cache_enabled, user_count, requests)
+            print(f"{provider:<10}{'on' if cache_enabled else 'off':<7}"
+                  f"{results[0]:>12,.1f}{results[1]:>12,.1f}"
+                  f"{results[2]:>12,.1f}{results[3]:>15,.1f}")
+
+
+if __name__ == '__main__':
+    main(sys.argv)
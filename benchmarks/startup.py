@@ -0,0 +1,49 @@
+"""Startup time: rebuilding a store from a snapshot vs mapping it
+
+Usage: python -m benchmarks.startup [user_count ...]
+"""
+import os
+import sys
+import tempfile
+import time
+
+from app.models import User, UserStore
+from app.snapshot import MappedUserStore, load_snapshot, write_snapshot
+
+DEFAULT_SIZES = (100_000, 1_000_000, 10_000_000)
+
+
+def synthetic_users(count):
+    """Generate users without keeping them all in memory"""
+    for i in range(1, count + 1):
+        yield User(i, f"User {i}", f"user{i}@example.com", 1.7e9 + i)
+
+
+def main(argv):
+    sizes = [int(arg) for arg in argv[1:]] or DEFAULT_SIZES
+    print(f"{'users':>12}{'cold rebuild':>15}{'mmap open':>12}"
+          f"{'first read':>12}")
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'users.snap')
+        for count in sizes:
+            write_snapshot(synthetic_users(count), count + 1, path)
+
+            start = time.perf_counter()
+            store = UserStore()
+            load_snapshot(store, path)
+            cold = time.perf_counter() - start
+            del store
+
+            start = time.perf_counter()
+            mapped = MappedUserStore.open(path)
+            opened = time.perf_counter() - start
+            mapped.get_user(count // 2)
+            first_read = time.perf_counter() - start - opened
+
+            print(f"{count:>12,}{cold * 1000:>13.1f}ms{opened * 1000:>10.2f}ms"
+                  f"{first_read * 1000:>10.3f}ms")
+            mapped.clear_all()
+
+
+if __name__ == '__main__':
+    main(sys.argv)
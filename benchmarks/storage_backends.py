@@ -0,0 +1,64 @@
+"""Read/write throughput of each storage backend
+
+Usage: python -m benchmarks.storage_backends [user_count]
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+
+from app.columnar_store import ColumnarUserStore
+from app.concurrent_store import ConcurrentUserStore
+from app.models import UserStore
+from app.sqlite_store import SQLiteUserStore
+
+
+def run(store, user_count):
+    """Return (creates/sec, reads/sec, updates/sec, page reads/sec)"""
+    start = time.perf_counter()
+    for i in range(user_count):
+        store.create_user(f"User {i}", f"user{i}@example.com")
+    creates = user_count / (time.perf_counter() - start)
+
+    ids = [random.randint(1, user_count) for _ in range(user_count)]
+    start = time.perf_counter()
+    for user_id in ids:
+        store.get_user(user_id)
+    reads = user_count / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for user_id in ids[:user_count // 10]:
+        store.update_user(user_id, name="Renamed")
+    updates = (user_count // 10) / (time.perf_counter() - start)
+
+    pages = max(1, user_count // 100)
+    start = time.perf_counter()
+    for user_id in ids[:pages]:
+        store.get_users_page(user_id, 100)
+    page_reads = pages / (time.perf_counter() - start)
+    return creates, reads, updates, page_reads
+
+
+def main(argv):
+    user_count = int(argv[1]) if len(argv) > 1 else 100_000
+    with tempfile.TemporaryDirectory() as directory:
+        backends = (
+            ('memory', UserStore),
+            ('concurrent', ConcurrentUserStore),
+            ('columnar', ColumnarUserStore),
+            ('sqlite', lambda: SQLiteUserStore(
+                os.path.join(directory, 'users.db'))),
+        )
+        print(f"{user_count:,} users, operations/sec")
+        print(f"{'backend':<12}{'create':>12}{'get':>12}{'update':>12}"
+              f"{'page(100)':>12}")
+        for name, factory in backends:
+            store = factory()
+            results = run(store, user_count)
+            store.close()
+            print(f"{name:<12}" + ''.join(f"{r:>12,.0f}" for r in results))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,394 @@
+"""Microbenchmarks of store operations, serialization and endpoints
+
+Every case runs against a store of each requested size and reports
+operations per second, latency percentiles and the bytes allocated per
+operation (the peak tracemalloc sees above the starting point). Results
+can be saved as a JSON baseline and later runs compared against it: a
+case regresses when its median latency or its allocations grow by more
+than the threshold, and the run then exits with status 1.
+
+Baselines are only comparable on the machine that recorded them, and
+only with runs of the same backend at sizes the baseline has results
+for; --compare refuses any other baseline before running.
+
+Usage:
+    python -m benchmarks.suite --save benchmarks/baseline.json
+    python -m benchmarks.suite --compare benchmarks/baseline.json
+    python -m benchmarks.suite --sizes 1000,1000000 --only 'GET *'
+"""
+import argparse
+import fnmatch
+import gc
+import json
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, Dict, List, NamedTuple, Optional
+
+from app import create_app
+from app.config import Config
+
+DEFAULT_SIZES = (1_000, 10_000, 100_000)
+DEFAULT_THRESHOLD = 0.2
+# Allocation growth below this many bytes per operation is never flagged
+ALLOC_SLACK_BYTES = 256
+# Timed iterations of cheap cases; O(n) cases run fewer on large stores
+ITERATIONS = 2000
+HEAVY_BUDGET = 2_000_000  # iterations * store size for O(n) cases
+ALLOC_ITERATIONS = 20
+
+
+class BenchConfig(Config):
+    METRICS_ENABLED = False
+    COMPRESSION_ENABLED = False
+
+
+class Context:
+    """What a case's setup gets: the app, its store and a client"""
+
+    def __init__(self, app, size: int):
+        self.app = app
+        self.store = app.extensions['user_store']
+        self.client = app.test_client()
+        self.size = size
+        self.random = random.Random(size)
+        self._unique = 0
+
+    def random_id(self) -> int:
+        """ID of one of the users the store was filled with"""
+        return self.random.randint(1, self.size)
+
+    def unique(self) -> int:
+        """A number no earlier call returned, for unique emails"""
+        self._unique += 1
+        return self._unique
+
+    def spare_users(self, count: int) -> List[int]:
+        """IDs of `count` freshly created users, for destructive cases"""
+        base = self.unique()
+        users = self.store.create_users(
+            [("Spare", f"spare{base}-{i}@bench.example")
+             for i in range(count)])
+        return [user.id for user in users]
+
+
+class Case(NamedTuple):
+    """One benchmark: `setup(context, runs)` returns the timed op"""
+    name: str
+    setup: Callable[[Context, int], Callable[[int], object]]
+    heavy: bool = False  # O(store size) per operation
+
+
+CASES: List[Case] = []
+
+
+def case(name: str, heavy: bool = False):
+    """Register a setup function as a benchmark case"""
+    def register(setup):
+        CASES.append(Case(name, setup, heavy))
+        return setup
+    return register
+
+
+@case('store.create_user')
+def _create_user(ctx, runs):
+    base = ctx.unique()
+    return lambda i: ctx.store.create_user(
+        "New User", f"new{base}-{i}@bench.example")
+
+
+@case('store.get_user')
+def _get_user(ctx, runs):
+    ids = [ctx.random_id() for _ in range(runs)]
+    return lambda i: ctx.store.get_user(ids[i])
+
+
+@case('store.get_user_by_email')
+def _get_user_by_email(ctx, runs):
+    emails = [f"user{ctx.random_id() - 1}@example.com" for _ in range(runs)]
+    return lambda i: ctx.store.get_user_by_email(emails[i])
+
+
+@case('store.get_users_page')
+def _get_users_page(ctx, runs):
+    ids = [ctx.random_id() for _ in range(runs)]
+    return lambda i: ctx.store.get_users_page(ids[i], 100)
+
+
+@case('store.search_users')
+def _search_users(ctx, runs):
+    prefixes = [f"User {ctx.random_id()}" for _ in range(runs)]
+    return lambda i: ctx.store.search_users(name_prefix=prefixes[i],
+                                            sort='name', limit=20)
+
+
+@case('store.update_user')
+def _update_user(ctx, runs):
+    ids = [ctx.random_id() for _ in range(runs)]
+    return lambda i: ctx.store.update_user(ids[i], name=f"Renamed {i}")
+
+
+@case('store.delete_user')
+def _delete_user(ctx, runs):
+    ids = ctx.spare_users(runs)
+    return lambda i: ctx.store.delete_user(ids[i])
+
+
+@case('store.count_users')
+def _count_users(ctx, runs):
+    return lambda i: ctx.store.count_users()
+
+
+@case('store.stats')
+def _stats(ctx, runs):
+    return lambda i: ctx.store.stats(20)
+
+
+@case('store.get_all_users', heavy=True)
+def _get_all_users(ctx, runs):
+    return lambda i: ctx.store.get_all_users()
+
+
+@case('User.to_dict')
+def _to_dict(ctx, runs):
+    users = [ctx.store.get_user(ctx.random_id()) for _ in range(runs)]
+    return lambda i: users[i].to_dict()
+
+
+@case('json.user')
+def _json_user(ctx, runs):
+    users = [ctx.store.get_user(ctx.random_id()) for _ in range(runs)]
+    dumps = ctx.app.json.dumps_bytes
+    return lambda i: dumps(users[i].to_dict())
+
+
+@case('GET /api/users/<id>')
+def _get_user_route(ctx, runs):
+    paths = [f'/api/users/{ctx.random_id()}' for _ in range(runs)]
+    return lambda i: ctx.client.get(paths[i])
+
+
+@case('GET /api/users?limit=100')
+def _get_page_route(ctx, runs):
+    paths = [f'/api/users?limit=100&after_id={ctx.random_id()}'
+             for _ in range(runs)]
+    return lambda i: ctx.client.get(paths[i])
+
+
+@case('GET /api/users?name_prefix')
+def _search_route(ctx, runs):
+    paths = [f'/api/users?name_prefix=User+{ctx.random_id()}&sort=name'
+             f'&limit=20' for _ in range(runs)]
+    return lambda i: ctx.client.get(paths[i])
+
+
+@case('GET /api/users', heavy=True)
+def _list_route(ctx, runs):
+    return lambda i: ctx.client.get('/api/users')
+
+
+@case('GET /api/users/count')
+def _count_route(ctx, runs):
+    return lambda i: ctx.client.get('/api/users/count')
+
+
+@case('GET /api/users/stats')
+def _stats_route(ctx, runs):
+    return lambda i: ctx.client.get('/api/users/stats')
+
+
+@case('POST /api/users')
+def _create_route(ctx, runs):
+    base = ctx.unique()
+    return lambda i: ctx.client.post('/api/users', json={
+        "name": "New User", "email": f"post{base}-{i}@bench.example"})
+
+
+@case('PUT /api/users/<id>')
+def _update_route(ctx, runs):
+    paths = [f'/api/users/{ctx.random_id()}' for _ in range(runs)]
+    return lambda i: ctx.client.put(paths[i], json={"name": f"Renamed {i}"})
+
+
+@case('DELETE /api/users/<id>')
+def _delete_route(ctx, runs):
+    paths = [f'/api/users/{user_id}' for user_id in ctx.spare_users(runs)]
+    return lambda i: ctx.client.delete(paths[i])
+
+
+def _percentile(ordered: List[int], fraction: float) -> float:
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def measure(ctx: Context, bench: Case, iterations: int) -> Dict:
+    """Time `iterations` runs of a case, then trace the allocations of a
+    few more"""
+    warmup = min(50, iterations // 10)
+    alloc_runs = min(ALLOC_ITERATIONS, iterations)
+    op = bench.setup(ctx, warmup + iterations + alloc_runs)
+    for i in range(warmup):
+        op(i)
+
+    gc.collect()
+    timings = []
+    clock = time.perf_counter_ns
+    start = clock()
+    for i in range(warmup, warmup + iterations):
+        begin = clock()
+        op(i)
+        timings.append(clock() - begin)
+    total = clock() - start
+    timings.sort()
+
+    allocated = []
+    tracemalloc.start()
+    try:
+        for i in range(warmup + iterations, warmup + iterations + alloc_runs):
+            before = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            op(i)
+            allocated.append(tracemalloc.get_traced_memory()[1] - before)
+    finally:
+        tracemalloc.stop()
+
+    return {"ops_per_sec": iterations / total * 1e9,
+            "p50_us": _percentile(timings, 0.5) / 1e3,
+            "p90_us": _percentile(timings, 0.9) / 1e3,
+            "p99_us": _percentile(timings, 0.99) / 1e3,
+            "alloc_bytes": sorted(allocated)[len(allocated) // 2]}
+
+
+def _make_app(backend: str, directory: str, size: int):
+    class SuiteConfig(BenchConfig):
+        USER_STORE_BACKEND = backend
+        SQLITE_PATH = f'{directory}/users-{size}.db'
+
+    app = create_app(SuiteConfig)
+    store = app.extensions['user_store']
+    for start in range(0, size, 10_000):
+        store.create_users([(f"User {i}", f"user{i}@example.com")
+                            for i in range(start, min(size, start + 10_000))])
+    return app
+
+
+def run(sizes, backend: str = 'memory', only: Optional[str] = None,
+        iterations: int = ITERATIONS, report=print) -> Dict[str, Dict]:
+    """Results of every selected case at every size, keyed
+    'name[size]'"""
+    cases = [bench for bench in CASES
+             if only is None or fnmatch.fnmatchcase(bench.name, only)]
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for size in sizes:
+            app = _make_app(backend, directory, size)
+            ctx = Context(app, size)
+            report(f"\n{size:,} users ({backend})")
+            report(f"{'case':<30}{'ops/s':>12}{'p50 µs':>10}{'p90 µs':>10}"
+                   f"{'p99 µs':>10}{'alloc B/op':>12}")
+            for bench in cases:
+                count = iterations
+                if bench.heavy:
+                    count = max(3, min(iterations, HEAVY_BUDGET // size))
+                result = measure(ctx, bench, count)
+                results[f'{bench.name}[{size}]'] = result
+                report(f"{bench.name:<30}{result['ops_per_sec']:>12,.0f}"
+                       f"{result['p50_us']:>10,.1f}{result['p90_us']:>10,.1f}"
+                       f"{result['p99_us']:>10,.1f}"
+                       f"{result['alloc_bytes']:>12,}")
+            app.extensions['user_store'].close()
+    return results
+
+
+def compare(results: Dict[str, Dict], baseline: Dict[str, Dict],
+            threshold: float = DEFAULT_THRESHOLD) -> List[str]:
+    """Descriptions of the cases that regressed against baseline
+
+    Cases missing from either side are ignored.
+    """
+    regressions = []
+    for key in sorted(results.keys() & baseline.keys()):
+        now, before = results[key], baseline[key]
+        if now['p50_us'] > before['p50_us'] * (1 + threshold):
+            regressions.append(
+                f"{key}: p50 {before['p50_us']:,.1f} -> "
+                f"{now['p50_us']:,.1f} µs "
+                f"(+{now['p50_us'] / before['p50_us'] - 1:.0%})")
+        limit = before['alloc_bytes'] * (1 + threshold) + ALLOC_SLACK_BYTES
+        if now['alloc_bytes'] > limit:
+            regressions.append(
+                f"{key}: allocations {before['alloc_bytes']:,} -> "
+                f"{now['alloc_bytes']:,} B/op")
+    return regressions
+
+
+def _sizes(results: Dict[str, Dict]) -> List[int]:
+    """Store sizes of results keyed 'name[size]'"""
+    return sorted({int(key[key.rindex('[') + 1:-1]) for key in results})
+
+
+def mismatch(baseline: Dict, backend: str, sizes) -> Optional[str]:
+    """Why a saved baseline cannot be compared with a run of `backend`
+    at `sizes`, or None if it can"""
+    recorded = baseline.get('backend', 'memory')
+    if recorded != backend:
+        return f"baseline is of the {recorded} backend, not {backend}"
+    missing = sorted(set(sizes) - set(_sizes(baseline['results'])))
+    if missing:
+        return ("baseline has no results at size "
+                f"{', '.join(map(str, missing))}")
+    return None
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks.suite',
+        description="Store, serialization and endpoint microbenchmarks")
+    parser.add_argument('--sizes', default=','.join(map(str, DEFAULT_SIZES)),
+                        help="comma-separated store sizes")
+    parser.add_argument('--backend', default='memory',
+                        help="USER_STORE_BACKEND to measure")
+    parser.add_argument('--only', help="glob of case names to run")
+    parser.add_argument('--iterations', type=int, default=ITERATIONS)
+    parser.add_argument('--save', metavar='FILE',
+                        help="write the results as a JSON baseline")
+    parser.add_argument('--compare', metavar='FILE',
+                        help="fail if a case regressed against this baseline")
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help="allowed growth before a regression "
+                             "(default: %(default)s, i.e. 20%%)")
+    args = parser.parse_args(argv[1:])
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as file:
+            baseline = json.load(file)
+        problem = mismatch(baseline, args.backend, sizes)
+        if problem:
+            parser.error(f"{args.compare}: {problem}")
+    results = run(sizes, args.backend, args.only, args.iterations)
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as file:
+            json.dump({"python": platform.python_version(),
+                       "machine": platform.node(),
+                       "backend": args.backend,
+                       "recorded": time.strftime('%Y-%m-%dT%H:%M:%S'),
+                       "results": results}, file, indent=1, sort_keys=True)
+        print(f"\nSaved baseline to {args.save}")
+    if baseline is not None:
+        regressions = compare(results, baseline['results'], args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} regressions past "
+                  f"{args.threshold:.0%}:")
+            for regression in regressions:
+                print(f"  {regression}")
+            return 1
+        print(f"\nNo regressions past {args.threshold:.0%}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,71 @@
+"""Memory and read speed of the tiered store against the in-memory one
+
+Loads the same users into UserStore and into TieredUserStore at a few
+memory budgets, then reads Zipf-distributed user IDs, with a full
+listing halfway through to check it does not flush the hot set.
+Memory is what tracemalloc sees allocated once loading is done.
+
+Usage: python -m benchmarks.tiered_store [user_count] [reads]
+"""
+import random
+import sys
+import time
+import tracemalloc
+
+from app.models import UserStore
+from app.tiered_store import TieredUserStore
+from benchmarks.replay import Zipf
+
+BUDGETS_MIB = (1, 4, 16)
+
+
+def run(factory, user_count, reads):
+    """Return (MiB allocated, reads/sec, hit rate or None)"""
+    tracemalloc.start()
+    store = factory()
+    for start in range(0, user_count, 10_000):
+        store.create_users([(f"User {i}", f"user{i}@example.com")
+                            for i in range(start,
+                                           min(user_count, start + 10_000))])
+    allocated = tracemalloc.get_traced_memory()[0] / 2 ** 20
+    tracemalloc.stop()
+
+    pick = Zipf(user_count, 1.1, random.Random(0))
+    ids = [pick() for _ in range(reads)]
+    before = getattr(store, 'cache_stats', dict)()
+    start = time.perf_counter()
+    for user_id in ids[:reads // 2]:
+        store.get_user(user_id)
+    elapsed = time.perf_counter() - start
+    store.get_all_users()
+    start = time.perf_counter()
+    for user_id in ids[reads // 2:]:
+        store.get_user(user_id)
+    elapsed += time.perf_counter() - start
+
+    hit_rate = None
+    if hasattr(store, 'cache_stats'):
+        after = store.cache_stats()
+        hits = after['hits'] - before['hits']
+        hit_rate = hits / (hits + after['misses'] - before['misses'])
+    store.close()
+    return allocated, reads / elapsed, hit_rate
+
+
+def main(argv):
+    user_count = int(argv[1]) if len(argv) > 1 else 200_000
+    reads = int(argv[2]) if len(argv) > 2 else 200_000
+    print(f"{user_count:,} users, {reads:,} Zipf(1.1) reads")
+    print(f"{'store':<16}{'MiB':>8}{'reads/s':>12}{'hit rate':>10}")
+    stores = [('memory', UserStore)] + [
+        (f'tiered {budget} MiB',
+         lambda budget=budget: TieredUserStore(budget * 2 ** 20))
+        for budget in BUDGETS_MIB]
+    for name, factory in stores:
+        allocated, rate, hit_rate = run(factory, user_count, reads)
+        hits = '-' if hit_rate is None else f"{hit_rate:.1%}"
+        print(f"{name:<16}{allocated:>8.1f}{rate:>12,.0f}{hits:>10}")
+
+
+if __name__ == '__main__':
+    main(sys.argv)
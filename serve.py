@@ -0,0 +1,16 @@
+"""Production entry point: pre-forked workers sharing one user store"""
+import argparse
+
+from app.config import Config
+from app.prefork import default_workers, serve
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--workers', type=int, default=default_workers(),
+                        help='worker processes (default: one per core)')
+    parser.add_argument('--asgi', action='store_true',
+                        help='run workers under uvicorn')
+    args = parser.parse_args()
+    serve(Config, args.host, args.port, args.workers, args.asgi)
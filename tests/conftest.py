@@ -2,18 +2,25 @@
 import pytest
 from app import create_app
 from app.config import TestingConfig
-from app.models import user_store
 
 
-@pytest.fixture
-def app():
-    """Create and configure test app"""
-    app = create_app(TestingConfig)
+@pytest.fixture(params=['memory', 'sqlite', 'tiered'])
+def app(request, tmp_path):
+    """Create and configure test app, once per storage backend"""
+    class BackendConfig(TestingConfig):
+        USER_STORE_BACKEND = request.param
+        SQLITE_PATH = str(tmp_path / 'users.db')
+        # Room for a handful of users, so most reads go to the spill file
+        TIERED_MEMORY_BUDGET = 4096
+        TIERED_SPILL_PATH = str(tmp_path / 'users.spill')
+
+    app = create_app(BackendConfig)
 
     yield app
 
     # Cleanup
-    user_store.clear_all()
+    app.extensions['user_store'].clear_all()
+    app.extensions['user_store'].close()
 
 
 @pytest.fixture
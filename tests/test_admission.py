@@ -0,0 +1,186 @@
+"""Tests for admission control and load shedding"""
+import pytest
+
+from app import admission, create_app
+from app.admission import AdmissionController, TokenBuckets
+from app.config import TestingConfig
+
+
+def _make_app(**settings):
+    class AdmissionConfig(TestingConfig):
+        ADMISSION_ENABLED = True
+        ADMISSION_INITIAL_LIMIT = 4
+        ADMISSION_MIN_LIMIT = 1
+    for key, value in settings.items():
+        setattr(AdmissionConfig, key, value)
+    return create_app(AdmissionConfig)
+
+
+class TestConcurrencyLimits:
+    """Test priority classes sharing the adaptive limit"""
+
+    def test_lower_classes_shed_first(self):
+        """Test that bulk, write and read stop at 1/2, 3/4 and all of it"""
+        controller = AdmissionController(initial_limit=8)
+        admitted = []
+        for priority in ('bulk', 'write', 'read'):
+            while controller.admit(priority, '/r', 'c') is None:
+                admitted.append(priority)
+            assert controller.admit(priority, '/r', 'c') == (503, 1)
+        assert admitted == ['bulk'] * 4 + ['write'] * 2 + ['read'] * 2
+        assert controller.admit('critical', '/r', 'c') is None
+        assert controller.admit('stream', '/r', 'c') is None
+        assert controller.stats()['shed'] == {
+            ('limit', 'bulk'): 2, ('limit', 'read'): 2,
+            ('limit', 'write'): 2}
+
+    def test_route_limit(self):
+        """Test that a route limit holds whatever the adaptive limit"""
+        controller = AdmissionController(route_limits={'/slow': 1})
+        assert controller.admit('bulk', '/slow', 'c') is None
+        assert controller.admit('bulk', '/slow', 'c') == (503, 1)
+        assert controller.admit('bulk', '/fast', 'c') is None
+
+        controller.release('bulk', '/slow', 0.0)
+        assert controller.admit('bulk', '/slow', 'c') is None
+        assert controller.stats()['route_inflight'] == {'/slow': 1}
+
+
+class TestAdaptiveLimit:
+    """Test the AIMD limit driven by latency"""
+
+    @pytest.fixture
+    def every_request(self, monkeypatch):
+        """Adjust the limit after every completed request"""
+        monkeypatch.setattr(admission, 'WINDOW_S', 0)
+
+    def test_backs_off(self, every_request):
+        """Test that slow requests shrink the limit down to the minimum"""
+        controller = AdmissionController(initial_limit=100, min_limit=80,
+                                         target_latency_s=0.01)
+        controller.admit('read', '/r', 'c')
+        controller.release('read', '/r', 1.0)
+        assert controller.limit == pytest.approx(100 * admission.BACKOFF)
+        for _ in range(5):
+            controller.admit('read', '/r', 'c')
+            controller.release('read', '/r', 1.0)
+        assert controller.limit == 80
+
+    def test_once_per_window(self, monkeypatch):
+        """Test that a window of requests makes a single adjustment"""
+        monkeypatch.setattr(admission, 'WINDOW_S', 3600)
+        controller = AdmissionController(initial_limit=100,
+                                         target_latency_s=0.01)
+        for _ in range(10):
+            controller.admit('read', '/r', 'c')
+            controller.release('read', '/r', 1.0)
+        assert controller.limit == 100
+        assert controller.latency is None
+
+    def test_grows_only_when_used(self, every_request):
+        """Test additive increase while at least half the limit is used"""
+        controller = AdmissionController(initial_limit=4, max_limit=6,
+                                         target_latency_s=1.0)
+        controller.admit('read', '/r', 'c')
+        controller.release('read', '/r', 0.001)
+        assert controller.limit == 4
+
+        for _ in range(2):
+            controller.admit('read', '/r', 'c')
+        for _ in range(5):
+            controller.admit('read', '/r', 'c')
+            controller.release('read', '/r', 0.001)
+        assert controller.limit == 6
+
+    def test_bulk_latency_ignored(self, every_request):
+        """Test that slow bulk requests do not shrink the limit"""
+        controller = AdmissionController(initial_limit=8,
+                                         target_latency_s=0.01)
+        controller.admit('bulk', '/r', 'c')
+        controller.release('bulk', '/r', 60.0)
+        assert controller.limit == 8
+        assert controller.latency is None
+
+
+class TestTokenBuckets:
+    """Test per-client rate limits"""
+
+    def test_burst_then_wait(self):
+        """Test that a client gets its burst, then a wait until a token"""
+        buckets = TokenBuckets(rate=0.5, burst=2)
+        assert buckets.take('a') == 0
+        assert buckets.take('a') == 0
+        assert buckets.take('a') == pytest.approx(2, abs=0.01)
+        assert buckets.take('b') == 0
+
+    def test_full_buckets_pruned(self, monkeypatch):
+        """Test that idle clients are forgotten once there are many"""
+        monkeypatch.setattr(admission, '_MAX_BUCKETS', 3)
+        buckets = TokenBuckets(rate=1e9, burst=1)
+        for key in 'abcd':
+            buckets.take(key)
+        assert len(buckets) == 1
+
+
+class TestSheddingRequests:
+    """Test the hooks around the API"""
+
+    def test_disabled_by_default(self, app):
+        """Test that admission control is off unless configured"""
+        assert 'admission' not in app.extensions
+
+    def test_overload_spares_reads_and_health(self):
+        """Test that bulk writes are shed while reads are still served"""
+        app = _make_app()
+        client = app.test_client()
+        controller = app.extensions['admission']
+        controller.admit('read', '/busy', 'c')
+        controller.admit('read', '/busy', 'c')
+
+        response = client.post('/api/users/batch', json=[])
+        assert response.status_code == 503
+        assert response.headers['Retry-After'] == '1'
+        assert 'error' in response.json
+        assert client.get('/api/users').status_code == 200
+        assert client.get('/api/health').status_code == 200
+        assert controller.stats()['inflight'] == 2
+
+    def test_slots_released(self):
+        """Test that finished and failed requests give their slot back"""
+        app = _make_app()
+        client = app.test_client()
+        for _ in range(10):
+            client.post('/api/users', json={"name": "A",
+                                            "email": "a@example.com"})
+            client.get('/api/users/999')
+            client.get('/api/no-such-route')
+        assert app.extensions['admission'].stats()['inflight'] == 0
+
+    def test_rate_limit_per_client(self):
+        """Test that each client key has its own bucket"""
+        client = _make_app(ADMISSION_RATE=0.001, ADMISSION_BURST=2,
+                           ADMISSION_CLIENT_HEADER='X-API-Key').test_client()
+        alice = {'X-API-Key': 'alice'}
+        assert client.get('/api/users', headers=alice).status_code == 200
+        assert client.get('/api/users', headers=alice).status_code == 200
+        response = client.get('/api/users', headers=alice)
+        assert response.status_code == 429
+        assert int(response.headers['Retry-After']) > 1
+        assert client.get('/api/health', headers=alice).status_code == 200
+        assert client.get('/api/users', headers={
+            'X-API-Key': 'bob'}).status_code == 200
+
+    def test_shed_counts_in_metrics(self):
+        """Test that refusals show up in GET /api/metrics"""
+        app = _make_app(ADMISSION_ROUTE_LIMITS={'/api/users/import': 0})
+        client = app.test_client()
+        client.post('/api/users/import', data=b'', content_type='text/csv')
+        text = client.get('/api/metrics').get_data(True)
+        assert ('admission_shed_total{reason="route",priority="bulk"} 1'
+                in text)
+        assert 'admission_limit 4.0' in text
+
+    def test_unknown_class_rejected(self):
+        """Test that a typo in ADMISSION_ROUTE_CLASSES fails fast"""
+        with pytest.raises(ValueError):
+            _make_app(ADMISSION_ROUTE_CLASSES={'/api/users': 'urgent'})
@@ -0,0 +1,240 @@
+"""Tests for the ASGI app, driven directly through the ASGI interface"""
+import asyncio
+import json
+import time
+
+import pytest
+
+from app import create_asgi_app
+from app.async_store import AsyncUserStore
+from app.changefeed import ChangeFeed
+from app.config import TestingConfig
+from app.models import UserStore
+from app.sqlite_store import SQLiteUserStore
+from app.wal import (FSYNC_ALWAYS, FSYNC_INTERVAL, DurableUserStore,
+                     WriteAheadLog)
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def asgi_app(request, tmp_path):
+    """ASGI app, once per storage backend"""
+    class BackendConfig(TestingConfig):
+        USER_STORE_BACKEND = request.param
+        SQLITE_PATH = str(tmp_path / 'users.db')
+
+    asgi_app = create_asgi_app(BackendConfig)
+    yield asgi_app
+    asgi_app.app.extensions['user_store'].clear_all()
+    asgi_app.app.extensions['user_store'].close()
+
+
+def _scope(method, target, headers=()):
+    path, _, query = target.partition('?')
+    return {'type': 'http', 'asgi': {'version': '3.0'},
+            'http_version': '1.1', 'method': method, 'scheme': 'http',
+            'path': path, 'query_string': query.encode(), 'root_path': '',
+            'headers': [(name.lower().encode(), value.encode())
+                        for name, value in headers],
+            'client': ('127.0.0.1', 50000), 'server': ('testserver', 80)}
+
+
+async def request(app, method, target, body=None, headers=()):
+    """Send one request; returns (status, headers, body bytes)"""
+    headers = list(headers)
+    data = b''
+    if body is not None:
+        data = json.dumps(body).encode()
+        headers.append(('Content-Type', 'application/json'))
+    messages = [{'type': 'http.request', 'body': data}]
+    sent = []
+
+    async def receive():
+        if messages:
+            return messages.pop()
+        await asyncio.Event().wait()  # the client never disconnects
+
+    async def send(message):
+        sent.append(message)
+
+    await app(_scope(method, target, headers), receive, send)
+    start = sent[0]
+    assert start['type'] == 'http.response.start'
+    response_headers = {name.decode(): value.decode()
+                        for name, value in start['headers']}
+    return (start['status'], response_headers,
+            b''.join(message.get('body', b'') for message in sent[1:]))
+
+
+class TestAsgiRoutes:
+    """Test the routes served by the ASGI app"""
+
+    def test_user_crud(self, asgi_app):
+        """Test create, read, conditional update and delete"""
+        async def scenario():
+            status, headers, body = await request(
+                asgi_app, 'POST', '/api/users',
+                {"name": "John", "email": "john@example.com"})
+            assert status == 201
+            user = json.loads(body)
+            etag = headers['etag']
+
+            status, headers, body = await request(
+                asgi_app, 'GET', f'/api/users/{user["id"]}?fields=name')
+            assert (status, json.loads(body)) == (200, {"name": "John"})
+            assert headers['etag'] == etag
+            status, _, body = await request(
+                asgi_app, 'GET', f'/api/users/{user["id"]}',
+                headers=[('If-None-Match', etag)])
+            assert (status, body) == (304, b'')
+
+            status, headers, body = await request(
+                asgi_app, 'PUT', f'/api/users/{user["id"]}',
+                {"name": "Jane"}, [('If-Match', etag)])
+            assert (status, json.loads(body)['name']) == (200, "Jane")
+            status, _, _ = await request(
+                asgi_app, 'DELETE', f'/api/users/{user["id"]}',
+                headers=[('If-Match', etag)])
+            assert status == 412
+
+            status, _, _ = await request(asgi_app, 'DELETE',
+                                         f'/api/users/{user["id"]}')
+            assert status == 200
+            status, _, _ = await request(asgi_app, 'GET',
+                                         f'/api/users/{user["id"]}')
+            assert status == 404
+
+        asyncio.run(scenario())
+
+    def test_errors_match_wsgi(self, asgi_app):
+        """Test validation errors, conflicts and unknown routes"""
+        async def scenario():
+            new_user = {"name": "John", "email": "john@example.com"}
+            await request(asgi_app, 'POST', '/api/users', new_user)
+            status, _, _ = await request(asgi_app, 'POST', '/api/users',
+                                         new_user)
+            assert status == 409
+            status, _, body = await request(asgi_app, 'POST', '/api/users',
+                                            {"name": "Jane"})
+            assert status == 400 and b'Missing required' in body
+            status, _, _ = await request(asgi_app, 'GET', '/api/nowhere')
+            assert status == 404
+            status, _, _ = await request(asgi_app, 'PATCH', '/api/users/1')
+            assert status == 405
+
+        asyncio.run(scenario())
+
+    def test_sync_routes_fall_back(self, asgi_app):
+        """Test that routes without a coroutine view still work"""
+        async def scenario():
+            for i in range(3):
+                await request(asgi_app, 'POST', '/api/users',
+                              {"name": f"U{i}", "email": f"u{i}@x.com"})
+            status, headers, body = await request(
+                asgi_app, 'GET', '/api/users?stream=1')
+            assert status == 200
+            assert [user['name'] for user in json.loads(body)] == \
+                ["U0", "U1", "U2"]
+            assert int(headers['x-change-seq']) == 3
+            status, _, body = await request(asgi_app, 'POST', '/api/batch',
+                                            [{"path": "/api/users/1"}])
+            assert json.loads(body)['results'][0]['body']['name'] == "U0"
+
+        asyncio.run(scenario())
+
+    def test_long_poll_wakes_on_write(self, asgi_app):
+        """Test that a long poll returns once another request writes"""
+        async def scenario():
+            poll = asyncio.ensure_future(request(
+                asgi_app, 'GET', '/api/users/changes?since=0&wait=5'))
+            await asyncio.sleep(0.05)
+            assert not poll.done()
+            start = time.monotonic()
+            await request(asgi_app, 'POST', '/api/users',
+                          {"name": "John", "email": "john@example.com"})
+            status, _, body = await poll
+            assert time.monotonic() - start < 2
+            changes = json.loads(body)
+            assert status == 200 and changes['next_since'] == 1
+            assert changes['changes'][0]['op'] == 'create'
+
+        asyncio.run(scenario())
+
+    def test_sse_stream_until_disconnect(self, asgi_app):
+        """Test that SSE events are sent as they happen"""
+        async def scenario():
+            events = asyncio.Queue()
+            disconnect = asyncio.Event()
+            requested = []
+
+            async def receive():
+                if not requested:
+                    requested.append(True)
+                    return {'type': 'http.request', 'body': b''}
+                await disconnect.wait()
+                return {'type': 'http.disconnect'}
+
+            async def send(message):
+                await events.put(message)
+
+            stream = asyncio.ensure_future(asgi_app(
+                _scope('GET', '/api/users/changes?format=sse'),
+                receive, send))
+            start = await events.get()
+            assert start['status'] == 200
+            assert (b'content-type', b'text/event-stream; charset=utf-8') \
+                in start['headers']
+            await request(asgi_app, 'POST', '/api/users',
+                          {"name": "John", "email": "john@example.com"})
+            event = (await asyncio.wait_for(events.get(), 2))['body']
+            assert event.startswith(b'id: ') and b'event: change' in event
+
+            disconnect.set()
+            await asyncio.wait_for(stream, 2)
+
+        asyncio.run(scenario())
+
+
+class TestAsyncUserStore:
+    """Test the async store adapter"""
+
+    def test_calls_through_to_store(self):
+        """Test that coroutines return the store's results"""
+        async def scenario():
+            store = AsyncUserStore(UserStore())
+            user = await store.create_user("John", "john@example.com")
+            assert (await store.get_user(user.id)).name == "John"
+            assert await store.count_users() == 1
+            assert [u.id for u in await store.search_users(
+                name_prefix="Jo")] == [user.id]
+            assert await store.delete_user(user.id)
+            assert await store.version() == 2
+
+        asyncio.run(scenario())
+
+    def test_offloads_blocking_stores(self, tmp_path):
+        """Test that only stores that may block go to the thread pool"""
+        sqlite = SQLiteUserStore(str(tmp_path / 'users.db'))
+        try:
+            assert AsyncUserStore(sqlite).offload
+            assert not AsyncUserStore(UserStore()).offload
+            for policy, offload in ((FSYNC_ALWAYS, True),
+                                    (FSYNC_INTERVAL, False)):
+                wal = WriteAheadLog(str(tmp_path / 'wal'), policy)
+                durable = DurableUserStore(UserStore(), wal)
+                assert AsyncUserStore(durable).offload is offload
+        finally:
+            sqlite.close()
+
+    def test_change_feed_read_async(self):
+        """Test that read_async waits for a change without a thread"""
+        async def scenario():
+            feed = ChangeFeed()
+            store = UserStore()
+            store.add_listener(feed.record)
+            assert await feed.read_async(0, timeout=0.01) == []
+            asyncio.get_running_loop().call_later(
+                0.05, store.create_user, "John", "john@example.com")
+            changes = await feed.read_async(0, timeout=5)
+            assert [change['seq'] for change in changes] == [1]
+
+        asyncio.run(scenario())
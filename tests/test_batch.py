@@ -0,0 +1,111 @@
+"""Tests for the bulk user endpoints"""
+import json
+
+NDJSON = 'application/x-ndjson'
+
+
+def _ndjson(rows):
+    return ''.join(json.dumps(row) + '\n' for row in rows)
+
+
+def _parse_ndjson(response):
+    return [json.loads(line)
+            for line in response.get_data(as_text=True).splitlines()]
+
+
+class TestBatchCreate:
+    """Test POST /api/users/batch"""
+
+    def test_create_from_json_array(self, client):
+        """Test that every valid row is created in order"""
+        rows = [{"name": f"User {i}", "email": f"user{i}@example.com"}
+                for i in range(3)]
+
+        response = client.post('/api/users/batch', json=rows)
+
+        assert response.status_code == 200
+        results = response.get_json()
+        assert [r['status'] for r in results] == [201, 201, 201]
+        assert [r['user']['name'] for r in results] == \
+            ["User 0", "User 1", "User 2"]
+        assert client.get('/api/users/count').get_json()['total_users'] == 3
+
+    def test_invalid_rows_reported_per_row(self, client):
+        """Test that bad rows fail alone with the single-create errors"""
+        rows = [{"name": "A", "email": "a@x.com"}, {"name": "B"}, "junk",
+                {"name": "C", "email": "c@x.com"}]
+
+        results = client.post('/api/users/batch', json=rows).get_json()
+
+        assert [r['index'] for r in results] == [0, 1, 2, 3]
+        assert [r['status'] for r in results] == [201, 400, 400, 201]
+        assert 'email' in results[1]['error'].lower()
+        assert [r['user']['id'] for r in results if r['status'] == 201] == \
+            [1, 2]
+
+    def test_create_from_ndjson_stream(self, app, client):
+        """Test NDJSON input spanning several chunks streams results"""
+        app.config['BATCH_CHUNK_SIZE'] = 2
+        rows = [{"name": f"User {i}", "email": f"user{i}@example.com"}
+                for i in range(5)]
+        body = _ndjson(rows[:2]) + '{not json\n\n' + _ndjson(rows[2:])
+
+        response = client.post('/api/users/batch', data=body,
+                               content_type=NDJSON)
+
+        assert response.mimetype == NDJSON
+        results = _parse_ndjson(response)
+        assert [r['index'] for r in results] == list(range(6))
+        assert [r['status'] for r in results] == \
+            [201, 201, 400, 201, 201, 201]
+        assert results[2]['error'] == "Malformed JSON"
+
+    def test_non_array_body_rejected(self, client):
+        """Test that a JSON object body is refused up front"""
+        response = client.post('/api/users/batch',
+                               json={"name": "A", "email": "a@x.com"})
+
+        assert response.status_code == 400
+
+
+class TestBatchUpdateDelete:
+    """Test PATCH and DELETE /api/users/batch"""
+
+    def _create(self, client, count):
+        rows = [{"name": f"User {i}", "email": f"user{i}@example.com"}
+                for i in range(count)]
+        results = client.post('/api/users/batch', json=rows).get_json()
+        return [r['user']['id'] for r in results]
+
+    def test_update(self, client):
+        """Test updates apply per row and report missing users"""
+        ids = self._create(client, 2)
+        rows = [{"id": ids[0], "name": "Renamed"},
+                {"id": 999, "name": "Ghost"},
+                {"name": "No id"}]
+
+        results = client.patch('/api/users/batch', json=rows).get_json()
+
+        assert [r['status'] for r in results] == [200, 404, 400]
+        assert results[0]['user']['name'] == "Renamed"
+        assert results[0]['user']['email'] == "user0@example.com"
+
+    def test_delete(self, client):
+        """Test deletes accept bare IDs and objects"""
+        ids = self._create(client, 3)
+
+        response = client.delete('/api/users/batch',
+                                 json=[ids[0], {"id": ids[1]}, ids[0], "x"])
+
+        results = response.get_json()
+        assert [r['status'] for r in results] == [200, 200, 404, 400]
+        remaining = client.get('/api/users').get_json()
+        assert [u['id'] for u in remaining] == [ids[2]]
+
+    def test_ndjson_output_on_request(self, client):
+        """Test that JSON input can ask for streamed NDJSON results"""
+        ids = self._create(client, 2)
+
+        response = client.delete('/api/users/batch?format=ndjson', json=ids)
+
+        assert [r['status'] for r in _parse_ndjson(response)] == [200, 200]
@@ -0,0 +1,81 @@
+"""Tests for the benchmark suite's baseline regression gate"""
+import json
+
+import pytest
+
+from benchmarks import suite
+
+
+def _result(p50_us, alloc_bytes=1000):
+    return {"ops_per_sec": 1e6 / p50_us, "p50_us": p50_us,
+            "p90_us": p50_us, "p99_us": p50_us, "alloc_bytes": alloc_bytes}
+
+
+def _save(path, backend, results):
+    path.write_text(json.dumps({"backend": backend, "results": results}))
+    return str(path)
+
+
+class TestCompare:
+    """Test comparing results with a baseline"""
+
+    def test_regression_over_threshold(self):
+        """Test that latency or allocations past the threshold are flagged"""
+        baseline = {'a[10]': _result(10.0), 'b[10]': _result(10.0, 1000)}
+        results = {'a[10]': _result(12.5), 'b[10]': _result(10.0, 2000)}
+
+        regressions = suite.compare(results, baseline, threshold=0.2)
+
+        assert len(regressions) == 2
+        assert regressions[0].startswith('a[10]: p50 10.0 -> 12.5')
+        assert regressions[1].startswith('b[10]: allocations')
+
+    def test_growth_under_threshold(self):
+        """Test that growth within the threshold and slack passes"""
+        baseline = {'a[10]': _result(10.0, 1000), 'gone[10]': _result(1.0)}
+        results = {'a[10]': _result(11.9, 1000 * 1.2
+                                    + suite.ALLOC_SLACK_BYTES),
+                   'new[10]': _result(99.0)}
+
+        assert suite.compare(results, baseline, threshold=0.2) == []
+
+    def test_mismatched_backend_or_size(self):
+        """Test that baselines of another backend or size are refused"""
+        baseline = {"backend": 'memory',
+                    "results": {'a[10]': _result(1.0),
+                                'a[100]': _result(1.0)}}
+
+        assert suite.mismatch(baseline, 'memory', [10, 100]) is None
+        assert 'sqlite' in suite.mismatch(baseline, 'sqlite', [10])
+        assert '1000' in suite.mismatch(baseline, 'memory', [10, 1000])
+
+
+class TestCompareRun:
+    """Test the exit status of python -m benchmarks.suite --compare"""
+
+    ARGS = ['suite', '--sizes', '10', '--iterations', '5',
+            '--only', 'store.count_users']
+
+    def test_exit_status(self, tmp_path, capsys):
+        """Test exit 1 on a regression and 0 without one"""
+        fast = _save(tmp_path / 'fast.json', 'memory',
+                     {'store.count_users[10]': _result(1e-6, 0)})
+        slow = _save(tmp_path / 'slow.json', 'memory',
+                     {'store.count_users[10]': _result(1e6, 1e6)})
+
+        assert suite.main(self.ARGS + ['--compare', fast]) == 1
+        assert 'regressions past' in capsys.readouterr().out
+        assert suite.main(self.ARGS + ['--compare', slow]) == 0
+
+    def test_mismatch_refused_before_running(self, tmp_path, capsys):
+        """Test that a baseline of another backend stops the run"""
+        baseline = _save(tmp_path / 'sqlite.json', 'sqlite',
+                         {'store.count_users[10]': _result(1.0)})
+
+        with pytest.raises(SystemExit) as exit_info:
+            suite.main(self.ARGS + ['--compare', baseline])
+
+        assert exit_info.value.code == 2
+        captured = capsys.readouterr()
+        assert 'sqlite backend' in captured.err
+        assert 'users (memory)' not in captured.out
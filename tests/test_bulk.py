@@ -0,0 +1,213 @@
+"""Tests for bulk export and import of users"""
+import csv
+import io
+import json
+
+import pytest
+
+from app import bulk
+from app.models import User
+
+
+def _users():
+    return [User(7, "Zoë", "zoe@example.com", 1.5, 3),
+            User(3, "Al", "al@example.org", 2.25, 1),
+            User(2 ** 40, "Zoë", "no-at-sign", 0.0, 300),
+            User(9, "", "@example.com", -1.0, 1)]
+
+
+def _decode(data):
+    return list(bulk.read_columnar(io.BytesIO(data)))
+
+
+class TestColumnarFormat:
+    """Test encoding and decoding record batches"""
+
+    def test_round_trip(self):
+        """Test that every field survives, whatever the ID order"""
+        users = _users()
+        data = b''.join(bulk.iter_columnar(users, batch_size=3))
+        batches = _decode(data)
+
+        assert [len(batch.ids) for batch in batches] == [3, 1]
+        rows = [row for batch in batches for row in zip(*batch)]
+        assert rows == [(u.id, u.name, u.email, u.created_ts, u.version)
+                        for u in users]
+
+    def test_empty_stream(self):
+        """Test that no users encode to an empty, valid stream"""
+        data = b''.join(bulk.iter_columnar([], batch_size=10))
+        assert data == bulk.MAGIC + b'\0'
+        assert not _decode(data)
+
+    def test_repeated_strings_stored_once(self):
+        """Test that names and email domains are dictionary encoded"""
+        users = [User(i, "Same Name", f"u{i}@example.com", 0.0)
+                 for i in range(1, 1001)]
+        batch = bulk.encode_batch(users)
+        assert batch.count(b"Same Name") == 1
+        assert batch.count(b"example.com") == 1
+
+    @pytest.mark.parametrize('data', [
+        b'', b'NOTMAGIC', bulk.MAGIC, bulk.MAGIC + b'\x05abc',
+        bulk.MAGIC + b'\x02\x05\x02\0',
+    ])
+    def test_malformed_streams(self, data):
+        """Test that broken input raises FormatError"""
+        with pytest.raises(bulk.FormatError):
+            _decode(data)
+
+    def test_oversized_frame_rejected_unread(self):
+        """Test that a frame over the limit is refused before reading it"""
+        frame = bytearray()
+        bulk._put_varints(frame, (1024,))
+        stream = io.BytesIO(bulk.MAGIC + bytes(frame) + b'x' * 1024)
+        with pytest.raises(bulk.FormatError, match='larger than 1000'):
+            list(bulk.read_columnar(stream, max_batch_bytes=1000))
+        assert stream.tell() == len(bulk.MAGIC) + len(frame)
+
+    def test_trailing_bytes_rejected(self):
+        """Test that a batch with extra bytes is rejected"""
+        batch = bulk.encode_batch(_users())
+        with pytest.raises(bulk.FormatError):
+            bulk.decode_batch(batch + b'\0')
+
+
+def _seed(client, count):
+    client.post('/api/users/batch', json=[
+        {"name": f"User {i}", "email": f"user{i}@example.com"}
+        for i in range(count)])
+
+
+class TestExport:
+    """Test GET /api/users/export"""
+
+    def test_formats_agree(self, client):
+        """Test that every format holds the same users"""
+        _seed(client, 25)
+        client.delete('/api/users/4')
+        listed = client.get('/api/users').json
+
+        response = client.get('/api/users/export')
+        assert response.mimetype == bulk.COLUMNAR_MIMETYPE
+        batches = _decode(response.get_data())
+        assert [email for batch in batches for email in batch.emails] == \
+            [user['email'] for user in listed]
+
+        response = client.get('/api/users/export?format=csv')
+        assert response.mimetype == 'text/csv'
+        rows = list(csv.DictReader(io.StringIO(response.get_data(True))))
+        assert [int(row['id']) for row in rows] == \
+            [user['id'] for user in listed]
+
+        response = client.get('/api/users/export',
+                              headers={'Accept': 'application/x-ndjson'})
+        lines = [json.loads(line) for line in response.get_data(True)
+                 .splitlines()]
+        assert [line['name'] for line in lines] == \
+            [user['name'] for user in listed]
+        assert {line['version'] for line in lines} == {1}
+
+    def test_unknown_format(self, client):
+        """Test that an unknown ?format= is rejected"""
+        assert client.get('/api/users/export?format=xml').status_code == 400
+
+    def test_etag(self, client):
+        """Test that an unchanged store answers 304"""
+        _seed(client, 3)
+        etag = client.get('/api/users/export').headers['ETag']
+        response = client.get('/api/users/export',
+                              headers={'If-None-Match': etag})
+        assert response.status_code == 304
+
+    def test_reads_one_snapshot(self, app, client):
+        """Test that writes during an export do not show up in it"""
+        app.config['USERS_STREAM_CHUNK_SIZE'] = 2
+        _seed(client, 6)
+        response = client.get('/api/users/export?format=ndjson',
+                              buffered=False)
+        chunks = iter(response.response)
+        first = next(chunks)
+        store = app.extensions['user_store']
+        store.create_user("Late", "late@example.com")
+        store.update_user(4, name="Renamed")
+        store.delete_user(5)
+        body = first + b''.join(chunks)
+        lines = [json.loads(line) for line in body.splitlines()]
+        assert [line['id'] for line in lines] == [1, 2, 3, 4, 5, 6]
+        assert lines[3]['name'] == "User 3"
+
+
+class TestImport:
+    """Test POST /api/users/import"""
+
+    def test_round_trip_through_export(self, app, client):
+        """Test that an export loads into an empty store"""
+        _seed(client, 30)
+        for output, content_type in (('columnar', bulk.COLUMNAR_MIMETYPE),
+                                     ('csv', 'text/csv'),
+                                     ('ndjson', 'application/x-ndjson')):
+            data = client.get(f'/api/users/export?format={output}').data
+            app.extensions['user_store'].clear_all()
+            response = client.post('/api/users/import', data=data,
+                                   content_type=content_type)
+            assert response.json == {"created": 30, "duplicates": 0,
+                                     "invalid": 0}
+            assert client.get('/api/users/count').json == \
+                {"total_users": 30}
+
+    def test_counts_duplicates_and_invalid_rows(self, client):
+        """Test that bad rows are counted rather than reported"""
+        _seed(client, 2)
+        body = ('name,email\nNew,new@example.com\nCopy,user1@example.com\n'
+                ',blank@example.com\nShort\n')
+        response = client.post('/api/users/import', data=body,
+                               content_type='text/csv')
+        assert response.json == {"created": 1, "duplicates": 1,
+                                 "invalid": 2}
+
+    def test_malformed_body(self, client):
+        """Test that a broken body stops the import with a 400"""
+        data = b''.join(bulk.iter_columnar(_users(), batch_size=2))
+        response = client.post('/api/users/import', data=data[:-3],
+                               content_type=bulk.COLUMNAR_MIMETYPE)
+        assert response.status_code == 400
+        assert response.json['created'] == 2
+
+        response = client.post('/api/users/import', data=b'{"name":\n',
+                               content_type='application/x-ndjson')
+        assert response.status_code == 400
+
+    def test_bad_csv_header(self, client):
+        """Test that a header without the columns, or with a field past
+        the csv field limit, gets a 400"""
+        oversized = 'x' * (csv.field_size_limit() + 1)
+        for body, error in (('id,title\n1,x\n', 'must name'),
+                            (f'name,email,{oversized}\n', 'field limit')):
+            response = client.post('/api/users/import', data=body,
+                                   content_type='text/csv')
+            assert response.status_code == 400
+            assert error in response.json['error']
+
+    def test_oversized_length_prefix(self, app, client):
+        """Test that a frame past BULK_MAX_BATCH_BYTES gets a 400"""
+        for length in (2 ** 62, 2 ** 31):
+            frame = bytearray()
+            bulk._put_varints(frame, (length,))
+            response = client.post('/api/users/import',
+                                   data=bulk.MAGIC + bytes(frame) + b'abc',
+                                   content_type=bulk.COLUMNAR_MIMETYPE)
+            assert response.status_code == 400
+            assert 'larger than' in response.json['error']
+
+        data = b''.join(bulk.iter_columnar(_users(), batch_size=4))
+        app.config['BULK_MAX_BATCH_BYTES'] = 16
+        response = client.post('/api/users/import', data=data,
+                               content_type=bulk.COLUMNAR_MIMETYPE)
+        assert response.status_code == 400
+        assert response.json['created'] == 0
+
+    def test_unsupported_content_type(self, client):
+        """Test that other bodies get 415"""
+        response = client.post('/api/users/import', json=[])
+        assert response.status_code == 415
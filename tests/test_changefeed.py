@@ -0,0 +1,178 @@
+"""Tests for the change feed and GET /api/users/changes"""
+import json
+import threading
+import time
+
+import pytest
+
+from app import create_app
+from app.changefeed import ChangeFeed, CursorExpired
+from app.config import TestingConfig
+from app.models import UserStore
+
+
+def _create(client, name="John", email="john@example.com"):
+    return client.post('/api/users', json={"name": name, "email": email})
+
+
+class TestChangeFeed:
+    """Test the ring buffer itself"""
+
+    def test_sequence_and_payloads(self):
+        """Test that every mutation is numbered and captured"""
+        store = UserStore()
+        feed = ChangeFeed()
+        store.add_listener(feed.record)
+
+        user = store.create_user("John", "john@example.com")
+        store.update_user(user.id, name="Jane")
+        store.delete_user(user.id)
+        store.clear_all()
+
+        changes = feed.read(0)
+        assert [(c['seq'], c['op']) for c in changes] == \
+            [(1, 'create'), (2, 'update'), (3, 'delete'), (4, 'clear')]
+        assert changes[0]['user']['name'] == "John"
+        assert changes[1]['user']['name'] == "Jane"
+        assert changes[2]['id'] == user.id
+        assert feed.read(2, limit=1) == [changes[2]]
+        assert feed.read(4) == []
+
+    def test_expired_cursors(self):
+        """Test cursors that fell out of the ring or are not ours"""
+        store = UserStore()
+        feed = ChangeFeed(capacity=3)
+        store.add_listener(feed.record)
+        for i in range(5):
+            store.create_user(f"U{i}", f"u{i}@x.com")
+
+        assert [c['seq'] for c in feed.read(2)] == [3, 4, 5]
+        for since, epoch in ((1, None), (6, None), (4, 'other')):
+            with pytest.raises(CursorExpired):
+                feed.read(since, epoch=epoch)
+
+    def test_long_poll_wakes_on_change(self):
+        """Test that a waiting reader returns as soon as a change lands"""
+        store = UserStore()
+        feed = ChangeFeed()
+        store.add_listener(feed.record)
+        timer = threading.Timer(0.05, store.create_user,
+                                ("John", "john@example.com"))
+        timer.start()
+
+        start = time.monotonic()
+        changes = feed.read(0, timeout=5)
+
+        assert [c['op'] for c in changes] == ['create']
+        assert time.monotonic() - start < 4
+        assert feed.read(1, timeout=0.01) == []
+
+
+class TestChangesEndpoint:
+    """Test following the feed over HTTP"""
+
+    def test_resync_then_follow(self, client):
+        """Test a mirror that snapshots the list and applies changes"""
+        _create(client)
+        listing = client.get('/api/users')
+        mirror = {u['id']: u for u in listing.get_json()}
+        since = int(listing.headers['X-Change-Seq'])
+        epoch = listing.headers['X-Change-Epoch']
+
+        _create(client, "Jane", "jane@example.com")
+        client.put('/api/users/1', json={"name": "Johnny"})
+        client.delete('/api/users/2')
+
+        body = client.get(f'/api/users/changes?since={since}'
+                          f'&epoch={epoch}').get_json()
+        for change in body['changes']:
+            if change['op'] == 'delete':
+                mirror.pop(change['id'])
+            else:
+                mirror[change['user']['id']] = change['user']
+
+        assert body['next_since'] == since + 3
+        assert list(mirror.values()) == client.get('/api/users').get_json()
+
+    def test_expired_cursor_asks_for_resync(self, client):
+        """Test the explicit 410 resync answer"""
+        _create(client)
+
+        response = client.get('/api/users/changes?since=99')
+
+        assert response.status_code == 410
+        assert response.get_json()['resync'] is True
+        assert response.get_json()['seq'] == 1
+        assert client.get('/api/users/changes?since=0&epoch=nope'
+                          ).status_code == 410
+
+    def test_bad_parameters(self, client):
+        """Test that non-integer cursors are rejected"""
+        assert client.get('/api/users/changes?since=x').status_code == 400
+        assert client.get('/api/users/changes?wait=-1').status_code == 400
+
+    def test_last_event_id_ignored_without_sse(self, client):
+        """Test that a stray Last-Event-ID only matters to SSE requests"""
+        _create(client)
+        for header in ('garbage', 'deadbeef:5'):
+            response = client.get('/api/users/changes?since=0', headers={
+                'Last-Event-ID': header})
+            assert response.status_code == 200
+            assert len(response.get_json()['changes']) == 1
+
+        response = client.get('/api/users/changes?format=sse', headers={
+            'Last-Event-ID': 'garbage'})
+        assert response.status_code == 400
+
+    def test_long_poll_times_out_empty(self, client):
+        """Test a long poll with nothing to report"""
+        body = client.get('/api/users/changes?since=0&wait=1').get_json()
+
+        assert body['changes'] == []
+        assert body['next_since'] == 0
+
+
+class TestServerSentEvents:
+    """Test the SSE mode of the changes endpoint"""
+
+    @pytest.fixture
+    def sse_app(self):
+        """App with a short heartbeat"""
+        class SSEConfig(TestingConfig):
+            CHANGE_FEED_HEARTBEAT_S = 0.01
+        return create_app(SSEConfig)
+
+    def test_stream_and_resume(self, sse_app):
+        """Test event framing and resuming from Last-Event-ID"""
+        client = sse_app.test_client()
+        _create(client)
+        _create(client, "Jane", "jane@example.com")
+
+        response = client.get('/api/users/changes?format=sse',
+                              buffered=False)
+        chunks = iter(response.response)
+        first = next(chunks).decode()
+        next(chunks)
+        keep_alive = next(chunks).decode()
+        response.close()
+
+        assert response.mimetype == 'text/event-stream'
+        event_id = first.split('\n')[0][len('id: '):]
+        assert first.split('\n')[1] == 'event: change'
+        assert json.loads(first.split('\n')[2][len('data: '):])['seq'] == 1
+        assert keep_alive == ': keep-alive\n\n'
+
+        resumed = client.get('/api/users/changes', buffered=False, headers={
+            'Accept': 'text/event-stream', 'Last-Event-ID': event_id})
+        second = next(iter(resumed.response)).decode()
+        resumed.close()
+        assert json.loads(second.split('\n')[2][len('data: '):])['seq'] == 2
+
+    def test_stale_event_id_gets_resync_event(self, sse_app):
+        """Test that an SSE client from another run is told to resync"""
+        client = sse_app.test_client()
+
+        response = client.get('/api/users/changes?format=sse', headers={
+            'Last-Event-ID': 'deadbeef:5'})
+
+        assert response.get_data(as_text=True).startswith('event: resync')
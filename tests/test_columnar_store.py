@@ -0,0 +1,97 @@
+"""Tests for the compact columnar user store and User layout"""
+from datetime import datetime
+
+from app import create_app
+from app.columnar_store import ColumnarUserStore
+from app.config import TestingConfig
+from app.models import User
+
+
+class TestUserLayout:
+    """Test the slotted User model"""
+
+    def test_user_has_no_instance_dict(self):
+        """Test that User instances carry no __dict__"""
+        user = User(1, "John", "john@example.com")
+
+        assert not hasattr(user, '__dict__')
+
+    def test_created_at_formatted_from_epoch(self):
+        """Test that created_at is derived from the stored epoch"""
+        user = User(1, "John", "john@example.com", created_ts=0.0)
+
+        assert user.created_at == datetime.fromtimestamp(0.0).isoformat()
+        assert user.to_dict()['created_at'] == user.created_at
+
+
+class TestColumnarUserStore:
+    """Test ColumnarUserStore operations"""
+
+    def test_create_and_get(self):
+        """Test round-tripping users, including non-ASCII text"""
+        store = ColumnarUserStore()
+        created = store.create_user("Zoë", "zoe@example.com")
+
+        user = store.get_user(created.id)
+
+        assert user.to_dict() == created.to_dict()
+        assert store.get_user(999) is None
+
+    def test_update_and_delete(self):
+        """Test updates replace fields and deletes hide the row"""
+        store = ColumnarUserStore()
+        first = store.create_user("John", "john@example.com")
+        second = store.create_user("Jane", "jane@example.com")
+
+        store.update_user(first.id, email="johnny@example.com")
+        assert store.get_user(first.id).email == "johnny@example.com"
+        assert store.get_user(first.id).name == "John"
+
+        assert store.delete_user(second.id)
+        assert not store.delete_user(second.id)
+        assert store.get_user(second.id) is None
+        assert store.update_user(second.id, name="Ghost") is None
+        assert [u.id for u in store.get_all_users()] == [first.id]
+
+    def test_compaction_keeps_live_rows(self):
+        """Test that reclaiming tombstones and dead bytes loses nothing"""
+        store = ColumnarUserStore()
+        for i in range(3000):
+            store.create_user(f"User {i}", f"user{i}@example.com")
+        for user_id in range(1, 3001, 3):
+            store.update_user(user_id, name=f"Renamed {user_id}")
+        for user_id in range(2, 3001, 3):
+            store.delete_user(user_id)
+        for user_id in range(3, 3001, 3):
+            store.delete_user(user_id)
+
+        users = store.get_all_users()
+
+        assert len(store._ids) < 3000
+        assert [u.id for u in users] == list(range(1, 3001, 3))
+        assert all(u.name == f"Renamed {u.id}" for u in users)
+
+    def test_pagination(self):
+        """Test keyset pages skip deleted rows"""
+        store = ColumnarUserStore()
+        for i in range(6):
+            store.create_user(f"User {i}", f"user{i}@example.com")
+        store.delete_user(3)
+
+        assert [u.id for u in store.get_users_page(1, 3)] == [2, 4, 5]
+        assert [u.id for u in store.iter_users(chunk_size=2)] == \
+            [1, 2, 4, 5, 6]
+
+    def test_backend_selected_from_config(self):
+        """Test that the API works on top of the columnar store"""
+        class ColumnarConfig(TestingConfig):
+            USER_STORE_BACKEND = 'columnar'
+
+        client = create_app(ColumnarConfig).test_client()
+        user_id = client.post('/api/users', json={
+            "name": "John", "email": "john@example.com"}).get_json()['id']
+
+        client.put(f'/api/users/{user_id}', json={"name": "Jane"})
+
+        assert client.get(f'/api/users/{user_id}').get_json()['name'] == \
+            "Jane"
@@ -0,0 +1,174 @@
+"""Tests for response compression and compressed request bodies"""
+import gzip
+import json
+import tracemalloc
+import zlib
+
+import pytest
+
+from app import create_app
+from app.config import TestingConfig
+
+
+def _create_users(client, count):
+    client.post('/api/users/batch', json=[
+        {"name": f"User {i}", "email": f"user{i}@example.com"}
+        for i in range(count)])
+
+
+class TestResponseCompression:
+    """Test Accept-Encoding negotiation on responses"""
+
+    @pytest.mark.parametrize('encoding, decompress', [
+        ('gzip', gzip.decompress), ('deflate', zlib.decompress)])
+    def test_large_listing_compressed(self, client, encoding, decompress):
+        """Test that big listings are compressed with the chosen encoding"""
+        _create_users(client, 50)
+        plain = client.get('/api/users').data
+
+        response = client.get('/api/users',
+                              headers={'Accept-Encoding': encoding})
+
+        assert response.headers['Content-Encoding'] == encoding
+        assert 'Accept-Encoding' in response.headers['Vary']
+        assert int(response.headers['Content-Length']) == len(response.data)
+        assert len(response.data) < len(plain)
+        assert decompress(response.data) == plain
+
+    def test_streamed_listing_compressed(self, client):
+        """Test compression of a streamed body without a length"""
+        _create_users(client, 50)
+        plain = client.get('/api/users?stream=1').data
+
+        response = client.get('/api/users?stream=1',
+                              headers={'Accept-Encoding': 'gzip'})
+
+        assert response.headers['Content-Encoding'] == 'gzip'
+        assert 'Content-Length' not in response.headers
+        assert gzip.decompress(response.data) == plain
+
+    @pytest.mark.parametrize('path', ['/api/users/1', '/api/users?stream=1'])
+    def test_small_responses_left_alone(self, client, path):
+        """Test that bodies under the threshold are not compressed"""
+        _create_users(client, 1)
+
+        response = client.get(path, headers={'Accept-Encoding': 'gzip'})
+
+        assert 'Content-Encoding' not in response.headers
+        assert json.loads(response.data)
+
+    def test_identity_and_refused_encodings(self, client):
+        """Test clients that do not accept any supported encoding"""
+        _create_users(client, 50)
+
+        for accept in ('identity', 'gzip;q=0', 'compress'):
+            response = client.get('/api/users',
+                                  headers={'Accept-Encoding': accept})
+            assert 'Content-Encoding' not in response.headers
+
+    def test_weak_etag_still_revalidates(self, client):
+        """Test conditional GETs against a compressed response's ETag"""
+        _create_users(client, 50)
+        response = client.get('/api/users',
+                              headers={'Accept-Encoding': 'gzip'})
+        etag = response.headers['ETag']
+
+        assert etag.startswith('W/')
+        assert client.get('/api/users', headers={
+            'Accept-Encoding': 'gzip',
+            'If-None-Match': etag}).status_code == 304
+
+    def test_threshold_and_level_from_config(self):
+        """Test COMPRESSION_MIN_BYTES and COMPRESSION_ENABLED"""
+        class TinyThresholdConfig(TestingConfig):
+            COMPRESSION_MIN_BYTES = 1
+            COMPRESSION_LEVEL = 9
+
+        class DisabledConfig(TestingConfig):
+            COMPRESSION_ENABLED = False
+
+        tiny = create_app(TinyThresholdConfig).test_client()
+        disabled = create_app(DisabledConfig).test_client()
+        headers = {'Accept-Encoding': 'gzip'}
+
+        assert tiny.get('/api/health', headers=headers
+                        ).headers['Content-Encoding'] == 'gzip'
+        _create_users(disabled, 50)
+        assert 'Content-Encoding' not in disabled.get(
+            '/api/users', headers=headers).headers
+
+
+class TestRequestDecompression:
+    """Test compressed request bodies on the write endpoints"""
+
+    def test_gzip_json_body(self, client):
+        """Test creating a user from a gzipped JSON body"""
+        body = gzip.compress(json.dumps(
+            {"name": "John", "email": "john@example.com"}).encode())
+
+        response = client.post('/api/users', data=body, headers={
+            'Content-Type': 'application/json', 'Content-Encoding': 'gzip'})
+
+        assert response.status_code == 201
+        assert response.get_json()['name'] == "John"
+
+    def test_deflate_ndjson_batch(self, client):
+        """Test streaming a deflated NDJSON body into the batch endpoint"""
+        lines = ''.join(json.dumps({"name": f"U{i}", "email": f"{i}@x.com"})
+                        + '\n' for i in range(500))
+
+        response = client.post('/api/users/batch',
+                               data=zlib.compress(lines.encode()), headers={
+                                   'Content-Type': 'application/x-ndjson',
+                                   'Content-Encoding': 'deflate'})
+
+        results = [json.loads(line) for line in response.data.splitlines()]
+        assert len(results) == 500
+        assert all(result['status'] == 201 for result in results)
+
+    def test_unsupported_and_corrupt_bodies(self, client):
+        """Test unknown encodings and bodies that fail to decompress"""
+        headers = {'Content-Type': 'application/json'}
+
+        assert client.post('/api/users', data=b'{}', headers=dict(
+            headers, **{'Content-Encoding': 'compress'})).status_code == 415
+        assert client.post('/api/users', data=b'not gzip', headers=dict(
+            headers, **{'Content-Encoding': 'gzip'})).status_code == 400
+
+    def test_decompressed_size_limit(self):
+        """Test that decompression bombs are cut off"""
+        class SmallLimitConfig(TestingConfig):
+            COMPRESSION_MAX_REQUEST_BYTES = 1024
+
+        client = create_app(SmallLimitConfig).test_client()
+        body = gzip.compress(json.dumps(
+            {"name": "x" * 100_000, "email": "a@x.com"}).encode())
+
+        response = client.post('/api/users', data=body, headers={
+            'Content-Type': 'application/json', 'Content-Encoding': 'gzip'})
+
+        assert response.status_code == 413
+
+    def test_bomb_never_inflated_whole(self):
+        """Test that a high-ratio bomb is refused in bounded memory"""
+        class SmallLimitConfig(TestingConfig):
+            COMPRESSION_MAX_REQUEST_BYTES = 1024 * 1024
+
+        client = create_app(SmallLimitConfig).test_client()
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        zeros = bytes(1024 * 1024)
+        body = b''.join(compressor.compress(zeros) for _ in range(256))
+        body += compressor.flush()
+        assert len(body) < 512 * 1024  # 256 MiB inflated, over 1000:1
+
+        tracemalloc.start()
+        try:
+            response = client.post('/api/users/import', data=body, headers={
+                'Content-Type': 'application/x-ndjson',
+                'Content-Encoding': 'gzip'})
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        assert response.status_code == 413
+        assert peak < 8 * 1024 * 1024
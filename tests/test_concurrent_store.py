@@ -0,0 +1,173 @@
+"""Tests for the thread-safe user store"""
+import threading
+
+import pytest
+
+from app import create_app
+from app.concurrent_store import ConcurrentUserStore
+from app.config import TestingConfig
+
+
+def _hammer(store, thread_count, per_thread):
+    """Create users from several threads at once, returning all IDs"""
+    barrier = threading.Barrier(thread_count)
+    results = [[] for _ in range(thread_count)]
+
+    def worker(slot):
+        barrier.wait()
+        for i in range(per_thread):
+            user = store.create_user(f"User {slot}-{i}",
+                                     f"user{slot}-{i}@example.com")
+            results[slot].append(user.id)
+
+    threads = [threading.Thread(target=worker, args=(slot,))
+               for slot in range(thread_count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return [user_id for ids in results for user_id in ids]
+
+
+class TestConcurrentUserStore:
+    """Test ConcurrentUserStore under concurrent access"""
+
+    @pytest.mark.parametrize('thread_count', [1, 4, 16])
+    def test_no_id_collisions(self, thread_count):
+        """Test that concurrent creates never hand out duplicate IDs"""
+        store = ConcurrentUserStore(shard_count=4)
+        ids = _hammer(store, thread_count, 500)
+
+        assert len(ids) == len(set(ids)) == thread_count * 500
+        assert sorted(ids) == list(range(1, thread_count * 500 + 1))
+        assert len(store.get_all_users()) == thread_count * 500
+
+    def test_concurrent_deletes_and_reads(self):
+        """Test that readers see consistent snapshots while writers delete"""
+        store = ConcurrentUserStore(shard_count=4)
+        ids = _hammer(store, 4, 250)
+        errors = []
+
+        def deleter():
+            for user_id in ids[::2]:
+                store.delete_user(user_id)
+
+        def reader():
+            try:
+                for _ in range(50):
+                    users = store.get_all_users()
+                    assert [u.id for u in users] == sorted(u.id for u in users)
+                    store.get_users_page(0, 100)
+            except AssertionError as exc:
+                errors.append(exc)
+
+        threads = [threading.Thread(target=deleter)]
+        threads += [threading.Thread(target=reader) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert not errors
+        assert [u.id for u in store.get_all_users()] == sorted(ids[1::2])
+
+    def test_pagination_merges_shards_in_order(self):
+        """Test that pages come back in ID order across shards"""
+        store = ConcurrentUserStore(shard_count=3)
+        for i in range(10):
+            store.create_user(f"User {i}", f"user{i}@example.com")
+        store.delete_user(4)
+
+        page = store.get_users_page(after_id=2, limit=4)
+
+        assert [u.id for u in page] == [3, 5, 6, 7]
+        assert [u.id for u in store.iter_users(chunk_size=3)] == \
+            [1, 2, 3, 5, 6, 7, 8, 9, 10]
+
+    def test_bulk_operations(self):
+        """Test bulk create/update/delete keep row order across shards"""
+        store = ConcurrentUserStore(shard_count=3)
+        users = store.create_users([(f"User {i}", f"user{i}@example.com")
+                                    for i in range(7)])
+
+        updated = store.update_users([(5, "Five", None), (99, "X", None),
+                                      (1, None, "one@example.com")])
+        deleted = store.delete_users([2, 2, 6])
+
+        assert [u.id for u in users] == list(range(1, 8))
+        assert [u.name if u else None for u in updated] == \
+            ["Five", None, "User 0"]
+        assert deleted == [True, False, True]
+        assert [u.id for u in store.get_all_users()] == [1, 3, 4, 5, 7]
+
+    def test_update_and_clear(self):
+        """Test update and clear_all behave like the basic store"""
+        store = ConcurrentUserStore()
+        user = store.create_user("John", "john@example.com")
+
+        store.update_user(user.id, name="Jane")
+        assert store.get_user(user.id).name == "Jane"
+        assert store.update_user(999, name="Nobody") is None
+
+        store.clear_all()
+        assert store.get_all_users() == []
+        assert store.create_user("New", "new@example.com").id == 1
+
+    def test_updates_never_seen_halfway(self):
+        """Test that readers see each update whole, and snapshots none"""
+        store = ConcurrentUserStore()
+        user = store.create_user("Name 0", "n0@example.com")
+        snapshot = store.get_all_users()
+        done = threading.Event()
+        torn = []
+
+        def writer():
+            for i in range(1, 2001):
+                store.update_user(user.id, f"Name {i}", f"n{i}@example.com")
+            done.set()
+
+        def reader():
+            while not done.is_set():
+                seen = store.get_user(user.id)
+                name, email, version = seen.name, seen.email, seen.version
+                if (name[5:] != email[1:-12]
+                        or version != int(name[5:]) + 1):
+                    torn.append((name, email, version))
+
+        threads = [threading.Thread(target=writer),
+                   threading.Thread(target=reader)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert not torn
+        assert store.get_user(user.id).version == 2001
+        assert (snapshot[0].name, snapshot[0].version) == ("Name 0", 1)
+
+
+class TestConcurrentBackendConfig:
+    """Test selecting the concurrent store through Config"""
+
+    def test_backend_selected_from_config(self):
+        """Test that USER_STORE_BACKEND picks the store implementation"""
+        class ConcurrentConfig(TestingConfig):
+            USER_STORE_BACKEND = 'concurrent'
+
+        app = create_app(ConcurrentConfig)
+        client = app.test_client()
+
+        assert isinstance(app.extensions['user_store'], ConcurrentUserStore)
+        response = client.post('/api/users',
+                               json={"name": "John",
+                                     "email": "john@example.com"})
+        assert response.status_code == 201
+        assert client.get('/api/users').get_json()[0]['name'] == "John"
+
+    def test_unknown_backend_rejected(self):
+        """Test that a typo in USER_STORE_BACKEND fails fast"""
+        class BadConfig(TestingConfig):
+            USER_STORE_BACKEND = 'nope'
+
+        with pytest.raises(ValueError):
+            create_app(BadConfig)
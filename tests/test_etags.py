@@ -0,0 +1,119 @@
+"""Tests for ETags and conditional requests"""
+import pytest
+
+from app.models import VersionConflict
+
+
+def _create(client, name="John", email="john@example.com"):
+    response = client.post('/api/users', json={"name": name, "email": email})
+    return response.get_json()['id'], response.headers['ETag']
+
+
+class TestConditionalGet:
+    """Test If-None-Match handling on read endpoints"""
+
+    def test_user_not_modified(self, client):
+        """Test that an unchanged user answers 304 with no body"""
+        user_id, etag = _create(client)
+
+        response = client.get(f'/api/users/{user_id}',
+                              headers={'If-None-Match': etag})
+
+        assert response.status_code == 304
+        assert response.data == b''
+        assert response.headers['ETag'] == etag
+
+    def test_user_etag_changes_on_update(self, client):
+        """Test that updates bump the user's version and ETag"""
+        user_id, etag = _create(client)
+        client.put(f'/api/users/{user_id}', json={"name": "Jane"})
+
+        response = client.get(f'/api/users/{user_id}',
+                              headers={'If-None-Match': etag})
+
+        assert response.status_code == 200
+        assert response.headers['ETag'] != etag
+        assert response.get_json()['name'] == "Jane"
+
+    def test_list_etag_tracks_store_version(self, client):
+        """Test that any mutation invalidates the listing ETag"""
+        _create(client)
+        etag = client.get('/api/users').headers['ETag']
+
+        assert client.get('/api/users', headers={
+            'If-None-Match': etag}).status_code == 304
+        assert client.get('/api/users?stream=1', headers={
+            'If-None-Match': etag}).status_code == 304
+        assert client.get('/api/users/count').headers['ETag'] == etag
+
+        _create(client, "Jane", "jane@example.com")
+
+        response = client.get('/api/users', headers={'If-None-Match': etag})
+        assert response.status_code == 200
+        assert len(response.get_json()) == 2
+
+    def test_etag_changes_after_clear(self, app, client):
+        """Test that clearing the store never reuses an old ETag"""
+        user_id, etag = _create(client)
+        app.extensions['user_store'].clear_all()
+        _create(client)
+
+        response = client.get(f'/api/users/{user_id}',
+                              headers={'If-None-Match': etag})
+
+        assert response.status_code == 200
+
+
+class TestConditionalWrite:
+    """Test If-Match handling on PUT and DELETE"""
+
+    def test_put_with_current_etag(self, client):
+        """Test that a matching If-Match lets the update through"""
+        user_id, etag = _create(client)
+
+        response = client.put(f'/api/users/{user_id}', json={"name": "Jane"},
+                              headers={'If-Match': etag})
+
+        assert response.status_code == 200
+        assert response.headers['ETag'] != etag
+
+    def test_put_with_stale_etag(self, client):
+        """Test that a stale If-Match is refused with 412"""
+        user_id, etag = _create(client)
+        client.put(f'/api/users/{user_id}', json={"name": "Jane"})
+
+        response = client.put(f'/api/users/{user_id}', json={"name": "Bob"},
+                              headers={'If-Match': etag})
+
+        assert response.status_code == 412
+        assert client.get(f'/api/users/{user_id}').get_json()['name'] == \
+            "Jane"
+
+    def test_delete_with_etags(self, client):
+        """Test that DELETE honours If-Match, including *"""
+        user_id, etag = _create(client)
+        client.put(f'/api/users/{user_id}', json={"name": "Jane"})
+
+        assert client.delete(f'/api/users/{user_id}', headers={
+            'If-Match': etag}).status_code == 412
+        assert client.delete(f'/api/users/{user_id}', headers={
+            'If-Match': '*'}).status_code == 200
+        assert client.delete('/api/users/999', headers={
+            'If-Match': '*'}).status_code == 404
+
+
+class TestStoreVersions:
+    """Test version bookkeeping in the store itself"""
+
+    def test_expected_version_is_checked_atomically(self, app):
+        """Test that the store refuses writes pinned to an old version"""
+        store = app.extensions['user_store']
+        user = store.create_user("John", "john@example.com")
+        store.update_user(user.id, name="Jane", expected_version=1)
+
+        assert store.get_user(user.id).version == 2
+        with pytest.raises(VersionConflict):
+            store.update_user(user.id, name="Bob", expected_version=1)
+        with pytest.raises(VersionConflict):
+            store.delete_user(user.id, expected_version=1)
+        assert store.delete_user(user.id, expected_version=2)
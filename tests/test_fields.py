@@ -0,0 +1,91 @@
+"""Tests for sparse fieldsets (?fields=)"""
+import json
+
+import pytest
+
+from app.models import User
+from app.serialization import USER_FIELDS, parse_fields, projection
+
+
+def _create_users(client, count=3):
+    for i in range(count):
+        client.post('/api/users', json={"name": f"User {i}",
+                                        "email": f"user{i}@example.com"})
+
+
+class TestFieldsParameter:
+    """Test ?fields= on the user read endpoints"""
+
+    def test_single_user(self, client):
+        """Test projecting one user"""
+        _create_users(client, 1)
+
+        response = client.get('/api/users/1?fields=id,email')
+
+        assert response.get_json() == {"id": 1, "email": "user0@example.com"}
+        assert 'ETag' in response.headers
+
+    @pytest.mark.parametrize('query', ['', '&limit=2', '&stream=1',
+                                       '&name_prefix=User'])
+    def test_listings(self, client, query):
+        """Test that every listing mode honours the projection"""
+        _create_users(client)
+
+        users = client.get(f'/api/users?fields=email{query}').get_json()
+
+        assert users and all(list(user) == ['email'] for user in users)
+
+    def test_ndjson(self, client):
+        """Test projected NDJSON lines"""
+        _create_users(client, 2)
+
+        response = client.get('/api/users?fields=name&format=ndjson')
+
+        assert [json.loads(line) for line in response.data.splitlines()] \
+            == [{"name": "User 0"}, {"name": "User 1"}]
+
+    def test_smaller_responses(self, client):
+        """Test that projected listings are smaller on the wire"""
+        _create_users(client, 20)
+
+        full = client.get('/api/users').data
+        sparse = client.get('/api/users?fields=id').data
+
+        assert len(sparse) * 4 < len(full)
+
+    @pytest.mark.parametrize('fields', ['password', '', 'id,,nope'])
+    def test_invalid_fields(self, client, fields):
+        """Test that unknown or empty field lists are rejected"""
+        _create_users(client, 1)
+
+        assert client.get(f'/api/users?fields={fields}').status_code == 400
+        assert client.get(f'/api/users/1?fields={fields}').status_code == 400
+
+
+class TestProjection:
+    """Test parsing field sets and compiling projections"""
+
+    def test_canonical_field_sets(self):
+        """Test that spellings of a field set normalize to one tuple"""
+        assert parse_fields('email, id,email') == ('id', 'email')
+        assert parse_fields(','.join(reversed(USER_FIELDS))) is None
+        assert projection(parse_fields('email,id')) is \
+            projection(parse_fields('id,email'))
+
+    def test_projection_reads_only_requested_fields(self):
+        """Test that created_at is not formatted unless requested"""
+        class Watched(User):
+            __slots__ = ()
+
+            @property
+            def created_at(self):
+                raise AssertionError("created_at was read")
+
+        user = Watched(1, "John", "john@example.com")
+
+        assert projection(('id', 'name'))(user) == {"id": 1, "name": "John"}
+
+    def test_rejects_unknown_fields(self):
+        """Test that only known fields can be compiled"""
+        with pytest.raises(ValueError):
+            projection(('id', '__class__'))
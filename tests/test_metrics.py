@@ -0,0 +1,140 @@
+"""Tests for request instrumentation and GET /api/metrics"""
+import threading
+
+from app import create_app
+from app.config import TestingConfig
+from app.metrics import Metrics
+
+
+def _metric(text, name, **labels):
+    """Value of one sample in Prometheus text output"""
+    wanted = ','.join(f'{key}="{value}"' for key, value in labels.items())
+    for line in text.splitlines():
+        if line.startswith(f'{name}{{{wanted}}}'):
+            return float(line.rsplit(' ', 1)[1])
+    raise AssertionError(f"{name} {labels} not found")
+
+
+class TestMetricsEndpoint:
+    """Test the metrics exposed over HTTP"""
+
+    def test_request_histograms_and_bytes(self, client):
+        """Test per-route, per-status request series"""
+        client.post('/api/users', json={"name": "John",
+                                        "email": "john@example.com"})
+        client.get('/api/users/1')
+        client.get('/api/users/1')
+        client.get('/api/users/99')
+
+        response = client.get('/api/metrics')
+        text = response.get_data(as_text=True)
+
+        assert response.status_code == 200
+        assert response.content_type.startswith('text/plain')
+        route = '/api/users/<int:user_id>'
+        assert _metric(text, 'http_request_duration_seconds_count',
+                       route=route, method='GET', status=200) == 2
+        assert _metric(text, 'http_request_duration_seconds_count',
+                       route=route, method='GET', status=404) == 1
+        assert _metric(text, 'http_request_duration_seconds_bucket',
+                       route=route, method='GET', status=200,
+                       le='+Inf') == 2
+        assert _metric(text, 'http_request_bytes_total', route='/api/users',
+                       method='POST', status=201) > 0
+        assert _metric(text, 'http_response_bytes_total', route=route,
+                       method='GET', status=200) > 0
+
+    def test_store_operations(self, client):
+        """Test store call timings and user counts"""
+        client.post('/api/users/batch', json=[
+            {"name": "A", "email": "a@x.com"},
+            {"name": "B", "email": "b@x.com"}])
+        client.get('/api/users?limit=1')
+
+        text = client.get('/api/metrics').get_data(as_text=True)
+
+        assert _metric(text, 'user_store_operation_seconds_count',
+                       operation='create_users') == 1
+        assert _metric(text, 'user_store_operation_users_total',
+                       operation='create_users') == 2
+        assert _metric(text, 'user_store_operation_users_total',
+                       operation='get_users_page') == 1
+        assert 'operation="create_user"' not in text
+
+    def test_streamed_response_bytes(self, client):
+        """Test that streamed bodies are counted once sent"""
+        client.post('/api/users', json={"name": "A", "email": "a@x.com"})
+        body = client.get('/api/users?stream=1').data
+
+        text = client.get('/api/metrics').get_data(as_text=True)
+
+        assert _metric(text, 'http_response_bytes_total',
+                       route='/api/users', method='GET',
+                       status=200) == len(body)
+
+    def test_unmatched_routes_and_disabling(self, client):
+        """Test 404s for unknown URLs and the METRICS_ENABLED switch"""
+        client.get('/nowhere')
+        text = client.get('/api/metrics').get_data(as_text=True)
+        assert _metric(text, 'http_request_duration_seconds_count',
+                       route='unmatched', method='GET', status=404) == 1
+
+        class NoMetricsConfig(TestingConfig):
+            METRICS_ENABLED = False
+
+        app = create_app(NoMetricsConfig)
+        assert app.test_client().get('/api/metrics').status_code == 404
+
+
+class TestMetrics:
+    """Test the Metrics recorder directly"""
+
+    def test_threads_merge_without_losing_counts(self):
+        """Test concurrent observations from many threads"""
+        metrics = Metrics(buckets=(0.1, 1.0))
+
+        def worker():
+            for _ in range(1000):
+                metrics.observe_request('/r', 'GET', 200, 0.5, 1, 2)
+
+        threads = [threading.Thread(target=worker) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        text = metrics.render()
+
+        labels = {'route': '/r', 'method': 'GET', 'status': 200}
+        assert _metric(text, 'http_request_duration_seconds_bucket',
+                       **labels, le='0.1') == 0
+        assert _metric(text, 'http_request_duration_seconds_bucket',
+                       **labels, le='1.0') == 8000
+        assert _metric(text, 'http_request_duration_seconds_sum',
+                       **labels) == 4000.0
+        assert _metric(text, 'http_response_bytes_total', **labels) == 16000
+
+    def test_ended_threads_retired(self):
+        """Test that short-lived threads keep their counts, not entries"""
+        metrics = Metrics(buckets=(0.1, 1.0))
+        for _ in range(200):
+            thread = threading.Thread(target=metrics.observe_request,
+                                      args=('/r', 'GET', 200, 0.5, 1, 2))
+            thread.start()
+            thread.join()
+        metrics.observe_operation('get_user', 0.01, 1)
+
+        assert len(metrics._threads) <= 1
+        text = metrics.render()
+        labels = {'route': '/r', 'method': 'GET', 'status': 200}
+        assert _metric(text, 'http_request_duration_seconds_count',
+                       **labels) == 200
+        assert _metric(text, 'http_request_bytes_total', **labels) == 200
+        assert _metric(text, 'user_store_operation_seconds_count',
+                       operation='get_user') == 1
+
+    def test_label_values_escaped(self):
+        """Test that quotes in label values cannot break the format"""
+        metrics = Metrics()
+        metrics.observe_request('/a"b', 'GET', 200, 0.0, 0, 0)
+
+        assert 'route="/a\\"b"' in metrics.render()
@@ -0,0 +1,165 @@
+"""Tests for POST /api/batch"""
+import pytest
+
+from app import create_app
+from app.config import TestingConfig
+from app.models import UserStore
+
+
+def _batch(client, requests, atomic=False):
+    response = client.post('/api/batch',
+                           json={"requests": requests, "atomic": atomic})
+    assert response.status_code == 200
+    return response.get_json()
+
+
+class TestBatchDispatch:
+    """Test running several API calls in one request"""
+
+    def test_results_in_order(self, client):
+        """Test that each request gets its own status and body"""
+        results = _batch(client, [
+            {"method": "POST", "path": "/api/users",
+             "body": {"name": "John", "email": "john@example.com"}},
+            {"path": "/api/users/1"},
+            {"path": "/api/users/99"},
+            {"path": "/api/users/count"},
+        ])['results']
+
+        assert [r['status'] for r in results] == [201, 200, 404, 200]
+        assert results[1]['body']['email'] == "john@example.com"
+        assert results[3]['body'] == {"total_users": 1}
+
+    def test_read_modify_write_with_etag(self, client):
+        """Test that returned ETags work as If-Match in later requests"""
+        client.post('/api/users',
+                    json={"name": "John", "email": "john@example.com"})
+        etag = _batch(client, [{"path": "/api/users/1"}])['results'][0]['etag']
+
+        results = _batch(client, [
+            {"method": "PUT", "path": "/api/users/1",
+             "body": {"name": "Jane"}, "headers": {"If-Match": etag}},
+            {"method": "PUT", "path": "/api/users/1",
+             "body": {"name": "Bob"}, "headers": {"If-Match": etag}},
+        ])['results']
+
+        assert [r['status'] for r in results] == [200, 412]
+        assert client.get('/api/users/1').get_json()['name'] == "Jane"
+
+    def test_query_strings_and_unknown_paths(self, client):
+        """Test query parameters, 404s and endpoints that cannot be batched"""
+        results = _batch(client, [
+            {"path": "/api/users?fields=id"},
+            {"path": "/api/nope"},
+            {"method": "POST", "path": "/api/batch", "body": []},
+            {"path": "/api/users/changes?wait=5"},
+            {"path": "/api/users/export"},
+            {"method": "POST", "path": "/api/users/import",
+             "headers": {"Content-Type": "text/csv"}, "body": "name,email"},
+        ])['results']
+
+        assert [r['status'] for r in results] == \
+            [200, 404, 405, 405, 405, 405]
+        assert results[0]['body'] == []
+
+    @pytest.mark.parametrize('body', [
+        None, {"requests": "x"}, [{"path": "api/users"}], [42],
+        [{"path": "/api/users", "headers": []}],
+    ])
+    def test_invalid_batches(self, client, body):
+        """Test that malformed batches are rejected as a whole"""
+        assert client.post('/api/batch', json=body).status_code == 400
+
+    def test_too_many_requests(self, app, client):
+        """Test the BATCH_MAX_REQUESTS cap"""
+        app.config['BATCH_MAX_REQUESTS'] = 2
+        response = client.post('/api/batch', json=[{"path": "/api/health"}]
+                               * 3)
+        assert response.status_code == 400
+
+
+class TestAtomicBatch:
+    """Test batches applied as one transaction"""
+
+    def test_commit(self, client):
+        """Test that an all-successful atomic batch is applied"""
+        body = _batch(client, [
+            {"method": "POST", "path": "/api/users",
+             "body": {"name": "John", "email": "john@example.com"}},
+            {"method": "PUT", "path": "/api/users/1",
+             "body": {"name": "Jane"}},
+        ], atomic=True)
+
+        assert body['committed'] is True
+        assert client.get('/api/users/1').get_json()['name'] == "Jane"
+        changes = client.get('/api/users/changes?since=0').get_json()
+        assert [c['op'] for c in changes['changes']] == ['create', 'update']
+
+    def test_rollback(self, app, client):
+        """Test that a failing request undoes the writes before it"""
+        client.post('/api/users',
+                    json={"name": "John", "email": "john@example.com"})
+        store = app.extensions['user_store']
+        version = store.version
+        seq = client.get('/api/users').headers['X-Change-Seq']
+
+        body = _batch(client, [
+            {"method": "PUT", "path": "/api/users/1",
+             "body": {"name": "Jane"}},
+            {"method": "POST", "path": "/api/users",
+             "body": {"name": "Ann", "email": "ann@example.com"}},
+            {"method": "DELETE", "path": "/api/users/1"},
+            {"method": "POST", "path": "/api/users",
+             "body": {"name": "Bob", "email": "ann@example.com"}},
+            {"method": "DELETE", "path": "/api/users/1"},
+        ], atomic=True)
+
+        assert body['committed'] is False
+        assert [r['status'] for r in body['results']] == \
+            [200, 201, 200, 409, 424]
+        users = client.get('/api/users').get_json()
+        assert [(u['id'], u['name']) for u in users] == [(1, "John")]
+        assert store.version == version
+        assert client.get('/api/users').headers['X-Change-Seq'] == seq
+        assert client.post('/api/users', json={
+            "name": "Ann", "email": "ann@example.com"}).status_code == 201
+
+    def test_needs_transactional_store(self):
+        """Test that atomic batches are refused on other backends"""
+        class ConcurrentConfig(TestingConfig):
+            USER_STORE_BACKEND = 'concurrent'
+
+        client = create_app(ConcurrentConfig).test_client()
+        response = client.post('/api/batch', json={
+            "requests": [{"path": "/api/health"}], "atomic": True})
+
+        assert response.status_code == 400
+        assert _batch(client, [{"path": "/api/health"}])['results'][0][
+            'status'] == 200
+
+
+class TestUserStoreTransaction:
+    """Test the in-memory store's undo journal"""
+
+    def test_undo_restores_indexes(self):
+        """Test that rollback restores users, indexes and listeners"""
+        store = UserStore()
+        heard = []
+        store.add_listener(lambda op, user: heard.append(op))
+        john = store.create_user("John", "john@example.com")
+
+        with pytest.raises(RuntimeError):
+            with store.transaction():
+                store.update_user(john.id, name="Jane",
+                                  email="jane@example.com")
+                store.create_user("Ann", "ann@example.com")
+                store.clear_all()
+                store.create_user("Bob", "john@example.com")
+                raise RuntimeError
+
+        assert heard == ['create']
+        assert [u.name for u in store.get_all_users()] == ["John"]
+        assert store.get_user_by_email("john@example.com").id == john.id
+        assert store.get_user_by_email("jane@example.com") is None
+        assert store.search_users(name_prefix="J") == [store.get_user(1)]
+        assert store.get_user(john.id).version == 1
@@ -0,0 +1,157 @@
+"""Tests for copy-on-write maps and UserStore snapshots"""
+import gc
+import random
+import threading
+import weakref
+
+import pytest
+
+from app import persistent
+from app.models import UserStore
+from app.persistent import SortedMap
+
+
+class _Value:
+    """Weak-referenceable map value"""
+
+
+class TestSortedMap:
+    """Test the copy-on-write B+ tree"""
+
+    @pytest.fixture(autouse=True)
+    def small_nodes(self, monkeypatch):
+        """Split nodes early so a few hundred keys build a deep tree"""
+        monkeypatch.setattr(persistent, 'NODE_SIZE', 4)
+
+    @pytest.mark.parametrize('seed', range(20))
+    def test_frozen_views_match_a_model(self, seed):
+        """Test every view against a dict copied when it was frozen"""
+        rnd = random.Random(seed)
+        live, model, views = SortedMap(), {}, []
+        for step in range(500):
+            key = rnd.randrange(120) if seed % 2 else step
+            roll = rnd.random()
+            if roll < 0.6:
+                live.set(key, -key)
+                model[key] = -key
+            elif roll < 0.9:
+                live.discard(key)
+                model.pop(key, None)
+            else:
+                views.append((live.freeze(), dict(model)))
+        views.append((live, model))
+
+        for view, expected in views:
+            keys = sorted(expected)
+            assert len(view) == len(expected)
+            assert list(view.values()) == [expected[k] for k in keys]
+            for _ in range(20):
+                low, high = rnd.randrange(-5, 505), rnd.randrange(-5, 505)
+                in_range = [expected[k] for k in keys if low <= k < high]
+                assert list(view.values(low, high)) == in_range
+                assert list(view.values(low, high, reverse=True)) == \
+                    in_range[::-1]
+                assert view.get(low) == expected.get(low)
+
+    def test_old_versions_are_reclaimed(self):
+        """Test that a replaced value lives exactly as long as its view"""
+        live = SortedMap()
+        value = _Value()
+        ref = weakref.ref(value)
+        for key in range(50):
+            live.set(key, value if key == 7 else _Value())
+        view = live.freeze()
+        live.set(7, _Value())
+        del value
+        gc.collect()
+
+        assert ref() is not None
+        assert view.get(7) is ref()
+        del view
+        assert ref() is None
+
+
+class TestUserSnapshots:
+    """Test point-in-time reads on the in-memory store"""
+
+    def test_snapshot_ignores_later_writes(self):
+        """Test that updates, deletes and clears leave a snapshot intact"""
+        store = UserStore()
+        store.create_users([("John", "john@example.com"),
+                            ("Jane", "jane@example.com")])
+        snapshot = store.snapshot()
+
+        store.update_user(1, name="Johnny", email="johnny@example.com")
+        store.delete_user(2)
+        store.create_user("Ann", "ann@example.com")
+        store.clear_all()
+
+        assert [u.name for u in snapshot.get_all_users()] == ["John", "Jane"]
+        assert snapshot.get_user_by_email("john@example.com").id == 1
+        assert snapshot.get_user_by_email("johnny@example.com") is None
+        assert [u.name for u in snapshot.search_users(name_prefix="J")] == \
+            ["John", "Jane"]
+        assert snapshot.count_users() == 2
+        assert snapshot.version == 2
+        assert store.count_users() == 0
+
+    def test_snapshot_is_reused_until_a_write(self):
+        """Test that taking snapshots without writes in between is free"""
+        store = UserStore()
+        store.create_user("John", "john@example.com")
+        first = store.snapshot()
+
+        assert store.snapshot() is first
+        store.update_user(1, name="Jane")
+        assert store.snapshot() is not first
+        assert store.snapshot().get_user(1).name == "Jane"
+
+    def test_updates_replace_users(self):
+        """Test that an update leaves the old User object unchanged"""
+        store = UserStore()
+        user = store.create_user("John", "john@example.com")
+        updated = store.update_user(user.id, name="Jane")
+
+        assert (user.name, user.version) == ("John", 1)
+        assert (updated.name, updated.version) == ("Jane", 2)
+        assert store.get_user(user.id) is updated
+
+    def test_streaming_sees_one_state(self):
+        """Test that iter_users is unaffected by writes mid-iteration"""
+        store = UserStore()
+        store.create_users([(f"User {i}", f"user{i}@example.com")
+                            for i in range(100)])
+        users = store.iter_users(chunk_size=10)
+        first = next(users)
+
+        store.delete_user(50)
+        store.create_user("Late", "late@example.com")
+
+        ids = [first.id] + [user.id for user in users]
+        assert ids == list(range(1, 101))
+
+    def test_readers_during_writes(self):
+        """Test that listings never show a write halfway applied"""
+        store = UserStore()
+        store.create_users([(f"User {i}", f"user{i}@example.com")
+                            for i in range(200)])
+        stop = threading.Event()
+
+        def write():
+            while not stop.is_set():
+                user = store.create_user("Temp", "temp@example.com")
+                store.delete_user(user.id)
+
+        writer = threading.Thread(target=write)
+        writer.start()
+        try:
+            for _ in range(200):
+                snapshot = store.snapshot()
+                users = snapshot.get_all_users()
+                assert len(users) == snapshot.count_users()
+                assert len(users) in (200, 201)
+                by_name = snapshot.search_users(name_prefix="Temp")
+                assert len(by_name) == len(users) - 200
+        finally:
+            stop.set()
+            writer.join()
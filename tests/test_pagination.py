@@ -0,0 +1,111 @@
+"""Tests for paginated and streamed user listings"""
+import json
+
+
+def _create_users(client, count):
+    """Create `count` users and return their IDs"""
+    ids = []
+    for i in range(count):
+        payload = {"name": f"User {i}", "email": f"user{i}@example.com"}
+        ids.append(client.post('/api/users', json=payload).get_json()['id'])
+    return ids
+
+
+class TestPagination:
+    """Test keyset pagination of GET /api/users"""
+
+    def test_first_page(self, client):
+        """Test that limit caps the page and exposes the next cursor"""
+        ids = _create_users(client, 5)
+
+        response = client.get('/api/users?limit=2')
+
+        assert response.status_code == 200
+        assert [u['id'] for u in response.get_json()] == ids[:2]
+        assert response.headers['X-Next-After-Id'] == str(ids[1])
+        assert 'rel="next"' in response.headers['Link']
+
+    def test_walk_all_pages(self, client):
+        """Test following cursors visits every user exactly once"""
+        ids = _create_users(client, 7)
+
+        seen = []
+        after_id = 0
+        while True:
+            response = client.get(f'/api/users?limit=3&after_id={after_id}')
+            page = response.get_json()
+            seen.extend(u['id'] for u in page)
+            if 'X-Next-After-Id' not in response.headers:
+                break
+            after_id = response.headers['X-Next-After-Id']
+
+        assert seen == ids
+
+    def test_after_id_skips_deleted_users(self, client):
+        """Test that cursors stay valid when users are deleted"""
+        ids = _create_users(client, 4)
+        client.delete(f'/api/users/{ids[1]}')
+
+        response = client.get(f'/api/users?after_id={ids[0]}')
+
+        assert [u['id'] for u in response.get_json()] == [ids[2], ids[3]]
+
+    def test_limit_clamped_to_max_page_size(self, app, client):
+        """Test that oversized limits are clamped"""
+        app.config['USERS_MAX_PAGE_SIZE'] = 2
+        _create_users(client, 3)
+
+        response = client.get('/api/users?limit=50')
+
+        assert len(response.get_json()) == 2
+
+    def test_invalid_limit(self, client):
+        """Test that non-numeric or non-positive limits are rejected"""
+        assert client.get('/api/users?limit=abc').status_code == 400
+        response = client.get('/api/users?limit=0')
+        assert response.status_code == 400
+        assert 'limit must be a positive integer' in response.json['error']
+        assert client.get('/api/users?after_id=-1').status_code == 400
+
+
+class TestStreaming:
+    """Test streamed listings of GET /api/users"""
+
+    def test_stream_json_array(self, app, client):
+        """Test chunked JSON array output across several store chunks"""
+        app.config['USERS_STREAM_CHUNK_SIZE'] = 2
+        ids = _create_users(client, 5)
+
+        response = client.get('/api/users?stream=1')
+
+        assert response.status_code == 200
+        assert response.is_streamed
+        assert [u['id'] for u in response.get_json()] == ids
+
+    def test_stream_empty_array(self, client):
+        """Test that an empty streamed listing is still valid JSON"""
+        response = client.get('/api/users?stream=1')
+
+        assert response.get_json() == []
+
+    def test_stream_ndjson(self, app, client):
+        """Test NDJSON output selected through the Accept header"""
+        app.config['USERS_STREAM_CHUNK_SIZE'] = 2
+        ids = _create_users(client, 3)
+
+        response = client.get('/api/users',
+                              headers={'Accept': 'application/x-ndjson'})
+
+        assert response.mimetype == 'application/x-ndjson'
+        lines = response.get_data(as_text=True).splitlines()
+        assert [json.loads(line)['id'] for line in lines] == ids
+
+    def test_stream_respects_limit(self, client):
+        """Test that streaming honours limit and after_id"""
+        ids = _create_users(client, 5)
+
+        response = client.get(
+            f'/api/users?format=ndjson&limit=2&after_id={ids[0]}')
+
+        lines = response.get_data(as_text=True).splitlines()
+        assert [json.loads(line)['id'] for line in lines] == ids[1:3]
@@ -0,0 +1,144 @@
+"""Tests for sampled request profiling"""
+import marshal
+import time
+
+import pytest
+
+from app import create_app
+from app.config import TestingConfig
+from app.profiling import RequestProfiler
+
+
+TOKEN = 's3cret'
+ADMIN = {'Authorization': f'Bearer {TOKEN}'}
+
+
+def _make_app(mode='cprofile', rate=1.0, token=TOKEN):
+    class ProfilingConfig(TestingConfig):
+        PROFILING_ENABLED = True
+        PROFILING_MODE = mode
+        PROFILING_SAMPLE_RATE = rate
+        PROFILING_SAMPLE_INTERVAL_MS = 1
+        PROFILING_ADMIN_TOKEN = token
+    return create_app(ProfilingConfig)
+
+
+class TestCProfileMode:
+    """Test per-request cProfile aggregation"""
+
+    def test_text_report_by_route(self):
+        """Test that sampled requests show up in the merged report"""
+        app = _make_app()
+        client = app.test_client()
+        client.post('/api/users', json={"name": "A", "email": "a@x.com"})
+        client.get('/api/users/1')
+
+        report = client.get('/api/admin/profile',
+                            headers=ADMIN).get_data(as_text=True)
+        only_get = client.get('/api/admin/profile?route='
+                              '/api/users/<int:user_id>',
+                              headers=ADMIN).get_data(as_text=True)
+
+        assert 'create_user' in report
+        assert 'get_user' in only_get
+        assert 'create_user' not in only_get
+        assert app.extensions['profiler'].requests[
+            '/api/users/<int:user_id>'] == 1
+
+    def test_binary_dump_and_reset(self):
+        """Test the marshalled pstats output and resetting"""
+        app = _make_app()
+        client = app.test_client()
+        client.get('/api/health')
+
+        response = client.get('/api/admin/profile?format=pstats',
+                              headers=ADMIN)
+        stats = marshal.loads(response.data)
+        assert any(func[2] == 'health_check' for func in stats)
+        assert app.extensions['profiler'].requests['/api/health'] == 1
+
+        assert client.get('/api/admin/profile?reset=1',
+                          headers=ADMIN).status_code == 200
+        assert app.extensions['profiler'].requests['/api/health'] == 1
+        assert client.delete('/api/admin/profile',
+                             headers=ADMIN).status_code == 204
+        assert app.extensions['profiler'].requests['/api/health'] == 0
+
+    def test_unsampled_requests_not_profiled(self):
+        """Test a zero sample rate"""
+        app = _make_app(rate=0.0)
+        client = app.test_client()
+        client.get('/api/health')
+
+        assert not app.extensions['profiler'].requests
+
+    def test_bad_format_rejected(self):
+        """Test asking for collapsed stacks in cProfile mode"""
+        client = _make_app().test_client()
+
+        assert client.get('/api/admin/profile?format=collapsed',
+                          headers=ADMIN).status_code == 400
+        assert client.get('/api/admin/profile?sort=nope',
+                          headers=ADMIN).status_code == 400
+
+
+class TestSampleMode:
+    """Test the statistical stack sampler"""
+
+    def test_collapsed_stacks(self):
+        """Test that a slow request leaves sampled stacks behind"""
+        app = _make_app(mode='sample')
+
+        @app.route('/slow')
+        def slow():
+            deadline = time.monotonic() + 0.05
+            while time.monotonic() < deadline:
+                pass
+            return 'done'
+
+        client = app.test_client()
+        client.get('/slow')
+        text = client.get('/api/admin/profile?format=collapsed',
+                          headers=ADMIN).get_data(as_text=True)
+        app.extensions['profiler'].stop()
+
+        lines = [line for line in text.splitlines()
+                 if line.startswith('/slow;')]
+        # A sample may also land in the request hooks around the view
+        assert any(';slow (' in line for line in lines)
+        assert all(int(line.rsplit(' ', 1)[1]) > 0 for line in lines)
+
+
+class TestProfilerAccess:
+    """Test access to the admin endpoint"""
+
+    def test_disabled_by_default(self, client):
+        """Test that profiling is off unless configured"""
+        assert client.get('/api/admin/profile').status_code == 404
+
+    def test_token_required(self):
+        """Test the admin bearer token on reads and resets"""
+        client = _make_app().test_client()
+
+        assert client.get('/api/admin/profile').status_code == 403
+        assert client.delete('/api/admin/profile').status_code == 403
+        assert client.get('/api/admin/profile', headers={
+            'Authorization': 'Bearer wrong'}).status_code == 403
+        assert client.get('/api/admin/profile',
+                          headers=ADMIN).status_code == 200
+
+    def test_closed_without_token(self):
+        """Test that no request gets in while no token is configured"""
+        client = _make_app(token=None).test_client()
+
+        for headers in ({}, {'Authorization': 'Bearer '},
+                        {'Authorization': 'Bearer None'}):
+            assert client.get('/api/admin/profile',
+                              headers=headers).status_code == 403
+            assert client.delete('/api/admin/profile',
+                                 headers=headers).status_code == 403
+
+    def test_unknown_mode_rejected(self):
+        """Test that a typo in PROFILING_MODE fails fast"""
+        with pytest.raises(ValueError):
+            RequestProfiler(mode='trace')
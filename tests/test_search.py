@@ -0,0 +1,180 @@
+"""Tests for secondary indexes and user search"""
+import random
+from datetime import datetime
+
+import pytest
+
+from app.models import (BaseUserStore, DuplicateEmail, User, UserStore,
+                        prefix_end)
+
+
+def _create(client, name, email):
+    return client.post('/api/users', json={"name": name, "email": email})
+
+
+def _names(response):
+    return [user['name'] for user in response.get_json()]
+
+
+class TestSearchEndpoint:
+    """Test filtering and sorting through GET /api/users"""
+
+    @pytest.fixture
+    def people(self, client):
+        """Create a handful of users"""
+        for name in ("Bob", "alice", "Alicia", "Albert", "Carol"):
+            _create(client, name, f"{name.lower()}@example.com")
+        return client
+
+    def test_email_lookup(self, people):
+        """Test exact email matches"""
+        response = people.get('/api/users?email=carol@example.com')
+
+        assert response.status_code == 200
+        assert _names(response) == ["Carol"]
+        assert people.get('/api/users?email=nobody@x.com').get_json() == []
+
+    def test_name_prefix_is_case_sensitive(self, people):
+        """Test prefix queries, in ID order by default"""
+        assert _names(people.get('/api/users?name_prefix=Al')) == \
+            ["Alicia", "Albert"]
+        assert _names(people.get('/api/users?name_prefix=al')) == ["alice"]
+
+    def test_sort_orders(self, people):
+        """Test sorting by name and creation time in both directions"""
+        assert _names(people.get('/api/users?sort=name')) == \
+            ["Albert", "Alicia", "Bob", "Carol", "alice"]
+        assert _names(people.get('/api/users?sort=-name&limit=2')) == \
+            ["alice", "Carol"]
+        assert _names(people.get('/api/users?sort=-created_at')) == \
+            ["Carol", "Albert", "Alicia", "alice", "Bob"]
+
+    def test_created_after(self, people):
+        """Test filtering on creation time"""
+        users = people.get('/api/users').get_json()
+
+        response = people.get('/api/users', query_string={
+            'created_after': users[2]['created_at']})
+
+        assert _names(response) == ["Albert", "Carol"]
+
+    def test_created_after_accepts_iso_timestamps(self, client):
+        """Test that created_at values round-trip as created_after"""
+        created = _create(client, "A", "a@x.com").get_json()['created_at']
+
+        assert datetime.fromisoformat(created)
+        assert client.get('/api/users', query_string={
+            'created_after': created}).get_json() == []
+
+    def test_filters_combine_and_paginate(self, people):
+        """Test combined filters and keyset pages over a search"""
+        response = people.get('/api/users?name_prefix=A&limit=1')
+
+        assert _names(response) == ["Alicia"]
+        assert 'name_prefix=A' in response.headers['Link']
+        next_page = people.get('/api/users?name_prefix=A&limit=1&after_id='
+                               + response.headers['X-Next-After-Id'])
+        assert _names(next_page) == ["Albert"]
+
+    @pytest.mark.parametrize('query', ['sort=age', 'created_after=yesterday',
+                                       'sort=name&after_id=2'])
+    def test_invalid_search(self, people, query):
+        """Test that bad search parameters are rejected"""
+        assert people.get(f'/api/users?{query}').status_code == 400
+
+
+class TestUniqueEmail:
+    """Test that email addresses identify one user"""
+
+    def test_duplicate_create_rejected(self, client):
+        """Test creating a second user with a taken email"""
+        assert _create(client, "John", "john@example.com").status_code == 201
+
+        response = _create(client, "Johnny", "john@example.com")
+
+        assert response.status_code == 409
+        assert len(client.get('/api/users').get_json()) == 1
+
+    def test_update_to_taken_email_rejected(self, client):
+        """Test that updates cannot steal another user's email"""
+        _create(client, "John", "john@example.com")
+        _create(client, "Jane", "jane@example.com")
+
+        assert client.put('/api/users/2', json={
+            "email": "john@example.com"}).status_code == 409
+        assert client.put('/api/users/2', json={
+            "email": "jane@example.com"}).status_code == 200
+
+    def test_email_freed_by_update_and_delete(self, client):
+        """Test that old addresses can be reused"""
+        _create(client, "John", "john@example.com")
+        _create(client, "Jane", "jane@example.com")
+        client.put('/api/users/1', json={"email": "j@example.com"})
+        client.delete('/api/users/2')
+
+        assert _create(client, "A", "john@example.com").status_code == 201
+        assert _create(client, "B", "jane@example.com").status_code == 201
+
+    def test_batch_rows_rejected_individually(self, client):
+        """Test that duplicate rows fail without failing the batch"""
+        response = client.post('/api/users/batch', json=[
+            {"name": "A", "email": "a@x.com"},
+            {"name": "B", "email": "a@x.com"},
+            {"name": "C", "email": "c@x.com"}])
+
+        assert [row['status'] for row in response.get_json()] == \
+            [201, 409, 201]
+        statuses = client.patch('/api/users/batch', json=[
+            {"id": 1, "email": "c@x.com"}]).get_json()
+        assert statuses[0]['status'] == 409
+
+
+class TestUserStoreIndexes:
+    """Test that UserStore's indexes stay in step with its users"""
+
+    def test_indexes_match_a_full_scan(self):
+        """Test indexed search against the scanning default after churn"""
+        rng = random.Random(7)
+        store = UserStore()
+        for i in range(300):
+            op = rng.random()
+            user_id = rng.randint(1, max(1, store.next_id - 1))
+            name = rng.choice(["Ann", "Andy", "Bea", "Bo", "Cy"]) + str(i)
+            try:
+                if op < 0.6:
+                    store.create_user(name, f"{i % 250}@x.com")
+                elif op < 0.85:
+                    store.update_user(user_id, name=name,
+                                      email=f"{i % 250}@x.com")
+                else:
+                    store.delete_user(user_id)
+            except DuplicateEmail:
+                pass
+
+        middle = store.get_all_users()[len(store.users) // 2].created_ts
+        for query in ({}, {'name_prefix': 'A'}, {'name_prefix': 'Bo'},
+                      {'created_after': middle}, {'email': '7@x.com'},
+                      {'name_prefix': 'A', 'created_after': middle},
+                      {'after_id': 50}):
+            for sort in ('id', 'name', '-name', 'created_at', '-id'):
+                for limit in (None, 5):
+                    args = dict(query, sort=sort, limit=limit)
+                    assert store.search_users(**args) == \
+                        BaseUserStore.search_users(store, **args), args
+
+    def test_restore_replaces_index_entries(self):
+        """Test that recovery keeps the indexes consistent"""
+        store = UserStore()
+        store.restore_user(User(3, "Old", "old@x.com", 1.0))
+        store.restore_user(User(3, "New", "new@x.com", 1.0))
+
+        assert store.get_user_by_email("old@x.com") is None
+        assert store.get_user_by_email("new@x.com").id == 3
+        assert store.search_users(name_prefix="Old") == []
+
+    def test_prefix_end(self):
+        """Test the upper bound used for prefix ranges"""
+        assert prefix_end("ab") == "ac"
+        assert prefix_end("a\U0010ffff") == "b"
+        assert prefix_end("\U0010ffff") is None
+        assert prefix_end("퟿") == ""
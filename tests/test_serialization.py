@@ -0,0 +1,128 @@
+"""Tests for the encoded JSON cache and JSON providers"""
+import json
+
+import pytest
+
+from app import create_app
+from app.config import TestingConfig
+from app.json_provider import (OrjsonProvider, StdlibJSONProvider, orjson,
+                               select_provider)
+from app.models import User, UserStore
+from app.serialization import UserJSONCache
+
+
+def _cache(store=None, **kwargs):
+    encode = StdlibJSONProvider(create_app(TestingConfig)).dumps_bytes
+    cache = UserJSONCache(encode, **kwargs)
+    if store is not None:
+        store.add_listener(cache.invalidate)
+    return cache
+
+
+class TestUserJSONCache:
+    """Test caching and invalidating encoded users"""
+
+    def test_reuses_bytes_until_update(self):
+        """Test that bytes are reused and re-encoded after an update"""
+        store = UserStore()
+        cache = _cache(store)
+        user = store.create_user("John", "john@example.com")
+
+        first = cache.user_bytes(user)
+        assert cache.user_bytes(user) is first
+        assert json.loads(first) == user.to_dict()
+
+        updated = store.update_user(user.id, name="Jane")
+
+        assert json.loads(cache.user_bytes(updated))['name'] == "Jane"
+
+    def test_stale_entry_never_served(self):
+        """Test that a missed invalidation cannot serve old bytes"""
+        cache = _cache()
+        cache.user_bytes(User(1, "Old", "old@example.com", 1.0))
+
+        recreated = User(1, "New", "new@example.com", 2.0)
+
+        assert json.loads(cache.user_bytes(recreated))['name'] == "New"
+
+    def test_delete_and_clear_invalidate(self):
+        """Test that deletes and clears drop entries"""
+        store = UserStore()
+        cache = _cache(store)
+        users = store.create_users([("A", "a@x.com"), ("B", "b@x.com")])
+        cache.list_bytes(users)
+        assert len(cache) == 2
+
+        store.delete_user(users[0].id)
+        assert len(cache) == 1
+        store.clear_all()
+        assert len(cache) == 0
+
+    def test_list_and_stream_encodings(self):
+        """Test arrays and NDJSON assembled from cached fragments"""
+        users = [User(i, f"User {i}", f"u{i}@x.com", float(i))
+                 for i in range(1, 4)]
+        cache = _cache()
+        expected = [user.to_dict() for user in users]
+
+        assert json.loads(cache.list_bytes(users)) == expected
+        assert json.loads(b''.join(cache.iter_array(users))) == expected
+        assert b''.join(cache.iter_array([])) == b'[]'
+        assert cache.list_bytes([]) == b'[]'
+        assert [json.loads(line) for line in cache.iter_lines(users)] == \
+            expected
+
+    def test_size_limit_and_disabled(self):
+        """Test that the cache stays bounded and can be switched off"""
+        users = [User(i, "U", "u@x.com", 0.0) for i in range(10)]
+        bounded = _cache(max_entries=4)
+        disabled = _cache(enabled=False)
+
+        bounded.list_bytes(users)
+        disabled.list_bytes(users)
+
+        assert len(bounded) == 4
+        assert len(disabled) == 0
+
+
+class TestJSONProviders:
+    """Test choosing the app's JSON provider"""
+
+    def test_select_provider(self):
+        """Test the JSON_PROVIDER names"""
+        assert select_provider('stdlib') is StdlibJSONProvider
+        expected = StdlibJSONProvider if orjson is None else OrjsonProvider
+        assert select_provider('auto') is expected
+        with pytest.raises(ValueError):
+            select_provider('nope')
+
+    @pytest.mark.skipif(orjson is None, reason="orjson is not installed")
+    def test_orjson_matches_stdlib(self):
+        """Test that both providers produce the same documents"""
+        app = create_app(TestingConfig)
+        obj = {"b": [1, 2.5, None], "a": "Zoë"}
+
+        for sort_keys in (True, False):
+            stdlib = StdlibJSONProvider(app)
+            fast = OrjsonProvider(app)
+            stdlib.sort_keys = fast.sort_keys = sort_keys
+            assert fast.dumps_bytes(obj).decode() == \
+                stdlib.dumps(obj, ensure_ascii=False, separators=(',', ':'))
+            assert fast.loads(fast.dumps(obj)) == obj
+
+    @pytest.mark.parametrize('provider', ['stdlib', 'auto'])
+    def test_responses_with_each_provider(self, provider):
+        """Test that the API answers the same with either provider"""
+        class ProviderConfig(TestingConfig):
+            JSON_PROVIDER = provider
+
+        client = create_app(ProviderConfig).test_client()
+        created = client.post('/api/users', json={
+            "name": "Zoë", "email": "zoe@example.com"}).get_json()
+        client.put('/api/users/1', json={"name": "Zoe"})
+
+        assert client.get('/api/users/1').get_json()['name'] == "Zoe"
+        assert client.get('/api/users').get_json() == [
+            dict(created, name="Zoe")]
+        assert list(client.get('/api/users/1').get_json()) == \
+            ["id", "name", "email", "created_at"]
@@ -0,0 +1,200 @@
+"""Tests for the store shared between processes and the prefork server"""
+import http.client
+import json
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+from multiprocessing import AuthenticationError
+
+import pytest
+
+from app import create_app
+from app.changefeed import ChangeFeed, CursorExpired
+from app.config import TestingConfig
+from app.models import DuplicateEmail, UserStore, VersionConflict
+from app.shared_store import RemoteUserStore, StoreServer
+
+AUTHKEY = b'test-key'
+
+
+@pytest.fixture
+def socket_path():
+    """Path for a Unix socket, short enough for the OS limit"""
+    directory = tempfile.mkdtemp(prefix='store-')
+    yield os.path.join(directory, 'store.sock')
+    shutil.rmtree(directory, ignore_errors=True)
+
+
+@pytest.fixture
+def owner(socket_path):
+    """StoreServer for an in-memory store and its change feed"""
+    store = UserStore()
+    feed = ChangeFeed()
+    store.add_listener(feed.record)
+    server = StoreServer(socket_path, AUTHKEY)
+    server.start(store, feed)
+    yield server
+    server.close()
+
+
+@pytest.fixture
+def remote(owner):
+    """RemoteUserStore connected to the owner"""
+    store = RemoteUserStore(owner.path, AUTHKEY)
+    yield store
+    store.close()
+
+
+class TestRemoteUserStore:
+    """Test calls forwarded to the owner's store"""
+
+    def test_crud_and_errors(self, owner, remote):
+        """Test that results and store errors come back unchanged"""
+        user = remote.create_user("John", "john@example.com")
+        assert owner.store.get_user(user.id).name == "John"
+        assert remote.get_user_by_email("john@example.com").id == user.id
+        with pytest.raises(DuplicateEmail):
+            remote.create_user("Jane", "john@example.com")
+        updated = remote.update_user(user.id, name="Johnny")
+        assert updated.version == 2
+        with pytest.raises(VersionConflict):
+            remote.delete_user(user.id, expected_version=1)
+        assert [u.name for u in remote.search_users(name_prefix="Jo")] == \
+            ["Johnny"]
+        assert remote.count_users() == 1
+        assert (remote.version, remote.epoch) == \
+            (owner.store.version, owner.store.epoch)
+        assert remote.delete_user(user.id)
+        assert remote.get_user(user.id) is None
+
+    def test_transaction(self, owner, remote):
+        """Test that a transaction commits or rolls back as a whole"""
+        assert remote.supports_transactions
+        with remote.transaction():
+            remote.create_user("A", "a@x.com")
+            remote.create_user("B", "b@x.com")
+        with pytest.raises(DuplicateEmail):
+            with remote.transaction():
+                remote.create_user("C", "c@x.com")
+                remote.create_user("A2", "a@x.com")
+        assert [u.name for u in owner.store.get_all_users()] == ["A", "B"]
+        assert [c['op'] for c in remote.change_feed.read(0)] == \
+            ['create', 'create']
+
+    def test_pipeline(self, remote):
+        """Test that pipelined calls return their results in order"""
+        users = remote.pipeline([('create_user', (f"U{i}", f"u{i}@x.com"))
+                                 for i in range(100)])
+        assert [user.id for user in users] == list(range(1, 101))
+        assert remote.pipeline([('get_user', (5,)),
+                                ('count_users', ())])[1] == 100
+        with pytest.raises(DuplicateEmail):
+            remote.pipeline([('create_user', ("X", "u1@x.com")),
+                             ('create_user', ("Y", "y@x.com"))])
+        assert remote.get_user_by_email("y@x.com") is not None
+
+    def test_concurrent_clients_get_distinct_ids(self, owner):
+        """Test that creates from many clients never share an ID"""
+        clients = [RemoteUserStore(owner.path, AUTHKEY) for _ in range(4)]
+        ids = []
+
+        def create(client, worker):
+            for i in range(50):
+                ids.append(client.create_user(
+                    "User", f"w{worker}-{i}@x.com").id)
+
+        threads = [threading.Thread(target=create, args=(client, n))
+                   for n, client in enumerate(clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert sorted(ids) == list(range(1, 201))
+        for client in clients:
+            client.close()
+
+    def test_change_feed(self, remote):
+        """Test reading and long-polling the owner's feed"""
+        threading.Timer(0.05, remote.create_user,
+                        ("John", "john@example.com")).start()
+        changes = remote.change_feed.read(0, timeout=5)
+        assert [c['seq'] for c in changes] == [1]
+        assert remote.change_feed.position() == \
+            (remote.change_feed.epoch, 1)
+        with pytest.raises(CursorExpired):
+            remote.change_feed.read(5)
+
+    def test_rejects_wrong_key(self, owner):
+        """Test that a client needs the owner's key"""
+        with pytest.raises(AuthenticationError):
+            RemoteUserStore(owner.path, b'wrong')
+
+
+class TestSharedApps:
+    """Test apps in different processes sharing one owner"""
+
+    def test_apps_see_the_same_users(self, owner):
+        """Test IDs, ETags and the change feed across two apps"""
+        class WorkerConfig(TestingConfig):
+            SHARED_STORE_SOCKET = owner.path
+            SHARED_STORE_AUTHKEY = AUTHKEY
+
+        first = create_app(WorkerConfig).test_client()
+        second = create_app(WorkerConfig).test_client()
+        created = first.post('/api/users', json={"name": "John",
+                                                 "email": "john@x.com"})
+        assert created.status_code == 201
+        response = second.get(f'/api/users/{created.json["id"]}')
+        assert response.json == created.json
+        assert response.headers['ETag'] == created.headers['ETag']
+        assert second.post('/api/users', json={
+            "name": "Jane", "email": "john@x.com"}).status_code == 409
+
+        changes = second.get('/api/users/changes?since=0').json
+        assert [c['op'] for c in changes['changes']] == ['create']
+        assert second.get('/api/users/count').json == {"total_users": 1}
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class TestPreforkServer:
+    """Test serve.py end to end"""
+
+    def test_workers_share_users(self):
+        """Test that requests spread over workers see one store"""
+        port = _free_port()
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        server = subprocess.Popen(
+            [sys.executable, 'serve.py', '--host', '127.0.0.1',
+             '--port', str(port), '--workers', '3'],
+            cwd=root, stdout=subprocess.PIPE, text=True)
+        try:
+            assert 'with 3 workers' in server.stdout.readline()
+            ids = []
+            for i in range(12):
+                # A new connection each time, so several workers answer
+                conn = http.client.HTTPConnection('127.0.0.1', port)
+                conn.request('POST', '/api/users',
+                             json.dumps({"name": f"U{i}",
+                                         "email": f"u{i}@x.com"}),
+                             {'Content-Type': 'application/json'})
+                ids.append(json.loads(conn.getresponse().read())['id'])
+                conn.close()
+            assert ids == list(range(1, 13))
+            conn = http.client.HTTPConnection('127.0.0.1', port)
+            conn.request('GET', '/api/users/count')
+            assert json.loads(conn.getresponse().read()) == \
+                {"total_users": 12}
+            conn.close()
+        finally:
+            server.send_signal(signal.SIGTERM)
+            assert server.wait(10) == 0
@@ -0,0 +1,158 @@
+"""Tests for memory-mapped snapshots and checkpointing"""
+import os
+
+import pytest
+
+from app import create_app
+from app.config import TestingConfig
+from app.models import User, UserStore
+from app.snapshot import (MappedUserStore, Snapshot, checkpoint,
+                          load_snapshot, write_snapshot)
+
+
+def _users(count, start=1):
+    return [User(i, f"User {i}", f"user{i}@example.com", float(i))
+            for i in range(start, start + count)]
+
+
+def _make_config(tmp_path, backend='mapped'):
+    class SnapshotConfig(TestingConfig):
+        USER_STORE_BACKEND = backend
+        WAL_PATH = str(tmp_path / 'users.wal')
+        SNAPSHOT_PATH = str(tmp_path / 'users.snap')
+        SNAPSHOT_INTERVAL_S = 3600
+    return SnapshotConfig
+
+
+def _shutdown(app):
+    store = app.extensions['user_store']
+    store.checkpointer.stop()
+    store.wal.close()
+
+
+class TestSnapshotFile:
+    """Test writing and mapping snapshot files"""
+
+    def test_round_trip(self, tmp_path):
+        """Test that every field survives a write and map"""
+        path = str(tmp_path / 'users.snap')
+        users = _users(5) + [User(9, "Zoë", "zoe@example.com", 9.5)]
+
+        assert write_snapshot(users, 12, path) == 6
+        snapshot = Snapshot(path)
+
+        assert snapshot.next_id == 12
+        assert [u.to_dict() for u in snapshot] == \
+            [u.to_dict() for u in users]
+        assert snapshot.user_at(snapshot.find(9)).name == "Zoë"
+        assert snapshot.find(7) == -1
+        snapshot.close()
+
+    def test_empty_snapshot(self, tmp_path):
+        """Test that an empty store produces a mappable snapshot"""
+        path = str(tmp_path / 'users.snap')
+        write_snapshot([], 1, path)
+
+        store = MappedUserStore.open(path)
+
+        assert store.get_all_users() == []
+        assert store.create_user("A", "a@x.com").id == 1
+
+    def test_rejects_other_files(self, tmp_path):
+        """Test that a file without the snapshot magic is refused"""
+        path = tmp_path / 'users.snap'
+        path.write_bytes(b'\0' * 64)
+
+        with pytest.raises(ValueError):
+            Snapshot(str(path))
+
+    def test_cold_load(self, tmp_path):
+        """Test rebuilding a regular store from a snapshot"""
+        path = str(tmp_path / 'users.snap')
+        write_snapshot(_users(3), 4, path)
+        store = UserStore()
+
+        assert load_snapshot(store, path) == 3
+        assert store.get_user(2).email == "user2@example.com"
+        assert store.create_user("New", "new@x.com").id == 4
+
+
+class TestMappedUserStore:
+    """Test the snapshot-plus-overlay store"""
+
+    def test_overlay_mutations(self, tmp_path):
+        """Test updates, deletes and creates on top of a snapshot"""
+        path = str(tmp_path / 'users.snap')
+        write_snapshot(_users(6), 7, path)
+        store = MappedUserStore.open(path)
+
+        store.update_user(2, name="Renamed")
+        store.delete_user(3)
+        created = store.create_user("New", "new@example.com")
+
+        assert created.id == 7
+        assert store.get_user(2).name == "Renamed"
+        assert store.get_user(2).created_ts == 2.0
+        assert store.get_user(3) is None
+        assert not store.delete_user(3)
+        assert [u.id for u in store.get_all_users()] == [1, 2, 4, 5, 6, 7]
+        assert [u.id for u in store.get_users_page(1, 3)] == [2, 4, 5]
+        assert [u.id for u in store.iter_users(chunk_size=2)] == \
+            [1, 2, 4, 5, 6, 7]
+
+
+class TestCheckpointing:
+    """Test folding the WAL into snapshots across restarts"""
+
+    @pytest.mark.parametrize('backend', ['mapped', 'memory'])
+    def test_restart_from_snapshot_and_log(self, tmp_path, backend):
+        """Test that a checkpoint plus later log records restore state"""
+        config = _make_config(tmp_path, backend)
+        app = create_app(config)
+        client = app.test_client()
+        for i in range(4):
+            client.post('/api/users', json={"name": f"User {i}",
+                                            "email": f"user{i}@example.com"})
+        assert checkpoint(app.extensions['user_store'],
+                          config.SNAPSHOT_PATH) == 4
+        client.put('/api/users/1', json={"name": "After snapshot"})
+        client.delete('/api/users/4')
+        client.post('/api/users', json={"name": "Late", "email": "l@x.com"})
+        before = client.get('/api/users').get_json()
+        _shutdown(app)
+
+        app = create_app(config)
+        client = app.test_client()
+
+        assert client.get('/api/users').get_json() == before
+        assert not os.path.exists(config.WAL_PATH + '.prev')
+        assert client.post('/api/users', json={
+            "name": "Next", "email": "n@x.com"}).get_json()['id'] == 6
+        _shutdown(app)
+
+    def test_interrupted_checkpoint_keeps_records(self, tmp_path):
+        """Test that a rotated log is replayed if no snapshot followed"""
+        config = _make_config(tmp_path, 'memory')
+        app = create_app(config)
+        client = app.test_client()
+        client.post('/api/users', json={"name": "A", "email": "a@x.com"})
+        app.extensions['user_store'].wal.rotate()
+        client.post('/api/users', json={"name": "B", "email": "b@x.com"})
+        app.extensions['user_store'].wal.rotate()
+        client.post('/api/users', json={"name": "C", "email": "c@x.com"})
+        _shutdown(app)
+
+        app = create_app(config)
+
+        names = [u['name'] for u in
+                 app.test_client().get('/api/users').get_json()]
+        assert names == ["A", "B", "C"]
+        _shutdown(app)
+
+    def test_mapped_backend_requires_path(self):
+        """Test that the mapped backend needs a snapshot location"""
+        class BadConfig(TestingConfig):
+            USER_STORE_BACKEND = 'mapped'
+
+        with pytest.raises(ValueError):
+            create_app(BadConfig)
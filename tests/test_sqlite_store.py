@@ -0,0 +1,150 @@
+"""Tests for the SQLite storage backend"""
+import sqlite3
+import threading
+
+import pytest
+
+from app.models import OP_CREATE, User
+from app.sqlite_store import SQLiteUserStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    """SQLite store on a fresh database file"""
+    store = SQLiteUserStore(str(tmp_path / 'users.db'))
+    yield store
+    store.close()
+
+
+class TestSQLiteUserStore:
+    """Test SQLiteUserStore behaviour beyond the shared API suite"""
+
+    def test_data_persists_across_instances(self, store):
+        """Test that a second store on the same file sees the users"""
+        store.create_user("John", "john@example.com")
+
+        reopened = SQLiteUserStore(store.path)
+
+        assert reopened.get_user(1).name == "John"
+        assert reopened.next_id == 2
+        reopened.close()
+
+    def test_email_lookup(self, store):
+        """Test the indexed email lookup"""
+        store.create_user("John", "john@example.com")
+        jane = store.create_user("Jane", "jane@example.com")
+
+        assert store.get_user_by_email("jane@example.com").id == jane.id
+        assert store.get_user_by_email("nobody@example.com") is None
+
+    def test_deleted_ids_not_reused(self, store):
+        """Test that AUTOINCREMENT keeps IDs unique after deletes"""
+        store.create_user("A", "a@x.com")
+        store.delete_user(store.create_user("B", "b@x.com").id)
+
+        assert store.create_user("C", "c@x.com").id == 3
+
+    def test_restore_and_next_id(self, store):
+        """Test recovery hooks used by WAL replay and snapshots"""
+        store.restore_user(User(7, "Restored", "r@x.com", 1.0))
+        store.next_id = 10
+
+        assert store.get_user(7).created_ts == 1.0
+        assert store.create_user("New", "n@x.com").id == 10
+
+    def test_transaction_batches_and_rolls_back(self, store):
+        """Test that a failed transaction leaves no rows or notifications"""
+        events = []
+        store.add_listener(lambda op, user: events.append(op))
+
+        with store.transaction():
+            store.create_user("A", "a@x.com")
+            store.create_user("B", "b@x.com")
+        with pytest.raises(RuntimeError):
+            with store.transaction():
+                store.create_user("C", "c@x.com")
+                raise RuntimeError("abort")
+
+        assert [u.name for u in store.get_all_users()] == ["A", "B"]
+        assert events == [OP_CREATE, OP_CREATE]
+
+    def test_listeners_told_after_commit(self, store):
+        """Test that listeners see committed writes, and never hear of a
+        transaction whose COMMIT fails"""
+        seen = []
+
+        def listener(op, user):
+            other = sqlite3.connect(store.path)
+            seen.append(other.execute('SELECT COUNT(*) FROM users WHERE '
+                                      'id = ?', (user.id,)).fetchone()[0])
+            other.close()
+        store.add_listener(listener)
+        store.create_user("John", "john@example.com")
+        assert seen == [1]
+
+        # A deferred foreign key is only checked at COMMIT, which fails
+        conn = store._conn()
+        conn.execute('PRAGMA foreign_keys = ON')
+        conn.execute('CREATE TEMP TABLE parent (id INTEGER PRIMARY KEY)')
+        conn.execute('CREATE TEMP TABLE child (parent_id INTEGER '
+                     'REFERENCES parent (id) DEFERRABLE INITIALLY DEFERRED)')
+        with pytest.raises(sqlite3.IntegrityError):
+            with store.transaction():
+                store.create_user("Jane", "jane@example.com")
+                conn.execute('INSERT INTO child VALUES (1)')
+        assert seen == [1]
+        assert store.get_user_by_email("jane@example.com") is None
+
+    def test_connection_per_thread(self, store):
+        """Test that concurrent writers each get a connection"""
+        connections = set()
+
+        def writer(slot):
+            for i in range(25):
+                store.create_user(f"User {slot}-{i}", f"u{slot}-{i}@x.com")
+            connections.add(store._conn())
+
+        threads = [threading.Thread(target=writer, args=(slot,))
+                   for slot in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        ids = [u.id for u in store.get_all_users()]
+        assert ids == list(range(1, 101))
+        assert len(connections) == 4
+
+    def test_connections_closed_with_their_thread(self, store):
+        """Test that short-lived threads do not leave connections behind"""
+        for slot in range(100):
+            thread = threading.Thread(target=store.get_user, args=(slot,))
+            thread.start()
+            thread.join()
+
+        assert len(store._connections) <= 1
+        assert store.get_user(1) is None
+
+    def test_snapshot_reads_one_state(self, store):
+        """Test that a snapshot does not see later writes"""
+        store.create_users([(f"User {i}", f"u{i}@example.com")
+                            for i in range(5)])
+        snapshot = store.snapshot()
+        users = snapshot.iter_users(chunk_size=2)
+        assert next(users).id == 1
+
+        store.update_user(2, name="Changed")
+        store.delete_user(3)
+        store.create_user("Late", "late@example.com")
+
+        assert [u.name for u in users] == \
+            ["User 1", "User 2", "User 3", "User 4"]
+        assert snapshot.count_users() == 5
+        assert snapshot.get_user(6) is None
+        assert snapshot.version < store.version
+        assert store.get_user(2).name == "Changed"
+
+    def test_in_memory_database_rejected(self):
+        """Test that per-connection in-memory databases are refused"""
+        with pytest.raises(ValueError):
+            SQLiteUserStore(':memory:')
@@ -0,0 +1,130 @@
+"""Tests for the incrementally maintained user stats"""
+import random
+from datetime import datetime, timezone
+
+import pytest
+
+from app.models import User, UserStore
+from app.stats import StatsMismatch, UserStats, email_domain
+
+# 2024-01-02T03:04:00Z
+MINUTE = 1704164640
+
+
+def _series(stats, name):
+    return {datetime.fromisoformat(bucket['start']).timestamp():
+            bucket['count'] for bucket in stats['created'][name]}
+
+
+class TestStatsEndpoint:
+    """Test GET /api/users/stats"""
+
+    def test_counts_and_domains(self, client):
+        """Test the total and the domain histogram, most common first"""
+        for name, email in [("A", "a@example.com"), ("B", "b@Other.org"),
+                            ("C", "c@example.com")]:
+            client.post('/api/users', json={"name": name, "email": email})
+
+        stats = client.get('/api/users/stats').get_json()
+
+        assert stats['total_users'] == 3
+        assert list(stats['domains'].items()) == [("example.com", 2),
+                                                  ("other.org", 1)]
+        assert len(stats['created']['minute']) == 60
+        assert len(stats['created']['hour']) == 48
+        assert len(stats['created']['day']) == 30
+        assert sum(b['count'] for b in stats['created']['minute']) == 3
+        assert sum(b['count'] for b in stats['created']['day']) == 3
+
+    def test_follows_writes(self, client):
+        """Test that updates move users between domains and deletes and
+        clears take them out"""
+        client.post('/api/users', json={"name": "A", "email": "a@x.com"})
+        client.post('/api/users', json={"name": "B", "email": "b@x.com"})
+        client.put('/api/users/1', json={"email": "a@y.com"})
+        client.delete('/api/users/2')
+
+        stats = client.get('/api/users/stats').get_json()
+        assert stats['total_users'] == 1
+        assert stats['domains'] == {"y.com": 1}
+        assert sum(b['count'] for b in stats['created']['hour']) == 1
+
+    def test_top_domains(self, app, client):
+        """Test that STATS_TOP_DOMAINS caps the histogram"""
+        app.config['STATS_TOP_DOMAINS'] = 1
+        client.post('/api/users/batch', json=[
+            {"name": "A", "email": "a@x.com"},
+            {"name": "B", "email": "b@y.com"},
+            {"name": "C", "email": "c@y.com"}])
+
+        assert client.get('/api/users/stats').get_json()['domains'] == \
+            {"y.com": 2}
+
+
+class TestUserStats:
+    """Test the aggregates kept by the in-memory store"""
+
+    def test_buckets(self):
+        """Test that users land in UTC-aligned minute, hour and day
+        buckets"""
+        stats = UserStats.of([User(1, "A", "a@x.com", MINUTE + 1),
+                              User(2, "B", "b@x.com", MINUTE + 59),
+                              User(3, "C", "c@x.com", MINUTE + 60)])
+        summary = stats.summary(MINUTE + 61)
+
+        minutes = _series(summary, 'minute')
+        assert minutes[MINUTE] == 2
+        assert minutes[MINUTE + 60] == 1
+        assert max(minutes) == MINUTE + 60
+        assert _series(summary, 'hour')[MINUTE - 4 * 60] == 3
+        day = datetime(2024, 1, 2, tzinfo=timezone.utc).timestamp()
+        assert _series(summary, 'day')[day] == 3
+
+    def test_email_domain(self):
+        """Test domain extraction"""
+        assert email_domain("a@B.com") == "b.com"
+        assert email_domain("a@b@c.org") == "c.org"
+        assert email_domain("nobody") == ""
+
+    def test_random_writes_stay_consistent(self):
+        """Test the maintained aggregates against recounts"""
+        rnd = random.Random(7)
+        store = UserStore()
+        for _ in range(500):
+            roll = rnd.random()
+            email = f"u{rnd.randrange(10**6)}@d{rnd.randrange(5)}.com"
+            if roll < 0.5:
+                store.restore_user(User(rnd.randrange(1, 200), "N", email,
+                                        MINUTE + rnd.randrange(10**6)))
+            elif roll < 0.8:
+                store.update_user(rnd.randrange(1, 200), email=email)
+            elif roll < 0.99:
+                store.delete_user(rnd.randrange(1, 200))
+            else:
+                store.clear_all()
+            store.check_stats()
+
+    def test_rollback_restores_stats(self):
+        """Test that undone writes are uncounted too"""
+        store = UserStore()
+        store.create_user("A", "a@x.com")
+        before = store.stats()['domains']
+
+        with pytest.raises(RuntimeError):
+            with store.transaction():
+                store.create_user("B", "b@y.com")
+                store.update_user(1, email="a@z.com")
+                raise RuntimeError
+
+        assert store.stats()['domains'] == before
+        assert store.count_users() == 1
+        store.check_stats()
+
+    def test_check_detects_drift(self):
+        """Test that check_stats notices aggregates gone wrong"""
+        store = UserStore()
+        store.create_user("A", "a@x.com")
+        store._stats.domains['x.com'] += 1  # pylint: disable=protected-access
+
+        with pytest.raises(StatsMismatch, match='domains'):
+            store.check_stats()
@@ -0,0 +1,177 @@
+"""Tests for the tiered store: users in RAM up to a budget, the rest on disk"""
+import os
+
+import pytest
+
+from app import create_app
+from app.config import TestingConfig
+from app.models import DuplicateEmail
+from app.tiered_store import TieredUserStore, _footprint
+
+# Room for about ten users
+BUDGET = 4096
+
+
+@pytest.fixture
+def store(tmp_path):
+    """TieredUserStore with a small budget"""
+    store = TieredUserStore(BUDGET, str(tmp_path / 'users.spill'))
+    yield store
+    store.close()
+
+
+def _fill(store, count):
+    return store.create_users([(f"User {i}", f"user{i}@example.com")
+                               for i in range(count)])
+
+
+class TestTieredUserStore:
+    """Test TieredUserStore operations"""
+
+    def test_cold_users_fault_back_in(self, store):
+        """Test that users spilled to disk read back unchanged"""
+        created = _fill(store, 200)
+        stats = store.cache_stats()
+        assert stats['resident_bytes'] <= BUDGET
+        assert stats['evictions'] == stats['spills'] >= 180
+        assert os.path.getsize(store.path) == stats['spill_file_bytes'] > 0
+
+        for user in created:
+            assert store.get_user(user.id).to_dict() == user.to_dict()
+        assert store.get_user_by_email("user7@example.com").id == 8
+        assert store.cache_stats()['misses'] >= 180
+        assert store.count_users() == 200
+        assert [u.id for u in store.get_all_users()] == list(range(1, 201))
+
+    def test_writes_to_cold_users(self, store):
+        """Test updating and deleting users that are only on disk"""
+        _fill(store, 100)
+        updated = store.update_user(1, name="Renamed",
+                                    email="renamed@example.com")
+        assert updated.version == 2
+        store.get_users_page(0, 100)
+        assert store.get_user_by_email("user0@example.com") is None
+        assert store.get_user_by_email("renamed@example.com").name == \
+            "Renamed"
+        with pytest.raises(DuplicateEmail):
+            store.create_user("Copy", "renamed@example.com")
+
+        assert store.delete_user(2)
+        assert not store.delete_user(2)
+        assert store.get_user(2) is None
+        assert store.count_users() == 99
+        store.check_stats()
+
+    def test_scan_keeps_hot_users(self, store):
+        """Test that neither a listing nor one-off reads evict the hot set"""
+        _fill(store, 500)
+        hot = [1, 2, 3, 4]
+        for _ in range(2):
+            for user_id in hot:
+                store.get_user(user_id)
+
+        store.get_all_users()
+        for user_id in range(100, 400):
+            store.get_user(user_id)
+        before = store.cache_stats()
+        for user_id in hot:
+            store.get_user(user_id)
+        after = store.cache_stats()
+        assert after['hits'] - before['hits'] == len(hot)
+        assert after['misses'] == before['misses']
+
+    def test_budget_counts_footprints(self, store):
+        """Test that resident bytes are the sum of the cached users"""
+        users = _fill(store, 3)
+        assert store.cache_stats()['resident_bytes'] == \
+            sum(_footprint(user) for user in users)
+
+    def test_compaction_keeps_live_users(self, tmp_path):
+        """Test that reclaiming dead rows and records loses nothing"""
+        store = TieredUserStore(BUDGET, str(tmp_path / 'users.spill'))
+        _fill(store, 3000)
+        for user_id in range(1, 3001, 2):
+            store.delete_user(user_id)
+        # About 3 MiB of records, almost all of them superseded
+        for round_number in range(40):
+            for user_id in range(2, 3001, 2):
+                store.update_user(user_id, name=f"Round {round_number}")
+
+        assert store.count_users() == 1500
+        users = store.get_all_users()
+        assert [u.id for u in users] == list(range(2, 3001, 2))
+        assert {u.name for u in users} == {"Round 39"}
+        assert os.path.getsize(store.path) < 1.5 * 1024 * 1024
+        store.check_stats()
+        store.close()
+
+    def test_snapshot_survives_compaction_and_clear(self, store):
+        """Test that a snapshot keeps its users whatever the store does"""
+        _fill(store, 2000)
+        store.update_user(7, name="Before")
+        snapshot = store.snapshot()
+        for user_id in range(1, 2001, 2):
+            store.delete_user(user_id)
+        for round_number in range(3):
+            for user_id in range(2, 2001, 2):
+                store.update_user(user_id, name=f"Round {round_number}")
+        store.clear_all()
+        store.create_user("After", "after@example.com")
+
+        assert snapshot.count_users() == 2000
+        users = snapshot.get_all_users()
+        assert [u.id for u in users] == list(range(1, 2001))
+        assert users[6].name == "Before"
+        assert {u.name for u in users[7:]} == {
+            f"User {i}" for i in range(7, 2000)}
+        assert snapshot.get_user(2).name == "User 1"
+        assert [u.id for u in snapshot.get_users_page(1990, 3)] == \
+            [1991, 1992, 1993]
+
+    def test_transaction_rolls_back(self, store):
+        """Test that a failed transaction leaves no trace"""
+        _fill(store, 50)
+        with pytest.raises(DuplicateEmail):
+            with store.transaction():
+                store.update_user(1, name="Changed")
+                store.delete_user(2)
+                store.create_user("New", "new@example.com")
+                store.create_user("Dup", "user3@example.com")
+
+        assert store.get_user(1).name == "User 0"
+        assert store.get_user(2).name == "User 1"
+        assert store.get_user_by_email("new@example.com") is None
+        assert store.count_users() == 50
+        store.check_stats()
+
+    def test_temporary_spill_file_removed(self):
+        """Test that close deletes a spill file the store created"""
+        store = TieredUserStore(BUDGET)
+        _fill(store, 50)
+        assert os.path.exists(store.path)
+        store.close()
+        assert not os.path.exists(store.path)
+
+
+class TestTieredBackend:
+    """Test the tiered backend wired into the app"""
+
+    def test_cache_counters_exported(self, tmp_path):
+        """Test that /api/metrics carries the cache counters"""
+        class TieredConfig(TestingConfig):
+            USER_STORE_BACKEND = 'tiered'
+            TIERED_MEMORY_BUDGET = BUDGET
+            TIERED_SPILL_PATH = str(tmp_path / 'users.spill')
+
+        app = create_app(TieredConfig)
+        client = app.test_client()
+        for i in range(30):
+            client.post('/api/users', json={"name": f"U{i}",
+                                            "email": f"u{i}@x.com"})
+        client.get('/api/users/1')
+
+        body = client.get('/api/metrics').get_data(as_text=True)
+        assert 'user_store_cache_misses_total 1' in body
+        assert 'user_store_cache_evictions_total' in body
+        assert f'user_store_cache_memory_budget {BUDGET}' in body
+        app.extensions['user_store'].close()
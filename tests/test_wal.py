@@ -0,0 +1,117 @@
+"""Tests for write-ahead log persistence"""
+import os
+import threading
+
+import pytest
+
+from app import create_app
+from app.concurrent_store import ConcurrentUserStore
+from app.config import TestingConfig
+from app.models import UserStore
+from app.wal import DurableUserStore, WriteAheadLog
+
+
+def _make_config(path, policy='always', backend='memory'):
+    class WalConfig(TestingConfig):
+        WAL_PATH = str(path)
+        WAL_FSYNC = policy
+        USER_STORE_BACKEND = backend
+    return WalConfig
+
+
+def _restart(app, config):
+    """Close the app's log and boot a fresh app from it"""
+    app.extensions['user_store'].wal.close()
+    return create_app(config)
+
+
+class TestWriteAheadLog:
+    """Test logging and replaying store mutations"""
+
+    @pytest.mark.parametrize('policy', ['always', 'interval', 'os'])
+    @pytest.mark.parametrize('backend', ['memory', 'concurrent', 'columnar'])
+    def test_restart_restores_users(self, tmp_path, policy, backend):
+        """Test that users survive an app restart"""
+        config = _make_config(tmp_path / 'users.wal', policy, backend)
+        app = create_app(config)
+        client = app.test_client()
+        for i in range(3):
+            client.post('/api/users', json={"name": f"User {i}",
+                                            "email": f"user{i}@example.com"})
+        client.put('/api/users/1', json={"name": "Renamed"})
+        client.delete('/api/users/2')
+        before = client.get('/api/users').get_json()
+
+        client = _restart(app, config).test_client()
+
+        assert client.get('/api/users').get_json() == before
+        assert client.get('/api/users/1').get_json()['name'] == "Renamed"
+
+    def test_deleted_ids_not_reused(self, tmp_path):
+        """Test that deleting the newest user doesn't free its ID"""
+        config = _make_config(tmp_path / 'users.wal')
+        app = create_app(config)
+        client = app.test_client()
+        client.post('/api/users', json={"name": "A", "email": "a@x.com"})
+        client.post('/api/users', json={"name": "B", "email": "b@x.com"})
+        client.delete('/api/users/2')
+
+        client = _restart(app, config).test_client()
+        response = client.post('/api/users',
+                               json={"name": "C", "email": "c@x.com"})
+
+        assert response.get_json()['id'] == 3
+
+    def test_torn_tail_is_truncated(self, tmp_path):
+        """Test that a half-written final record is dropped on replay"""
+        path = tmp_path / 'users.wal'
+        config = _make_config(path)
+        app = create_app(config)
+        client = app.test_client()
+        client.post('/api/users', json={"name": "A", "email": "a@x.com"})
+        client.post('/api/users', json={"name": "B", "email": "b@x.com"})
+        app.extensions['user_store'].wal.close()
+        good_size = os.path.getsize(path)
+        with open(path, 'ab') as log:
+            log.write(b'\x40\x00\x00\x00garbage')
+
+        client = create_app(config).test_client()
+
+        assert len(client.get('/api/users').get_json()) == 2
+        assert os.path.getsize(path) == good_size
+
+    def test_group_commit_batches_fsyncs(self, tmp_path, monkeypatch):
+        """Test that concurrent writers share fsyncs"""
+        fsyncs = []
+        real_fsync = os.fsync
+
+        def slow_fsync(fd):
+            fsyncs.append(fd)
+            threading.Event().wait(0.002)
+            real_fsync(fd)
+
+        monkeypatch.setattr(os, 'fsync', slow_fsync)
+        wal = WriteAheadLog(str(tmp_path / 'users.wal'), 'always')
+        wal.open()
+        store = DurableUserStore(ConcurrentUserStore(), wal)
+
+        def writer():
+            for i in range(20):
+                store.create_user(f"User {i}", f"user{i}@example.com")
+
+        threads = [threading.Thread(target=writer) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        wal.close()
+
+        assert len(fsyncs) < 160
+        replayed = UserStore()
+        assert WriteAheadLog(wal.path).replay(replayed) == 160
+        assert len(replayed.get_all_users()) == 160
+
+    def test_invalid_fsync_policy(self, tmp_path):
+        """Test that an unknown fsync policy is rejected"""
+        with pytest.raises(ValueError):
+            WriteAheadLog(str(tmp_path / 'users.wal'), 'sometimes')